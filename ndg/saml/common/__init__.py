@@ -28,7 +28,300 @@ __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __license__ = "http://www.apache.org/licenses/LICENSE-2.0"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = "$Id$"
+import hashlib
+from datetime import datetime
+
 from ndg.saml.common.xml import SAMLConstants, QName
+from ndg.saml.utils import (reduceSlots, getSlotNames, TypedList, 
+                            FrozenTypedList)
+
+
+# Caches for the class used to represent each SAML class in digests and 
+# equality tests, the slots used in each and the frozen variant of each class 
+_canonicalClasses = {}
+_digestSlots = {}
+_frozenClasses = {}
+
+
+def _getCanonicalClass(cls):
+    """Get the SAML class to use for digest and equality comparisons.  This
+    is the first class in the MRO which defines __slots__ skipping frozen
+    variants and classes which only change how content is stored, marked with
+    _storageVariant, so that for example an ElementTree subclass instance 
+    compares equal to its core SAML type
+    
+    :param cls: class to check
+    :type cls: type
+    :return: canonical class
+    :rtype: type
+    """
+    canonicalClass = _canonicalClasses.get(cls)
+    if canonicalClass is None:
+        for canonicalClass in cls.__mro__:
+            classDict = canonicalClass.__dict__
+            if ('__slots__' in classDict and 
+                not classDict.get('_frozen', False) and
+                not classDict.get('_storageVariant', False)):
+                break
+            
+        _canonicalClasses[cls] = canonicalClass
+        
+    return canonicalClass
+
+
+def _getDigestSlots(cls):
+    """Get the slot attribute names and their public names for use in digest
+    and equality comparisons.  Slots listed in TRANSIENT_ATTRIBUTES are 
+    excluded
+    
+    :param cls: canonical class
+    :type cls: type
+    :return: tuple of (slot name, public name) tuples
+    :rtype: tuple
+    """
+    digestSlots = _digestSlots.get(cls)
+    if digestSlots is None:
+        _digestSlots_ = []
+        for slotName in getSlotNames(cls):
+            publicName = slotName.rsplit('__', 1)[-1]
+            if publicName not in cls.TRANSIENT_ATTRIBUTES:
+                _digestSlots_.append((slotName, publicName))
+                
+        digestSlots = tuple(_digestSlots_)
+        _digestSlots[cls] = digestSlots
+        
+    return digestSlots
+
+
+def _isElement(value):
+    """Test for an ElementTree element without importing a specific 
+    ElementTree implementation
+    
+    :param value: object to test
+    :type value: object
+    :return: True if value is an ElementTree element
+    :rtype: bool
+    """
+    return hasattr(value, 'tag') and hasattr(value, 'attrib')
+
+
+def _updateDigest(hashObj, value, ignoreVolatile):
+    """Add a value to a digest.  SAML objects contribute their own digest so
+    that memoised digests of frozen objects are reused
+    
+    :param hashObj: hash object to update
+    :type hashObj: hashlib hash
+    :param value: value to add
+    :type value: object
+    :param ignoreVolatile: passed to the digest of SAML objects
+    :type ignoreVolatile: bool
+    :raise TypeError: no canonical representation for the type of value
+    """
+    if value is None:
+        hashObj.update('N;')
+        
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        hashObj.update('S%d:' % len(value))
+        hashObj.update(value)
+        
+    elif isinstance(value, SAMLObject):
+        hashObj.update('O')
+        hashObj.update(value.digest(ignoreVolatile=ignoreVolatile))
+    
+    elif isinstance(value, (list, tuple)):
+        hashObj.update('L%d[' % len(value))
+        for item in value:
+            _updateDigest(hashObj, item, ignoreVolatile)
+        hashObj.update(']')
+        
+    elif hasattr(value, 'iterAttributes'):
+        # Columnar attribute list - iterate without caching attributes
+        hashObj.update('L%d[' % len(value))
+        for item in value.iterAttributes():
+            _updateDigest(hashObj, item, ignoreVolatile)
+        hashObj.update(']')
+        
+    elif isinstance(value, dict):
+        hashObj.update('M')
+        _updateDigest(hashObj, sorted(value.items()), ignoreVolatile)
+        
+    elif isinstance(value, (bool, int, long, float)):
+        hashObj.update('I%r;' % value)
+        
+    elif isinstance(value, datetime):
+        hashObj.update('D%s;' % value.isoformat())
+        
+    elif isinstance(value, SAMLVersion):
+        hashObj.update('V')
+        _updateDigest(hashObj, str(value), ignoreVolatile)
+        
+    elif isinstance(value, QName):
+        hashObj.update('Q')
+        _updateDigest(hashObj, 
+                      (value.namespaceURI, value.localPart, value.prefix),
+                      ignoreVolatile)
+        
+    elif _isElement(value):
+        hashObj.update('E')
+        _updateDigest(hashObj, str(value.tag), ignoreVolatile)
+        _updateDigest(hashObj, sorted(value.attrib.items()), ignoreVolatile)
+        _updateDigest(hashObj, value.text, ignoreVolatile)
+        _updateDigest(hashObj, list(value), ignoreVolatile)
+        _updateDigest(hashObj, value.tail, ignoreVolatile)
+        
+    elif hasattr(value, 'canonicalValue'):
+        # Value types e.g. DecisionType may provide a plain value to use in
+        # their place
+        hashObj.update('C')
+        _updateDigest(hashObj, value.canonicalValue(), ignoreVolatile)
+        
+    elif hasattr(value.__class__, '__slots__') or hasattr(value, '__dict__'):
+        # Other objects e.g. DecisionType or XACML context types
+        hashObj.update('X%s.%s' % (value.__class__.__module__, 
+                                   value.__class__.__name__))
+        for slotName in getSlotNames(value.__class__):
+            _updateDigest(hashObj, slotName, ignoreVolatile)
+            _updateDigest(hashObj, getattr(value, slotName, None), 
+                          ignoreVolatile)
+            
+        for item in sorted(getattr(value, '__dict__', {}).items()):
+            _updateDigest(hashObj, item, ignoreVolatile)
+    else:
+        raise TypeError("No canonical digest representation for %r type" %
+                        type(value))
+
+
+def _isStructurallyEqual(value1, value2):
+    """Compare two values from SAML objects
+    
+    :param value1: first value
+    :type value1: object
+    :param value2: second value
+    :type value2: object
+    :return: True if the values are equal
+    :rtype: bool
+    """
+    if value1 is value2:
+        return True
+    
+    if value1 is None or value2 is None:
+        return False
+    
+    if isinstance(value1, SAMLObject) or isinstance(value2, SAMLObject):
+        return value1 == value2
+    
+    isSequence1 = (isinstance(value1, (list, tuple)) or 
+                   hasattr(value1, 'iterAttributes'))
+    isSequence2 = (isinstance(value2, (list, tuple)) or 
+                   hasattr(value2, 'iterAttributes'))
+    if isSequence1 or isSequence2:
+        if not (isSequence1 and isSequence2) or len(value1) != len(value2):
+            return False
+        
+        items1 = getattr(value1, 'iterAttributes', lambda: value1)()
+        items2 = getattr(value2, 'iterAttributes', lambda: value2)()
+        for item1, item2 in zip(items1, items2):
+            if not _isStructurallyEqual(item1, item2):
+                return False
+        return True
+    
+    if _isElement(value1) or _isElement(value2):
+        return (_isElement(value1) and _isElement(value2) and
+                value1.tag == value2.tag and
+                value1.attrib == value2.attrib and
+                value1.text == value2.text and
+                value1.tail == value2.tail and
+                _isStructurallyEqual(list(value1), list(value2)))
+    
+    try:
+        return value1 == value2
+    except TypeError:
+        # e.g. QName and DecisionType raise TypeError for mismatched types
+        return False
+    
+
+def _freezeValue(value):
+    """Make a value held by a SAML object read only
+    
+    :param value: value to freeze
+    :type value: object
+    :return: frozen value - this may be a new object e.g. lists are 
+    converted to tuples
+    :rtype: object
+    """
+    if hasattr(value, 'freeze'):
+        # SAML objects and columnar attribute lists
+        return value.freeze()
+    
+    elif isinstance(value, TypedList):
+        for item in value:
+            _freezeValue(item)
+            
+        if not isinstance(value, FrozenTypedList):
+            value.__class__ = FrozenTypedList
+        return value
+    
+    elif isinstance(value, (list, tuple)):
+        return tuple([_freezeValue(item) for item in value])
+    
+    return value
+
+
+def _frozenSetAttr(self, name, value):
+    """__setattr__ for frozen SAML objects
+    
+    :raise AttributeError: object is read only
+    """
+    raise AttributeError("%r object is frozen and can't be modified" %
+                         self.__class__.__name__)
+
+
+def _frozenDelAttr(self, name):
+    """__delattr__ for frozen SAML objects
+    
+    :raise AttributeError: object is read only
+    """
+    raise AttributeError("%r object is frozen and can't be modified" %
+                         self.__class__.__name__)
+    
+    
+def _frozenHash(self):
+    '''Frozen objects hash by content consistent with structural equality
+    
+    :return: hash of the content digest
+    :rtype: int
+    '''
+    return hash(self.digest())
+
+
+def _getFrozenClass(cls):
+    """Get a read only variant of a SAML class.  It has the same slots as
+    the class and so objects can be switched to it by assigning __class__
+    
+    :param cls: SAML class
+    :type cls: type
+    :return: frozen variant of the class
+    :rtype: type
+    """
+    frozenClass = _frozenClasses.get(cls)
+    if frozenClass is None:
+        frozenClass = type(cls.__name__, (cls,), {
+            '__slots__': (),
+            '__module__': cls.__module__,
+            '_frozen': True,
+            '__setattr__': _frozenSetAttr,
+            '__delattr__': _frozenDelAttr,
+            '__hash__': _frozenHash,
+            
+            # Frozen classes are generated and can't be referenced from a 
+            # pickle.  Objects are unpickled as the modifiable class
+            '__reduce__': lambda self: reduceSlots(self, cls=cls)
+        })
+        _frozenClasses[cls] = frozenClass
+        
+    return frozenClass
  
 
 class SAMLObject(object):
@@ -37,11 +330,27 @@ class SAMLObject(object):
     :cvar DEFAULT_ELEMENT_LOCAL_NAME: default XML element name - derived classes
     must specify 
     :type DEFAULT_ELEMENT_LOCAL_NAME: None
+    :cvar DIGEST_ALGORITHM: hashlib algorithm name used by digest
+    :type DIGEST_ALGORITHM: string
+    :cvar VOLATILE_ATTRIBUTES: names of attributes which vary between 
+    otherwise identical objects e.g. ID and IssueInstant.  These are excluded
+    from the digest if requested
+    :type VOLATILE_ATTRIBUTES: tuple
+    :cvar TRANSIENT_ATTRIBUTES: names of attributes holding data derived from
+    the content of the object e.g. memoised digests.  These are never included
+    in digests or equality comparisons
+    :type TRANSIENT_ATTRIBUTES: tuple
     :ivar __qname: qualified name for XML element
     :type __qname: ndg.saml.common.xml.QName
+    :ivar __digests: memoised digests for frozen objects
+    :type __digests: NoneType / dict
     """
     DEFAULT_ELEMENT_LOCAL_NAME = None
-    __slots__ = ('__qname',)
+    DIGEST_ALGORITHM = 'sha256'
+    VOLATILE_ATTRIBUTES = ()
+    TRANSIENT_ATTRIBUTES = ('digests',)
+    _frozen = False
+    __slots__ = ('__qname', '__digests')
     
     def __init__(self,
                  namespaceURI=SAMLConstants.SAML20_NS, 
@@ -64,6 +373,7 @@ class SAMLObject(object):
         self.__qname = QName(namespaceURI, 
                              elementLocalName, 
                              namespacePrefix)
+        self.__digests = None
             
     @property
     def qname(self):
@@ -126,6 +436,146 @@ class SAMLObject(object):
         for attrName, val in attrDict.items():
             setattr(self, attrName, val)
             
+    def __reduce__(self):
+        '''Compact pickling.  State is saved as a flat tuple of the slot 
+        values of this class and its bases together with the slot names so 
+        that pickles still load after slots are added - see 
+        ndg.saml.utils.reduceSlots.
+        __getstate__ and __setstate__ are retained so that pickles made with
+        the previous attribute dictionary scheme can still be loaded.
+        
+        :return: callable to restore the object and its arguments
+        :rtype: tuple
+        '''
+        return reduceSlots(self)
+    
+    @property
+    def frozen(self):
+        """True if this object has been made read only with freeze
+        
+        :return: frozen state
+        :rtype: bool
+        """
+        return self._frozen
+    
+    def unfrozenClass(self):
+        '''Get the SAML class of this object as it was before it was frozen.
+        Use in place of __class__ where frozen objects need mapping to their
+        SAML type e.g. for serialisation
+        
+        :return: modifiable class
+        :rtype: type
+        '''
+        if self._frozen:
+            # Frozen variants are derived directly from the modifiable class
+            # - see _getFrozenClass
+            return self.__class__.__bases__[0]
+        
+        return self.__class__
+    
+    def freeze(self):
+        '''Make this object and the SAML objects and lists it contains read
+        only.  Once frozen, digests are memoised and the object is hashable.
+        Attempts to modify a frozen object raise AttributeError.  Plain lists
+        are converted to tuples.  Objects are not frozen when unpickled.
+        
+        :return: this object
+        :rtype: ndg.saml.common.SAMLObject
+        '''
+        if self._frozen:
+            return self
+        
+        cls = self.__class__
+        for slotName in getSlotNames(cls):
+            value = getattr(self, slotName, None)
+            frozenValue = _freezeValue(value)
+            if frozenValue is not value:
+                setattr(self, slotName, frozenValue)
+        
+        self.__digests = {}
+        self.__class__ = _getFrozenClass(cls)
+        return self
+    
+    def digest(self, ignoreVolatile=False):
+        '''Canonical digest of the content of this object.  It is computed
+        from the object attributes and those of the objects it contains without
+        serialising to XML.  Each contained SAML object contributes its own
+        digest so that the memoised digests of frozen objects are reused.
+        
+        :param ignoreVolatile: set to True to exclude attributes listed in 
+        VOLATILE_ATTRIBUTES e.g. ID and IssueInstant, from this object and the
+        objects it contains
+        :type ignoreVolatile: bool
+        :return: hex digest
+        :rtype: string
+        '''
+        if self._frozen:
+            digest = self.__digests.get(ignoreVolatile)
+            if digest is not None:
+                return digest
+            
+        cls = _getCanonicalClass(self.__class__)
+        hashObj = hashlib.new(self.DIGEST_ALGORITHM)
+        hashObj.update(cls.__name__)
+        for slotName, publicName in _getDigestSlots(cls):
+            if ignoreVolatile and publicName in self.VOLATILE_ATTRIBUTES:
+                continue
+            
+            hashObj.update('|%s=' % publicName)
+            _updateDigest(hashObj, getattr(self, slotName, None), 
+                          ignoreVolatile)
+        
+        digest = hashObj.hexdigest()
+        if self._frozen:
+            self.__digests[ignoreVolatile] = digest
+            
+        return digest
+    
+    def __eq__(self, samlObject):
+        '''Structural equality - SAML objects are equal if they are of the 
+        same SAML type and their attributes are equal
+        
+        :param samlObject: object to compare with
+        :type samlObject: ndg.saml.common.SAMLObject
+        :return: True if equal
+        :rtype: bool
+        '''
+        if self is samlObject:
+            return True
+        
+        if not isinstance(samlObject, SAMLObject):
+            return NotImplemented
+        
+        cls = _getCanonicalClass(self.__class__)
+        if cls is not _getCanonicalClass(samlObject.__class__):
+            return False
+        
+        if self._frozen and samlObject._frozen:
+            return self.digest() == samlObject.digest()
+        
+        for slotName, publicName in _getDigestSlots(cls):
+            if not _isStructurallyEqual(getattr(self, slotName, None),
+                                        getattr(samlObject, slotName, None)):
+                return False
+            
+        return True
+    
+    def __ne__(self, samlObject):
+        '''
+        :param samlObject: object to compare with
+        :type samlObject: ndg.saml.common.SAMLObject
+        :return: True if not equal
+        :rtype: bool
+        '''
+        isEqual = self.__eq__(samlObject)
+        if isEqual is NotImplemented:
+            return isEqual
+        return not isEqual
+    
+    # Objects which can be modified compare by content and so are unhashable.
+    # Frozen objects hash by content - see _frozenHash
+    __hash__ = None
+            
 
 class SAMLVersion(object):
     """Version helper class
@@ -189,6 +639,14 @@ class SAMLVersion(object):
         for attrName, val in attrDict.items():
             setattr(self, attrName, val)
     
+    def __reduce__(self):
+        '''Compact pickling using the version tuple only
+        
+        :return: class and its arguments
+        :rtype: tuple
+        '''
+        return self.__class__, (self.__version,)
+    
     def __str__(self):
         """
         :return: string representation of SAML version
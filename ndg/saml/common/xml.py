@@ -399,6 +399,15 @@ class QName(object):
         self.namespaceURI = namespaceURI
         self.localPart = localPart
         self.prefix = prefix
+        
+    def __reduce__(self):
+        '''Compact pickling using the constructor arguments
+        
+        :return: class and its arguments
+        :rtype: tuple
+        '''
+        return self.__class__, (self.__namespaceURI, self.__localPart, 
+                                self.__prefix)
     
     def _getPrefix(self):
         """Get prefix
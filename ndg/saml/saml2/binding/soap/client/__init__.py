@@ -11,15 +11,18 @@ __revision__ = '$Id$'
 import logging
 log = logging.getLogger(__name__)
 
-from os import path
-from ConfigParser import ConfigParser, SafeConfigParser
-
 from ndg.saml.common import SAMLObject
 
-from ndg.saml.utils.factory import importModuleObject
+from ndg.saml.utils.factory import importModuleObject, readConfigItems
 from ndg.soap import SOAPEnvelopeBase
 from ndg.soap.etree import SOAPEnvelope
-from ndg.soap.client import (UrlLib2SOAPClient, UrlLib2SOAPRequest)
+from ndg.soap.client import (HTTPSOAPClient, UrlLib2SOAPClient, 
+                             UrlLib2SOAPRequest)
+from ndg.soap.transport import HTTPTransportBase
+from ndg.soap.utils.hedging import HedgePolicy
+from ndg.soap.utils.routing import (EndpointSelector, NoEndpointAvailableError,
+                                    makeEndpointSelector)
+from ndg.soap.utils.metrics import RequestTiming
 
 from ndg.saml.saml2.binding.soap import SOAPBindingInvalidResponse
     
@@ -34,6 +37,9 @@ class SOAPBinding(object):
     RESPONSE_ENVELOPE_CLASS_OPTNAME = 'responseEnvelopeClass'
     SERIALISE_OPTNAME = 'serialise'
     DESERIALISE_OPTNAME = 'deserialise'  
+    TRANSPORT_OPTNAME = 'transport'
+    HEDGE_POLICY_OPTNAME = 'hedgePolicy'
+    ENDPOINT_SELECTOR_OPTNAME = 'endpointSelector'
     
     CONFIG_FILE_OPTNAMES = (
         REQUEST_ENVELOPE_CLASS_OPTNAME,
@@ -44,7 +50,9 @@ class SOAPBinding(object):
     
     __PRIVATE_ATTR_PREFIX = "__"
     __slots__ = tuple([__PRIVATE_ATTR_PREFIX + i 
-                       for i in CONFIG_FILE_OPTNAMES + ("client",)])
+                       for i in CONFIG_FILE_OPTNAMES + ("client",
+                                                        "hedgePolicy",
+                                                        "endpointSelector")])
     del i
     
     isIterable = staticmethod(_isIterable)
@@ -58,6 +66,8 @@ class SOAPBinding(object):
         '''Create SAML SOAP Client - Nb. serialisation functions must be set
         before send()ing the request'''
         self.__client = None
+        self.__hedgePolicy = None
+        self.__endpointSelector = None
         self.__serialise = None
         self.__deserialise = None
         
@@ -139,25 +149,263 @@ class SOAPBinding(object):
         return self.__client
 
     def _setClient(self, value):     
-        if not isinstance(value, UrlLib2SOAPClient):
+        if not isinstance(value, HTTPSOAPClient):
             raise TypeError('Expecting %r for "client"; got %r' % 
-                            (UrlLib2SOAPClient, type(value)))
+                            (HTTPSOAPClient, type(value)))
         self.__client = value
 
     client = property(_getClient, _setClient, 
                       doc="SOAP Client object")   
 
-    def send(self, samlObj, uri=None, request=None):
+    def _getTransport(self):
+        return self.client.transport
+
+    def _setTransport(self, value):
+        self.setTransport(value)
+
+    transport = property(_getTransport, _setTransport,
+                         doc="HTTP transport used by the SOAP client.  May "
+                             "be set with a ndg.soap.transport."
+                             "HTTPTransportBase derived instance, class or "
+                             "class name e.g. "
+                             "\"ndg.soap.transport:"
+                             "HTTPConnectionPoolTransport\".  Nb. handlers "
+                             "added to client.openerDirector apply to the "
+                             "default urllib2 transport only")
+    
+    def _getHedgePolicy(self):
+        return self.__hedgePolicy
+
+    def _setHedgePolicy(self, value):
+        if not isinstance(value, (HedgePolicy, type(None))):
+            raise TypeError('Expecting %r or None type for "hedgePolicy"; got '
+                            '%r' % (HedgePolicy, type(value)))
+        self.__hedgePolicy = value
+
+    hedgePolicy = property(_getHedgePolicy, _setHedgePolicy,
+                           doc="ndg.soap.utils.hedging.HedgePolicy for "
+                               "sending a duplicate of a slow query to a "
+                               "replica of the service.  Only used when the "
+                               "uri is passed to send.  Set to None to "
+                               "disable.  Options prefixed with "
+                               "\"hedgePolicy.\" in the configuration are "
+                               "passed to HedgePolicy")
+    
+    def _getEndpointSelector(self):
+        return self.__endpointSelector
+
+    def _setEndpointSelector(self, value):
+        if not isinstance(value, (EndpointSelector, type(None))):
+            raise TypeError('Expecting %r or None type for "endpointSelector"; '
+                            'got %r' % (EndpointSelector, type(value)))
+        self.__endpointSelector = value
+
+    endpointSelector = property(_getEndpointSelector, _setEndpointSelector,
+                                doc="ndg.soap.utils.routing.EndpointSelector "
+                                    "choosing the service endpoint for "
+                                    "queries sent without a uri.  Options "
+                                    "prefixed with \"endpointSelector.\" in "
+                                    "the configuration are passed to "
+                                    "makeEndpointSelector e.g. "
+                                    "\"endpointSelector.routing = hash\" to "
+                                    "route queries by subject")
+
+    def _getUris(self):
+        if self.__endpointSelector is None:
+            return ()
+        
+        return self.__endpointSelector.uris
+
+    def _setUris(self, value):
+        if self.__endpointSelector is None:
+            self.__endpointSelector = EndpointSelector(uris=value)
+        else:
+            self.__endpointSelector.uris = value
+
+    uris = property(_getUris, _setUris,
+                    doc="Equivalent service endpoint URIs to route queries "
+                        "sent without a uri between.  May be set with a "
+                        "comma or space separated string.  Sets the URIs of "
+                        "the endpointSelector creating one if needed")
+    
+    @staticmethod
+    def _makeTransport(transport, **kw):
+        '''Make an HTTP transport from the settings passed to setTransport
+        
+        :rtype: ndg.soap.transport.HTTPTransportBase
+        :return: transport instance
+        '''
+        if isinstance(transport, basestring):
+            transport = importModuleObject(transport, 
+                                           objectType=HTTPTransportBase)
+            
+        if isinstance(transport, type):
+            transport = transport(**kw)
+            
+        elif kw:
+            raise TypeError('Transport keywords %r given for a transport '
+                            'instance' % kw.keys())
+            
+        return transport
+            
+    def setTransport(self, transport, **kw):
+        '''Set the HTTP transport for the SOAP client
+        
+        :type transport: ndg.soap.transport.HTTPTransportBase / type / 
+        basestring
+        :param transport: transport instance, class or class name to import
+        :type kw: dict
+        :param kw: keywords for the transport class constructor.  Only used
+        when transport is a class or class name
+        '''
+        self.client.transport = self._makeTransport(transport, **kw)
+
+    def _getObservers(self):
+        return self.client.observers
+
+    def _setObservers(self, value):
+        self.client.observers = value
+
+    observers = property(_getObservers, _setObservers,
+                         doc="Callables passed a "
+                             "ndg.soap.utils.metrics.RequestTiming instance "
+                             "with the phase timings of each request made.  "
+                             "Set on the SOAP client object")
+
+    def _getCompression(self):
+        return self.client.compression
+
+    def _setCompression(self, value):
+        if isinstance(value, basestring) and value.lower() == 'none':
+            value = None
+            
+        self.client.compression = value
+
+    compression = property(_getCompression, _setCompression,
+                           doc="Content encoding, 'gzip' or 'deflate', for "
+                               "compressing requests and requesting "
+                               "compressed responses.  None or 'none' "
+                               "disables compression.  Set on the SOAP "
+                               "client object")
+
+    def _getCompressLevel(self):
+        return self.client.compressLevel
+
+    def _setCompressLevel(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        self.client.compressLevel = value
+
+    compressLevel = property(_getCompressLevel, _setCompressLevel,
+                             doc="Compression level for requests from 1 "
+                                 "(fastest) to 9 (smallest).  Set on the "
+                                 "SOAP client object")
+
+    def _getCompressMinSize(self):
+        return self.client.compressMinSize
+
+    def _setCompressMinSize(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        self.client.compressMinSize = value
+
+    compressMinSize = property(_getCompressMinSize, _setCompressMinSize,
+                               doc="Requests smaller than this number of "
+                                   "bytes are sent uncompressed.  Set on the "
+                                   "SOAP client object")
+
+    @staticmethod
+    def _getEndpoint(uri, request):
+        """Get the service URI for timing records"""
+        if uri is not None:
+            return uri
+        
+        return getattr(request, 'url', None)
+
+    def send(self, samlObj, uri=None, request=None, timing=None):
         '''Make an request/query to a remote SAML service
         
         :type samlObj: saml.common.SAMLObject
         :param samlObj: SAML query/request object
         :type uri: basestring 
         :param uri: uri of service.  May be omitted if set from request.url
+        or an endpoint selector is set to choose it
         :type request: ndg.security.common.soap.UrlLib2SOAPRequest
         :param request: SOAP request object to which query will be attached
         defaults to ndg.security.common.soap.client.UrlLib2SOAPRequest
+        :type timing: ndg.soap.utils.metrics.RequestTiming / NoneType
+        :param timing: record to add phase timings to.  If None and observers
+        are set, a record is created and passed to them when the request
+        completes.  If set, the caller is responsible for notifying observers
+        '''
+        if timing is not None or not self.observers:
+            return self._send(samlObj, uri, request, timing)
+        
+        timing = RequestTiming(self._getEndpoint(uri, request))
+        try:
+            return self._send(samlObj, uri, request, timing)
+        except Exception, e:
+            timing.error = type(e).__name__
+            raise
+        finally:
+            timing.notify(self.observers)
+            
+    def _send(self, samlObj, uri, request, timing):
+        '''Make a request recording phase timings in timing if set.  The 
+        request is hedged if a hedge policy is set'''
+        selector = self.__endpointSelector
+        routed = uri is None and request is None and selector is not None
+        if routed:
+            key = self._getRoutingKey(samlObj)
+            uri = selector.select(key=key)
+            
+        if (self.__hedgePolicy is None or uri is None or 
+            request is not None):
+            if routed:
+                return selector.call(uri, 
+                    lambda _uri: self._sendRequest(samlObj, _uri, None, 
+                                                   timing))
+            
+            return self._sendRequest(samlObj, uri, request, timing)
+        
+        # Each attempt creates its own SOAP request.  Phase timings can't be
+        # recorded for concurrent attempts so the time to the first 
+        # response is recorded as one phase
+        sendAttempt = lambda _uri: self._sendRequest(samlObj, _uri, None, 
+                                                     None)
+        hedgeUri = None
+        if routed:
+            sendAttempt = lambda _uri, _send=sendAttempt: selector.call(_uri, 
+                                                                        _send)
+            try:
+                hedgeUri = selector.select(exclude=(uri,), key=key)
+            except NoEndpointAvailableError:
+                pass
+            
+        response = self.__hedgePolicy.send(sendAttempt, uri, 
+                                           hedgeUri=hedgeUri)
+        if timing is not None:
+            timing.mark('hedgedSend')
+            
+        return response
+        
+    def _getRoutingKey(self, samlObj):
+        '''Get the key used by the endpoint selector to route a request.  
+        Derived classes return a key such as the query subject so that 
+        requests for the same subject go to the same replica
+        
+        :type samlObj: saml.common.SAMLObject
+        :param samlObj: SAML query/request object
+        :rtype: basestring / NoneType
+        :return: routing key or None to route by latency only
         '''
+        return None
+        
+    def _sendRequest(self, samlObj, uri, request, timing):
+        '''Make a request to a single endpoint recording phase timings in 
+        timing if set'''
         if self.serialise is None:
             raise AttributeError('No "serialise" method set to serialise the '
                                  'request')
@@ -179,19 +427,34 @@ class SOAPBinding(object):
             request.url = uri
         
         samlElem = self.serialise(samlObj)
+        if timing is not None:
+            timing.mark('serialise')
             
         # Attach query to SOAP body
         request.envelope.body.elem.append(samlElem)
             
-        response = self.client.send(request)
+        response = self.client.send(request, timing=timing)
         
         if len(response.envelope.body.elem) != 1:
             raise SOAPBindingInvalidResponse("Expecting single child element "
                                              "is SOAP body")
             
-        response = self.deserialise(response.envelope.body.elem[0])
+        response = self._deserialiseResponse(response.envelope.body.elem[0])
+        if timing is not None:
+            timing.mark('deserialise')
         
         return response
+    
+    def _deserialiseResponse(self, elem):
+        """Deserialise the response element from the SOAP body.  Derived 
+        classes may override to pass additional parse options
+        
+        :type elem: ElementTree.Element
+        :param elem: response element
+        :rtype: ndg.saml.common.SAMLObject
+        :return: deserialised response
+        """
+        return self.deserialise(elem)
 
     @classmethod
     def fromConfig(cls, cfg, **kw):
@@ -208,31 +471,20 @@ class SOAPBinding(object):
 
     def parseConfig(self, cfg, prefix='', section='DEFAULT'):
         '''Read config file settings
-        :type cfg: basestring /ConfigParser derived type
-        :param cfg: configuration file path or ConfigParser type object
+        :type cfg: basestring /ConfigParser derived type / 
+        ndg.saml.utils.factory.CompiledConfig
+        :param cfg: configuration file path, ConfigParser type object or
+        compiled configuration.  Use a compiled configuration to create 
+        bindings repeatedly without re-reading the file
         :type prefix: basestring
         :param prefix: prefix for option names e.g. "attributeQuery."
         :type section: baestring
         :param section: configuration file section from which to extract
         parameters.
         '''  
-        if isinstance(cfg, basestring):
-            cfgFilePath = path.expandvars(cfg)
-            hereDir = path.dirname(cfgFilePath)
-            _cfg = SafeConfigParser(defaults=dict(here=hereDir))
-            _cfg.optionxform = str
-
-            _cfg.read(cfgFilePath)
-            
-        elif isinstance(cfg, ConfigParser):
-            _cfg = cfg   
-        else:
-            raise AttributeError('Expecting basestring or ConfigParser type '
-                                 'for "cfg" attribute; got %r type' % type(cfg))
-        
         # Get items for this section as a dictionary so that parseKeywords can
         # used to update the object
-        kw = dict(_cfg.items(section))
+        kw = readConfigItems(cfg, section=section)
         if 'prefix' not in kw and prefix:
             kw['prefix'] = prefix
             
@@ -250,15 +502,47 @@ class SOAPBinding(object):
         variable names.  However, they may prefixed with <prefix>
         """
         prefixLen = len(prefix)
+        
+        # Options prefixed with "transport.", "hedgePolicy." or
+        # "endpointSelector." are keywords for the transport class, hedge
+        # policy and endpoint selector
+        componentKw = {
+            SOAPBinding.TRANSPORT_OPTNAME: {},
+            SOAPBinding.HEDGE_POLICY_OPTNAME: {},
+            SOAPBinding.ENDPOINT_SELECTOR_OPTNAME: {}
+        }
+        transport = None
+        
         for optName, val in kw.items():
             if prefix:
                 # Filter attributes based on prefix
-                if optName.startswith(prefix):
-                    setattr(self, optName[prefixLen:], val)
+                if not optName.startswith(prefix):
+                    continue
+                
+                optName = optName[prefixLen:]
+                
+            componentName, _, componentOptName = optName.partition('.')
+            if optName == SOAPBinding.TRANSPORT_OPTNAME:
+                transport = val
+                
+            elif componentOptName and componentName in componentKw:
+                componentKw[componentName][componentOptName] = val
             else:
-                # No prefix set - attempt to set all attributes   
                 setattr(self, optName, val)
                 
+        if transport is not None:
+            self.setTransport(transport, 
+                              **componentKw[SOAPBinding.TRANSPORT_OPTNAME])
+            
+        hedgePolicyKw = componentKw[SOAPBinding.HEDGE_POLICY_OPTNAME]
+        if hedgePolicyKw:
+            self.hedgePolicy = HedgePolicy(**hedgePolicyKw)
+            
+        endpointSelectorKw = componentKw[SOAPBinding.ENDPOINT_SELECTOR_OPTNAME]
+        if endpointSelectorKw:
+            endpointSelectorKw.setdefault('uris', self.uris)
+            self.endpointSelector = makeEndpointSelector(**endpointSelectorKw)
+                
     @classmethod
     def fromKeywords(cls, prefix='', **kw):
         """Create a new instance initialising instance variables from the 
@@ -274,7 +558,7 @@ class SOAPBinding(object):
         :rtype: ndg.saml.saml2.binding.soap.client.SOAPBinding or derived type
         """
         obj = cls()
-        obj.fromKeywords(prefix=prefix, **kw)
+        obj.parseKeywords(prefix=prefix, **kw)
         
         return obj
         
@@ -8,34 +8,18 @@ __copyright__ = "(C) 2009 Science and Technology Facilities Council"
 __license__ = "http://www.apache.org/licenses/LICENSE-2.0"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id$'
-from urlparse import urlparse
 import logging
 log = logging.getLogger(__name__)
 
-try:
-    from ndg.httpsclient.https import HTTPSContextHandler as HTTPSHandler_
-    
-except ImportError:
-    from M2Crypto.m2urllib2 import HTTPSHandler as HTTPSHandler_
-
 from ndg.saml.saml2.core import AttributeQuery
+from ndg.saml.xml import AttributeFilter
 from ndg.saml.saml2.binding.soap.client.subjectquery import (
                                                     SubjectQuerySOAPBinding,
                                                     SubjectQueryResponseError)
-
-# Prevent whole module breaking if this is not available - it's only needed for
-# AttributeQuerySslSOAPBinding
-try:
-    from ndg.saml.utils.pyopenssl import SSLContextProxy as SSLContextProxy_
-    _sslContextProxySupport = True
-    
-except ImportError:
-    try:
-        from ndg.saml.utils.m2crypto import SSLContextProxy as SSLContextProxy_
-        _sslContextProxySupport = True
-        
-    except ImportError:
-        _sslContextProxySupport = False
+from ndg.soap.transport import UrlLib2Transport
+from ndg.saml.utils.ssl_context import (SSLContextProxySupport,
+                                        SSLContextHTTPSHandler,
+                                        importSSLContextProxy)
 
 
 class AttributeQueryResponseError(SubjectQueryResponseError):
@@ -48,11 +32,20 @@ class AttributeQuerySOAPBinding(SubjectQuerySOAPBinding):
     SERIALISE_KW = 'serialise'
     DESERIALISE_KW = 'deserialise'
     QUERY_TYPE = AttributeQuery
+    
+    ATTRIBUTE_FILTER_NAMES_OPTNAME = 'attributeFilterNames'
+    ATTRIBUTE_FILTER_NAME_FORMATS_OPTNAME = 'attributeFilterNameFormats'
+    
+    CONFIG_FILE_OPTNAMES = SubjectQuerySOAPBinding.CONFIG_FILE_OPTNAMES + (
+        ATTRIBUTE_FILTER_NAMES_OPTNAME,
+        ATTRIBUTE_FILTER_NAME_FORMATS_OPTNAME
+    )
 
-    __slots__ = ()
+    __slots__ = ('__attributeFilter',)
     
     def __init__(self, **kw):
         '''Create SOAP Client for SAML Attribute Query'''
+        self.__attributeFilter = None
         
         # Default to ElementTree based serialisation/deserialisation
         if AttributeQuerySOAPBinding.SERIALISE_KW not in kw:
@@ -73,49 +66,133 @@ class AttributeQuerySOAPBinding(SubjectQuerySOAPBinding):
         making settings parameters read from a config file
         """
         super(AttributeQuerySOAPBinding, self).__setattr__(name, value)
+        
+    def _getAttributeFilter(self):
+        return self.__attributeFilter
+    
+    def _setAttributeFilter(self, value):
+        if value is not None and not isinstance(value, AttributeFilter):
+            raise TypeError('Expecting %r type or None for "attributeFilter" '
+                            'attribute; got %r' % (AttributeFilter, 
+                                                   type(value)))
+        self.__attributeFilter = value
+        
+    attributeFilter = property(_getAttributeFilter, _setAttributeFilter,
+                               doc="Filter selecting the attributes to be "
+                                   "parsed from responses.  If None, all "
+                                   "attributes are parsed.  The deserialise "
+                                   "callable must accept an attributeFilter "
+                                   "keyword as ResponseElementTree.fromXML "
+                                   "does")
+    
+    def _getAttributeFilterNames(self):
+        if self.__attributeFilter is None:
+            return frozenset()
+        return self.__attributeFilter.names
+    
+    def _setAttributeFilterNames(self, value):
+        if self.__attributeFilter is None:
+            self.__attributeFilter = AttributeFilter()
+        self.__attributeFilter.names = value
+        
+    attributeFilterNames = property(_getAttributeFilterNames,
+                                    _setAttributeFilterNames,
+                                    doc="Names of the attributes to be parsed "
+                                        "from responses.  May be set from a "
+                                        "whitespace separated string")
+    
+    def _getAttributeFilterNameFormats(self):
+        if self.__attributeFilter is None:
+            return frozenset()
+        return self.__attributeFilter.nameFormats
+    
+    def _setAttributeFilterNameFormats(self, value):
+        if self.__attributeFilter is None:
+            self.__attributeFilter = AttributeFilter()
+        self.__attributeFilter.nameFormats = value
+        
+    attributeFilterNameFormats = property(_getAttributeFilterNameFormats,
+                                          _setAttributeFilterNameFormats,
+                                          doc="NameFormats of the attributes "
+                                              "to be parsed from responses.  "
+                                              "May be set from a whitespace "
+                                              "separated string")
+    
+    def _deserialiseResponse(self, elem):
+        """Deserialise the response passing the attribute filter if set
+        
+        :type elem: ElementTree.Element
+        :param elem: response element
+        :rtype: ndg.saml.saml2.core.Response
+        :return: deserialised response
+        """
+        if self.__attributeFilter is None:
+            return self.deserialise(elem)
+        
+        return self.deserialise(elem, attributeFilter=self.__attributeFilter)
 
     
 class AttributeQuerySslSOAPBinding(AttributeQuerySOAPBinding):
     """Specialisation of AttributeQuerySOAPbinding taking in the setting of
     SSL parameters for mutual authentication
     """
-    SSL_CONTEXT_PROXY_SUPPORT = _sslContextProxySupport
-    __slots__ = ('__sslCtxProxy',)
+    SSL_CONTEXT_PROXY_SUPPORT = SSLContextProxySupport()
+    __slots__ = ('__sslCtxProxy', '__httpsHandler')
     
     def __init__(self, **kw):
-        if not AttributeQuerySslSOAPBinding.SSL_CONTEXT_PROXY_SUPPORT:
-            raise ImportError("ndg.saml.utils.m2crypto import "
-                              "failed - missing M2Crypto package?")
+        # Import the SSL backend - raises ImportError if none is available
+        sslContextProxyClass = importSSLContextProxy()
         
-        # Miss out default HTTPSHandler and set in send() instead
+        # Miss out default HTTPSHandler and add one using the SSL context
+        # proxy instead
         if 'handlers' in kw:
             raise TypeError("__init__() got an unexpected keyword argument "
                             "'handlers'")
             
         super(AttributeQuerySslSOAPBinding, self).__init__(handlers=(), **kw)
-        self.__sslCtxProxy = SSLContextProxy_()
+        self.__sslCtxProxy = sslContextProxyClass()
+        
+        # One handler serves all requests.  It creates and caches an SSL
+        # context per host so the proxy is never modified when sending
+        self.__httpsHandler = SSLContextHTTPSHandler(self.__sslCtxProxy)
+        self.client.openerDirector.add_handler(self.__httpsHandler)
 
-    def send(self, query, **kw):
-        """Override base class implementation to pass explicit SSL Context
-        """
-        if 'uri' in kw:
-            parsed_url = urlparse(kw['uri'])
-            self.sslCtxProxy.ssl_valid_hostname = parsed_url.netloc.split(':'
-                                                                          )[0]
+    def setTransport(self, transport, **kw):
+        '''Set the HTTP transport for the SOAP client.  SSL settings are 
+        applied by the HTTPS handler added to the urllib2 opener so only 
+        ndg.soap.transport.UrlLib2Transport derived transports can be used.  
+        The handler is added to the opener of the new transport
+        
+        :type transport: ndg.soap.transport.UrlLib2Transport / type / 
+        basestring
+        :param transport: transport instance, class or class name to import
+        :type kw: dict
+        :param kw: keywords for the transport class constructor.  Only used
+        when transport is a class or class name
+        :raise TypeError: transport is not a urllib2 transport
+        '''
+        transport = self._makeTransport(transport, **kw)
+        if not isinstance(transport, UrlLib2Transport):
+            raise TypeError('Expecting %r derived transport for %r: SSL '
+                            'settings are applied to urllib2 requests only; '
+                            'got %r' % (UrlLib2Transport, type(self), 
+                                        type(transport)))
             
-        httpsHandler = HTTPSHandler_(ssl_context=self.sslCtxProxy())
-        self.client.openerDirector.add_handler(httpsHandler)
-        return super(AttributeQuerySslSOAPBinding, self).send(query, **kw)
+        if self.__httpsHandler not in transport.openerDirector.handlers:
+            transport.openerDirector.add_handler(self.__httpsHandler)
             
+        self.client.transport = transport
+
     def _getSslCtxProxy(self):
         return self.__sslCtxProxy
     
     def _setSslCtxProxy(self, value):
-        if not isinstance(value, SSLContextProxy_):
+        if not isinstance(value, importSSLContextProxy()):
             raise TypeError('Expecting %r type for "sslCtxProxy attribute; got '
                             '%r' % type(value))
             
         self.__sslCtxProxy = value
+        self.__httpsHandler.sslCtxProxy = value
             
     sslCtxProxy = property(fget=_getSslCtxProxy, fset=_setSslCtxProxy,
                            doc="SSL Context Proxy object used for setting up "
@@ -135,3 +212,6 @@ class AttributeQuerySslSOAPBinding(AttributeQuerySOAPBinding):
                 setattr(self.sslCtxProxy, name, value)
             except Exception:
                 raise e
+            
+            # Discard contexts created with the previous settings
+            self.__httpsHandler.clearCache()
@@ -9,7 +9,6 @@ __copyright__ = "(C) 2009 Science and Technology Facilities Council"
 __license__ = "http://www.apache.org/licenses/LICENSE-2.0"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id$'
-from urlparse import urlparse
 import logging
 log = logging.getLogger(__name__)
 
@@ -17,29 +16,11 @@ from ndg.saml.saml2.core import AuthzDecisionQuery
 from ndg.saml.saml2.binding.soap.client.subjectquery import (
                                                     SubjectQuerySOAPBinding,
                                                     SubjectQueryResponseError)
+from ndg.soap.transport import UrlLib2Transport
+from ndg.saml.utils.ssl_context import (SSLContextProxySupport,
+                                        SSLContextHTTPSHandler,
+                                        importSSLContextProxy)
 
-# Prevent whole module breaking if this is not available - it's only needed for
-# AuthzDecisionQuerySslSOAPBinding
-try:
-    from ndg.httpsclient.https import HTTPSContextHandler as HTTPSHandler_
-
-except ImportError:
-    from M2Crypto.m2urllib2 import HTTPSHandler as HTTPSHandler_
-
-# Prevent whole module breaking if this is not available - it's only needed for
-# AttributeQuerySslSOAPBinding
-try:
-    from ndg.saml.utils.pyopenssl import SSLContextProxy as SSLContextProxy_
-    _sslContextProxySupport = True
-    
-except ImportError:
-    try:
-        from ndg.saml.utils.m2crypto import SSLContextProxy as SSLContextProxy_
-        _sslContextProxySupport = True
-        
-    except ImportError:
-        _sslContextProxySupport = False
-    
 
 class AuthzDecisionQueryResponseError(SubjectQueryResponseError):
     """SAML Response error from Attribute Query"""
@@ -69,41 +50,75 @@ class AuthzDecisionQuerySOAPBinding(SubjectQuerySOAPBinding):
             kw[cls.DESERIALISE_KW] = ResponseElementTree.fromXML
 
         super(AuthzDecisionQuerySOAPBinding, self).__init__(**kw)
+        
+    def _getRoutingKey(self, query):
+        '''Route queries by resource so that each replica of a service sees
+        the same resources
+        
+        :type query: ndg.saml.saml2.core.AuthzDecisionQuery
+        :param query: authorisation decision query
+        :rtype: basestring / NoneType
+        :return: resource URI or the subject NameID value if not set
+        '''
+        resource = getattr(query, 'resource', None)
+        if resource:
+            return resource
+        
+        return super(AuthzDecisionQuerySOAPBinding, self)._getRoutingKey(query)
 
     
 class AuthzDecisionQuerySslSOAPBinding(AuthzDecisionQuerySOAPBinding):
     """Specialisation of AuthzDecisionQuerySOAPbinding taking in the setting of
     SSL parameters for mutual authentication
     """
-    SSL_CONTEXT_PROXY_SUPPORT = _sslContextProxySupport
-    __slots__ = ('__sslCtxProxy',)
+    SSL_CONTEXT_PROXY_SUPPORT = SSLContextProxySupport()
+    __slots__ = ('__sslCtxProxy', '__httpsHandler')
     
     def __init__(self, **kw):
-        if not AuthzDecisionQuerySslSOAPBinding.SSL_CONTEXT_PROXY_SUPPORT:
-            raise ImportError("ndg.security.common.utils.m2crypto import "
-                              "failed - missing M2Crypto package?")
+        # Import the SSL backend - raises ImportError if none is available
+        sslContextProxyClass = importSSLContextProxy()
         
-        # Miss out default HTTPSHandler and set in send() instead
+        # Miss out default HTTPSHandler and add one using the SSL context
+        # proxy instead
         if 'handlers' in kw:
             raise TypeError("__init__() got an unexpected keyword argument "
                             "'handlers'")
             
         super(AuthzDecisionQuerySslSOAPBinding, self).__init__(handlers=(), 
                                                                **kw)
-        self.__sslCtxProxy = SSLContextProxy_()
-
-    def send(self, query, **kw):
-        """Override base class implementation to pass explicit SSL Context
-        """
-        if 'uri' in kw:
-            parsed_url = urlparse(kw['uri'])
-            self.sslCtxProxy.ssl_valid_hostname = parsed_url.netloc.split(':'
-                                                                          )[0]
+        self.__sslCtxProxy = sslContextProxyClass()
+        
+        # One handler serves all requests.  It creates and caches an SSL
+        # context per host so the proxy is never modified when sending
+        self.__httpsHandler = SSLContextHTTPSHandler(self.__sslCtxProxy)
+        self.client.openerDirector.add_handler(self.__httpsHandler)
 
-        httpsHandler = HTTPSHandler_(ssl_context=self.sslCtxProxy())
-        self.client.openerDirector.add_handler(httpsHandler)
-        return super(AuthzDecisionQuerySslSOAPBinding, self).send(query, **kw)
+    def setTransport(self, transport, **kw):
+        '''Set the HTTP transport for the SOAP client.  SSL settings are 
+        applied by the HTTPS handler added to the urllib2 opener so only 
+        ndg.soap.transport.UrlLib2Transport derived transports can be used.  
+        The handler is added to the opener of the new transport
         
+        :type transport: ndg.soap.transport.UrlLib2Transport / type / 
+        basestring
+        :param transport: transport instance, class or class name to import
+        :type kw: dict
+        :param kw: keywords for the transport class constructor.  Only used
+        when transport is a class or class name
+        :raise TypeError: transport is not a urllib2 transport
+        '''
+        transport = self._makeTransport(transport, **kw)
+        if not isinstance(transport, UrlLib2Transport):
+            raise TypeError('Expecting %r derived transport for %r: SSL '
+                            'settings are applied to urllib2 requests only; '
+                            'got %r' % (UrlLib2Transport, type(self), 
+                                        type(transport)))
+            
+        if self.__httpsHandler not in transport.openerDirector.handlers:
+            transport.openerDirector.add_handler(self.__httpsHandler)
+            
+        self.client.transport = transport
+
     @property
     def sslCtxProxy(self):
         """SSL Context Proxy object used for setting up an SSL Context for
@@ -126,3 +141,6 @@ class AuthzDecisionQuerySslSOAPBinding(AuthzDecisionQuerySOAPBinding):
                 setattr(self.sslCtxProxy, name, value)
             except:
                 raise e
+            
+            # Discard contexts created with the previous settings
+            self.__httpsHandler.clearCache()
@@ -20,6 +20,7 @@ from ndg.saml.saml2.core import RequestAbstractType, StatusCode
 from ndg.saml.utils import str2Bool
 from ndg.saml.saml2.binding.soap.client import (SOAPBinding,
                                                 SOAPBindingInvalidResponse)
+from ndg.soap.utils.metrics import RequestTiming
 
 
 class RequestResponseError(SOAPBindingInvalidResponse):
@@ -217,9 +218,38 @@ class RequestBaseSOAPBinding(SOAPBinding):
         :type request: ndg.security.common.soap.UrlLib2SOAPRequest
         :param request: SOAP request object to which query will be attached
         defaults to ndg.security.common.soap.client.UrlLib2SOAPRequest
+        :type timing: ndg.soap.utils.metrics.RequestTiming / NoneType
+        :param timing: record to add phase timings to.  If None and observers
+        are set, a record is created and passed to them when the request
+        completes
         '''
+        if kw.get('timing') is not None or not self.observers:
+            return self._sendQuery(query, **kw)
+        
+        timing = kw['timing'] = RequestTiming(
+                    self._getEndpoint(kw.get('uri'), kw.get('request')))
+        try:
+            return self._sendQuery(query, **kw)
+        except RequestResponseError, e:
+            timing.error = type(e).__name__
+            response = getattr(e, 'response', None)
+            if response is not None:
+                timing.samlStatus = response.status.statusCode.value
+            raise
+        except Exception, e:
+            timing.error = type(e).__name__
+            raise
+        finally:
+            timing.notify(self.observers)
+        
+    def _sendQuery(self, query, **kw):
+        '''Make the query and validate the response recording a validation
+        phase timing if a timing record is passed in kw'''
+        timing = kw.get('timing')
         self._validateQueryParameters(query)
         self._initSend(query)
+        if timing is not None:
+            timing.mark('initialise')
            
         log.debug("Sending request: query ID: %s", query.id)
         response = super(RequestBaseSOAPBinding, self).send(query, **kw)
@@ -250,5 +280,8 @@ class RequestBaseSOAPBinding(SOAPBinding):
             raise samlRespError
         
         self._verifyTimeConditions(response)
+        if timing is not None:
+            timing.samlStatus = response.status.statusCode.value
+            timing.mark('validation')
             
         return response 
@@ -29,5 +29,20 @@ class SubjectQuerySOAPBinding(RequestBaseSOAPBinding):
     def __init__(self, **kw):
         '''Create SOAP Client for a SAML Subject Query'''       
         super(SubjectQuerySOAPBinding, self).__init__(**kw)
+        
+    def _getRoutingKey(self, query):
+        '''Route queries by subject NameID so that each replica of a service
+        sees the same subjects
+        
+        :type query: ndg.saml.saml2.core.SubjectQuery
+        :param query: subject query
+        :rtype: basestring / NoneType
+        :return: subject NameID value
+        '''
+        subject = getattr(query, 'subject', None)
+        if subject is None or subject.nameID is None:
+            return None
+        
+        return subject.nameID.value
 
 
@@ -8,33 +8,16 @@ __copyright__ = "(C) 2011 Science and Technology Facilities Council"
 __license__ = "http://www.apache.org/licenses/LICENSE-2.0"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id$'
-from urlparse import urlparse
 import logging
 log = logging.getLogger(__name__)
 
 from ndg.saml.saml2.binding.soap.client.requestbase import \
                                                         RequestBaseSOAPBinding
 from ndg.saml.saml2.xacml_profile import XACMLAuthzDecisionQuery
-
-try:
-    from ndg.httpsclient.https import HTTPSContextHandler as HTTPSHandler_
-
-except ImportError:
-    from M2Crypto.m2urllib2 import HTTPSHandler as HTTPSHandler_
-
-# Prevent whole module breaking if this is not available - it's only needed for
-# XACMLAuthzDecisionQuerySslSOAPBinding
-try:
-    from ndg.saml.utils.pyopenssl import SSLContextProxy as SSLContextProxy_
-    _sslContextProxySupport = True
-    
-except ImportError:
-    try:
-        from ndg.saml.utils.m2crypto import SSLContextProxy as SSLContextProxy_
-        _sslContextProxySupport = True
-        
-    except ImportError:
-        _sslContextProxySupport = False
+from ndg.soap.transport import UrlLib2Transport
+from ndg.saml.utils.ssl_context import (SSLContextProxySupport,
+                                        SSLContextHTTPSHandler,
+                                        importSSLContextProxy)
 
 
 class XACMLAuthzDecisionQuerySOAPBinding(RequestBaseSOAPBinding):
@@ -69,36 +52,54 @@ class XACMLAuthzDecisionQuerySslSOAPBinding(XACMLAuthzDecisionQuerySOAPBinding):
     """Specialisation of AuthzDecisionQuerySOAPbinding taking in the setting of
     SSL parameters for mutual authentication
     """
-    SSL_CONTEXT_PROXY_SUPPORT = _sslContextProxySupport
-    __slots__ = ('__sslCtxProxy',)
+    SSL_CONTEXT_PROXY_SUPPORT = SSLContextProxySupport()
+    __slots__ = ('__sslCtxProxy', '__httpsHandler')
     
     def __init__(self, **kw):
-        if not XACMLAuthzDecisionQuerySslSOAPBinding.SSL_CONTEXT_PROXY_SUPPORT:
-            raise ImportError("ndg.security.common.utils.m2crypto import "
-                              "failed - missing M2Crypto package?")
+        # Import the SSL backend - raises ImportError if none is available
+        sslContextProxyClass = importSSLContextProxy()
         
-        # Miss out default HTTPSHandler and set in send() instead
+        # Miss out default HTTPSHandler and add one using the SSL context
+        # proxy instead
         if 'handlers' in kw:
             raise TypeError("__init__() got an unexpected keyword argument "
                             "'handlers'")
             
         super(XACMLAuthzDecisionQuerySslSOAPBinding, self).__init__(handlers=(), 
                                                                     **kw)
-        self.__sslCtxProxy = SSLContextProxy_()
+        self.__sslCtxProxy = sslContextProxyClass()
+        
+        # One handler serves all requests.  It creates and caches an SSL
+        # context per host so the proxy is never modified when sending
+        self.__httpsHandler = SSLContextHTTPSHandler(self.__sslCtxProxy)
+        self.client.openerDirector.add_handler(self.__httpsHandler)
 
-    def send(self, query, **kw):
-        """Override base class implementation to pass explicit SSL Context
-        """
-        if 'uri' in kw:
-            parsed_url = urlparse(kw['uri'])
-            self.sslCtxProxy.ssl_valid_hostname = parsed_url.netloc.split(':'
-                                                                          )[0]
-                                                                          
-        httpsHandler = HTTPSHandler_(ssl_context=self.sslCtxProxy())
-        self.client.openerDirector.add_handler(httpsHandler)
-        return super(XACMLAuthzDecisionQuerySslSOAPBinding, self).send(query, 
-                                                                       **kw)
+    def setTransport(self, transport, **kw):
+        '''Set the HTTP transport for the SOAP client.  SSL settings are 
+        applied by the HTTPS handler added to the urllib2 opener so only 
+        ndg.soap.transport.UrlLib2Transport derived transports can be used.  
+        The handler is added to the opener of the new transport
         
+        :type transport: ndg.soap.transport.UrlLib2Transport / type / 
+        basestring
+        :param transport: transport instance, class or class name to import
+        :type kw: dict
+        :param kw: keywords for the transport class constructor.  Only used
+        when transport is a class or class name
+        :raise TypeError: transport is not a urllib2 transport
+        '''
+        transport = self._makeTransport(transport, **kw)
+        if not isinstance(transport, UrlLib2Transport):
+            raise TypeError('Expecting %r derived transport for %r: SSL '
+                            'settings are applied to urllib2 requests only; '
+                            'got %r' % (UrlLib2Transport, type(self), 
+                                        type(transport)))
+            
+        if self.__httpsHandler not in transport.openerDirector.handlers:
+            transport.openerDirector.add_handler(self.__httpsHandler)
+            
+        self.client.transport = transport
+
     @property
     def sslCtxProxy(self):
         """SSL Context Proxy object used for setting up an SSL Context for
@@ -121,3 +122,6 @@ class XACMLAuthzDecisionQuerySslSOAPBinding(XACMLAuthzDecisionQuerySOAPBinding):
                 setattr(self.sslCtxProxy, name, value)
             except:
                 raise e
+            
+            # Discard contexts created with the previous settings
+            self.__httpsHandler.clearCache()
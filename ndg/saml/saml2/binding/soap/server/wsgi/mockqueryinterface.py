@@ -0,0 +1,614 @@
+"""Mock SAML 2.0 query interface for offline performance testing.  Responses
+to attribute and authorisation decision queries are synthesised with a
+configurable size, decision mix, latency and error rate so that clients and
+the SOAP query interface middleware can be measured without a real attribute
+authority or authorisation service
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = "$Id$"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+import logging
+log = logging.getLogger(__name__)
+import time
+import random
+from uuid import uuid4
+from datetime import datetime, timedelta
+
+from ndg.saml.common import SAMLVersion
+from ndg.saml.saml2.core import (Assertion, Attribute, AttributeStatement,
+                                 AuthzDecisionStatement, AttributeQuery,
+                                 AuthzDecisionQuery, DecisionType, Issuer,
+                                 Subject, NameID, Conditions, StatusCode,
+                                 XSStringAttributeValue)
+
+
+class MockQueryInterfaceFault(Exception):
+    """Fault injected by the mock query interface.  This is not caught by the
+    SOAP query interface middleware and so results in a HTTP 500 response"""
+
+
+class MockQueryInterfaceConfigError(Exception):
+    """Invalid mock query interface setting"""
+
+
+class LatencyDistribution(object):
+    """Random latency drawn from a named distribution.  Distributions are
+    specified as a string of the form <name>:<arg1>,<arg2>... with times in
+    seconds e.g.
+
+    constant:0.01
+    uniform:0.005,0.02
+    normal:0.01,0.002
+    lognormal:-4.6,0.5
+    exponential:0.01
+
+    :cvar DISTRIBUTIONS: number of parameters for each distribution name
+    :type DISTRIBUTIONS: dict
+    """
+    DISTRIBUTIONS = {
+        'constant': 1,
+        'uniform': 2,
+        'normal': 2,
+        'lognormal': 2,
+        'exponential': 1
+    }
+
+    def __init__(self, spec='constant:0'):
+        ''':type spec: basestring
+        :param spec: distribution specification
+        '''
+        self.__name = None
+        self.__args = None
+        self.spec = spec
+
+    def _getSpec(self):
+        return '%s:%s' % (self.__name, ','.join([str(i) for i in self.__args]))
+
+    def _setSpec(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError('Expecting string type for latency distribution '
+                            '"spec"; got %r' % type(value))
+
+        name, _, args = value.strip().partition(':')
+        name = name.strip().lower()
+        nArgs = self.__class__.DISTRIBUTIONS.get(name)
+        if nArgs is None:
+            raise MockQueryInterfaceConfigError('Unknown latency distribution '
+                                                '%r: expecting one of %r' %
+                                                (name, sorted(
+                                        self.__class__.DISTRIBUTIONS.keys())))
+        try:
+            args = tuple([float(arg) for arg in args.split(',') if arg.strip()])
+        except ValueError:
+            raise MockQueryInterfaceConfigError('Expecting numeric parameters '
+                                                'for latency distribution; got '
+                                                '%r' % value)
+        if len(args) != nArgs:
+            raise MockQueryInterfaceConfigError('Expecting %d parameter(s) for '
+                                                '%r latency distribution; got '
+                                                '%r' % (nArgs, name, value))
+        self.__name = name
+        self.__args = args
+
+    spec = property(_getSpec, _setSpec,
+                    doc="Distribution specification <name>:<arg1>,<arg2>...")
+
+    def sample(self, rng=random):
+        """Draw a latency.  Negative values are returned as zero
+
+        :type rng: random.Random
+        :param rng: random number generator
+        :rtype: float
+        :return: latency in seconds
+        """
+        if self.__name == 'constant':
+            value = self.__args[0]
+        elif self.__name == 'uniform':
+            value = rng.uniform(*self.__args)
+        elif self.__name == 'normal':
+            value = rng.normalvariate(*self.__args)
+        elif self.__name == 'lognormal':
+            value = rng.lognormvariate(*self.__args)
+        elif self.__name == 'exponential':
+            mean = self.__args[0]
+            value = mean and rng.expovariate(1./mean)
+
+        return max(0., value)
+
+
+class MockQueryInterface(object):
+    """Callable synthesising responses to SAML attribute and authorisation
+    decision queries.  Set as the query interface for
+    ndg.saml.saml2.binding.soap.server.wsgi.queryinterface.SOAPQueryInterfaceMiddleware
+
+    Attribute queries listing attributes are answered with those attributes.
+    Queries listing none are answered with nAttributes attributes.  Each has
+    nValues string values of valueSize characters.  Decisions for
+    authorisation decision queries are drawn at random from decisionMix.
+
+    :cvar DEFAULT_ATTRIBUTE_NAME_PREFIX: prefix for the names of attributes
+    returned for queries which don't list any
+    :type DEFAULT_ATTRIBUTE_NAME_PREFIX: basestring
+    :cvar DECISIONS: decision types keyed by lower case name
+    :type DECISIONS: dict
+    """
+    DEFAULT_ATTRIBUTE_NAME_PREFIX = "urn:ndg:saml:mock:attribute:"
+    DECISIONS = {
+        'permit': DecisionType.PERMIT,
+        'deny': DecisionType.DENY,
+        'indeterminate': DecisionType.INDETERMINATE
+    }
+
+    def __init__(self):
+        self.__nAttributes = 10
+        self.__nValues = 1
+        self.__valueSize = 32
+        self.__attributeNamePrefix = \
+            MockQueryInterface.DEFAULT_ATTRIBUTE_NAME_PREFIX
+        self.__decisionMix = ((DecisionType.PERMIT, 1.),)
+        self.__latency = LatencyDistribution()
+        self.__errorRate = 0.
+        self.__errorStatusCode = StatusCode.RESPONDER_URI
+        self.__faultRate = 0.
+        self.__assertionLifetime = timedelta(seconds=60*60*8)
+        self.__rng = random.Random()
+
+    @staticmethod
+    def _toInt(name, value, minValue=0):
+        """Convert an integer setting, allowing for string values from
+        config files"""
+        if isinstance(value, basestring):
+            value = int(value)
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int or string type for %r; got %r' %
+                            (name, type(value)))
+        if value < minValue:
+            raise ValueError('Expecting %r >= %d; got %d' % (name, minValue,
+                                                              value))
+        return value
+
+    @staticmethod
+    def _toRate(name, value):
+        """Convert a rate setting in the range 0 to 1, allowing for string
+        values from config files"""
+        if isinstance(value, basestring):
+            value = float(value)
+        elif not isinstance(value, (float, int, long)):
+            raise TypeError('Expecting float or string type for %r; got %r' %
+                            (name, type(value)))
+        if not 0. <= value <= 1.:
+            raise ValueError('Expecting %r in the range 0 to 1; got %r' %
+                             (name, value))
+        return float(value)
+
+    def _getNAttributes(self):
+        return self.__nAttributes
+
+    def _setNAttributes(self, value):
+        self.__nAttributes = self._toInt('nAttributes', value)
+
+    nAttributes = property(_getNAttributes, _setNAttributes,
+                           doc="Number of attributes returned for attribute "
+                               "queries which don't list any")
+
+    def _getNValues(self):
+        return self.__nValues
+
+    def _setNValues(self, value):
+        self.__nValues = self._toInt('nValues', value)
+
+    nValues = property(_getNValues, _setNValues,
+                       doc="Number of values returned for each attribute")
+
+    def _getValueSize(self):
+        return self.__valueSize
+
+    def _setValueSize(self, value):
+        self.__valueSize = self._toInt('valueSize', value, minValue=1)
+
+    valueSize = property(_getValueSize, _setValueSize,
+                         doc="Number of characters in each attribute value")
+
+    def _getAttributeNamePrefix(self):
+        return self.__attributeNamePrefix
+
+    def _setAttributeNamePrefix(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError('Expecting string type for "attributeNamePrefix"; '
+                            'got %r' % type(value))
+        self.__attributeNamePrefix = value
+
+    attributeNamePrefix = property(_getAttributeNamePrefix,
+                                   _setAttributeNamePrefix,
+                                   doc="Prefix for the names of attributes "
+                                       "returned for queries which don't list "
+                                       "any")
+
+    def _getDecisionMix(self):
+        return self.__decisionMix
+
+    def _setDecisionMix(self, value):
+        '''
+        :type value: basestring / dict
+        :param value: relative weights for each decision keyed by decision
+        name.  Strings are whitespace separated <decision>=<weight> settings
+        e.g. "permit=0.9 deny=0.1"
+        '''
+        if isinstance(value, basestring):
+            try:
+                value = dict([(name, float(weight))
+                              for name, weight in [item.split('=')
+                                                   for item in value.split()]])
+            except ValueError:
+                raise MockQueryInterfaceConfigError('Expecting whitespace '
+                                                    'separated <decision>='
+                                                    '<weight> settings for '
+                                                    '"decisionMix"; got %r' %
+                                                    value)
+        elif not isinstance(value, dict):
+            raise TypeError('Expecting string or dict type for "decisionMix"; '
+                            'got %r' % type(value))
+
+        total = float(sum(value.values()))
+        if total <= 0.:
+            raise MockQueryInterfaceConfigError('Expecting a positive weight '
+                                                'for at least one decision in '
+                                                '"decisionMix"')
+        decisionMix = []
+        for name, weight in sorted(value.items()):
+            decision = MockQueryInterface.DECISIONS.get(name.lower())
+            if decision is None:
+                raise MockQueryInterfaceConfigError('Unknown decision %r in '
+                                                    '"decisionMix": expecting '
+                                                    'one of %r' % (name,
+                                    sorted(MockQueryInterface.DECISIONS.keys())))
+            decisionMix.append((decision, weight / total))
+
+        self.__decisionMix = tuple(decisionMix)
+
+    decisionMix = property(_getDecisionMix, _setDecisionMix,
+                           doc="Decision types and their probabilities for "
+                               "authorisation decision queries")
+
+    def _getLatency(self):
+        return self.__latency
+
+    def _setLatency(self, value):
+        if isinstance(value, basestring):
+            value = LatencyDistribution(value)
+
+        elif not isinstance(value, LatencyDistribution):
+            raise TypeError('Expecting string or %r type for "latency"; got '
+                            '%r' % (LatencyDistribution, type(value)))
+        self.__latency = value
+
+    latency = property(_getLatency, _setLatency,
+                       doc="Distribution of the latency injected into each "
+                           "query - see LatencyDistribution")
+
+    def _getErrorRate(self):
+        return self.__errorRate
+
+    def _setErrorRate(self, value):
+        self.__errorRate = self._toRate('errorRate', value)
+
+    errorRate = property(_getErrorRate, _setErrorRate,
+                         doc="Fraction of queries answered with the "
+                             "errorStatusCode status")
+
+    def _getErrorStatusCode(self):
+        return self.__errorStatusCode
+
+    def _setErrorStatusCode(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError('Expecting string type for "errorStatusCode"; got '
+                            '%r' % type(value))
+        self.__errorStatusCode = value
+
+    errorStatusCode = property(_getErrorStatusCode, _setErrorStatusCode,
+                               doc="SAML status code URI for error responses")
+
+    def _getFaultRate(self):
+        return self.__faultRate
+
+    def _setFaultRate(self, value):
+        self.__faultRate = self._toRate('faultRate', value)
+
+    faultRate = property(_getFaultRate, _setFaultRate,
+                         doc="Fraction of queries for which a "
+                             "MockQueryInterfaceFault is raised")
+
+    def _getAssertionLifetime(self):
+        return self.__assertionLifetime
+
+    def _setAssertionLifetime(self, value):
+        if isinstance(value, timedelta):
+            self.__assertionLifetime = value
+
+        elif isinstance(value, (float, int, long)):
+            self.__assertionLifetime = timedelta(seconds=value)
+
+        elif isinstance(value, basestring):
+            self.__assertionLifetime = timedelta(seconds=float(value))
+        else:
+            raise TypeError('Expecting timedelta, float, int, long or string '
+                            'type for "assertionLifetime"; got %r' %
+                            type(value))
+
+    assertionLifetime = property(_getAssertionLifetime,
+                                 _setAssertionLifetime,
+                                 doc="Validity period of assertions returned")
+
+    def _setSeed(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+        self.__rng.seed(value)
+
+    seed = property(fset=_setSeed,
+                    doc="Seed the random number generator so that decisions, "
+                        "latencies and errors are reproducible")
+
+    def makeValue(self, name, iValue):
+        """Make an attribute value string of valueSize characters
+
+        :type name: basestring
+        :param name: attribute name
+        :type iValue: int
+        :param iValue: index of the value
+        :rtype: basestring
+        :return: attribute value
+        """
+        value = '%s:%d:' % (name, iValue)
+        return (value + 'x' * self.valueSize)[-self.valueSize:]
+
+    def _addAttributeStatement(self, query, assertion):
+        """Add an attribute statement answering an attribute query"""
+        if query.attributes:
+            attributes = [(i.name, i.nameFormat, i.friendlyName)
+                          for i in query.attributes]
+        else:
+            attributes = [(self.attributeNamePrefix + str(i),
+                           XSStringAttributeValue.DEFAULT_FORMAT,
+                           'attr%d' % i)
+                          for i in range(self.nAttributes)]
+
+        attributeStatement = AttributeStatement()
+        for name, nameFormat, friendlyName in attributes:
+            attribute = Attribute()
+            attribute.name = name
+            if nameFormat is not None:
+                attribute.nameFormat = nameFormat
+            if friendlyName is not None:
+                attribute.friendlyName = friendlyName
+
+            for iValue in range(self.nValues):
+                attributeValue = XSStringAttributeValue()
+                attributeValue.value = self.makeValue(name, iValue)
+                attribute.attributeValues.append(attributeValue)
+
+            attributeStatement.attributes.append(attribute)
+
+        assertion.attributeStatements.append(attributeStatement)
+
+    def _chooseDecision(self):
+        """Draw a decision type from the decision mix"""
+        x = self.__rng.random()
+        for decision, probability in self.decisionMix:
+            x -= probability
+            if x < 0.:
+                return decision
+
+        return self.decisionMix[-1][0]
+
+    def _addAuthzDecisionStatement(self, query, assertion):
+        """Add an authorisation decision statement answering an
+        authorisation decision query"""
+        authzDecisionStatement = AuthzDecisionStatement()
+        authzDecisionStatement.decision = self._chooseDecision()
+        authzDecisionStatement.resource = query.resource
+        authzDecisionStatement.actions.extend(query.actions)
+        assertion.authzDecisionStatements.append(authzDecisionStatement)
+
+    def __call__(self, query, response):
+        """Answer a query
+
+        :type query: ndg.saml.saml2.core.SubjectQuery
+        :param query: attribute or authorisation decision query
+        :type response: ndg.saml.saml2.core.Response
+        :param response: response initialised by the SOAP query interface
+        middleware
+        :rtype: ndg.saml.saml2.core.Response
+        :return: response
+        :raise MockQueryInterfaceFault: for a fraction faultRate of queries
+        """
+        latency = self.latency.sample(self.__rng)
+        if latency:
+            time.sleep(latency)
+
+        if self.faultRate and self.__rng.random() < self.faultRate:
+            raise MockQueryInterfaceFault('Fault injected for query %r' %
+                                          query.id)
+
+        if self.errorRate and self.__rng.random() < self.errorRate:
+            response.status.statusCode.value = self.errorStatusCode
+            response.status.statusMessage.value = ('Error injected by mock '
+                                                   'query interface')
+            return response
+
+        assertion = Assertion()
+        assertion.version = SAMLVersion(SAMLVersion.VERSION_20)
+        assertion.id = str(uuid4())
+        assertion.issueInstant = datetime.utcnow()
+
+        if response.issuer is not None and response.issuer.value is not None:
+            assertion.issuer = Issuer()
+            assertion.issuer.value = response.issuer.value
+            assertion.issuer.format = response.issuer.format
+
+        assertion.subject = Subject()
+        assertion.subject.nameID = NameID()
+        assertion.subject.nameID.format = query.subject.nameID.format
+        assertion.subject.nameID.value = query.subject.nameID.value
+
+        assertion.conditions = Conditions()
+        assertion.conditions.notBefore = assertion.issueInstant
+        assertion.conditions.notOnOrAfter = (assertion.issueInstant +
+                                             self.assertionLifetime)
+
+        if isinstance(query, AttributeQuery):
+            self._addAttributeStatement(query, assertion)
+
+        elif isinstance(query, AuthzDecisionQuery):
+            self._addAuthzDecisionStatement(query, assertion)
+        else:
+            response.status.statusCode.value = StatusCode.REQUESTER_URI
+            response.status.statusMessage.value = ('Query type %r is not '
+                                                   'supported' % type(query))
+            return response
+
+        response.assertions.append(assertion)
+        return response
+
+
+class MockQueryInterfaceMiddleware(object):
+    """WSGI filter setting a MockQueryInterface in environ for a downstream
+    SOAPQueryInterfaceMiddleware to call e.g. in a Paste ini file pipeline:
+
+    [filter:MockAttributeAuthorityFilter]
+    paste.filter_app_factory = ndg.saml.saml2.binding.soap.server.wsgi.mockqueryinterface:MockQueryInterfaceMiddleware.filter_app_factory
+    prefix = mock.
+    mock.queryInterfaceKeyName = attributeQueryInterface
+    mock.nValues = 2
+    mock.latency = uniform:0.005,0.02
+
+    :cvar QUERY_INTERFACE_KEYNAME_OPTNAME: option name for the environ key
+    to set the query interface in.  This must match the setting for
+    SOAPQueryInterfaceMiddleware
+    :type QUERY_INTERFACE_KEYNAME_OPTNAME: basestring
+    :cvar QUERY_INTERFACE_OPTNAMES: options set on the MockQueryInterface
+    instance
+    :type QUERY_INTERFACE_OPTNAMES: tuple
+    """
+    QUERY_INTERFACE_KEYNAME_OPTNAME = 'queryInterfaceKeyName'
+    QUERY_INTERFACE_OPTNAMES = (
+        'nAttributes',
+        'nValues',
+        'valueSize',
+        'attributeNamePrefix',
+        'decisionMix',
+        'latency',
+        'errorRate',
+        'errorStatusCode',
+        'faultRate',
+        'assertionLifetime',
+        'seed'
+    )
+
+    def __init__(self, app):
+        ''':type app: callable following WSGI interface
+        :param app: next middleware application in the chain
+        '''
+        self._app = app
+        self.__queryInterfaceKeyName = None
+        self.__queryInterface = MockQueryInterface()
+
+    def initialise(self, global_conf, prefix='', **app_conf):
+        '''
+        :type global_conf: dict
+        :param global_conf: PasteDeploy global configuration dictionary
+        :type prefix: basestring
+        :param prefix: prefix for configuration items
+        :type app_conf: dict
+        :param app_conf: PasteDeploy application specific configuration
+        dictionary
+        '''
+        cls = MockQueryInterfaceMiddleware
+        self.queryInterfaceKeyName = app_conf.get(
+                                prefix + cls.QUERY_INTERFACE_KEYNAME_OPTNAME)
+
+        for name in cls.QUERY_INTERFACE_OPTNAMES:
+            val = app_conf.get(prefix + name)
+            if val is not None:
+                setattr(self.queryInterface, name, val)
+
+    @classmethod
+    def filter_app_factory(cls, app, global_conf, **app_conf):
+        """Set-up using a Paste app factory pattern.
+
+        :type app: callable following WSGI interface
+        :param app: next middleware application in the chain
+        :type global_conf: dict
+        :param global_conf: PasteDeploy global configuration dictionary
+        :type app_conf: dict
+        :param app_conf: PasteDeploy application specific configuration
+        dictionary
+        """
+        app = cls(app)
+        app.initialise(global_conf, **app_conf)
+
+        return app
+
+    def _getQueryInterfaceKeyName(self):
+        return self.__queryInterfaceKeyName
+
+    def _setQueryInterfaceKeyName(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError('Expecting string type for "queryInterfaceKeyName"'
+                            '; got %r' % type(value))
+        self.__queryInterfaceKeyName = value
+
+    queryInterfaceKeyName = property(_getQueryInterfaceKeyName,
+                                     _setQueryInterfaceKeyName,
+                                     doc="environ key name for the query "
+                                         "interface")
+
+    @property
+    def queryInterface(self):
+        """Mock query interface set in environ"""
+        return self.__queryInterface
+
+    def __call__(self, environ, start_response):
+        """Set the query interface in environ and call the next application
+
+        :type environ: dict
+        :param environ: WSGI environment variables dictionary
+        :type start_response: function
+        :param start_response: standard WSGI start response function
+        """
+        environ[self.queryInterfaceKeyName] = self.__queryInterface
+        return self._app(environ, start_response)
+
+
+def serve(cfgFilePath, host='127.0.0.1', port=5000):
+    """Serve a Paste ini file configuration with the standard library wsgiref
+    server
+
+    :type cfgFilePath: basestring
+    :param cfgFilePath: Paste ini file path
+    :type host: basestring
+    :param host: host name or address to listen on
+    :type port: int
+    :param port: port number to listen on
+    """
+    from os import path
+    from wsgiref.simple_server import make_server
+    from paste.deploy import loadapp
+
+    app = loadapp('config:%s' % path.abspath(cfgFilePath))
+    server = make_server(host, port, app)
+    log.info("Serving %r on %s:%d", cfgFilePath, host, port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        raise SystemExit("usage: %s <ini file> [port]" % sys.argv[0])
+
+    logging.basicConfig(level=logging.INFO)
+    serve(sys.argv[1], port=int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
@@ -18,6 +18,19 @@ from datetime import datetime, timedelta
 
 from ndg.soap.server.wsgi.middleware import SOAPMiddleware
 from ndg.soap.etree import SOAPEnvelope
+from ndg.soap.utils.metrics import (RequestTiming, HistogramObserver,
+                                    ThreadLocalHistogramObserver)
+from ndg.soap.utils.tracing import (TraceContext, SpanExporter, SpanObserver,
+                                    TRACEPARENT_ENVIRON_KEYNAME,
+                                    findTraceparentHeaderBlock,
+                                    setCurrentTraceContext)
+from ndg.soap.utils.compression import (ACCEPT_ENCODING_ENVIRON_KEYNAME,
+                                        CONTENT_ENCODING_ENVIRON_KEYNAME,
+                                        CONTENT_ENCODING_HEADER,
+                                        DEFAULT_COMPRESS_LEVEL,
+                                        DEFAULT_COMPRESS_MIN_SIZE,
+                                        CompressionError, normaliseEncoding,
+                                        chooseEncoding, compress, decompress)
 
 from ndg.saml.utils import str2Bool
 from ndg.saml.utils.factory import importModuleObject
@@ -29,18 +42,11 @@ from ndg.saml.saml2.core import (Response, Status, StatusCode, StatusMessage,
                                  Issuer) 
 from ndg.saml.saml2.binding.soap import SOAPBindingInvalidResponse
 
-try:
-    from ndg.saml.saml2.xacml_profile import XACMLAuthzDecisionQuery
-    import ndg.saml.xml.etree_xacml_profile as etree_xacml_profile
-except ImportError, e:
-    from warnings import warn
-    warn('Error importing XACML packages - disabling SAML XACML profile ' + \
-         'support.  (Error is: %s)' % e)
-    class XACMLAuthzDecisionQuery(object):
-        """XACML Authz Decision Query substitute"""
-        DEFAULT_ELEMENT_LOCAL_NAME = 'XACMLAuthzDecisionQuery'
-        
-    
+# The XACML profile modules depend on ndg.xacml and are imported when the
+# first XACML query is received
+XACML_AUTHZ_DECISION_QUERY_LOCAL_NAME = 'XACMLAuthzDecisionQuery'
+
+
 class SOAPQueryInterfaceMiddlewareError(Exception):
     """Base class for WSGI SAML 2.0 SOAP Query Interface Errors"""
 
@@ -65,6 +71,22 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
     :type DEFAULT_QUERY_INTERFACE_KEYNAME: basestring
     :param DEFAULT_QUERY_INTERFACE_KEYNAME: default key name for referencing
     SAML query interface in environ
+    :type METRICS_PATH_OPTNAME: basestring
+    :cvar METRICS_PATH_OPTNAME: app_conf option name for the path at which 
+    request metrics are served in Prometheus text format.  Setting it enables
+    metrics recording
+    :type METRICS_NAMESPACE: basestring
+    :cvar METRICS_NAMESPACE: prefix for Prometheus metric names
+    :type TRACE_EXPORTER_OPTNAME: basestring
+    :cvar TRACE_EXPORTER_OPTNAME: app_conf option name for the span exporter
+    class to instantiate.  Options prefixed with this name and a '.' are 
+    passed as keywords to it.  Setting it enables span export
+    :type TRACE_CONTEXT_KEYNAME: basestring
+    :cvar TRACE_CONTEXT_KEYNAME: environ key for the trace context of the 
+    query when it was sent with one or span export is enabled
+    :type MAX_DECOMPRESSED_REQUEST_SIZE: int
+    :cvar MAX_DECOMPRESSED_REQUEST_SIZE: limit in bytes for the size of 
+    compressed requests once decompressed
     """
     log = logging.getLogger('SOAPQueryInterfaceMiddleware')
     PATH_OPTNAME = "mountPath"
@@ -81,6 +103,19 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
     ISSUER_NAME_OPTNAME = 'issuerName'
     ISSUER_FORMAT_OPTNAME = 'issuerFormat'
     CLOCK_SKEW_TOLERANCE_OPTNAME = 'clockSkewTolerance'
+    METRICS_PATH_OPTNAME = 'metricsPath'
+    COMPRESS_RESPONSES_OPTNAME = 'compressResponses'
+    COMPRESS_LEVEL_OPTNAME = 'compressLevel'
+    COMPRESS_MIN_SIZE_OPTNAME = 'compressMinSize'
+    
+    MAX_DECOMPRESSED_REQUEST_SIZE = 8*1024*1024
+    
+    METRICS_NAMESPACE = 'ndg_saml_query_interface'
+    METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+    
+    TRACE_EXPORTER_OPTNAME = 'traceExporter'
+    TRACE_CONTEXT_KEYNAME = ('ndg.saml.saml2.binding.soap.server.wsgi.'
+                             'queryinterface.traceContext')
     
     CONFIG_FILE_OPTNAMES = (
         PATH_OPTNAME,
@@ -94,7 +129,11 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
         SAML_VERSION_OPTNAME,
         ISSUER_NAME_OPTNAME,
         ISSUER_FORMAT_OPTNAME,
-        CLOCK_SKEW_TOLERANCE_OPTNAME
+        CLOCK_SKEW_TOLERANCE_OPTNAME,
+        METRICS_PATH_OPTNAME,
+        COMPRESS_RESPONSES_OPTNAME,
+        COMPRESS_LEVEL_OPTNAME,
+        COMPRESS_MIN_SIZE_OPTNAME
     )
     
     def __init__(self, app):
@@ -119,6 +158,12 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
         self.__verifyTimeConditions = True
         self.__verifySAMLVersion = True
         self.__samlVersion = SAMLVersion.VERSION_20
+        self.__metricsPath = None
+        self.__metrics = None
+        self.__spanObserver = None
+        self.__compressResponses = False
+        self.__compressLevel = DEFAULT_COMPRESS_LEVEL
+        self.__compressMinSize = DEFAULT_COMPRESS_MIN_SIZE
         
         # Proxy object for SAML Response Issuer attributes.  By generating a 
         # proxy the Response objects inherent attribute validation can be 
@@ -143,6 +188,20 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
             if val is not None:
                 setattr(self, name, val)
 
+        if self.metricsPath is not None and self.metrics is None:
+            self.metrics = ThreadLocalHistogramObserver()
+            
+        cls = SOAPQueryInterfaceMiddleware
+        traceExporterName = app_conf.get(prefix + cls.TRACE_EXPORTER_OPTNAME)
+        if traceExporterName is not None:
+            traceExporterPrefix = prefix + cls.TRACE_EXPORTER_OPTNAME + '.'
+            traceExporterKw = dict([(name[len(traceExporterPrefix):], val)
+                                    for name, val in app_conf.items()
+                                    if name.startswith(traceExporterPrefix)])
+            
+            traceExporterClass = importModuleObject(traceExporterName)
+            self.traceExporter = traceExporterClass(**traceExporterKw)
+            
         if self.serialise is None:
             raise AttributeError('No "serialise" method set to serialise the '
                                  'SAML response from this middleware.')
@@ -346,6 +405,166 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
                              'include server domain name or '
                              'environ[\'SCRIPT_NAME\'] setting')
     
+    def _getMetricsPath(self):
+        return self.__metricsPath
+    
+    def _setMetricsPath(self, value):
+        if not isinstance(value, (basestring, type(None))):
+            raise TypeError('Expecting string or None type for "metricsPath" '
+                            'attribute; got %r' % value)
+            
+        self.__metricsPath = value or None
+            
+    metricsPath = property(fget=_getMetricsPath,
+                           fset=_setMetricsPath,
+                           doc='URL path equivalent to environ[\'PATH_INFO\'] '
+                               'at which to serve request metrics in '
+                               'Prometheus text format.  Set to None to '
+                               'disable')
+    
+    def _getMetrics(self):
+        return self.__metrics
+    
+    def _setMetrics(self, value):
+        if not isinstance(value, (HistogramObserver, type(None))):
+            raise TypeError('Expecting %r or None type for "metrics" '
+                            'attribute; got %r' % (HistogramObserver, value))
+            
+        self.__metrics = value
+            
+    metrics = property(fget=_getMetrics,
+                       fset=_setMetrics,
+                       doc='Aggregates phase timings, sizes and status codes '
+                           'for the requests processed.  Set to None to '
+                           'disable recording.  An instance may be shared '
+                           'between middleware mounted at different paths')
+    
+    def _getTraceExporter(self):
+        if self.__spanObserver is None:
+            return None
+        
+        return self.__spanObserver.exporter
+    
+    def _setTraceExporter(self, value):
+        if value is None:
+            self.__spanObserver = None
+            
+        elif isinstance(value, SpanExporter):
+            self.__spanObserver = SpanObserver(value, kind='server')
+        else:
+            raise TypeError('Expecting %r or None type for "traceExporter" '
+                            'attribute; got %r' % (SpanExporter, value))
+            
+    traceExporter = property(fget=_getTraceExporter,
+                             fset=_setTraceExporter,
+                             doc='Exports spans for each query and its '
+                                 'processing phases.  Queries are traced as '
+                                 'children of the trace context sent by the '
+                                 'client or else start a new trace.  Set to '
+                                 'None to disable')
+    
+    def _getCompressResponses(self):
+        return self.__compressResponses
+
+    def _setCompressResponses(self, value):
+        if isinstance(value, bool):
+            self.__compressResponses = value
+            
+        elif isinstance(value, basestring):
+            self.__compressResponses = str2Bool(value)
+        else:
+            raise TypeError('Expecting bool or string type for '
+                            '"compressResponses"; got %r instead' % 
+                            type(value))
+
+    compressResponses = property(_getCompressResponses, 
+                                 _setCompressResponses, 
+                                 doc='Set to True to compress responses of '
+                                     'compressMinSize bytes or more for '
+                                     'clients sending an Accept-Encoding '
+                                     'header for gzip or deflate.  Compressed '
+                                     'requests are accepted whatever the '
+                                     'setting')
+    
+    def _getCompressLevel(self):
+        return self.__compressLevel
+
+    def _setCompressLevel(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int or string type for '
+                            '"compressLevel"; got %r instead' % type(value))
+            
+        if not 1 <= value <= 9:
+            raise ValueError('Expecting a value from 1 to 9 for '
+                             '"compressLevel"; got %r' % value)
+        self.__compressLevel = value
+
+    compressLevel = property(_getCompressLevel, 
+                             _setCompressLevel, 
+                             doc='Compression level for responses from 1 '
+                                 '(fastest) to 9 (smallest)')
+    
+    def _getCompressMinSize(self):
+        return self.__compressMinSize
+
+    def _setCompressMinSize(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+            
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int or string type for '
+                            '"compressMinSize"; got %r instead' % type(value))
+        self.__compressMinSize = value
+
+    compressMinSize = property(_getCompressMinSize, 
+                               _setCompressMinSize, 
+                               doc='Responses smaller than this number of '
+                                   'bytes are sent uncompressed')
+    
+    def _getTimingObservers(self):
+        """Get the request timing observers for the metrics and tracing 
+        settings
+        
+        :rtype: list
+        :return: observers
+        """
+        return [observer 
+                for observer in (self.__metrics, self.__spanObserver)
+                if observer is not None]
+    
+    def _extractTraceContext(self, environ, soapRequest):
+        """Get the trace context for a query and set it in environ.  It 
+        continues the trace from a traceparent HTTP header or SOAP header 
+        block sent by the client.  A new trace is started if none was sent 
+        and span export is enabled
+        
+        :type environ: dict
+        :param environ: WSGI environment variables dictionary
+        :type soapRequest: ndg.soap.etree.SOAPEnvelope
+        :param soapRequest: parsed SOAP request
+        :rtype: ndg.soap.utils.tracing.TraceContext / NoneType
+        :return: trace context for the query or None
+        """
+        parentContext = TraceContext.parse(
+                                    environ.get(TRACEPARENT_ENVIRON_KEYNAME))
+        if parentContext is None:
+            parentContext = findTraceparentHeaderBlock(soapRequest)
+            
+        if parentContext is not None:
+            traceContext = parentContext.newChild()
+            
+        elif self.__spanObserver is not None:
+            traceContext = TraceContext()
+        else:
+            return None
+        
+        environ[SOAPQueryInterfaceMiddleware.TRACE_CONTEXT_KEYNAME
+                ] = traceContext
+        return traceContext
+    
     @classmethod
     def filter_app_factory(cls, app, global_conf, **app_conf):
         """Set-up using a Paste app factory pattern.  Set this method to avoid
@@ -390,6 +609,10 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
         :type start_response: function
         :param start_response: standard WSGI start response function
         """
+        if (self.metricsPath is not None and 
+            environ['PATH_INFO'] == self.metricsPath and
+            environ.get('REQUEST_METHOD') in ('GET', 'HEAD')):
+            return self._serveMetrics(environ, start_response)
     
         # Ignore non-matching path
         if environ['PATH_INFO'] not in (self.mountPath, self.mountPath + '/'):
@@ -399,6 +622,48 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
         if environ.get('REQUEST_METHOD') != 'POST':
             return self._app(environ, start_response)
         
+        observers = self._getTimingObservers()
+        if not observers:
+            return self._processQuery(environ, start_response, None)
+        
+        timing = RequestTiming(self.mountPath)
+        try:
+            return self._processQuery(environ, start_response, timing)
+        except Exception, e:
+            timing.error = type(e).__name__
+            raise
+        finally:
+            timing.notify(observers)
+            
+    def _serveMetrics(self, environ, start_response):
+        """Return the request metrics in Prometheus text format
+        
+        :type environ: dict
+        :param environ: WSGI environment variables dictionary
+        :type start_response: function
+        :param start_response: standard WSGI start response function
+        """
+        response = self.metrics.toPrometheus(
+                    namespace=SOAPQueryInterfaceMiddleware.METRICS_NAMESPACE)
+        start_response("200 OK",
+                       [('Content-length', str(len(response))),
+                        ('Content-type', 
+                         SOAPQueryInterfaceMiddleware.METRICS_CONTENT_TYPE)])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        
+        return [response]
+        
+    def _processQuery(self, environ, start_response, timing):
+        """Process a SOAP SAML query recording phase timings in timing if set
+        
+        :type environ: dict
+        :param environ: WSGI environment variables dictionary
+        :type start_response: function
+        :param start_response: standard WSGI start response function
+        :type timing: ndg.soap.utils.metrics.RequestTiming / NoneType
+        :param timing: request timing record
+        """
         soapRequestStream = environ.get('wsgi.input')
         if soapRequestStream is None:
             raise SOAPQueryInterfaceMiddlewareError('No "wsgi.input" in '
@@ -417,11 +682,32 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
                                                     contentLength)
             
         soapRequestTxt = soapRequestStream.read(contentLength)
+        if timing is not None:
+            timing.mark('bodyRead')
+            timing.requestSize = len(soapRequestTxt)
+        
+        try:
+            requestEncoding = normaliseEncoding(
+                                environ.get(CONTENT_ENCODING_ENVIRON_KEYNAME))
+            if requestEncoding is not None:
+                soapRequestTxt = decompress(soapRequestTxt, requestEncoding,
+                        maxSize=self.__class__.MAX_DECOMPRESSED_REQUEST_SIZE)
+                if timing is not None:
+                    timing.mark('decompress')
+                    
+        except CompressionError, e:
+            raise SOAPQueryInterfaceMiddlewareError('Error reading request '
+                                                    'body: %s' % e)
         
         # Parse into a SOAP envelope object
         soapRequest = SOAPEnvelope()
         soapRequest.parse(StringIO(soapRequestTxt))
         
+        traceContext = self._extractTraceContext(environ, soapRequest)
+        if timing is not None:
+            timing.mark('envelopeParse')
+            timing.traceContext = traceContext
+        
         log.debug("SOAPQueryInterfaceMiddleware.__call__: received SAML "
                   "SOAP Query: %s", soapRequestTxt)
        
@@ -433,12 +719,23 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
         
         try:
             queryType = QName.getLocalPart(queryElem.tag)
-            if queryType == XACMLAuthzDecisionQuery.DEFAULT_ELEMENT_LOCAL_NAME:
+            if queryType == XACML_AUTHZ_DECISION_QUERY_LOCAL_NAME:
+                try:
+                    import ndg.saml.xml.etree_xacml_profile as \
+                                                        etree_xacml_profile
+                except ImportError, e:
+                    raise SOAPQueryInterfaceMiddlewareConfigError(
+                        'Error importing XACML packages - SAML XACML profile '
+                        'support is disabled.  (Error is: %s)' % e)
+                    
                 # Set up additional ElementTree parsing for XACML profile.
                 etree_xacml_profile.setElementTreeMap()
                 samlQuery = self.deserialiseXacmlProfile(queryElem)
             else:
                 samlQuery = self.deserialise(queryElem)
+                
+            if timing is not None:
+                timing.mark('deserialise')
 
         except UnknownAttrProfile, e:
             log.exception("%r raised parsing incoming query: %s" % 
@@ -463,13 +760,26 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
             self._validateQuery(samlQuery, samlResponse)
             
             samlResponse.inResponseTo = samlQuery.id
+            if timing is not None:
+                timing.mark('validation')
             
-            # Call query interface        
-            queryInterface(samlQuery, samlResponse)
+            # Call query interface.  Any queries it makes to other services 
+            # with trace context propagation enabled are sent as part of the
+            # same trace
+            previousTraceContext = setCurrentTraceContext(traceContext)
+            try:
+                queryInterface(samlQuery, samlResponse)
+            finally:
+                setCurrentTraceContext(previousTraceContext)
+                
+            if timing is not None:
+                timing.mark('queryInterface')
         
         # Convert to ElementTree representation to enable attachment to SOAP
         # response body
         samlResponseElem = self.serialise(samlResponse)
+        if timing is not None:
+            timing.mark('serialise')
         
         # Create SOAP response and attach the SAML Response payload
         soapResponse = SOAPEnvelope()
@@ -477,13 +787,34 @@ class SOAPQueryInterfaceMiddleware(SOAPMiddleware):
         soapResponse.body.elem.append(samlResponseElem)
         
         response = soapResponse.serialize()
+        if timing is not None:
+            timing.mark('envelopeSerialise')
         
         log.debug("SOAPQueryInterfaceMiddleware.__call__: sending response "
                   "...\n\n%s",
                   response)
-        start_response("200 OK",
-                       [('Content-length', str(len(response))),
-                        ('Content-type', 'text/xml')])
+        
+        headers = [('Content-type', 'text/xml')]
+        if self.compressResponses:
+            headers.append(('Vary', 'Accept-Encoding'))
+            responseEncoding = chooseEncoding(
+                                environ.get(ACCEPT_ENCODING_ENVIRON_KEYNAME))
+            
+            if (responseEncoding is not None and 
+                len(response) >= self.compressMinSize):
+                response = compress(response, responseEncoding, 
+                                    level=self.compressLevel)
+                headers.append((CONTENT_ENCODING_HEADER, responseEncoding))
+                if timing is not None:
+                    timing.mark('compress')
+                
+        headers.insert(0, ('Content-length', str(len(response))))
+        if timing is not None:
+            timing.responseSize = len(response)
+            timing.httpStatus = 200
+            timing.samlStatus = samlResponse.status.statusCode.value
+            
+        start_response("200 OK", headers)
         return [response]
     
     def _validateQuery(self, query, response):
@@ -28,13 +28,17 @@ __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __license__ = "http://www.apache.org/licenses/LICENSE-2.0"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = "$Id$"
+import sys
 from datetime import datetime
+from array import array
+from collections import MutableSequence
 from urlparse import urlsplit, urlunsplit
 import urllib
 
 from ndg.saml.common import SAMLObject, SAMLVersion
 from ndg.saml.common.xml import SAMLConstants, QName
-from ndg.saml.utils import TypedList
+from ndg.saml.utils import (TypedList, ObservedList, Observers, LRUCache, 
+                            reduceSlots)
 
 
 class Attribute(SAMLObject):
@@ -60,6 +64,8 @@ class Attribute(SAMLObject):
     :type URI_REFERENCE: string
     :cvar BASIC:  Basic attribute format ID.
     :type BASIC: string
+    :cvar TRANSIENT_ATTRIBUTES: names of attributes holding derived data
+    :type TRANSIENT_ATTRIBUTES: tuple
     
     :ivar __name: attribute name
     :type __name: NoneType / basestring
@@ -69,6 +75,8 @@ class Attribute(SAMLObject):
     :type __friendlyName: NoneType / basestring
     :ivar __attributeValues: list of values
     :type __attributeValues: list / tuple
+    :ivar __observers: objects to notify of changes to this attribute
+    :type __observers: NoneType / ndg.saml.utils.Observers
     '''
     
     # Local name of the Attribute element. 
@@ -105,11 +113,14 @@ class Attribute(SAMLObject):
     # Basic attribute format ID. 
     BASIC = "urn:oasis:names:tc:SAML:2.0:attrname-format:basic"
 
+    TRANSIENT_ATTRIBUTES = SAMLObject.TRANSIENT_ATTRIBUTES + ('observers',)
+    
     __slots__ = (
         '__name',
         '__nameFormat',
         '__friendlyName',
-        '__attributeValues'
+        '__attributeValues',
+        '__observers'
     )
     
     def __init__(self, **kw):
@@ -123,7 +134,8 @@ class Attribute(SAMLObject):
         self.__name = None
         self.__nameFormat = None
         self.__friendlyName = None
-        self.__attributeValues = []
+        self.__attributeValues = ObservedList()
+        self.__observers = None
 
     def __getstate__(self):
         '''Enable pickling
@@ -161,6 +173,7 @@ class Attribute(SAMLObject):
                             type(name))
         
         self.__name = name
+        self._notifyObservers()
         
     name = property(fget=_get_name,
                     fset=_set_name,
@@ -184,6 +197,7 @@ class Attribute(SAMLObject):
                             % type(nameFormat))
             
         self.__nameFormat = nameFormat
+        self._notifyObservers()
         
     nameFormat = property(fget=_get_nameFormat,
                           fset=_set_nameFormat,
@@ -207,6 +221,7 @@ class Attribute(SAMLObject):
                             "%r" % type(friendlyName))
             
         self.__friendlyName = friendlyName
+        self._notifyObservers()
         
     friendlyName = property(fget=_get_friendlyName,
                             fset=_set_friendlyName,
@@ -230,11 +245,48 @@ class Attribute(SAMLObject):
                             "got %r" % type(attributeValues))
             
         self.__attributeValues = attributeValues
+        self._notifyObservers()
         
     attributeValues = property(fget=_get_attributeValues,
                                fset=_set_attributeValues,
                                doc="the list of attribute values for this "
                                "attribute.")
+    
+    def addObserver(self, observer):
+        """Add an object to be notified when the name, name format, friendly
+        name or values of this attribute are changed - see 
+        ndg.saml.utils.Observers.  The observer is also added to the list of
+        values and to each value which supports observers.  Frozen attributes
+        can't be changed and so are not observed
+        
+        :param observer: object with a changed method
+        :type observer: object
+        """
+        if self._frozen:
+            return
+        
+        # The slot is unset for objects unpickled from the previous attribute
+        # dictionary scheme
+        observers = getattr(self, '_Attribute__observers', None)
+        if observers is None:
+            observers = Observers()
+            self.__observers = observers
+            
+        observers.add(observer)
+        
+        attributeValues = self.__attributeValues
+        if hasattr(attributeValues, 'addObserver'):
+            attributeValues.addObserver(observer)
+            
+        for attributeValue in attributeValues:
+            if hasattr(attributeValue, 'addObserver'):
+                attributeValue.addObserver(observer)
+    
+    def _notifyObservers(self):
+        """Notify observers that this attribute has changed"""
+        observers = getattr(self, '_Attribute__observers', None)
+        if observers is not None:
+            observers.notify()
 
 
 class Statement(SAMLObject):
@@ -313,9 +365,18 @@ class AttributeStatement(Statement):
         """
         super(AttributeStatement, self).__init__(**kw)
         
-        self.__attributes = TypedList(Attribute)
+        self.__attributes = self._createAttributeList()
         self.__encryptedAttributes = TypedList(Attribute)
 
+    def _createAttributeList(self):
+        """Create the list to hold the attributes of this statement.  
+        Derived classes may override to use a different list type
+        
+        :return: new empty attribute list
+        :rtype: ndg.saml.utils.TypedList
+        """
+        return TypedList(Attribute)
+
     def __getstate__(self):
         '''Enable pickling
         
@@ -351,6 +412,759 @@ class AttributeStatement(Statement):
     encryptedAttributes = property(fget=_get_encryptedAttributes)
 
 
+class ColumnarAttributeList(object):
+    '''Column oriented store for the attributes of an AttributeStatement.  
+    Attribute names, name formats and friendly names are held in parallel 
+    lists and xs:string values in a single shared pool indexed by an array of 
+    value offsets.  This keeps the memory cost of statements carrying many
+    thousands of attributes proportional to the raw strings.
+    
+    The list behaves like the ndg.saml.utils.TypedList of 
+    ndg.saml.saml2.core.Attribute used by AttributeStatement and implements
+    the full mutable sequence interface.  Attribute 
+    objects are only created when an item is accessed and are then cached so 
+    that changes made to them are preserved.  Call compact to fold cached
+    attributes which are no longer referenced elsewhere back into the 
+    columns and release them.
+    
+    Attributes with values other than XSStringAttributeValue can't be 
+    represented in the columns and are held as objects.
+    
+    :cvar OFFSET_TYPECODE: array type code for value offsets
+    :type OFFSET_TYPECODE: string
+    :cvar TRANSIENT_ATTRIBUTES: names of attributes holding derived data
+    :type TRANSIENT_ATTRIBUTES: tuple
+    
+    :ivar __names: attribute names
+    :type __names: list
+    :ivar __nameFormats: attribute name formats
+    :type __nameFormats: list
+    :ivar __friendlyNames: attribute friendly names
+    :type __friendlyNames: list
+    :ivar __valueOffsets: offsets into the value pool.  Values for attribute i 
+    are __valuePool[__valueOffsets[i]:__valueOffsets[i+1]]
+    :type __valueOffsets: array.array
+    :ivar __valuePool: xs:string attribute values for all attributes
+    :type __valuePool: list
+    :ivar __materialised: Attribute objects created from or added to this list
+    keyed by index.  Where present, these take precedence over the columns
+    :type __materialised: dict
+    :ivar __strings: lookup to share a single copy of repeated name format 
+    and friendly name strings
+    :type __strings: dict
+    :ivar __observers: objects to notify of changes to the list or the 
+    attributes it caches
+    :type __observers: NoneType / ndg.saml.utils.Observers
+    :ivar __frozen: True if the list has been made read only
+    :type __frozen: bool
+    '''
+    OFFSET_TYPECODE = 'l'
+    TRANSIENT_ATTRIBUTES = ('observers',)
+    
+    __slots__ = (
+        '__names',
+        '__nameFormats',
+        '__friendlyNames',
+        '__valueOffsets',
+        '__valuePool',
+        '__materialised',
+        '__strings',
+        '__observers',
+        '__frozen'
+    )
+    
+    def __init__(self, attributes=None):
+        '''
+        :param attributes: initial attributes to add to the list
+        :type attributes: iterable
+        '''
+        self.__names = []
+        self.__nameFormats = []
+        self.__friendlyNames = []
+        self.__valueOffsets = array(ColumnarAttributeList.OFFSET_TYPECODE, 
+                                    [0])
+        self.__valuePool = []
+        self.__materialised = {}
+        self.__strings = {}
+        self.__observers = None
+        self.__frozen = False
+        
+        if attributes is not None:
+            self.extend(attributes)
+
+    @property
+    def elementType(self):
+        """Type of the items held, for compatibility with 
+        ndg.saml.utils.TypedList
+        
+        :return: item type
+        :rtype: type
+        """
+        return Attribute
+    
+    def __reduce__(self):
+        '''Enable pickling.  The state is taken from a copy of this list 
+        with cached Attribute objects folded into the columns.  Attributes of
+        other types are pickled as objects.  This list is not changed.
+        
+        :return: callable to restore the object and its arguments
+        :rtype: tuple
+        '''
+        entries = self._getEntries()
+        for index, entry in enumerate(entries):
+            if (type(entry) is Attribute and 
+                self._getColumnValues(entry) is not None):
+                entries[index] = self.getColumns(index)
+                
+        # As with SAML objects, lists are not restored in a frozen state
+        attributes = self.__class__()
+        attributes._setEntries(entries, notify=False)
+        return reduceSlots(attributes)
+    
+    def _shareString(self, value):
+        """Return a shared copy of a repeated string value
+        
+        :param value: string to share
+        :type value: NoneType / basestring
+        :return: shared string
+        :rtype: NoneType / basestring
+        """
+        if value is None:
+            return None
+        return self.__strings.setdefault(value, value)
+    
+    @staticmethod
+    def _getColumnValues(attribute):
+        """Get the string values of an attribute if it can be held in columns
+        
+        :param attribute: attribute to check
+        :type attribute: ndg.saml.saml2.core.Attribute
+        :return: attribute values as strings or None if any of the values is 
+        not a plain xs:string
+        :rtype: NoneType / list
+        """
+        values = []
+        for attributeValue in attribute.attributeValues:
+            if type(attributeValue) is not XSStringAttributeValue:
+                return None
+            values.append(attributeValue.value)
+            
+        return values
+    
+    def addColumns(self, name, nameFormat=None, friendlyName=None, values=()):
+        """Add an attribute directly from its string components without 
+        creating an Attribute object.  This is the efficient route for 
+        parsers.
+        
+        :param name: attribute name
+        :type name: basestring
+        :param nameFormat: attribute name format
+        :type nameFormat: NoneType / basestring
+        :param friendlyName: attribute friendly name
+        :type friendlyName: NoneType / basestring
+        :param values: xs:string attribute values
+        :type values: iterable
+        :raise TypeError: invalid input type
+        """
+        self._checkNotFrozen()
+        self._addColumns(name, nameFormat, friendlyName, values)
+        self._notifyObservers()
+        
+    def _addColumns(self, name, nameFormat, friendlyName, values):
+        """Add an attribute from its string components without notifying
+        observers - see addColumns
+        """
+        for value in (name, nameFormat, friendlyName):
+            if value is not None and not isinstance(value, basestring):
+                raise TypeError("Expecting basestring type for attribute "
+                                "name, format and friendly name; got %r" % 
+                                type(value))
+            
+        self.__names.append(name)
+        self.__nameFormats.append(self._shareString(nameFormat))
+        self.__friendlyNames.append(self._shareString(friendlyName))
+        self.__valuePool.extend(values)
+        self.__valueOffsets.append(len(self.__valuePool))
+        
+    def getColumns(self, index):
+        """Get the string components of an attribute without creating an
+        Attribute object
+        
+        :param index: index of attribute
+        :type index: int
+        :return: tuple of name, name format, friendly name and values.  Values
+        are returned as strings unless the attribute is not a plain xs:string
+        type in which case the attribute value objects are returned
+        :rtype: tuple
+        """
+        index = self._checkIndex(index)
+        attribute = self.__materialised.get(index)
+        if attribute is not None:
+            values = self._getColumnValues(attribute)
+            if values is None:
+                values = list(attribute.attributeValues)
+                
+            return (attribute.name, attribute.nameFormat, 
+                    attribute.friendlyName, values)
+            
+        return (self.__names[index],
+                self.__nameFormats[index],
+                self.__friendlyNames[index],
+                self.__valuePool[self.__valueOffsets[index]:
+                                 self.__valueOffsets[index + 1]])
+    
+    def iterColumns(self):
+        """Iterate over the string components of each attribute without 
+        creating Attribute objects - see getColumns
+        
+        :return: iterator over (name, nameFormat, friendlyName, values) tuples
+        :rtype: generator
+        """
+        for index in xrange(len(self.__names)):
+            yield self.getColumns(index)
+    
+    def iterAttributes(self):
+        """Iterate over the attributes without caching the Attribute objects
+        created.  Use for read only access e.g. serialisation.  Changes made
+        to the objects returned may not be preserved.
+        
+        :return: iterator over attributes
+        :rtype: generator
+        """
+        for index in xrange(len(self.__names)):
+            yield self._materialise(index, cache=False)
+    
+    # References to a cached attribute held while _isFoldable checks it: the
+    # cache dictionary, the caller's argument, the parameter and the 
+    # argument to sys.getrefcount
+    _N_CACHE_REFS = 4
+    
+    def _isFoldable(self, attribute):
+        """Test whether a cached attribute can be folded back into the 
+        columns.  It must be a plain Attribute with xs:string values which is
+        not referenced other than by this list, so that no changes made to it
+        through another reference can be lost
+        
+        :param attribute: cached attribute
+        :type attribute: ndg.saml.saml2.core.Attribute
+        :return: True if the attribute can be folded
+        :rtype: bool
+        """
+        if type(attribute) is not Attribute:
+            return False
+        
+        if not hasattr(sys, 'getrefcount'):
+            # Other Python implementations - references can't be checked
+            return False
+        
+        if sys.getrefcount(attribute) > self._N_CACHE_REFS:
+            return False
+        
+        return self._getColumnValues(attribute) is not None
+    
+    def compact(self):
+        """Fold cached Attribute objects back into the columns and release 
+        them.  Attributes which are referenced elsewhere, are of a derived
+        type or have values other than XSStringAttributeValue are kept as 
+        objects
+        """
+        if not self.__materialised or self.__frozen:
+            return
+        
+        materialised = self.__materialised
+        foldable = [index for index in materialised 
+                    if self._isFoldable(materialised[index])]
+        if not foldable:
+            return
+        
+        entries = self._getEntries()
+        for index in foldable:
+            entries[index] = self.getColumns(index)
+            
+        # The content is unchanged so observers are not notified
+        self._setEntries(entries, notify=False)
+                
+    def _clear(self):
+        """Remove all items"""
+        self.__names = []
+        self.__nameFormats = []
+        self.__friendlyNames = []
+        self.__valueOffsets = array(ColumnarAttributeList.OFFSET_TYPECODE, 
+                                    [0])
+        self.__valuePool = []
+        self.__materialised = {}
+        self.__strings = {}
+        
+    @property
+    def frozen(self):
+        """True if this list has been made read only with freeze
+        
+        :return: frozen state
+        :rtype: bool
+        """
+        return self.__frozen
+    
+    def freeze(self):
+        """Make this list and the attributes it contains read only - see
+        ndg.saml.common.SAMLObject.freeze
+        
+        :return: this list
+        :rtype: ndg.saml.saml2.core.ColumnarAttributeList
+        """
+        if not self.__frozen:
+            self.compact()
+            for attribute in self.__materialised.values():
+                attribute.freeze()
+            self.__frozen = True
+            
+        return self
+    
+    def addObserver(self, observer):
+        """Add an object to be notified when the contents of this list or the
+        attributes it caches are changed - see ndg.saml.utils.Observers.  
+        Attributes cached subsequently are observed as well.  Frozen lists 
+        are not observed
+        
+        :param observer: object with a changed method
+        :type observer: object
+        """
+        if self.__frozen:
+            return
+        
+        if self.__observers is None:
+            self.__observers = Observers()
+            
+        self.__observers.add(observer)
+        for attribute in self.__materialised.values():
+            attribute.addObserver(observer)
+            
+    def _notifyObservers(self):
+        """Notify observers that the contents of this list have changed"""
+        if self.__observers is not None:
+            self.__observers.notify()
+            
+    def _checkNotFrozen(self):
+        """
+        :raise AttributeError: list is frozen
+        """
+        if self.__frozen:
+            raise AttributeError("List is frozen and can't be modified")
+        
+    def _checkIndex(self, index):
+        """Check and convert negative indices
+        
+        :param index: index to check
+        :type index: int
+        :return: non-negative index
+        :rtype: int
+        :raise IndexError: index out of range
+        """
+        nItems = len(self.__names)
+        if index < 0:
+            index += nItems
+            
+        if index < 0 or index >= nItems:
+            raise IndexError("list index out of range")
+        
+        return index
+        
+    def _materialise(self, index, cache=True):
+        """Create an Attribute object for the given index
+        
+        :param index: index of attribute
+        :type index: int
+        :param cache: set to False to create a transient attribute object
+        which is not kept by this list
+        :type cache: bool
+        :return: attribute
+        :rtype: ndg.saml.saml2.core.Attribute
+        """
+        attribute = self.__materialised.get(index)
+        if attribute is not None:
+            return attribute
+        
+        name, nameFormat, friendlyName, values = self.getColumns(index)
+        attribute = Attribute()
+        if name is not None:
+            attribute.name = name
+        if nameFormat is not None:
+            attribute.nameFormat = nameFormat
+        if friendlyName is not None:
+            attribute.friendlyName = friendlyName
+            
+        for value in values:
+            attributeValue = XSStringAttributeValue()
+            if value is not None:
+                attributeValue.value = value
+            attribute.attributeValues.append(attributeValue)
+        
+        if cache:
+            if self.__frozen:
+                attribute.freeze()
+            elif self.__observers is not None:
+                for observer in self.__observers:
+                    attribute.addObserver(observer)
+                    
+            self.__materialised[index] = attribute
+            
+        return attribute
+    
+    def _getEntries(self):
+        """Get the items as a plain list without creating Attribute objects.
+        Each entry is either the cached Attribute object or the tuple of 
+        columns for the item
+        
+        :return: list of entries
+        :rtype: list
+        """
+        entries = []
+        for index in xrange(len(self.__names)):
+            attribute = self.__materialised.get(index)
+            if attribute is None:
+                entries.append(self.getColumns(index))
+            else:
+                entries.append(attribute)
+                
+        return entries
+    
+    def _setEntries(self, entries, notify=True):
+        """Replace the contents with the given entries - see _getEntries
+        
+        :param entries: cached Attribute objects or column tuples
+        :type entries: list
+        :param notify: set to False if observers need not be notified
+        :type notify: bool
+        """
+        self._clear()
+        for entry in entries:
+            if isinstance(entry, Attribute):
+                self._append(entry)
+            else:
+                self._addColumns(*entry)
+                
+        if notify:
+            self._notifyObservers()
+    
+    @staticmethod
+    def _checkAttributes(attributes):
+        """Check the type of the items in the input iterable
+        
+        :param attributes: iterable of attributes
+        :type attributes: iterable
+        :return: attributes as a list
+        :rtype: list
+        :raise TypeError: invalid input type
+        """
+        attributes = list(attributes)
+        for attribute in attributes:
+            if not isinstance(attribute, Attribute):
+                raise TypeError("List items must be of type %s" % Attribute)
+            
+        return attributes
+    
+    def _append(self, attribute):
+        """Append an attribute without type checking or notifying observers.  
+        The attribute object is kept so that subsequent changes to it are 
+        preserved and the observers of this list are added to it
+        
+        :param attribute: attribute to append
+        :type attribute: ndg.saml.saml2.core.Attribute
+        """
+        if self.__observers is not None:
+            for observer in self.__observers:
+                attribute.addObserver(observer)
+                
+        self.__names.append(None)
+        self.__nameFormats.append(None)
+        self.__friendlyNames.append(None)
+        self.__valueOffsets.append(len(self.__valuePool))
+        self.__materialised[len(self.__names) - 1] = attribute
+        
+    def append(self, attribute):
+        """Append an attribute
+        
+        :param attribute: attribute to append
+        :type attribute: ndg.saml.saml2.core.Attribute
+        :raise TypeError: invalid input type
+        """
+        self._checkNotFrozen()
+        if not isinstance(attribute, Attribute):
+            raise TypeError("List items must be of type %s" % Attribute)
+        
+        self._append(attribute)
+        self._notifyObservers()
+        
+    def extend(self, attributes):
+        """Extend with the input iterable of attributes
+        
+        :param attributes: iterable to extend list with
+        :type attributes: iterable
+        :raise TypeError: invalid input type
+        """
+        self._checkNotFrozen()
+        for attribute in self._checkAttributes(attributes):
+            self._append(attribute)
+            
+        self._notifyObservers()
+        
+    def __iadd__(self, attributes):
+        """Extend with the input iterable of attributes with += operator
+        
+        :param attributes: iterable to extend list with
+        :type attributes: iterable
+        :return: this list
+        :rtype: ndg.saml.saml2.core.ColumnarAttributeList
+        """
+        self.extend(attributes)
+        return self
+    
+    def __len__(self):
+        return len(self.__names)
+    
+    def __iter__(self):
+        for index in xrange(len(self.__names)):
+            yield self._materialise(index)
+            
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._materialise(i) 
+                    for i in xrange(*index.indices(len(self.__names)))]
+            
+        return self._materialise(self._checkIndex(index))
+    
+    def __reversed__(self):
+        for index in xrange(len(self.__names) - 1, -1, -1):
+            yield self._materialise(index)
+            
+    def __setitem__(self, index, attribute):
+        self._checkNotFrozen()
+        if isinstance(index, slice):
+            entries = self._getEntries()
+            entries[index] = self._checkAttributes(attribute)
+            self._setEntries(entries)
+            return
+            
+        if not isinstance(attribute, Attribute):
+            raise TypeError("List items must be of type %s" % Attribute)
+        
+        index = self._checkIndex(index)
+        if self.__observers is not None:
+            for observer in self.__observers:
+                attribute.addObserver(observer)
+                
+        self.__materialised[index] = attribute
+        self._notifyObservers()
+        
+    def __delitem__(self, index):
+        self._checkNotFrozen()
+        if not isinstance(index, slice):
+            index = self._checkIndex(index)
+            
+        entries = self._getEntries()
+        del entries[index]
+        self._setEntries(entries)
+                
+    def __contains__(self, attribute):
+        return any(i is attribute or i == attribute for i in self)
+    
+    def __eq__(self, other):
+        """Compare item by item with another ColumnarAttributeList or list in 
+        the same way as list equality.  Attributes are compared without 
+        caching them
+        
+        :param other: object to compare with
+        :type other: any
+        :return: True if the items are equal
+        :rtype: bool
+        """
+        if isinstance(other, ColumnarAttributeList):
+            otherAttributes = other.iterAttributes()
+        elif isinstance(other, list):
+            otherAttributes = iter(other)
+        else:
+            return NotImplemented
+        
+        if len(self) != len(other):
+            return False
+        
+        for attribute, otherAttribute in zip(self.iterAttributes(), 
+                                             otherAttributes):
+            if attribute is not otherAttribute and attribute != otherAttribute:
+                return False
+            
+        return True
+    
+    def __ne__(self, other):
+        isEqual = self.__eq__(other)
+        if isEqual is NotImplemented:
+            return isEqual
+        
+        return not isEqual
+    
+    # Mutable, like list
+    __hash__ = None
+    
+    def insert(self, index, attribute):
+        """Insert an attribute before index
+        
+        :param index: index to insert at
+        :type index: int
+        :param attribute: attribute to insert
+        :type attribute: ndg.saml.saml2.core.Attribute
+        :raise TypeError: invalid input type
+        """
+        self._checkNotFrozen()
+        if not isinstance(attribute, Attribute):
+            raise TypeError("List items must be of type %s" % Attribute)
+        
+        if index >= len(self.__names):
+            self._append(attribute)
+            self._notifyObservers()
+        else:
+            entries = self._getEntries()
+            entries.insert(index, attribute)
+            self._setEntries(entries)
+            
+    def pop(self, index=-1):
+        """Remove and return the attribute at index (default last)
+        
+        :param index: index of attribute
+        :type index: int
+        :return: attribute removed
+        :rtype: ndg.saml.saml2.core.Attribute
+        :raise IndexError: list is empty or index is out of range
+        """
+        self._checkNotFrozen()
+        if not self.__names:
+            raise IndexError("pop from empty list")
+        
+        attribute = self[index]
+        del self[index]
+        return attribute
+    
+    def index(self, attribute, start=0, stop=None):
+        """Return the index of the first occurrence of attribute
+        
+        :param attribute: attribute to search for
+        :type attribute: ndg.saml.saml2.core.Attribute
+        :param start: index to start searching from
+        :type start: int
+        :param stop: index to stop searching at
+        :type stop: NoneType / int
+        :return: index of attribute
+        :rtype: int
+        :raise ValueError: attribute is not present
+        """
+        for i in xrange(*slice(start, stop).indices(len(self.__names))):
+            item = self._materialise(i, cache=False)
+            if item is attribute or item == attribute:
+                return i
+            
+        raise ValueError("%r is not in list" % attribute)
+    
+    def count(self, attribute):
+        """Return the number of occurrences of attribute
+        
+        :param attribute: attribute to count
+        :type attribute: ndg.saml.saml2.core.Attribute
+        :return: number of occurrences
+        :rtype: int
+        """
+        return sum(1 for item in self.iterAttributes()
+                   if item is attribute or item == attribute)
+    
+    def remove(self, attribute):
+        """Remove the first occurrence of attribute
+        
+        :param attribute: attribute to remove
+        :type attribute: ndg.saml.saml2.core.Attribute
+        :raise ValueError: attribute is not present
+        """
+        self._checkNotFrozen()
+        del self[self.index(attribute)]
+        
+    def reverse(self):
+        """Reverse the list in place"""
+        self._checkNotFrozen()
+        entries = self._getEntries()
+        entries.reverse()
+        self._setEntries(entries)
+        
+    def sort(self, cmp=None, key=None, reverse=False):
+        """Sort the list in place.  Arguments are as for list.sort.  All the
+        attributes are cached as objects so that they can be compared; call
+        compact afterwards to release them
+        
+        :param cmp: comparison function
+        :type cmp: NoneType / callable
+        :param key: function to extract a comparison key from each attribute
+        :type key: NoneType / callable
+        :param reverse: set to True to sort in descending order
+        :type reverse: bool
+        """
+        self._checkNotFrozen()
+        attributes = list(self)
+        attributes.sort(cmp=cmp, key=key, reverse=reverse)
+        self._setEntries(attributes)
+        
+    def __repr__(self):
+        return "<%s: %d attributes>" % (self.__class__.__name__, len(self))
+    
+MutableSequence.register(ColumnarAttributeList)
+    
+    
+class ColumnarAttributeStatement(AttributeStatement):
+    '''SAML 2.0 Core AttributeStatement with attributes held in a 
+    ColumnarAttributeList.  Use for statements carrying very large numbers of 
+    attributes.  The public interface is the same as AttributeStatement
+    '''
+    __slots__ = ()
+    
+    # This class differs from AttributeStatement in the way attributes are 
+    # stored only.  Compare and digest as AttributeStatement - see 
+    # ndg.saml.common._getCanonicalClass
+    _storageVariant = True
+    
+    def _createAttributeList(self):
+        """Create a column oriented store for the attributes
+        
+        :return: new empty attribute list
+        :rtype: ndg.saml.saml2.core.ColumnarAttributeList
+        """
+        return ColumnarAttributeList()
+    
+    @classmethod
+    def fromAttributeStatement(cls, attributeStatement):
+        """Create a columnar copy of an existing attribute statement
+        
+        :param attributeStatement: statement to copy
+        :type attributeStatement: ndg.saml.saml2.core.AttributeStatement
+        :return: new statement
+        :rtype: ndg.saml.saml2.core.ColumnarAttributeStatement
+        """
+        if not isinstance(attributeStatement, AttributeStatement):
+            raise TypeError("Expecting %r type; got %r" % (AttributeStatement, 
+                                                    type(attributeStatement)))
+        statement = cls()
+        
+        # Copy plain attributes into the columns so that the new statement 
+        # doesn't share Attribute objects with the original
+        attributes = statement.attributes
+        for attribute in attributeStatement.attributes:
+            values = attributes._getColumnValues(attribute)
+            if type(attribute) is Attribute and values is not None:
+                attributes.addColumns(attribute.name, 
+                                      nameFormat=attribute.nameFormat,
+                                      friendlyName=attribute.friendlyName,
+                                      values=values)
+            else:
+                attributes.append(attribute)
+                
+        statement.encryptedAttributes.extend(
+                                        attributeStatement.encryptedAttributes)
+        return statement
+
+
 class AuthnStatement(Statement):
     '''SAML 2.0 Core AuthnStatement.  Currently implemented in abstract form
     only
@@ -572,6 +1386,18 @@ class DecisionType(object):
         for attrName, val in attrDict.items():
             setattr(self, attrName, val)
             
+    def __reduce__(self):
+        '''Compact pickling.  Permit, Deny and Indeterminate subclasses
+        take no arguments
+        
+        :return: class and its arguments
+        :rtype: tuple
+        '''
+        if self.__class__ is DecisionType:
+            return DecisionType, (self.__value,)
+        else:
+            return self.__class__, ()
+            
     def _setValue(self, value):
         '''Set decision type
         :param value: decision value
@@ -606,6 +1432,15 @@ class DecisionType(object):
         '''
         return self.__value
 
+    def canonicalValue(self):
+        '''Value to use in place of this object in SAML object digests - see 
+        ndg.saml.common.SAMLObject.digest
+        
+        :return: decision value
+        :rtype: string
+        '''
+        return self.__value
+
     def __eq__(self, decision):
         """Test for equality against an input decision type
         
@@ -685,6 +1520,111 @@ DecisionType.DENY = DenyDecisionType()
 DecisionType.INDETERMINATE = IndeterminateDecisionType()
 
 
+class ResourceURINormaliser(object):
+    """Normalise HTTP(S) resource URIs: the path is quoted, the host name 
+    converted to lower case and redundant port numbers (80 for HTTP and 443 for
+    HTTPS) removed.  Results are held in a bounded LRU cache keyed by the URI
+    and the safe characters used for quoting so that repeated assignment of 
+    the same resource - the common case for a PEP protecting a fixed set of 
+    URIs - avoids re-parsing.  A single instance is shared by 
+    AuthzDecisionStatement and AuthzDecisionQuery - see their 
+    RESOURCE_NORMALISER class variable
+    
+    :cvar DEFAULT_CACHE_SIZE: default maximum number of cached URIs
+    :type DEFAULT_CACHE_SIZE: int
+    :ivar __cache: cache of normalised URIs
+    :type __cache: ndg.saml.utils.LRUCache
+    """
+    DEFAULT_CACHE_SIZE = 1024
+    
+    __slots__ = ('__cache',)
+    
+    def __init__(self, cacheSize=DEFAULT_CACHE_SIZE):
+        """:param cacheSize: maximum number of normalised URIs to cache
+        :type cacheSize: int
+        """
+        self.__cache = LRUCache(maxSize=cacheSize)
+        
+    def _getCacheSize(self):
+        return self.__cache.maxSize
+    
+    def _setCacheSize(self, value):
+        self.__cache.maxSize = value
+        
+    cacheSize = property(_getCacheSize, _setCacheSize,
+                         doc="Maximum number of normalised URIs to cache")
+    
+    @staticmethod
+    def normalise(value, safeNormalizationChars):
+        """Normalise a URI without reference to the cache
+        
+        :param value: HTTP or HTTPS URI
+        :type value: basestring
+        :param safeNormalizationChars: characters which should not be quoted
+        in the path component
+        :type safeNormalizationChars: basestring
+        :return: normalised URI
+        :rtype: basestring
+        """
+        splitResult = urlsplit(value)
+        uriComponents = list(splitResult)
+        
+        # hostname attribute is lowercase
+        uriComponents[1] = splitResult.hostname
+        
+        if splitResult.port is not None:
+            isHttpWithStdPort = (splitResult.port == 80 and 
+                                 splitResult.scheme == 'http')
+            
+            isHttpsWithStdPort = (splitResult.port == 443 and
+                                  splitResult.scheme == 'https')
+            
+            if not isHttpWithStdPort and not isHttpsWithStdPort:
+                uriComponents[1] += ":%d" % splitResult.port
+        
+        uriComponents[2] = urllib.quote(splitResult.path, 
+                                        safeNormalizationChars)
+        
+        return urlunsplit(uriComponents)
+    
+    def __call__(self, value, safeNormalizationChars):
+        """Normalise a URI returning the cached result if available
+        
+        :param value: HTTP or HTTPS URI
+        :type value: basestring
+        :param safeNormalizationChars: characters which should not be quoted
+        in the path component
+        :type safeNormalizationChars: basestring
+        :return: normalised URI
+        :rtype: basestring
+        """
+        # Type is included in the key so that equal str and unicode inputs 
+        # each get a result of their own type
+        key = (value, type(value), safeNormalizationChars)
+        normalisedValue = self.__cache.get(key)
+        if normalisedValue is None:
+            normalisedValue = self.normalise(value, safeNormalizationChars)
+            self.__cache.set(key, normalisedValue)
+            
+        return normalisedValue
+    
+    def cacheInfo(self):
+        """Get cache statistics
+        
+        :return: hits, misses, evictions, current size and maximum size
+        :rtype: dict
+        """
+        return self.__cache.cacheInfo()
+    
+    def clearCache(self):
+        """Empty the cache and reset its statistics"""
+        self.__cache.clear()
+
+
+# Normaliser shared between AuthzDecisionStatement and AuthzDecisionQuery
+resourceURINormaliser = ResourceURINormaliser()
+
+
 class AuthzDecisionStatement(Statement):
     '''SAML 2.0 Core AuthzDecisionStatement.  Currently implemented in abstract
     form only
@@ -699,6 +1639,8 @@ class AuthzDecisionStatement(Statement):
     :type TYPE_NAME: ndg.saml.common.xml.QName
     :cvar RESOURCE_ATTRIB_NAME: Resource attribute name
     :type RESOURCE_ATTRIB_NAME: string
+    :cvar RESOURCE_NORMALISER: memoising normaliser for resource URIs
+    :type RESOURCE_NORMALISER: ndg.saml.saml2.core.ResourceURINormaliser
     :cvar DECISION_ATTRIB_NAME: Decision attribute name
     :type DECISION_ATTRIB_NAME: string
     
@@ -737,6 +1679,9 @@ class AuthzDecisionStatement(Statement):
 
     # Resource attribute name
     RESOURCE_ATTRIB_NAME = "Resource"
+    
+    # Memoising normaliser for resource URIs shared with other classes 
+    RESOURCE_NORMALISER = resourceURINormaliser
 
     # Decision attribute name
     DECISION_ATTRIB_NAME = "Decision"
@@ -877,26 +1822,9 @@ class AuthzDecisionStatement(Statement):
             value.startswith('http://') or value.startswith('https://')):
             # Normalise the path, set the host name to lower case and remove 
             # port redundant numbers 80 and 443
-            splitResult = urlsplit(value)
-            uriComponents = list(splitResult)
-            
-            # hostname attribute is lowercase
-            uriComponents[1] = splitResult.hostname
-            
-            if splitResult.port is not None:
-                isHttpWithStdPort = (splitResult.port == 80 and 
-                                     splitResult.scheme == 'http')
-                
-                isHttpsWithStdPort = (splitResult.port == 443 and
-                                      splitResult.scheme == 'https')
-                
-                if not isHttpWithStdPort and not isHttpsWithStdPort:
-                    uriComponents[1] += ":%d" % splitResult.port
-            
-            uriComponents[2] = urllib.quote(splitResult.path, 
-                                            self.safeNormalizationChars)
-            
-            self.__resource = urlunsplit(uriComponents)
+            self.__resource = self.RESOURCE_NORMALISER(
+                                                value,
+                                                self.safeNormalizationChars)
         else:
             self.__resource = value
     
@@ -1763,6 +2691,9 @@ class Assertion(SAMLObject):
     # ID attribute name.
     ID_ATTRIB_NAME = "ID"
 
+    # Attributes excluded from digests when ignoring volatile content
+    VOLATILE_ATTRIBUTES = ('id', 'issueInstant')
+    
     __slots__ = (
         '__version',
         '__issueInstant',
@@ -2037,8 +2968,13 @@ class XSStringAttributeValue(AttributeValue):
     :cvar TYPE_NAME: QName of the XSI type
     :type TYPE_NAME: ndg.saml.common.xml.QName
     
+    :cvar TRANSIENT_ATTRIBUTES: names of attributes holding derived data
+    :type TRANSIENT_ATTRIBUTES: tuple
+    
     :ivar __value: value of this attribute
     :type __value: basestring
+    :ivar __observers: objects to notify of changes to the value
+    :type __observers: NoneType / ndg.saml.utils.Observers
     """
     
     # Local name of the XSI type
@@ -2050,8 +2986,10 @@ class XSStringAttributeValue(AttributeValue):
                       SAMLConstants.XSD_PREFIX)
     
     DEFAULT_FORMAT = "%s#%s" % (SAMLConstants.XSD_NS, TYPE_LOCAL_NAME)
+    
+    TRANSIENT_ATTRIBUTES = AttributeValue.TRANSIENT_ATTRIBUTES + ('observers',)
   
-    __slots__ = ('__value',)
+    __slots__ = ('__value', '__observers')
     
     def __init__(self, **kw):
         """
@@ -2060,6 +2998,7 @@ class XSStringAttributeValue(AttributeValue):
         """
         super(XSStringAttributeValue, self).__init__(**kw)
         self.__value = None
+        self.__observers = None
 
     def __getstate__(self):
         '''Enable pickling
@@ -2096,8 +3035,31 @@ class XSStringAttributeValue(AttributeValue):
                             value.__class__)
             
         self.__value = value
+        
+        observers = getattr(self, '_XSStringAttributeValue__observers', None)
+        if observers is not None:
+            observers.notify()
 
     value = property(fget=_getValue, fset=_setValue, doc="string value")  
+    
+    def addObserver(self, observer):
+        """Add an object to be notified when the value is changed - see
+        ndg.saml.utils.Observers.  Frozen values are not observed
+        
+        :param observer: object with a changed method
+        :type observer: object
+        """
+        if self._frozen:
+            return
+        
+        # The slot is unset for objects unpickled from the previous attribute
+        # dictionary scheme
+        observers = getattr(self, '_XSStringAttributeValue__observers', None)
+        if observers is None:
+            observers = Observers()
+            self.__observers = observers
+            
+        observers.add(observer)
 
 
 class StatusDetail(SAMLObject):
@@ -3030,6 +3992,9 @@ class RequestAbstractType(SAMLObject):
     # Inapplicable consent URI.
     INAPPLICABLE_CONSENT = "urn:oasis:names:tc:SAML:2.0:consent:inapplicable"
      
+    # Attributes excluded from digests when ignoring volatile content
+    VOLATILE_ATTRIBUTES = ('id', 'issueInstant')
+    
     __slots__ = (
         '__version',
         '__id',
@@ -3762,6 +4727,8 @@ class AuthzDecisionQuery(SubjectQuery):
     :type TYPE_NAME: string
     :cvar RESOURCE_ATTRIB_NAME: Resource attribute name.
     :type RESOURCE_ATTRIB_NAME: string
+    :cvar RESOURCE_NORMALISER: memoising normaliser for resource URIs
+    :type RESOURCE_NORMALISER: ndg.saml.saml2.core.ResourceURINormaliser
    
     :ivar resource: Resource attribute value.
     :type resource: string
@@ -3795,6 +4762,9 @@ class AuthzDecisionQuery(SubjectQuery):
     # Resource attribute name.
     RESOURCE_ATTRIB_NAME = "Resource"
     
+    # Memoising normaliser for resource URIs shared with other classes 
+    RESOURCE_NORMALISER = resourceURINormaliser
+    
     __slots__ = (
        '__resource',
        '__evidence',
@@ -3925,26 +4895,9 @@ class AuthzDecisionQuery(SubjectQuery):
             value.startswith('http://') or value.startswith('https://')):
             # Normalise the path, set the host name to lower case and remove 
             # port redundant numbers 80 and 443
-            splitResult = urlsplit(value)
-            uriComponents = list(splitResult)
-            
-            # hostname attribute is lowercase
-            uriComponents[1] = splitResult.hostname
-            
-            if splitResult.port is not None:
-                isHttpWithStdPort = (splitResult.port == 80 and 
-                                     splitResult.scheme == 'http')
-                
-                isHttpsWithStdPort = (splitResult.port == 443 and
-                                      splitResult.scheme == 'https')
-                
-                if not isHttpWithStdPort and not isHttpsWithStdPort:
-                    uriComponents[1] += ":%d" % splitResult.port
-            
-            uriComponents[2] = urllib.quote(splitResult.path, 
-                                            self.safeNormalizationChars)
-            
-            self.__resource = urlunsplit(uriComponents)
+            self.__resource = self.RESOURCE_NORMALISER(
+                                                value,
+                                                self.safeNormalizationChars)
         else:
             self.__resource = value
     
@@ -4110,6 +5063,9 @@ class StatusResponseType(SAMLObject):
     # Inapplicable consent URI
     INAPPLICABLE_CONSENT = "urn:oasis:names:tc:SAML:2.0:consent:inapplicable"
 
+    # Attributes excluded from digests when ignoring volatile content
+    VOLATILE_ATTRIBUTES = ('id', 'inResponseTo', 'issueInstant')
+    
     __slots__ = (    
         '__version',
         '__id',
@@ -4376,6 +5332,187 @@ class StatusResponseType(SAMLObject):
                           doc="Response extensions")    
 
 
+class AttributeIndex(object):
+    '''Index of the attribute values in a Response's attribute statements by
+    (name, NameFormat), name and friendlyName.  The index is built on first 
+    lookup.  For a response which is not frozen, the index registers itself 
+    as an observer of the lists of assertions, attribute statements, 
+    attributes and attribute values and of the attributes and values 
+    themselves.  Any change to them discards the index so that it is rebuilt
+    on the next lookup - see ndg.saml.utils.Observers.  Lookups are otherwise
+    dictionary lookups and do not walk the response.  If the response holds
+    a plain list e.g. one assigned to Attribute.attributeValues, changes to it
+    can't be observed and the index is rebuilt for every lookup instead.  Call
+    clear after modifying an attribute value type which doesn't support
+    observers.  The index is not pickled.
+    
+    :ivar __state: flag indicating whether all changes to the indexed content
+    are observed, followed by the index dictionaries or None if not yet built
+    :type __state: NoneType / tuple
+    '''
+    __slots__ = ('__state', '__weakref__')
+    
+    def __init__(self):
+        self.__state = None
+        
+    def __reduce__(self):
+        '''Pickle as an empty index
+        
+        :return: class and its arguments
+        :rtype: tuple
+        '''
+        return self.__class__, ()
+        
+    def clear(self):
+        '''Discard the index so that it is rebuilt on the next lookup'''
+        self.__state = None
+        
+    def changed(self):
+        '''Observer callback for changes to the indexed content'''
+        self.__state = None
+        
+    @staticmethod
+    def _isObservable(container):
+        '''Test whether changes to a list or attribute can be observed
+        
+        :param container: list or attribute
+        :type container: object
+        :return: False if the container can be modified but doesn't support
+        observers
+        :rtype: bool
+        '''
+        return hasattr(container, 'addObserver') or isinstance(container, 
+                                                               tuple)
+        
+    def _observe(self, container):
+        '''Register this index as an observer of a list or attribute
+        
+        :param container: list or attribute
+        :type container: object
+        :return: False if the container can be modified but doesn't support
+        observers
+        :rtype: bool
+        '''
+        if hasattr(container, 'addObserver'):
+            container.addObserver(self)
+            return True
+        
+        return isinstance(container, tuple)
+        
+    def _build(self, response):
+        '''Build the index dictionaries.  Each maps a key to a tuple of 
+        attribute values and a set of their plain values for membership tests.
+        Unless the response is frozen, this index is registered as an 
+        observer of the content indexed
+
+        :param response: response to index
+        :type response: ndg.saml.saml2.core.Response
+        :return: flag set to True if all changes to the indexed content are 
+        observed, followed by dictionaries keyed by (name, NameFormat), name 
+        and friendlyName
+        :rtype: tuple
+        '''
+        if response.frozen:
+            observe = lambda container: True
+        else:
+            observe = self._observe
+            
+        byNameAndFormat = {}
+        byName = {}
+        byFriendlyName = {}
+        
+        # Lists are observed after they have been iterated over so that lazy
+        # lists are loaded first
+        observed = True
+        for assertion in response.assertions:
+            for attributeStatement in assertion.attributeStatements:
+                attributes = attributeStatement.attributes
+                columnar = isinstance(attributes, ColumnarAttributeList)
+                if columnar:
+                    attributeIter = attributes.iterAttributes()
+                else:
+                    attributeIter = attributes
+                    
+                for attribute in attributeIter:
+                    # Observing a columnar list also observes the attributes
+                    # it caches.  Others are created from the columns as 
+                    # needed.  Observing an attribute also observes its list
+                    # of values
+                    if not columnar:
+                        observe(attribute)
+                        if not self._isObservable(attribute.attributeValues):
+                            observed = False
+                        
+                    keys = [(byNameAndFormat, 
+                             (attribute.name, attribute.nameFormat)),
+                            (byName, attribute.name)]
+                    if attribute.friendlyName is not None:
+                        keys.append((byFriendlyName, attribute.friendlyName))
+                        
+                    for index, key in keys:
+                        index.setdefault(key, []).extend(
+                                                    attribute.attributeValues)
+                        
+                observed = observe(attributes) and observed
+                
+            observed = observe(assertion.attributeStatements) and observed
+        
+        observed = observe(response.assertions) and observed
+        
+        for index in byNameAndFormat, byName, byFriendlyName:
+            for key, attributeValues in index.items():
+                plainValues = set()
+                for attributeValue in attributeValues:
+                    try:
+                        plainValues.add(attributeValue.value)
+                    except (AttributeError, TypeError):
+                        # No value property or unhashable value
+                        pass
+                    
+                index[key] = (tuple(attributeValues), frozenset(plainValues))
+            
+        return observed, byNameAndFormat, byName, byFriendlyName
+    
+    def lookup(self, response, name=None, nameFormat=None, friendlyName=None):
+        '''Look up attribute values by name and NameFormat, name alone or 
+        friendlyName
+        
+        :param response: response to which this index belongs
+        :type response: ndg.saml.saml2.core.Response
+        :param name: attribute name
+        :type name: NoneType / basestring
+        :param nameFormat: attribute NameFormat.  If omitted, attributes with 
+        the given name are matched whatever their NameFormat
+        :type nameFormat: NoneType / basestring
+        :param friendlyName: attribute friendlyName.  Used if name is not set
+        :type friendlyName: NoneType / basestring
+        :return: attribute values and the set of their plain values
+        :rtype: tuple
+        :raise TypeError: neither name nor friendlyName is set
+        '''
+        state = self.__state
+        if state is None or not state[0]:
+            state = self._build(response)
+            self.__state = state
+            
+        if name is not None:
+            if nameFormat is not None:
+                entry = state[1].get((name, nameFormat))
+            else:
+                entry = state[2].get(name)
+                
+        elif friendlyName is not None:
+            entry = state[3].get(friendlyName)
+        else:
+            raise TypeError('Expecting "name" or "friendlyName" keyword for '
+                            'attribute lookup')
+            
+        if entry is None:
+            return (), frozenset()
+        
+        return entry
+
+    
 class Response(StatusResponseType):
     '''SAML2 Core Response
     
@@ -4388,8 +5525,13 @@ class Response(StatusResponseType):
     :cvar TYPE_NAME: QName of the XSI type.
     :type TYPE_NAME: ndg.saml.common.xml.QName
     
+    :cvar TRANSIENT_ATTRIBUTES: names of attributes holding derived data
+    :type TRANSIENT_ATTRIBUTES: tuple
+    
     :ivar __indexedChildren: response elements
     :type __indexedChildren: list
+    :ivar __attributeIndex: index of attribute values in the assertions
+    :type __attributeIndex: ndg.saml.saml2.core.AttributeIndex
     '''
     
     # Element local name.
@@ -4408,7 +5550,10 @@ class Response(StatusResponseType):
                       TYPE_LOCAL_NAME, 
                       SAMLConstants.SAML20P_PREFIX)
     
-    __slots__ = ('__indexedChildren',)
+    TRANSIENT_ATTRIBUTES = StatusResponseType.TRANSIENT_ATTRIBUTES + (
+                                                            'attributeIndex',)
+    
+    __slots__ = ('__indexedChildren', '__attributeIndex')
     
     def __init__(self, **kw):
         '''
@@ -4417,8 +5562,10 @@ class Response(StatusResponseType):
         ''' 
         super(Response, self).__init__(**kw)
         
-        # Assertion child elements
-        self.__indexedChildren = []
+        # Assertion child elements.  Changes are observed by the attribute 
+        # index
+        self.__indexedChildren = ObservedList()
+        self.__attributeIndex = AttributeIndex()
 
     def __getstate__(self):
         '''Enable pickling
@@ -4446,3 +5593,76 @@ class Response(StatusResponseType):
         :rtype: list
         """
         return self.__indexedChildren
+    
+    def _getAttributeIndex(self):
+        '''Get the attribute index creating it if necessary e.g. for an 
+        object unpickled from the previous attribute dictionary scheme
+        
+        :return: attribute index
+        :rtype: ndg.saml.saml2.core.AttributeIndex
+        '''
+        attributeIndex = getattr(self, '_Response__attributeIndex', None)
+        if attributeIndex is None:
+            # Bypass __setattr__ so that the index can be added to frozen
+            # objects
+            attributeIndex = AttributeIndex()
+            object.__setattr__(self, '_Response__attributeIndex', 
+                               attributeIndex)
+            
+        return attributeIndex
+    
+    def getAttributeValues(self, name=None, nameFormat=None, 
+                           friendlyName=None):
+        '''Get the values of the attributes with the given name, name and 
+        NameFormat or friendlyName from all the attribute statements in this
+        response.  Lookups use an index built on first use - see 
+        AttributeIndex
+        
+        :param name: attribute name
+        :type name: NoneType / basestring
+        :param nameFormat: attribute NameFormat.  If omitted, attributes with 
+        the given name are matched whatever their NameFormat
+        :type nameFormat: NoneType / basestring
+        :param friendlyName: attribute friendlyName.  Used if name is not set
+        :type friendlyName: NoneType / basestring
+        :return: attribute values - empty if no attribute matches
+        :rtype: tuple
+        '''
+        return self._getAttributeIndex().lookup(self, 
+                                                name=name, 
+                                                nameFormat=nameFormat,
+                                                friendlyName=friendlyName)[0]
+    
+    def hasAttributeValue(self, value, name=None, nameFormat=None, 
+                          friendlyName=None):
+        '''Test whether an attribute identified as for getAttributeValues
+        has the given value
+        
+        :param value: plain value e.g. a string for an XSStringAttributeValue
+        or an AttributeValue object
+        :type value: basestring / ndg.saml.saml2.core.AttributeValue
+        :param name: attribute name
+        :type name: NoneType / basestring
+        :param nameFormat: attribute NameFormat
+        :type nameFormat: NoneType / basestring
+        :param friendlyName: attribute friendlyName
+        :type friendlyName: NoneType / basestring
+        :return: True if the value is present
+        :rtype: bool
+        '''
+        attributeValues, plainValues = self._getAttributeIndex().lookup(self, 
+                                                    name=name, 
+                                                    nameFormat=nameFormat,
+                                                    friendlyName=friendlyName)
+        if isinstance(value, AttributeValue):
+            return value in attributeValues
+        
+        return value in plainValues
+    
+    def invalidateAttributeIndex(self):
+        '''Discard the attribute index.  Changes to the assertions, 
+        statements and attributes of this response are detected automatically
+        and so this is only needed after modifying an attribute value type 
+        which doesn't support observers - see AttributeIndex
+        '''
+        self._getAttributeIndex().clear()
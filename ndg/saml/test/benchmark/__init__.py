@@ -0,0 +1,191 @@
+"""NDG SAML benchmark package - timings for performance sensitive parts of 
+the SAML implementation.  Modules are run as scripts e.g.
+
+python -m ndg.saml.test.benchmark.bench_pickle
+python -m ndg.saml.test.benchmark.bench_etree
+python -m ndg.saml.test.benchmark.bench_wsgi
+python -m ndg.saml.test.benchmark.bench_import
+python -m ndg.saml.test.benchmark.bench_query
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+from datetime import datetime, timedelta
+from uuid import uuid4
+import gc
+import timeit
+try:
+    # Python 3 or the pytracemalloc backport
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from ndg.saml.saml2.core import (SAMLVersion, Attribute, AttributeStatement, 
+                                 Assertion, Response, Issuer, Subject, NameID, 
+                                 StatusCode, StatusMessage, Status, Conditions, 
+                                 XSStringAttributeValue)
+from ndg.saml.utils import percentile, summariseLatencies
+from ndg.saml.test.support import (makeAttributeQuery, makeAuthzDecisionQuery,
+                                   ISSUER_DN, NAMEID_FORMAT, NAMEID_VALUE,
+                                   ATTRIBUTE_NAME_FORMAT, RESOURCE_URI)
+
+
+def makeAttributeResponse(nAssertions=1, nAttributes=10, nValues=1):
+    """Make an attribute query response of the given size
+    
+    @type nAssertions: int
+    @param nAssertions: number of assertions in the response
+    @type nAttributes: int
+    @param nAttributes: number of attributes in each assertion
+    @type nValues: int
+    @param nValues: number of values for each attribute
+    @rtype: ndg.saml.saml2.core.Response
+    @return: SAML response
+    """
+    response = Response()
+    response.issueInstant = datetime.utcnow()
+    response.id = str(uuid4())
+    response.inResponseTo = str(uuid4())
+    
+    response.issuer = Issuer()
+    response.issuer.format = Issuer.X509_SUBJECT
+    response.issuer.value = ISSUER_DN
+    
+    response.status = Status()
+    response.status.statusCode = StatusCode()
+    response.status.statusCode.value = StatusCode.SUCCESS_URI
+    response.status.statusMessage = StatusMessage()
+    response.status.statusMessage.value = "Response created successfully"
+    
+    for iAssertion in range(nAssertions):
+        assertion = Assertion()
+        assertion.version = SAMLVersion(SAMLVersion.VERSION_20)
+        assertion.id = str(uuid4())
+        assertion.issueInstant = response.issueInstant
+        
+        assertion.issuer = Issuer()
+        assertion.issuer.format = Issuer.X509_SUBJECT
+        assertion.issuer.value = ISSUER_DN
+        
+        assertion.subject = Subject()
+        assertion.subject.nameID = NameID()
+        assertion.subject.nameID.format = NAMEID_FORMAT
+        assertion.subject.nameID.value = NAMEID_VALUE
+        
+        assertion.conditions = Conditions()
+        assertion.conditions.notBefore = response.issueInstant
+        assertion.conditions.notOnOrAfter = (response.issueInstant + 
+                                             timedelta(seconds=60*60*8))
+        
+        attributeStatement = AttributeStatement()
+        for iAttribute in range(nAttributes):
+            attribute = Attribute()
+            attribute.name = "urn:badc:security:authz:1.0:attr:%d" % iAttribute
+            attribute.nameFormat = ATTRIBUTE_NAME_FORMAT
+            attribute.friendlyName = "attr%d" % iAttribute
+            
+            for iValue in range(nValues):
+                attributeValue = XSStringAttributeValue()
+                attributeValue.value = "urn:badc:group:%d:role:%d" % (
+                                                            iAttribute, iValue)
+                attribute.attributeValues.append(attributeValue)
+                
+            attributeStatement.attributes.append(attribute)
+            
+        assertion.attributeStatements.append(attributeStatement)
+        response.assertions.append(assertion)
+        
+    return response
+
+
+def timeCall(func, number=None, repeat=3, minTime=0.2):
+    """Time a callable taking the best of a number of repeats
+    
+    @type func: callable
+    @param func: callable taking no arguments
+    @type number: int / NoneType
+    @param number: number of calls per repeat.  If None, this is calibrated
+    so that each repeat takes at least minTime seconds
+    @type repeat: int
+    @param repeat: number of repeats
+    @type minTime: float
+    @param minTime: minimum duration of a repeat in seconds when calibrating
+    @rtype: tuple
+    @return: best time per call in seconds and number of calls per repeat
+    """
+    timer = timeit.default_timer
+    if number is None:
+        number = 1
+        while True:
+            t0 = timer()
+            for i in xrange(number):
+                func()
+            if timer() - t0 >= minTime:
+                break
+            number *= 2
+            
+    best = None
+    for i in range(repeat):
+        t0 = timer()
+        for j in xrange(number):
+            func()
+        elapsed = (timer() - t0) / number
+        if best is None or elapsed < best:
+            best = elapsed
+            
+    return best, number
+
+
+def measureMemory(func):
+    """Measure the memory allocated by a single call of a callable.  
+    Allocations are counted net of those freed before the call returns and so
+    are those held by the result and any caches.  If tracemalloc is 
+    available, they are counted as traced memory blocks and the peak traced 
+    memory in bytes is reported.  Otherwise, they are counted as objects 
+    tracked by the garbage collector and the peak memory is not measured.  
+    It is reported as None rather than derived from the peak resident set 
+    size of the process, which is only affected by a call which takes the 
+    process beyond its previous peak
+    
+    @type func: callable
+    @param func: callable taking no arguments
+    @rtype: dict
+    @return: allocations, peak memory and the method used to measure them
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            result = func()
+            after = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            del result
+        finally:
+            tracemalloc.stop()
+            
+        allocations = sum([stat.count_diff 
+                           for stat in after.compare_to(before, 'filename')
+                           if stat.count_diff > 0])
+        return dict(allocations=allocations, peakMemory=peak, 
+                    memoryMethod='tracemalloc')
+    
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        nObjects = gc.get_count()[0]
+        result = func()
+        allocations = gc.get_count()[0] - nObjects
+        del result
+    finally:
+        if gcEnabled:
+            gc.enable()
+        
+    return dict(allocations=allocations, peakMemory=None, 
+                memoryMethod='gc')
+
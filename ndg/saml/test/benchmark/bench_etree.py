@@ -0,0 +1,279 @@
+"""Benchmark the ElementTree serialisation and deserialisation of SAML objects
+under the lxml and the standard library ElementTree backends
+
+python -m ndg.saml.test.benchmark.bench_etree [-b BACKEND] [-a ASSERTIONS]
+    [-n ATTRIBUTES] [-v VALUES] [-j]
+
+The backend is selected with ndg.saml.Config.use_lxml which must be set
+before ndg.saml.xml.etree is imported.  Each backend is therefore run in a
+separate interpreter when more than one is requested.
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import sys
+import json
+import subprocess
+from datetime import datetime
+from uuid import uuid4
+from optparse import OptionParser
+
+from ndg.saml import Config
+from ndg.saml.common import SAMLVersion
+from ndg.saml.saml2.core import Issuer
+from ndg.saml.utils import SAMLDateTime
+from ndg.saml.test.benchmark import (makeAttributeResponse,
+                                     makeAttributeQuery,
+                                     makeAuthzDecisionQuery,
+                                     timeCall, measureMemory, ISSUER_DN)
+
+BACKENDS = ('lxml', 'etree')
+MODULE_NAME = 'ndg.saml.test.benchmark.bench_etree'
+
+
+def importEtree(backend):
+    """Import the SAML ElementTree module configured for the given backend
+
+    @type backend: string
+    @param backend: 'lxml' or 'etree' for the standard library ElementTree
+    @rtype: module
+    @return: ndg.saml.xml.etree module
+    @raise ValueError: unknown backend or the module has already been
+    imported with a different backend
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Expecting backend in %r; got %r" % (BACKENDS,
+                                                              backend))
+    Config.use_lxml = backend == 'lxml'
+    from ndg.saml.xml import etree
+
+    isLxml = etree.ElementTree.__name__.startswith('lxml')
+    if isLxml != Config.use_lxml:
+        raise ValueError("ndg.saml.xml.etree has already been imported with "
+                         "the %s ElementTree module" %
+                         etree.ElementTree.__name__)
+    return etree
+
+
+def _makeXacmlAuthzDecisionQuery(ElementTree):
+    """Make an XACML profile authorisation decision query.  Requires the
+    ndg_xacml package
+
+    @type ElementTree: module
+    @param ElementTree: ElementTree implementation in use
+    @rtype: tuple
+    @return: query and its ElementTree class
+    @raise ImportError: ndg_xacml is not installed
+    """
+    from ndg.saml.saml2.xacml_profile import XACMLAuthzDecisionQuery
+    from ndg.saml.xml.etree_xacml_profile import \
+        XACMLAuthzDecisionQueryElementTree
+    from ndg.xacml.core.context.action import Action
+    from ndg.xacml.core.context.environment import Environment
+    from ndg.xacml.core.context.request import Request
+    from ndg.xacml.core.context.resource import Resource
+    from ndg.xacml.core.context.subject import Subject
+
+    resource = Resource()
+    resource.resourceContent = ElementTree.Element(
+            "{urn:oasis:names:tc:xacml:2.0:context:schema:os}ResourceContent")
+
+    request = Request()
+    request.subjects.append(Subject())
+    request.resources.append(resource)
+    request.action = Action()
+    request.environment = Environment()
+
+    query = XACMLAuthzDecisionQuery()
+    query.xacmlContextRequest = request
+    query.version = SAMLVersion(SAMLVersion.VERSION_20)
+    query.id = str(uuid4())
+    query.issueInstant = datetime.utcnow()
+
+    query.issuer = Issuer()
+    query.issuer.format = Issuer.X509_SUBJECT
+    query.issuer.value = ISSUER_DN
+
+    return query, XACMLAuthzDecisionQueryElementTree
+
+
+def makeCases(etree, nAssertions=1, nAttributes=10, nValues=1):
+    """Make the callables to be timed
+
+    @type etree: module
+    @param etree: ndg.saml.xml.etree module
+    @type nAssertions: int
+    @param nAssertions: number of assertions in the response
+    @type nAttributes: int
+    @param nAttributes: number of attributes in each assertion and in the
+    attribute query
+    @type nValues: int
+    @param nValues: number of values for each attribute
+    @rtype: list
+    @return: (case name, operation name, callable) tuples
+    """
+    ElementTree = etree.ElementTree
+
+    def reparse(elem):
+        # Time deserialisation from a freshly parsed tree as a service would
+        return ElementTree.fromstring(ElementTree.tostring(elem))
+
+    samlObjects = [
+        ('AttributeQuery', makeAttributeQuery(nAttributes),
+         etree.AttributeQueryElementTree),
+        ('AuthzDecisionQuery', makeAuthzDecisionQuery(),
+         etree.AuthzDecisionQueryElementTree),
+        ('Response', makeAttributeResponse(nAssertions, nAttributes, nValues),
+         etree.ResponseElementTree)
+    ]
+    try:
+        xacmlQuery, xacmlElementTree = _makeXacmlAuthzDecisionQuery(
+                                                                ElementTree)
+        samlObjects.append(('XACMLAuthzDecisionQuery', xacmlQuery,
+                            xacmlElementTree))
+    except ImportError, e:
+        sys.stderr.write("Skipping XACMLAuthzDecisionQuery: %s\n" % e)
+
+    cases = []
+    for caseName, samlObject, elementTreeClass in samlObjects:
+        elem = reparse(elementTreeClass.toXML(samlObject))
+        cases += [
+            (caseName, 'toXML',
+             lambda samlObject=samlObject, toXML=elementTreeClass.toXML:
+                toXML(samlObject)),
+            (caseName, 'fromXML',
+             lambda elem=elem, fromXML=elementTreeClass.fromXML:
+                fromXML(elem))
+        ]
+
+    responseElem = etree.ResponseElementTree.toXML(samlObjects[2][1])
+    dtValue = datetime.utcnow()
+    dtString = SAMLDateTime.toString(dtValue)
+    cases += [
+        ('Response', 'prettyPrint', lambda: etree.prettyPrint(responseElem)),
+        ('SAMLDateTime', 'toString', lambda: SAMLDateTime.toString(dtValue)),
+        ('SAMLDateTime', 'fromString',
+         lambda: SAMLDateTime.fromString(dtString))
+    ]
+    return cases
+
+
+def run(backend, nAssertions=1, nAttributes=10, nValues=1):
+    """Run the benchmark for a given backend in this interpreter
+
+    @type backend: string
+    @param backend: 'lxml' or 'etree'
+    @type nAssertions: int
+    @param nAssertions: number of assertions in the response
+    @type nAttributes: int
+    @param nAttributes: number of attributes in each assertion
+    @type nValues: int
+    @param nValues: number of values for each attribute
+    @rtype: list
+    @return: results as a list of dictionaries
+    """
+    etree = importEtree(backend)
+    results = []
+    for caseName, operation, func in makeCases(etree, nAssertions,
+                                               nAttributes, nValues):
+        seconds, number = timeCall(func)
+        result = dict(backend=backend,
+                      elementTree=etree.ElementTree.__name__,
+                      python=sys.version.split()[0],
+                      case=caseName,
+                      operation=operation,
+                      seconds=seconds,
+                      opsPerSec=1./seconds,
+                      number=number,
+                      assertions=nAssertions,
+                      attributes=nAttributes,
+                      values=nValues)
+        result.update(measureMemory(func))
+        results.append(result)
+
+    return results
+
+
+def runAll(backends=BACKENDS, nAssertions=1, nAttributes=10, nValues=1):
+    """Run the benchmark for each backend in a separate interpreter
+
+    @type backends: iterable
+    @param backends: backends to run
+    @type nAssertions: int
+    @param nAssertions: number of assertions in the response
+    @type nAttributes: int
+    @param nAttributes: number of attributes in each assertion
+    @type nValues: int
+    @param nValues: number of values for each attribute
+    @rtype: list
+    @return: results for all the backends which could be run
+    """
+    results = []
+    for backend in backends:
+        args = [sys.executable, '-m', MODULE_NAME,
+                '-b', backend, '-j',
+                '-a', str(nAssertions),
+                '-n', str(nAttributes),
+                '-v', str(nValues)]
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            sys.stderr.write("Skipping %s backend: benchmark exited with "
+                             "status %d\n" % (backend, proc.returncode))
+            continue
+
+        results += json.loads(output)
+
+    return results
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-b", "--backend", dest="backend", default="all",
+                      choices=BACKENDS + ('all',),
+                      help="ElementTree backend: lxml, etree or all "
+                           "[default]")
+    parser.add_option("-a", "--assertions", dest="nAssertions", type="int",
+                      default=1, help="Number of assertions in the response")
+    parser.add_option("-n", "--attributes", dest="nAttributes", type="int",
+                      default=10, help="Number of attributes per assertion")
+    parser.add_option("-v", "--values", dest="nValues", type="int",
+                      default=1, help="Number of values per attribute")
+    parser.add_option("-j", "--json", dest="json", action="store_true",
+                      default=False, help="Output results as JSON")
+    opts = parser.parse_args()[0]
+
+    if opts.backend == 'all':
+        results = runAll(nAssertions=opts.nAssertions,
+                         nAttributes=opts.nAttributes,
+                         nValues=opts.nValues)
+    else:
+        results = run(opts.backend, opts.nAssertions, opts.nAttributes,
+                      opts.nValues)
+
+    if opts.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%-8s %-24s %-12s %12s %12s %12s" % ("backend", "case", "operation",
+                                               "ops/sec", "allocations",
+                                               "peak (kB)"))
+    for result in results:
+        peakMemory = result['peakMemory']
+        print("%-8s %-24s %-12s %12.1f %12d %12s" % (
+                result['backend'],
+                result['case'],
+                result['operation'],
+                result['opsPerSec'],
+                result['allocations'],
+                '-' if peakMemory is None else '%.1f' % (peakMemory/1024.)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Import time regression benchmark for the NDG SAML and SOAP packages
+
+python -m ndg.saml.test.benchmark.bench_import [-m MODULE] [-r REPEAT]
+    [-c] [-j]
+
+Each module is imported in a fresh interpreter so that no other module is
+already cached.  The best time over the repeats is compared against the
+module's budget, and the modules loaded are checked against those which
+should only load on first use: the SSL backends and XACML support.  Where
+the interpreter supports python -X importtime (3.7 onwards) its output is
+parsed to report the slowest imports with each module.  Python 2 has no
+equivalent so only the total time is reported there.
+
+With -c the exit status is 1 if any module is over budget or imports a
+module it should not.
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import re
+import sys
+import json
+import subprocess
+from optparse import OptionParser
+
+from ndg.saml.test.support import isLazyModule, importModule
+
+# Module name and import time budget in milliseconds.  Budgets are generous
+# so that they only catch regressions such as a new eager import of a heavy
+# package
+MODULES = (
+    ('ndg.saml.saml2.core', 150),
+    ('ndg.saml.xml.etree', 250),
+    ('ndg.soap.client', 150),
+    ('ndg.saml.saml2.binding.soap.client.attributequery', 250),
+    ('ndg.saml.saml2.binding.soap.client.authzdecisionquery', 250),
+    ('ndg.saml.saml2.binding.soap.server.wsgi.queryinterface', 300),
+)
+
+IMPORTTIME_PAT = re.compile(
+            r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(.+)$')
+
+
+def supportsImportTime():
+    """@rtype: bool
+    @return: True if the interpreter supports python -X importtime
+    """
+    return sys.version_info >= (3, 7)
+
+
+def timeImport(moduleName, repeat=3):
+    """Time the import of a module in fresh interpreters
+
+    @type moduleName: string
+    @param moduleName: module to import
+    @type repeat: int
+    @param repeat: number of interpreters to run.  The best time is used
+    @rtype: dict
+    @return: best time in seconds and the modules loaded by the import
+    @raise RuntimeError: the import failed
+    """
+    best = None
+    for i in range(repeat):
+        result = importModule(moduleName)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+
+    return best
+
+
+def parseImportTime(output):
+    """Parse python -X importtime output
+
+    @type output: string
+    @param output: standard error from the interpreter
+    @rtype: list
+    @return: (module, self time, cumulative time) tuples with times in
+    seconds
+    """
+    entries = []
+    for line in output.splitlines():
+        match = IMPORTTIME_PAT.match(line)
+        if match is None:
+            continue
+        selfTime, cumulative, indent, name = match.groups()
+        entries.append((name.strip(), int(selfTime)*1e-6,
+                        int(cumulative)*1e-6))
+    return entries
+
+
+def slowestImports(moduleName, n=5):
+    """Get the imports with the longest self time when importing a module
+
+    @type moduleName: string
+    @param moduleName: module to import
+    @type n: int
+    @param n: number of imports to return
+    @rtype: list
+    @return: (module, self time) tuples, slowest first, or an empty list if
+    the interpreter does not support python -X importtime
+    """
+    if not supportsImportTime():
+        return []
+
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             'import %s' % moduleName],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    error = proc.communicate()[1]
+    if not isinstance(error, str):
+        error = error.decode('utf-8', 'replace')
+
+    entries = parseImportTime(error)
+    entries.sort(key=lambda entry: entry[1], reverse=True)
+    return [(name, selfTime) for name, selfTime, cumulative in entries[:n]]
+
+
+def run(modules=MODULES, repeat=3):
+    """Time the import of each module and check it against its budget
+
+    @type modules: iterable
+    @param modules: module name and budget in milliseconds tuples
+    @type repeat: int
+    @param repeat: number of interpreters to run for each module
+    @rtype: list
+    @return: result for each module
+    """
+    results = []
+    for moduleName, budget in modules:
+        timing = timeImport(moduleName, repeat=repeat)
+        lazyModules = [name for name in timing['modules']
+                       if isLazyModule(name)]
+        milliseconds = timing['seconds']*1000.
+        results.append({
+            'module': moduleName,
+            'milliseconds': milliseconds,
+            'budget': budget,
+            'nModules': len(timing['modules']),
+            'lazyModules': lazyModules,
+            'slowest': slowestImports(moduleName),
+            'ok': milliseconds <= budget and not lazyModules
+        })
+    return results
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-m", "--module", dest="modules", action="append",
+                      default=[], help="Module to import.  May be repeated.  "
+                      "Defaults to all the modules with a budget")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int",
+                      default=3, help="Number of interpreters to run for "
+                      "each module")
+    parser.add_option("-c", "--check", dest="check", action="store_true",
+                      default=False, help="Exit with status 1 if any module "
+                      "is over budget or imports a lazily loaded module")
+    parser.add_option("-j", "--json", dest="json", action="store_true",
+                      default=False, help="Output results as JSON")
+    opts = parser.parse_args()[0]
+
+    if opts.modules:
+        budgets = dict(MODULES)
+        modules = [(name, budgets.get(name, float('inf')))
+                   for name in opts.modules]
+    else:
+        modules = MODULES
+
+    results = run(modules, repeat=opts.repeat)
+
+    if opts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%-58s %10s %10s %8s  %s" % ("module", "time (ms)",
+                                           "budget", "modules", "status"))
+        for result in results:
+            if result['lazyModules']:
+                status = 'imports ' + ', '.join(result['lazyModules'])
+            elif result['ok']:
+                status = 'ok'
+            else:
+                status = 'over budget'
+
+            print("%-58s %10.1f %10.0f %8d  %s" % (result['module'],
+                                                   result['milliseconds'],
+                                                   result['budget'],
+                                                   result['nModules'],
+                                                   status))
+            for name, selfTime in result['slowest']:
+                print("    %-54s %10.1f" % (name, selfTime*1000.))
+
+    if opts.check and [result for result in results if not result['ok']]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Benchmark pickling of SAML objects - compares the compact __reduce__ based
+scheme against the previous __getstate__/__setstate__ attribute dictionary 
+scheme
+
+python -m ndg.saml.test.benchmark.bench_pickle [-a ASSERTIONS] 
+    [-n ATTRIBUTES] [-v VALUES] [-j]
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import cPickle as pickle
+import json
+from optparse import OptionParser
+
+from ndg.saml.test.benchmark import makeAttributeResponse, timeCall
+from ndg.saml.test.legacy_pickle import LegacyPickling
+
+
+def benchmark(obj, protocol):
+    """Time pickling of a given object with a given protocol
+    
+    @param obj: object to pickle
+    @type obj: object
+    @type protocol: int
+    @param protocol: pickle protocol
+    @rtype: dict
+    @return: pickle size in bytes and dump and load times in seconds
+    """
+    jar = pickle.dumps(obj, protocol)
+    dumpTime = timeCall(lambda: pickle.dumps(obj, protocol))[0]
+    loadTime = timeCall(lambda: pickle.loads(jar))[0]
+    
+    return dict(size=len(jar), dumps=dumpTime, loads=loadTime)
+    
+
+def run(nAssertions=1, nAttributes=10, nValues=1, 
+        protocols=(0, pickle.HIGHEST_PROTOCOL)):
+    """Run the pickle benchmark for an attribute query response of the given
+    size
+    
+    @type nAssertions: int
+    @param nAssertions: number of assertions in the response
+    @type nAttributes: int
+    @param nAttributes: number of attributes in each assertion
+    @type nValues: int
+    @param nValues: number of values for each attribute
+    @type protocols: iterable
+    @param protocols: pickle protocols to test
+    @rtype: list
+    @return: results as a list of dictionaries
+    """
+    response = makeAttributeResponse(nAssertions, nAttributes, nValues)
+    results = []
+    for protocol in protocols:
+        with LegacyPickling(protocol):
+            legacy = benchmark(response, protocol)
+            
+        compact = benchmark(response, protocol)
+        for scheme, result in (('getstate', legacy), ('reduce', compact)):
+            result.update(scheme=scheme, 
+                          protocol=protocol, 
+                          assertions=nAssertions,
+                          attributes=nAttributes,
+                          values=nValues)
+            results.append(result)
+            
+    return results
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-a", "--assertions", dest="nAssertions", type="int",
+                      default=1, help="Number of assertions in the response")
+    parser.add_option("-n", "--attributes", dest="nAttributes", type="int",
+                      default=100, help="Number of attributes per assertion")
+    parser.add_option("-v", "--values", dest="nValues", type="int",
+                      default=1, help="Number of values per attribute")
+    parser.add_option("-j", "--json", dest="json", action="store_true",
+                      default=False, help="Output results as JSON")
+    opts = parser.parse_args()[0]
+    
+    results = run(opts.nAssertions, opts.nAttributes, opts.nValues)
+    if opts.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print("%-9s %-8s %10s %12s %12s" % ("scheme", "protocol", "bytes", 
+                                        "dumps (ms)", "loads (ms)"))
+    for result in results:
+        print("%-9s %-8d %10d %12.3f %12.3f" % (result['scheme'], 
+                                                result['protocol'],
+                                                result['size'], 
+                                                result['dumps'] * 1000.,
+                                                result['loads'] * 1000.))
+        
+
+if __name__ == "__main__":
+    main()
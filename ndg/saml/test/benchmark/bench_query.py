@@ -0,0 +1,137 @@
+"""Benchmark the cost of constructing a SAML query per request with the query
+factories: parsing the configuration keywords each time with from_kw against
+instantiating a query template parsed once
+
+python -m ndg.saml.test.benchmark.bench_query [-n ATTRIBUTES] [-j]
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import json
+from uuid import uuid4
+from datetime import datetime
+from optparse import OptionParser
+
+from ndg.saml.saml2.core import Action, XSStringAttributeValue
+from ndg.saml.utils.factory import (AttributeQueryFactory,
+                                    AuthzDecisionQueryFactory)
+from ndg.saml.test.benchmark import (timeCall, ISSUER_DN, NAMEID_FORMAT,
+                                     NAMEID_VALUE, RESOURCE_URI)
+
+PREFIX = 'query.'
+
+
+def makeAttributeQueryConfig(nAttributes=10):
+    """Make attribute query factory keywords
+
+    @type nAttributes: int
+    @param nAttributes: number of attributes to request
+    @rtype: dict
+    @return: keywords for AttributeQueryFactory.from_kw
+    """
+    config = {
+        'prefix': PREFIX,
+        PREFIX + 'subject.nameID.format': NAMEID_FORMAT,
+        PREFIX + 'issuer.value': ISSUER_DN
+    }
+    for iAttribute in range(nAttributes):
+        config[PREFIX + 'attributes.%d' % iAttribute] = '%s, %s, %s' % (
+                        "urn:badc:security:authz:1.0:attr:%d" % iAttribute,
+                        "attr%d" % iAttribute,
+                        XSStringAttributeValue.DEFAULT_FORMAT)
+    return config
+
+
+def makeAuthzDecisionQueryConfig():
+    """Make authorisation decision query factory keywords
+
+    @rtype: dict
+    @return: keywords for AuthzDecisionQueryFactory.from_kw
+    """
+    return {
+        'prefix': PREFIX,
+        PREFIX + 'subject.nameID.format': NAMEID_FORMAT,
+        PREFIX + 'issuer.value': ISSUER_DN,
+        PREFIX + 'actions.0': '%s, %s' % (Action.GHPP_NS_URI,
+                                          Action.HTTP_GET_ACTION)
+    }
+
+
+def _fromKw(factoryClass, config, **kw):
+    """Create a query by parsing the keywords then setting the per request
+    values as callers of from_kw have to.  ID and issue instant are set for
+    a like for like comparison with the template"""
+    query = factoryClass.from_kw(**config)
+    query.id = str(uuid4())
+    query.issueInstant = datetime.utcnow()
+    query.subject.nameID.value = kw['subject_id']
+    if 'resource' in kw:
+        query.resource = kw['resource']
+    return query
+
+
+def run(nAttributes=10):
+    """Time query construction with from_kw and with a query template
+
+    @type nAttributes: int
+    @param nAttributes: number of attributes in the attribute query
+    @rtype: list
+    @return: results for each query type and method
+    """
+    cases = (
+        ('AttributeQuery', AttributeQueryFactory,
+         makeAttributeQueryConfig(nAttributes),
+         dict(subject_id=NAMEID_VALUE)),
+        ('AuthzDecisionQuery', AuthzDecisionQueryFactory,
+         makeAuthzDecisionQueryConfig(),
+         dict(subject_id=NAMEID_VALUE, resource=RESOURCE_URI)),
+    )
+    results = []
+    for name, factoryClass, config, kw in cases:
+        fromKwTime = timeCall(lambda: _fromKw(factoryClass, config, **kw))[0]
+
+        template = factoryClass.template_from_kw(**config)
+        templateTime = timeCall(lambda: template.instantiate(**kw))[0]
+
+        for method, seconds in (('from_kw', fromKwTime),
+                                ('template', templateTime)):
+            results.append({
+                'query': name,
+                'method': method,
+                'microseconds': seconds*1e6,
+                'speedUp': fromKwTime/seconds
+            })
+    return results
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--attributes", dest="nAttributes", type="int",
+                      default=10, help="Number of attributes in the "
+                                       "attribute query")
+    parser.add_option("-j", "--json", dest="json", action="store_true",
+                      default=False, help="Output results as JSON")
+    opts = parser.parse_args()[0]
+
+    results = run(nAttributes=opts.nAttributes)
+    if opts.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%-20s %-10s %14s %10s" % ("query", "method", "us/query",
+                                     "speed up"))
+    for result in results:
+        print("%-20s %-10s %14.1f %10.1f" % (result['query'],
+                                             result['method'],
+                                             result['microseconds'],
+                                             result['speedUp']))
+
+
+if __name__ == "__main__":
+    main()
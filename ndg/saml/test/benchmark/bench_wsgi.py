@@ -0,0 +1,370 @@
+"""Benchmark an end to end SAML SOAP query round trip in process.  The client
+bindings are connected to the SOAP query interface WSGI middleware through an
+in-memory urllib2 handler so that no sockets are used.  Each request is split
+into phases:
+
+queryBuild - construct the SAML query
+serialise - client query serialisation to ElementTree
+envelope - client SOAP envelope serialisation to a string
+parse - service query deserialisation from ElementTree
+queryInterface - service query interface callable
+responseSerialise - service response serialisation to ElementTree
+clientParse - client SOAP envelope parsing and response deserialisation
+validation - client response status, ID and time condition checks
+server - the whole WSGI application call including service SOAP envelope
+parsing and serialisation
+total - the whole round trip
+
+python -m ndg.saml.test.benchmark.bench_wsgi [-q QUERY] [-c CONCURRENCY]
+    [-r REQUESTS] [-w WARMUP] [-n ATTRIBUTES] [-v VALUES] [-d DECISION]
+    [-l LATENCY] [-j]
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import sys
+import json
+import timeit
+import threading
+from optparse import OptionParser
+
+from ndg.soap.etree import SOAPEnvelope
+
+from ndg.saml.saml2.core import DecisionType
+from ndg.saml.saml2.binding.soap.client.attributequery import \
+    AttributeQuerySOAPBinding
+from ndg.saml.saml2.binding.soap.client.authzdecisionquery import \
+    AuthzDecisionQuerySOAPBinding
+from ndg.saml.xml.etree import (AttributeQueryElementTree,
+                                AuthzDecisionQueryElementTree,
+                                ResponseElementTree)
+from ndg.saml.utils import summariseLatencies
+from ndg.saml.test import support
+from ndg.saml.test.support import (makeAttributeQuery, makeAuthzDecisionQuery,
+                                   StubQueryInterface, SERVICE_URI)
+
+PHASES = ('queryBuild', 'serialise', 'envelope', 'parse', 'queryInterface',
+          'responseSerialise', 'clientParse', 'validation', 'server', 'total')
+
+QUERY_TYPES = {
+    'attribute': (AttributeQuerySOAPBinding,
+                  AttributeQueryElementTree.fromXML),
+    'authz': (AuthzDecisionQuerySOAPBinding,
+              AuthzDecisionQueryElementTree.fromXML)
+}
+
+DECISIONS = {
+    'permit': DecisionType.PERMIT,
+    'deny': DecisionType.DENY,
+    'indeterminate': DecisionType.INDETERMINATE
+}
+
+
+class PhaseTimer(threading.local):
+    """Record the time spent in each phase of a request.  Client and service
+    run in the same thread so a thread local instance collects the phases of
+    the request currently being made by that thread
+    """
+    timer = staticmethod(timeit.default_timer)
+
+    def __init__(self):
+        self.phases = {}
+        self.mark = None
+
+    def reset(self):
+        """Clear the phases recorded for the last request"""
+        self.phases = {}
+        self.mark = None
+
+    def add(self, phase, seconds):
+        """Add time to a phase
+
+        @type phase: string
+        @param phase: phase name
+        @type seconds: float
+        @param seconds: time elapsed
+        """
+        self.phases[phase] = self.phases.get(phase, 0.) + seconds
+
+    def wrap(self, phase, func):
+        """Wrap a callable so that calls to it are timed
+
+        @type phase: string
+        @param phase: phase name to add the call times to
+        @type func: callable
+        @param func: callable to wrap
+        @rtype: callable
+        @return: wrapped callable
+        """
+        def timedFunc(*arg, **kw):
+            t0 = self.timer()
+            try:
+                return func(*arg, **kw)
+            finally:
+                self.mark = self.timer()
+                self.add(phase, self.mark - t0)
+
+        return timedFunc
+
+phaseTimer = PhaseTimer()
+
+
+class TimedSOAPEnvelope(SOAPEnvelope):
+    """SOAP envelope recording client side serialisation and parse times"""
+
+    def serialize(self):
+        t0 = phaseTimer.timer()
+        try:
+            return super(TimedSOAPEnvelope, self).serialize()
+        finally:
+            phaseTimer.add('envelope', phaseTimer.timer() - t0)
+
+    def parse(self, source):
+        t0 = phaseTimer.timer()
+        try:
+            return super(TimedSOAPEnvelope, self).parse(source)
+        finally:
+            phaseTimer.add('clientParse', phaseTimer.timer() - t0)
+
+
+class TimedWSGIHandler(support.WSGIHandler):
+    """In-memory WSGI handler recording the service side time of each request
+    """
+
+    def callApp(self, environ, start_response):
+        t0 = phaseTimer.timer()
+        try:
+            # urllib2 handlers are old style classes
+            return support.WSGIHandler.callApp(self, environ, start_response)
+        finally:
+            phaseTimer.add('server', phaseTimer.timer() - t0)
+
+
+def makeApp(queryInterface, deserialise):
+    """Make the WSGI application stack for the service
+
+    @type queryInterface: callable
+    @param queryInterface: SAML query interface
+    @type deserialise: callable
+    @param deserialise: service query deserialisation callable
+    @rtype: callable
+    @return: WSGI application with timed query interface, deserialisation
+    and serialisation
+    """
+    return support.makeApp(
+                phaseTimer.wrap('queryInterface', queryInterface),
+                phaseTimer.wrap('parse', deserialise),
+                serialise=phaseTimer.wrap('responseSerialise',
+                                          ResponseElementTree.toXML))
+
+
+def makeBinding(queryType, app):
+    """Make a client binding connected to the given WSGI application
+
+    @type queryType: string
+    @param queryType: 'attribute' or 'authz'
+    @type app: callable
+    @param app: WSGI application
+    @rtype: ndg.saml.saml2.binding.soap.client.SOAPBinding
+    @return: binding with timed serialisation and deserialisation
+    """
+    bindingClass = QUERY_TYPES[queryType][0]
+    binding = bindingClass(requestEnvelopeClass=TimedSOAPEnvelope,
+                           responseEnvelopeClass=TimedSOAPEnvelope)
+    binding.client.openerDirector.add_handler(TimedWSGIHandler(app))
+    binding.clockSkewTolerance = 60.
+    binding.serialise = phaseTimer.wrap('serialise', binding.serialise)
+    binding.deserialise = phaseTimer.wrap('clientParse', binding.deserialise)
+    return binding
+
+
+def makeQuery(queryType, nAttributes):
+    """@type queryType: string
+    @param queryType: 'attribute' or 'authz'
+    @type nAttributes: int
+    @param nAttributes: number of attributes for an attribute query
+    @rtype: ndg.saml.saml2.core.SubjectQuery
+    @return: query
+    """
+    if queryType == 'attribute':
+        return makeAttributeQuery(nAttributes)
+    else:
+        return makeAuthzDecisionQuery()
+
+
+def roundTrip(binding, queryType, nAttributes):
+    """Make a single timed query
+
+    @type binding: ndg.saml.saml2.binding.soap.client.SOAPBinding
+    @param binding: binding made with makeBinding
+    @type queryType: string
+    @param queryType: 'attribute' or 'authz'
+    @type nAttributes: int
+    @param nAttributes: number of attributes for an attribute query
+    @rtype: dict
+    @return: time in seconds for each phase
+    """
+    phaseTimer.reset()
+    t0 = phaseTimer.timer()
+    query = makeQuery(queryType, nAttributes)
+    phaseTimer.add('queryBuild', phaseTimer.timer() - t0)
+
+    binding.send(query, uri=SERVICE_URI)
+
+    t1 = phaseTimer.timer()
+    phaseTimer.add('validation', t1 - phaseTimer.mark)
+    phaseTimer.add('total', t1 - t0)
+    return phaseTimer.phases
+
+
+def run(queryType='attribute', concurrency=1, nRequests=1000, nWarmUp=10,
+        nAttributes=10, nValues=1, decision='permit', latency=0.):
+    """Run the benchmark
+
+    @type queryType: string
+    @param queryType: 'attribute' or 'authz'
+    @type concurrency: int
+    @param concurrency: number of client threads
+    @type nRequests: int
+    @param nRequests: total number of timed requests
+    @type nWarmUp: int
+    @param nWarmUp: number of untimed requests made by each thread before
+    the timed requests start
+    @type nAttributes: int
+    @param nAttributes: number of attributes for an attribute query
+    @type nValues: int
+    @param nValues: number of values returned for each attribute
+    @type decision: string
+    @param decision: authorisation decision returned - 'permit', 'deny' or
+    'indeterminate'
+    @type latency: float
+    @param latency: query interface latency in seconds
+    @rtype: dict
+    @return: settings, throughput, errors and latency summaries by phase
+    """
+    queryInterface = StubQueryInterface(nValues=nValues,
+                                        decision=DECISIONS[decision],
+                                        latency=latency)
+    app = makeApp(queryInterface, QUERY_TYPES[queryType][1])
+
+    results = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [nRequests]
+    ready = threading.Event()
+
+    def worker():
+        binding = makeBinding(queryType, app)
+        for i in range(nWarmUp):
+            roundTrip(binding, queryType, nAttributes)
+
+        ready.wait()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            try:
+                phases = roundTrip(binding, queryType, nAttributes)
+            except Exception, e:
+                with lock:
+                    errors.append(type(e).__name__)
+            else:
+                with lock:
+                    results.append(phases.copy())
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    t0 = timeit.default_timer()
+    ready.set()
+    for thread in threads:
+        thread.join()
+    elapsed = timeit.default_timer() - t0
+
+    errorCounts = {}
+    for error in errors:
+        errorCounts[error] = errorCounts.get(error, 0) + 1
+
+    return dict(
+        query=queryType,
+        python=sys.version.split()[0],
+        concurrency=concurrency,
+        requests=nRequests,
+        attributes=nAttributes,
+        values=nValues,
+        decision=decision,
+        latency=latency,
+        seconds=elapsed,
+        requestsPerSec=len(results) / elapsed if elapsed else None,
+        errors=errorCounts,
+        phases=dict([(phase, summariseLatencies([result.get(phase, 0.)
+                                                 for result in results]))
+                     for phase in PHASES]))
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-q", "--query", dest="queryType", default="attribute",
+                      choices=sorted(QUERY_TYPES.keys()),
+                      help="Query type: attribute [default] or authz")
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int",
+                      default=1, help="Number of client threads")
+    parser.add_option("-r", "--requests", dest="nRequests", type="int",
+                      default=1000, help="Total number of timed requests")
+    parser.add_option("-w", "--warm-up", dest="nWarmUp", type="int",
+                      default=10, help="Number of untimed requests per "
+                                       "thread made before timing starts")
+    parser.add_option("-n", "--attributes", dest="nAttributes", type="int",
+                      default=10, help="Number of attributes queried")
+    parser.add_option("-v", "--values", dest="nValues", type="int",
+                      default=1, help="Number of values returned per "
+                                      "attribute")
+    parser.add_option("-d", "--decision", dest="decision", default="permit",
+                      choices=sorted(DECISIONS.keys()),
+                      help="Authorisation decision returned")
+    parser.add_option("-l", "--latency", dest="latency", type="float",
+                      default=0., help="Query interface latency in "
+                                       "milliseconds")
+    parser.add_option("-j", "--json", dest="json", action="store_true",
+                      default=False, help="Output results as JSON")
+    opts = parser.parse_args()[0]
+
+    result = run(queryType=opts.queryType,
+                 concurrency=opts.concurrency,
+                 nRequests=opts.nRequests,
+                 nWarmUp=opts.nWarmUp,
+                 nAttributes=opts.nAttributes,
+                 nValues=opts.nValues,
+                 decision=opts.decision,
+                 latency=opts.latency / 1000.)
+    if opts.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print("%s query: %d requests, %d threads, %.1f requests/sec" % (
+            result['query'], result['requests'], result['concurrency'],
+            result['requestsPerSec'] or 0.))
+    for error, count in sorted(result['errors'].items()):
+        print("%d %s errors" % (count, error))
+
+    print("%-18s %10s %10s %10s %10s %10s" % ("phase (ms)", "mean", "p50",
+                                              "p90", "p99", "max"))
+    for phase in PHASES:
+        summary = result['phases'][phase]
+        if not summary['n']:
+            continue
+        print("%-18s %10.3f %10.3f %10.3f %10.3f %10.3f" % tuple(
+                [phase] + [summary[i] * 1000.
+                           for i in ('mean', 'p50', 'p90', 'p99', 'max')]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Stress tests sharing one SAML SOAP binding between many client threads
+making queries to a local server
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import os
+import ssl
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+try:
+    from OpenSSL import SSL, crypto
+    from ndg.httpsclient.https import HTTPSContextHandler
+    pyopenssl_installed = True
+except ImportError:
+    pyopenssl_installed = False
+
+from ndg.saml.utils.ssl_context import SSLContextHTTPSHandler
+from ndg.saml.xml.etree import AttributeQueryElementTree
+from ndg.saml.test.support import (makeApp, makeAttributeQuery,
+                                   makeAttributeQueryBinding,
+                                   StubQueryInterface)
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """WSGI server handling each request in a new thread"""
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    """Request handler which doesn't log each request to stderr"""
+    def log_message(self, *arg):
+        pass
+
+
+class VerifyNoneSSLContextProxy(object):
+    """Minimal SSL context proxy recording the contexts it creates"""
+    def __init__(self):
+        self.ssl_valid_hostname = None
+        self.created = []
+
+    def __call__(self):
+        self.created.append(self.ssl_valid_hostname)
+        return SSL.Context(SSL.SSLv23_METHOD)
+
+
+class ConcurrentBindingTestCase(unittest.TestCase):
+    """Make queries with one binding shared between threads"""
+    N_THREADS = 8
+    N_REQUESTS = 25
+
+    def _makeServerCert(self):
+        """Make a self-signed certificate and key for the server.  
+        localhost.crt in this directory is signed with a digest too weak for
+        current OpenSSL versions
+        
+        @rtype: tuple
+        @return: certificate and private key file paths
+        """
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        
+        cert = crypto.X509()
+        cert.get_subject().CN = 'localhost'
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(60*60)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(key, 'sha256')
+        
+        self.certDir = mkdtemp()
+        certFilePath = os.path.join(self.certDir, 'localhost.crt')
+        priKeyFilePath = os.path.join(self.certDir, 'localhost.key')
+        with open(certFilePath, 'w') as certFile:
+            certFile.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        with open(priKeyFilePath, 'w') as priKeyFile:
+            priKeyFile.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+            
+        return certFilePath, priKeyFilePath
+        
+    def _startServer(self, withSSL=False):
+        app = makeApp(StubQueryInterface(), AttributeQueryElementTree.fromXML)
+        server = make_server('localhost', 0, app,
+                             server_class=ThreadingWSGIServer,
+                             handler_class=QuietWSGIRequestHandler)
+        scheme = 'http'
+        if withSSL:
+            certFilePath, priKeyFilePath = self._makeServerCert()
+            try:
+                server.socket = ssl.wrap_socket(server.socket,
+                                                certfile=certFilePath,
+                                                keyfile=priKeyFilePath,
+                                                server_side=True)
+            except Exception:
+                server.server_close()
+                raise
+            scheme = 'https'
+
+        self.server = server
+        serverThread = Thread(target=server.serve_forever,
+                              kwargs=dict(poll_interval=0.05))
+        serverThread.daemon = True
+        serverThread.start()
+        return '%s://localhost:%d/saml' % (scheme, server.server_port)
+
+    def tearDown(self):
+        if getattr(self, 'server', None) is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            
+        if getattr(self, 'certDir', None) is not None:
+            rmtree(self.certDir)
+
+    def _hammer(self, binding, uri):
+        """Send queries from N_THREADS threads at once checking each gets
+        the response to its own query"""
+        errors = []
+        lock = Lock()
+
+        def sendQueries(iThread):
+            for iRequest in range(self.N_REQUESTS):
+                query = makeAttributeQuery(2)
+                subjectId = 'https://openid.localhost/%d/%d' % (iThread,
+                                                                iRequest)
+                query.subject.nameID.value = subjectId
+                try:
+                    response = binding.send(query, uri=uri)
+                    nameID = response.assertions[0].subject.nameID
+                    if nameID.value != subjectId:
+                        raise Exception('Response for %r returned for '
+                                        'query for %r' % (nameID.value,
+                                                          subjectId))
+                except Exception, e:
+                    with lock:
+                        errors.append(e)
+
+        threads = [Thread(target=sendQueries, args=(i,))
+                   for i in range(self.N_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assert_(not errors, 'Errors from concurrent queries: %r' %
+                     errors[:5])
+
+    def test01SharedBinding(self):
+        uri = self._startServer()
+        binding = makeAttributeQueryBinding()
+        self._hammer(binding, uri)
+
+    @unittest.skipIf(not pyopenssl_installed, 'Need PyOpenSSL and '
+                     'ndg.httpsclient to run test02SharedSSLContextHandler')
+    def test02SharedSSLContextHandler(self):
+        uri = self._startServer(withSSL=True)
+        sslCtxProxy = VerifyNoneSSLContextProxy()
+        httpsHandler = SSLContextHTTPSHandler(sslCtxProxy)
+
+        binding = makeAttributeQueryBinding()
+        binding.client.openerDirector.add_handler(httpsHandler)
+        self._hammer(binding, uri)
+
+        # One context created for the host and the shared proxy left as it
+        # was
+        self.assert_(sslCtxProxy.created == ['localhost'])
+        self.assert_(sslCtxProxy.ssl_valid_hostname is None)
+        self.assert_(len(binding.client.openerDirector.handlers) == 3)
+
+        httpsHandler.clearCache()
+        self._hammer(binding, uri)
+        self.assert_(sslCtxProxy.created == ['localhost', 'localhost'])
+
+
+if __name__ == "__main__":
+    unittest.main()
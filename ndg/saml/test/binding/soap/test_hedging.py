@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Unit tests for hedging SAML SOAP queries to replicated services
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import time
+import unittest
+
+from ndg.soap.utils.hedging import HedgePolicy
+from ndg.soap.utils.metrics import timer
+from ndg.soap.transport import TransportCancelled, getCurrentCancelToken
+from ndg.saml.xml.etree import AttributeQueryElementTree
+from ndg.saml.test.support import (makeApp, makeAttributeQuery,
+                                   makeAttributeQueryBinding,
+                                   StubQueryInterface)
+
+
+class HedgedQueryTestCase(unittest.TestCase):
+    """Send queries to a slow replica hedging them to a fast one"""
+    SLOW_URI = 'http://slow.localhost/saml'
+    FAST_URI = 'http://fast.localhost/saml'
+    SLOW_LATENCY = 0.5
+    
+    def setUp(self):
+        slowApp = makeApp(StubQueryInterface(latency=self.SLOW_LATENCY),
+                          AttributeQueryElementTree.fromXML)
+        fastApp = makeApp(StubQueryInterface(),
+                          AttributeQueryElementTree.fromXML)
+        
+        def app(environ, start_response):
+            if environ['SERVER_NAME'].startswith('slow'):
+                return slowApp(environ, start_response)
+            
+            return fastApp(environ, start_response)
+        
+        self.binding = makeAttributeQueryBinding(app)
+        
+    def _send(self):
+        query = makeAttributeQuery()
+        t0 = timer()
+        response = self.binding.send(query, uri=self.SLOW_URI)
+        self.assert_(response.inResponseTo == query.id)
+        return timer() - t0
+    
+    def test01Hedge(self):
+        self.binding.parseKeywords(**{
+            'hedgePolicy.uris': '%s, %s' % (self.SLOW_URI, self.FAST_URI),
+            'hedgePolicy.delay': '0.05',
+            'hedgePolicy.budget': '1'
+        })
+        self.assert_(self.binding.hedgePolicy.uris == (self.SLOW_URI,
+                                                       self.FAST_URI))
+        
+        # The response from the fast replica is taken and the slow request
+        # is cancelled once it returns
+        self.assert_(self._send() < self.SLOW_LATENCY)
+        time.sleep(self.SLOW_LATENCY*2)
+        counters = self.binding.hedgePolicy.counters
+        self.assert_(counters['requests'] == 1)
+        self.assert_(counters['hedged'] == 1)
+        self.assert_(counters['hedgeWins'] == 1)
+        self.assert_(counters['cancelled'] == 1)
+        
+    def test02HedgeBudget(self):
+        self.binding.hedgePolicy = HedgePolicy(uris=(self.SLOW_URI, 
+                                                     self.FAST_URI),
+                                               delay=0.05,
+                                               budget=0.)
+        self.assert_(self._send() >= self.SLOW_LATENCY)
+        counters = self.binding.hedgePolicy.counters
+        self.assert_(counters['hedged'] == 0)
+        self.assert_(counters['budgetExhausted'] == 1)
+        
+    def test03ObservedHedgeDelay(self):
+        policy = HedgePolicy(uris=(self.SLOW_URI, self.FAST_URI),
+                             percentile=50.,
+                             initialDelay=0.05,
+                             minSamples=1,
+                             window=3,
+                             budget=1.)
+        
+        def send(uri):
+            if uri == self.FAST_URI:
+                return uri
+            
+            cancelToken = getCurrentCancelToken()
+            t0 = timer()
+            while timer() - t0 < self.SLOW_LATENCY:
+                if cancelToken.cancelled:
+                    raise TransportCancelled()
+                time.sleep(0.005)
+                
+            return uri
+        
+        self.assert_(policy.send(send, self.SLOW_URI) == self.FAST_URI)
+        
+        # The cancelled request is observed with its time to cancellation 
+        time.sleep(0.1)
+        self.assert_(policy.counters['cancelled'] == 1)
+        delay = policy.getHedgeDelay(self.SLOW_URI)
+        self.assert_(0.05 <= delay < self.SLOW_LATENCY)
+        
+        # Only the latest window latencies are used
+        for i in range(3):
+            policy.send(lambda uri: uri, self.SLOW_URI)
+            
+        self.assert_(policy.getHedgeDelay(self.SLOW_URI) < 0.05)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
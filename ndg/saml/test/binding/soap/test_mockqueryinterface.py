@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Unit tests for the mock SAML query interface for performance testing
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import unittest
+from uuid import uuid4
+from datetime import datetime
+from cStringIO import StringIO
+
+from ndg.soap.etree import SOAPEnvelope
+
+from ndg.saml.saml2.core import (Response, Status, StatusCode, StatusMessage,
+                                 Issuer, DecisionType)
+from ndg.saml.saml2.binding.soap.server.wsgi.mockqueryinterface import (
+    MockQueryInterface, MockQueryInterfaceMiddleware, MockQueryInterfaceFault,
+    MockQueryInterfaceConfigError, LatencyDistribution)
+from ndg.saml.xml.etree import AttributeQueryElementTree, ResponseElementTree
+from ndg.saml.test.support import makeAttributeQuery, makeAuthzDecisionQuery
+from ndg.saml.test.binding.soap import (WithPasteFixtureBaseTestCase,
+                                        paste_installed)
+
+
+def _createResponse():
+    """Make a response initialised as the SOAP query interface middleware
+    does"""
+    response = Response()
+    response.issueInstant = datetime.utcnow()
+    response.id = str(uuid4())
+    response.inResponseTo = str(uuid4())
+    response.issuer = Issuer()
+    response.status = Status()
+    response.status.statusCode = StatusCode()
+    response.status.statusCode.value = StatusCode.SUCCESS_URI
+    response.status.statusMessage = StatusMessage()
+    return response
+
+
+class MockQueryInterfaceTestCase(unittest.TestCase):
+    """Test mock query interface settings and responses"""
+
+    def test01AttributeQuery(self):
+        queryInterface = MockQueryInterface()
+        queryInterface.nValues = '3'
+        queryInterface.valueSize = 16
+
+        response = queryInterface(makeAttributeQuery(4), _createResponse())
+        attributes = response.assertions[0].attributeStatements[0].attributes
+        self.assert_(len(attributes) == 4)
+        self.assert_(len(attributes[0].attributeValues) == 3)
+        self.assert_(len(attributes[0].attributeValues[0].value) == 16)
+
+        # Queries listing no attributes get nAttributes attributes
+        queryInterface.nAttributes = 5
+        response = queryInterface(makeAttributeQuery(0), _createResponse())
+        attributes = response.assertions[0].attributeStatements[0].attributes
+        self.assert_(len(attributes) == 5)
+
+        # Check the response can be serialised
+        ResponseElementTree.toXML(response)
+
+    def test02DecisionMix(self):
+        queryInterface = MockQueryInterface()
+        queryInterface.decisionMix = 'permit=3 deny=1'
+        queryInterface.seed = 1
+
+        decisions = [queryInterface(makeAuthzDecisionQuery(),
+                                    _createResponse()
+                        ).assertions[0].authzDecisionStatements[0].decision
+                     for i in range(400)]
+        nPermit = decisions.count(DecisionType.PERMIT)
+        self.assert_(250 < nPermit < 350)
+        self.assert_(nPermit + decisions.count(DecisionType.DENY) == 400)
+
+        self.assertRaises(MockQueryInterfaceConfigError, setattr,
+                          queryInterface, 'decisionMix', 'maybe=1')
+
+    def test03Errors(self):
+        queryInterface = MockQueryInterface()
+        queryInterface.errorRate = '1'
+        response = queryInterface(makeAttributeQuery(), _createResponse())
+        self.assert_(response.status.statusCode.value ==
+                     StatusCode.RESPONDER_URI)
+        self.assert_(len(response.assertions) == 0)
+
+        queryInterface.faultRate = 1.
+        self.assertRaises(MockQueryInterfaceFault, queryInterface,
+                          makeAttributeQuery(), _createResponse())
+
+        self.assertRaises(ValueError, setattr, queryInterface, 'errorRate',
+                          1.5)
+
+    def test04LatencyDistribution(self):
+        latency = LatencyDistribution('uniform:0.01,0.02')
+        self.assert_(0.01 <= latency.sample() <= 0.02)
+        self.assert_(LatencyDistribution('exponential:0').sample() == 0.)
+        self.assert_(LatencyDistribution('normal:-1,0').sample() == 0.)
+
+        self.assertRaises(MockQueryInterfaceConfigError, LatencyDistribution,
+                          'pareto:1')
+        self.assertRaises(MockQueryInterfaceConfigError, LatencyDistribution,
+                          'uniform:1')
+
+    def test05Middleware(self):
+        app = MockQueryInterfaceMiddleware.filter_app_factory(
+                    lambda environ, start_response: environ['QUERY_IFACE'],
+                    {},
+                    prefix='mock.',
+                    **{'mock.queryInterfaceKeyName': 'QUERY_IFACE',
+                       'mock.nValues': '2',
+                       'mock.latency': 'constant:0'})
+        queryInterface = app({}, None)
+        self.assert_(isinstance(queryInterface, MockQueryInterface))
+        self.assert_(queryInterface.nValues == 2)
+
+
+class MockQueryInterfacePasteTestCase(WithPasteFixtureBaseTestCase):
+    """Test the mock query interfaces served with the SOAP query interface
+    middleware from a Paste ini file"""
+    CONFIG_FILENAME = 'mock-query-interface.ini'
+    SERVICE_URI = '/attributeauthority'
+
+    @unittest.skipIf(not paste_installed, 'Need Paste.Deploy to run '
+                     'MockQueryInterfacePasteTestCase')
+    def test01AttributeQuery(self):
+        query = makeAttributeQuery(3)
+        soapRequest = SOAPEnvelope()
+        soapRequest.create()
+        soapRequest.body.elem.append(AttributeQueryElementTree.toXML(query))
+
+        header = {
+            'soapAction': "http://www.oasis-open.org/committees/security",
+            'Content-type': 'text/xml'
+        }
+        response = self.app.post(self.__class__.SERVICE_URI,
+                                 params=soapRequest.serialize(),
+                                 headers=header,
+                                 status=200)
+        soapResponse = SOAPEnvelope()
+        soapResponse.parse(StringIO(response.body))
+        samlResponse = ResponseElementTree.fromXML(soapResponse.body.elem[0])
+        self.assert_(samlResponse.status.statusCode.value ==
+                     StatusCode.SUCCESS_URI)
+        self.assert_(len(samlResponse.assertions[0].attributeStatements[0
+                                                        ].attributes) == 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,14 +9,28 @@ __copyright__ = "(C) 2010 Science and Technology Facilities Council"
 __license__ = "http://www.apache.org/licenses/LICENSE-2.0"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id$'
+import os
+import json
 import unittest
 
 from datetime import timedelta
+from cStringIO import StringIO
+from tempfile import mkstemp
+
+from ndg.soap.etree import SOAPEnvelope
 from ndg.saml.saml2.binding.soap.server.wsgi.queryinterface import \
     SOAPQueryInterfaceMiddleware
     
 from ndg.saml.xml.etree import AttributeQueryElementTree    
 from ndg.saml.xml.etree import ResponseElementTree
+from ndg.soap.utils.tracing import (TraceContext, JSONFileSpanExporter,
+                                    SpanObserver, setCurrentTraceContext)
+from ndg.soap.utils.compression import (chooseEncoding, compress, 
+                                        decompress)
+from ndg.saml.saml2.binding.soap.client.attributequery import \
+    AttributeQuerySOAPBinding
+from ndg.saml.test.support import (makeAttributeQuery, WSGIHandler,
+                                   StubQueryInterface)
 
 
 class SOAPQueryInterfaceMiddlewareTestCase(unittest.TestCase):
@@ -39,6 +53,160 @@ class SOAPQueryInterfaceMiddlewareTestCase(unittest.TestCase):
         self.assert_(queryIface.serialise == ResponseElementTree.toXML)
         self.assert_(queryIface.clockSkewTolerance == timedelta(seconds=60*3))
 
+    def test02Metrics(self):
+        queryIface = SOAPQueryInterfaceMiddleware(None)
+        queryIface.initialise({}, 
+                              mountPath='/attribute-authority',
+                              metricsPath='/metrics',
+                              queryInterfaceKeyName='QUERY_IFACE_KEY',
+                              deserialise=AttributeQueryElementTree.fromXML,
+                              serialise=ResponseElementTree.toXML)
+        self.assert_(queryIface.metrics is not None)
+        
+        soapRequest = SOAPEnvelope()
+        soapRequest.create()
+        soapRequest.body.elem.append(
+                        AttributeQueryElementTree.toXML(makeAttributeQuery()))
+        request = soapRequest.serialize()
+        
+        def start_response(status, headers):
+            self.assert_(status == '200 OK')
+            
+        environ = {
+            'PATH_INFO': '/attribute-authority',
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': str(len(request)),
+            'wsgi.input': StringIO(request),
+            'QUERY_IFACE_KEY': lambda query, response: None
+        }
+        response = queryIface(environ, start_response)[0]
+        
+        stats = queryIface.metrics.dump()['/attribute-authority']
+        self.assert_(stats['requests'] == 1)
+        self.assert_(stats['bytesSent'] == len(request))
+        self.assert_(stats['bytesReceived'] == len(response))
+        self.assert_(stats['phases'].keys() == [
+            'bodyRead', 'envelopeParse', 'deserialise', 'validation', 
+            'queryInterface', 'serialise', 'envelopeSerialise', 'total'])
+        
+        metrics = queryIface({'PATH_INFO': '/metrics', 
+                              'REQUEST_METHOD': 'GET'}, start_response)[0]
+        self.assert_('ndg_saml_query_interface_requests_total'
+                     '{endpoint="/attribute-authority"} 1' in metrics)
+        self.assert_('ndg_saml_query_interface_phase_seconds_count'
+                     '{endpoint="/attribute-authority",phase="total"} 1' 
+                     in metrics)
+
+        
+    def test03TraceContext(self):
+        traceparent = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+        context = TraceContext.parse(traceparent)
+        self.assert_(context.toHeader() == traceparent)
+        self.assert_(context.newChild().parentId == context.spanId)
+        self.assert_(TraceContext.parse('00-%s-00f067aa0ba902b7-01' % 
+                                        ('0'*32)) is None)
+        self.assert_(TraceContext.parse('garbage') is None)
+        
+        fd, spanFilePath = mkstemp()
+        os.close(fd)
+        try:
+            queryIface = SOAPQueryInterfaceMiddleware(None)
+            queryIface.initialise({}, 
+                    mountPath='/attribute-authority',
+                    queryInterfaceKeyName='QUERY_IFACE_KEY',
+                    deserialise=AttributeQueryElementTree.fromXML,
+                    serialise=ResponseElementTree.toXML,
+                    traceExporter='ndg.soap.utils.tracing:'
+                                  'JSONFileSpanExporter',
+                    **{'traceExporter.filePath': spanFilePath})
+            
+            def app(environ, start_response):
+                environ['QUERY_IFACE_KEY'] = StubQueryInterface()
+                return queryIface(environ, start_response)
+            
+            binding = AttributeQuerySOAPBinding()
+            binding.client.openerDirector.add_handler(WSGIHandler(app))
+            binding.client.propagateTraceContext = True
+            binding.client.traceContextHeaderBlock = True
+            binding.observers = [SpanObserver(
+                                        JSONFileSpanExporter(spanFilePath))]
+            
+            # Client requests are children of the current thread's context
+            previousContext = setCurrentTraceContext(context)
+            try:
+                binding.send(makeAttributeQuery(), 
+                             uri='http://localhost/attribute-authority')
+            finally:
+                setCurrentTraceContext(previousContext)
+            
+            spans = [json.loads(line) for line in open(spanFilePath)]
+        finally:
+            os.remove(spanFilePath)
+            
+        serverSpans = [span for span in spans 
+                       if span['attributes'].get('kind') == 'server']
+        clientSpans = [span for span in spans 
+                       if span['attributes'].get('kind') == 'client']
+        self.assert_(len(serverSpans) == 1 and len(clientSpans) == 1)
+        self.assert_(set([span['traceId'] for span in spans]) == 
+                     set([context.traceId]))
+        self.assert_(clientSpans[0]['parentId'] == context.spanId)
+        self.assert_(serverSpans[0]['parentId'] == clientSpans[0]['spanId'])
+        self.assert_('queryInterface' in [span['name'] for span in spans
+                        if span['parentId'] == serverSpans[0]['spanId']])
+
+        
+    def test04Compression(self):
+        self.assert_(chooseEncoding('deflate;q=0.5, gzip') == 'gzip')
+        self.assert_(chooseEncoding('*;q=0.2, gzip;q=0') == 'deflate')
+        self.assert_(chooseEncoding('identity') is None)
+        self.assert_(decompress(compress('x'*100, 'deflate'), 
+                                'deflate') == 'x'*100)
+        
+        queryIface = SOAPQueryInterfaceMiddleware(None)
+        queryIface.initialise({}, 
+                              mountPath='/attribute-authority',
+                              queryInterfaceKeyName='QUERY_IFACE_KEY',
+                              deserialise=AttributeQueryElementTree.fromXML,
+                              serialise=ResponseElementTree.toXML,
+                              compressResponses='true',
+                              compressMinSize='100')
+        encodings = []
+        
+        def app(environ, start_response):
+            environ['QUERY_IFACE_KEY'] = StubQueryInterface(nValues=20)
+            
+            def _start_response(status, headers):
+                encodings.append((environ.get('HTTP_CONTENT_ENCODING'),
+                                  dict(headers).get('Content-encoding')))
+                return start_response(status, headers)
+            
+            return queryIface(environ, _start_response)
+        
+        binding = AttributeQuerySOAPBinding()
+        binding.client.openerDirector.add_handler(WSGIHandler(app))
+        binding.parseKeywords(prefix='attributeQuery.', 
+                              **{'attributeQuery.compression': 'gzip',
+                                 'attributeQuery.compressLevel': '9',
+                                 'attributeQuery.compressMinSize': '100'})
+        self.assert_(binding.client.compressLevel == 9)
+        
+        query = makeAttributeQuery(10)
+        response = binding.send(query, 
+                                uri='http://localhost/attribute-authority')
+        self.assert_(encodings == [('gzip', 'gzip')])
+        self.assert_(response.inResponseTo == query.id)
+        self.assert_(len(response.assertions[0].attributeStatements[0
+                                                        ].attributes) == 10)
+        
+        # Small requests are sent uncompressed and clients not accepting
+        # compression get uncompressed responses
+        binding.compressMinSize = 1024*1024
+        binding.send(query, uri='http://localhost/attribute-authority')
+        binding.compression = 'none'
+        binding.send(query, uri='http://localhost/attribute-authority')
+        self.assert_(encodings[1:] == [(None, 'gzip'), (None, None)])
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
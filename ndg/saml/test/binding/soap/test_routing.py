@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""Unit tests for routing SAML SOAP queries between replicated services
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import time
+import unittest
+
+from ndg.soap.transport import TransportCancelled
+from ndg.soap.utils.routing import (EndpointSelector, EndpointStats,
+                                    ConsistentHashSelector,
+                                    NoEndpointAvailableError)
+from ndg.saml.xml.etree import AttributeQueryElementTree
+from ndg.saml.test.support import (makeApp, makeAttributeQuery,
+                                   makeAttributeQueryBinding,
+                                   StubQueryInterface)
+
+
+class RoutedQueryTestCase(unittest.TestCase):
+    """Route queries between two replicas, one of which can be made to fail
+    """
+    GOOD_URI = 'http://good.localhost/saml'
+    BAD_URI = 'http://bad.localhost/saml'
+    
+    def setUp(self):
+        self.badReplicaDown = True
+        self.hits = {'good': 0, 'bad': 0}
+        goodApp = makeApp(StubQueryInterface(),
+                          AttributeQueryElementTree.fromXML)
+        
+        def app(environ, start_response):
+            if environ['SERVER_NAME'].startswith('bad'):
+                self.hits['bad'] += 1
+                if self.badReplicaDown:
+                    start_response('503 Service Unavailable', 
+                                   [('Content-type', 'text/plain')])
+                    return ['Service Unavailable']
+            else:
+                self.hits['good'] += 1
+                
+            return goodApp(environ, start_response)
+        
+        self.binding = makeAttributeQueryBinding(app)
+        
+    def _send(self):
+        query = makeAttributeQuery()
+        response = self.binding.send(query)
+        self.assert_(response.inResponseTo == query.id)
+        
+    def test01CircuitBreaker(self):
+        self.binding.parseKeywords(**{
+            'uris': '%s, %s' % (self.GOOD_URI, self.BAD_URI),
+            'endpointSelector.failureThreshold': '2',
+            'endpointSelector.cooldown': '0.2'
+        })
+        selector = self.binding.endpointSelector
+        self.assert_(selector.uris == (self.GOOD_URI, self.BAD_URI))
+        
+        # Failures are raised to the caller until the breaker opens
+        nFailures = 0
+        while (selector.stats[self.BAD_URI]['state'] != 
+               EndpointStats.OPEN):
+            try:
+                self._send()
+            except Exception:
+                nFailures += 1
+            self.assert_(nFailures <= 2)
+            
+        self.assert_(nFailures == 2)
+        
+        # No more queries go to the failed replica until the cooldown ends
+        nBadHits = self.hits['bad']
+        for i in range(10):
+            self._send()
+        self.assert_(self.hits['bad'] == nBadHits)
+        
+        # The trial request after the cooldown closes the breaker
+        self.badReplicaDown = False
+        time.sleep(0.2)
+        self.assert_(selector.getAvailableUris() == [self.GOOD_URI, 
+                                                     self.BAD_URI])
+        while self.hits['bad'] == nBadHits:
+            self._send()
+        self.assert_(selector.stats[self.BAD_URI]['state'] == 
+                     EndpointStats.CLOSED)
+        
+    def test02SpreadLoad(self):
+        self.badReplicaDown = False
+        self.binding.uris = (self.GOOD_URI, self.BAD_URI)
+        for i in range(40):
+            self._send()
+            
+        self.assert_(self.hits['good'] > 0)
+        self.assert_(self.hits['bad'] > 0)
+        stats = self.binding.endpointSelector.stats
+        self.assert_(stats[self.GOOD_URI]['requests'] + 
+                     stats[self.BAD_URI]['requests'] == 40)
+        self.assert_(stats[self.GOOD_URI]['latency'] is not None)
+        
+    def test03NoEndpointAvailable(self):
+        selector = EndpointSelector(uris=self.BAD_URI, failureThreshold=1)
+        self.binding.endpointSelector = selector
+        self.assertRaises(Exception, self._send)
+        self.assertRaises(NoEndpointAvailableError, self._send)
+        
+    def test04CancelledTrial(self):
+        selector = EndpointSelector(uris=(self.GOOD_URI, self.BAD_URI),
+                                    failureThreshold=1, cooldown=0.05)
+        
+        def fail(uri):
+            raise IOError('Connection refused')
+        
+        def cancel(uri):
+            raise TransportCancelled('Request cancelled')
+        
+        self.assertRaises(IOError, selector.call, self.BAD_URI, fail)
+        self.assert_(selector.getAvailableUris() == [self.GOOD_URI])
+        time.sleep(0.05)
+        
+        # Only one trial request is chosen after the cooldown
+        self.assert_(selector.select(exclude=(self.GOOD_URI,)) == 
+                     self.BAD_URI)
+        self.assert_(selector.stats[self.BAD_URI]['state'] == 
+                     EndpointStats.HALF_OPEN)
+        self.assert_(selector.getAvailableUris() == [self.GOOD_URI])
+        
+        # Cancelling the trial allows another one
+        self.assertRaises(TransportCancelled, selector.call, self.BAD_URI, 
+                          cancel)
+        self.assert_(selector.stats[self.BAD_URI]['state'] == 
+                     EndpointStats.OPEN)
+        self.assert_(selector.getAvailableUris() == [self.GOOD_URI, 
+                                                     self.BAD_URI])
+        
+        
+class HashRoutedQueryTestCase(unittest.TestCase):
+    """Route queries between replicas by subject"""
+    URIS = tuple(['http://replica%d.localhost/saml' % i for i in range(3)])
+    N_SUBJECTS = 30
+    
+    def setUp(self):
+        self.hits = []
+        replicaApp = makeApp(StubQueryInterface(),
+                             AttributeQueryElementTree.fromXML)
+        
+        def app(environ, start_response):
+            self.hits.append(environ['SERVER_NAME'])
+            return replicaApp(environ, start_response)
+        
+        self.binding = makeAttributeQueryBinding(app)
+        
+    def _route(self):
+        """Send a query for each subject returning the replica host used for
+        each"""
+        replicas = {}
+        for i in range(self.N_SUBJECTS):
+            subjectId = 'https://openid.localhost/%d' % i
+            query = makeAttributeQuery()
+            query.subject.nameID.value = subjectId
+            self.binding.send(query)
+            replicas[subjectId] = self.hits[-1]
+            
+        return replicas
+    
+    def test01RouteBySubject(self):
+        self.binding.parseKeywords(**{
+            'uris': ' '.join(self.URIS),
+            'endpointSelector.routing': 'hash'
+        })
+        self.assert_(isinstance(self.binding.endpointSelector, 
+                                ConsistentHashSelector))
+        
+        # Queries for a subject always go to the same replica and the 
+        # subjects are spread between them
+        replicas = self._route()
+        self.assert_(self._route() == replicas)
+        self.assert_(len(set(replicas.values())) == len(self.URIS))
+        
+        # Removing a replica only moves the subjects routed to it
+        self.binding.uris = self.URIS[:2]
+        newReplicas = self._route()
+        for subjectId, replica in replicas.items():
+            if not replica.startswith('replica2'):
+                self.assert_(newReplicas[subjectId] == replica)
+            
+    def test02BoundedLoad(self):
+        selector = ConsistentHashSelector(uris=self.URIS, loadFactor=1.25)
+        uri = selector.select(key='subject')
+        
+        # An endpoint with more than its share of the requests in progress is
+        # passed over
+        for i in range(3):
+            selector._begin(uri)
+        self.assert_(selector.select(key='subject') != uri)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Emulation of the pickling of SAML objects before compact __reduce__ based
+pickling was implemented, for testing that old pickles can still be loaded
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import copy_reg
+
+from ndg.saml.common import SAMLObject, SAMLVersion
+from ndg.saml.common.xml import QName
+from ndg.saml.saml2.core import DecisionType
+from ndg.saml.utils import (TypedList, reduceSlots, restoreSlots, 
+                            restoreNamedSlots)
+
+
+def _allSubclasses(cls):
+    """Get a class and all its subclasses
+    
+    @type cls: type
+    @param cls: base class
+    @rtype: list
+    @return: classes
+    """
+    classes = [cls]
+    for subclass in cls.__subclasses__():
+        classes.extend(_allSubclasses(subclass))
+    return classes
+
+
+class LegacyPickling(object):
+    """Context manager to pickle SAML objects with the attribute dictionary
+    state returned by their __getstate__ methods, as they were before 
+    __reduce__ was implemented.  Reduction functions are registered in the
+    copy_reg dispatch table which takes precedence over __reduce__.
+    """
+    def __init__(self, protocol):
+        """
+        @type protocol: int
+        @param protocol: pickle protocol to emulate the previous behaviour 
+        for
+        """
+        self.protocol = protocol
+        self.classes = (_allSubclasses(SAMLObject) + 
+                        _allSubclasses(DecisionType) + 
+                        [SAMLVersion, QName, TypedList])
+        self.savedDispatchTable = None
+        
+    def reduce(self, obj):
+        """Reduce object as the default pickle implementation would have
+        
+        @param obj: object to reduce
+        @type obj: object
+        @rtype: tuple
+        @return: reduce value
+        """
+        if self.protocol < 2:
+            if isinstance(obj, list):
+                # As copy_reg._reduce_ex for list subclasses without slots
+                return (copy_reg._reconstructor, (obj.__class__, list, 
+                                                  list(obj)), obj.__dict__)
+            
+            return copy_reg._reduce_ex(obj, self.protocol)
+        
+        if hasattr(obj, '__getstate__'):
+            state = obj.__getstate__()
+        else:
+            state = obj.__dict__
+            
+        if isinstance(obj, list):
+            return copy_reg.__newobj__, (obj.__class__,), state, iter(obj)
+        else:
+            return copy_reg.__newobj__, (obj.__class__,), state
+            
+    def __enter__(self):
+        self.savedDispatchTable = copy_reg.dispatch_table.copy()
+        for cls in self.classes:
+            copy_reg.dispatch_table[cls] = self.reduce
+        return self
+    
+    def __exit__(self, *arg):
+        copy_reg.dispatch_table.clear()
+        copy_reg.dispatch_table.update(self.savedDispatchTable)
+
+
+class TransientSlotsPickling(object):
+    """Context manager to pickle SAML objects with reduceSlots as they would
+    have been before the slots listed in TRANSIENT_ATTRIBUTES were added to 
+    the SAML classes
+    """
+    def __init__(self, named=True):
+        """
+        @type named: bool
+        @param named: set to False to emulate the first version of 
+        reduceSlots which recorded slot values without their names
+        """
+        self.named = named
+        self.savedDispatchTable = None
+        
+    def reduce(self, obj):
+        """Reduce object omitting its transient slots
+        
+        @param obj: object to reduce
+        @type obj: object
+        @rtype: tuple
+        @return: reduce value
+        """
+        args = reduceSlots(obj)[1]
+        cls, slotNames, values = args[:3]
+        state = [(slotName, value) 
+                 for slotName, value in zip(slotNames, values)
+                 if slotName.rsplit('__', 1)[-1] 
+                 not in cls.TRANSIENT_ATTRIBUTES]
+        slotNames = tuple([slotName for slotName, value in state])
+        values = tuple([value for slotName, value in state])
+        if self.named:
+            return restoreNamedSlots, (cls, slotNames, values) + args[3:]
+        else:
+            return restoreSlots, (cls, values) + args[3:]
+            
+    def __enter__(self):
+        self.savedDispatchTable = copy_reg.dispatch_table.copy()
+        for cls in _allSubclasses(SAMLObject):
+            copy_reg.dispatch_table[cls] = self.reduce
+        return self
+    
+    def __exit__(self, *arg):
+        copy_reg.dispatch_table.clear()
+        copy_reg.dispatch_table.update(self.savedDispatchTable)
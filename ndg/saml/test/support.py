@@ -0,0 +1,373 @@
+"""Fixtures shared by the unit tests and benchmarks: SAML query factories, a
+stub SAML query interface and a urllib2 handler which connects client bindings
+to the SOAP query interface WSGI middleware in memory so that no sockets are
+used
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import sys
+import json
+import time
+import httplib
+import urllib2
+import subprocess
+from urlparse import urlparse
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from ndg.saml.saml2.core import (SAMLVersion, Assertion, Attribute,
+                                 AttributeStatement, AuthzDecisionStatement,
+                                 AttributeQuery, AuthzDecisionQuery, Action,
+                                 DecisionType, Issuer, Subject, NameID,
+                                 Conditions, XSStringAttributeValue)
+from ndg.saml.saml2.binding.soap.client.attributequery import \
+    AttributeQuerySOAPBinding
+from ndg.saml.saml2.binding.soap.server.wsgi.queryinterface import \
+    SOAPQueryInterfaceMiddleware
+from ndg.saml.xml.etree import ResponseElementTree
+
+ISSUER_DN = "/O=NDG/OU=BADC/CN=attributeauthority.badc.rl.ac.uk"
+NAMEID_FORMAT = "urn:esg:openid"
+NAMEID_VALUE = "https://openid.localhost/philip.kershaw"
+ATTRIBUTE_NAME_FORMAT = XSStringAttributeValue.DEFAULT_FORMAT
+RESOURCE_URI = "http://localhost/My%20Secured%20URI"
+
+SERVICE_URI = "http://localhost/saml"
+QUERY_INTERFACE_KEYNAME = 'ndg.saml.test.support.queryInterface'
+
+# Modules loaded on first use only - importing the SAML and SOAP bindings must
+# not pull them in
+LAZY_MODULES = ('OpenSSL', 'M2Crypto', 'cryptography', 'ndg.xacml',
+                'ndg.saml.xml.etree_xacml_profile')
+
+# Run in the child interpreter: import the module given and report the time
+# taken and the modules loaded as JSON
+_IMPORT_SCRIPT = """
+import sys, json
+from timeit import default_timer
+before = set(sys.modules)
+start = default_timer()
+__import__(sys.argv[1])
+elapsed = default_timer() - start
+loaded = [name for name in set(sys.modules) - before
+          if sys.modules[name] is not None]
+sys.stdout.write(json.dumps(dict(seconds=elapsed, modules=sorted(loaded))))
+"""
+
+
+def makeAttributeQuery(nAttributes=10):
+    """Make an attribute query requesting the given number of attributes
+
+    @type nAttributes: int
+    @param nAttributes: number of attributes to request
+    @rtype: ndg.saml.saml2.core.AttributeQuery
+    @return: SAML attribute query
+    """
+    query = AttributeQuery()
+    query.version = SAMLVersion(SAMLVersion.VERSION_20)
+    query.id = str(uuid4())
+    query.issueInstant = datetime.utcnow()
+
+    query.issuer = Issuer()
+    query.issuer.format = Issuer.X509_SUBJECT
+    query.issuer.value = ISSUER_DN
+
+    query.subject = Subject()
+    query.subject.nameID = NameID()
+    query.subject.nameID.format = NAMEID_FORMAT
+    query.subject.nameID.value = NAMEID_VALUE
+
+    for iAttribute in range(nAttributes):
+        attribute = Attribute()
+        attribute.name = "urn:badc:security:authz:1.0:attr:%d" % iAttribute
+        attribute.nameFormat = ATTRIBUTE_NAME_FORMAT
+        attribute.friendlyName = "attr%d" % iAttribute
+        query.attributes.append(attribute)
+
+    return query
+
+
+def makeAuthzDecisionQuery(resourceURI=RESOURCE_URI):
+    """Make an authorisation decision query for a HTTP GET of the given
+    resource
+
+    @type resourceURI: basestring
+    @param resourceURI: resource URI
+    @rtype: ndg.saml.saml2.core.AuthzDecisionQuery
+    @return: SAML authorisation decision query
+    """
+    query = AuthzDecisionQuery()
+    query.version = SAMLVersion(SAMLVersion.VERSION_20)
+    query.id = str(uuid4())
+    query.issueInstant = datetime.utcnow()
+
+    query.issuer = Issuer()
+    query.issuer.format = Issuer.X509_SUBJECT
+    query.issuer.value = ISSUER_DN
+
+    query.subject = Subject()
+    query.subject.nameID = NameID()
+    query.subject.nameID.format = NAMEID_FORMAT
+    query.subject.nameID.value = NAMEID_VALUE
+
+    query.resource = resourceURI
+
+    action = Action()
+    action.namespace = Action.GHPP_NS_URI
+    action.value = Action.HTTP_GET_ACTION
+    query.actions.append(action)
+
+    return query
+
+
+class WSGIHandler(urllib2.BaseHandler):
+    """urllib2 handler passing requests directly to a WSGI application
+    instead of over a socket
+    """
+    # Ensure this handler takes precedence over urllib2.HTTPHandler
+    handler_order = 100
+
+    def __init__(self, app):
+        """
+        @type app: callable
+        @param app: WSGI application
+        """
+        self.app = app
+
+    def callApp(self, environ, start_response):
+        """Call the WSGI application and collect the response body
+
+        @type environ: dict
+        @param environ: WSGI environment
+        @type start_response: callable
+        @param start_response: WSGI start response callable
+        @rtype: string
+        @return: response body
+        """
+        result = self.app(environ, start_response)
+        try:
+            return ''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def http_open(self, req):
+        """Call the WSGI application with the request
+
+        @type req: urllib2.Request
+        @param req: request
+        @rtype: urllib.addinfourl
+        @return: response
+        """
+        data = req.get_data() or ''
+        url = urlparse(req.get_full_url())
+        environ = {
+            'REQUEST_METHOD': req.get_method(),
+            'SCRIPT_NAME': '',
+            'PATH_INFO': url.path or '/',
+            'QUERY_STRING': url.query,
+            'CONTENT_LENGTH': str(len(data)),
+            'SERVER_NAME': url.hostname or 'localhost',
+            'SERVER_PORT': str(url.port or 80),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': url.scheme,
+            'wsgi.input': StringIO(data),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        headers = dict(req.headers)
+        headers.update(req.unredirected_hdrs)
+        for name, value in headers.items():
+            name = name.upper().replace('-', '_')
+            if name == 'CONTENT_TYPE':
+                environ[name] = value
+            elif name != 'CONTENT_LENGTH':
+                environ['HTTP_' + name] = value
+
+        responseStatus = []
+        def start_response(status, responseHeaders, exc_info=None):
+            responseStatus[:] = [status, responseHeaders]
+
+        body = self.callApp(environ, start_response)
+
+        status, responseHeaders = responseStatus
+        headerText = ''.join(['%s: %s\r\n' % i for i in responseHeaders])
+        response = urllib2.addinfourl(StringIO(body),
+                                      httplib.HTTPMessage(StringIO(headerText)),
+                                      req.get_full_url(),
+                                      int(status.split()[0]))
+        response.msg = status.split(None, 1)[-1]
+        return response
+
+    https_open = http_open
+
+
+class StubQueryInterface(object):
+    """Configurable stub for the SAML query interface called by the SOAP
+    query interface middleware
+    """
+    def __init__(self, nValues=1, decision=DecisionType.PERMIT, latency=0.):
+        """
+        @type nValues: int
+        @param nValues: number of values returned for each attribute queried
+        @type decision: ndg.saml.saml2.core.DecisionType
+        @param decision: authorisation decision returned
+        @type latency: float
+        @param latency: time in seconds to sleep to simulate an attribute or
+        policy store look up
+        """
+        self.nValues = nValues
+        self.decision = decision
+        self.latency = latency
+
+    def __call__(self, query, response):
+        """Populate the response for the query
+
+        @type query: ndg.saml.saml2.core.SubjectQuery
+        @param query: SAML query
+        @type response: ndg.saml.saml2.core.Response
+        @param response: response to populate
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        response.issuer.format = Issuer.X509_SUBJECT
+        response.issuer.value = ISSUER_DN
+
+        assertion = Assertion()
+        assertion.version = SAMLVersion(SAMLVersion.VERSION_20)
+        assertion.id = str(uuid4())
+        assertion.issueInstant = response.issueInstant
+
+        assertion.issuer = Issuer()
+        assertion.issuer.format = Issuer.X509_SUBJECT
+        assertion.issuer.value = ISSUER_DN
+
+        assertion.subject = Subject()
+        assertion.subject.nameID = NameID()
+        assertion.subject.nameID.format = query.subject.nameID.format
+        assertion.subject.nameID.value = query.subject.nameID.value
+
+        assertion.conditions = Conditions()
+        assertion.conditions.notBefore = response.issueInstant
+        assertion.conditions.notOnOrAfter = (response.issueInstant +
+                                             timedelta(seconds=60*60*8))
+
+        if isinstance(query, AttributeQuery):
+            attributeStatement = AttributeStatement()
+            for queryAttribute in query.attributes:
+                attribute = Attribute()
+                attribute.name = queryAttribute.name
+                attribute.nameFormat = queryAttribute.nameFormat
+                if queryAttribute.friendlyName is not None:
+                    attribute.friendlyName = queryAttribute.friendlyName
+
+                for iValue in range(self.nValues):
+                    attributeValue = XSStringAttributeValue()
+                    attributeValue.value = "%s:%d" % (queryAttribute.name,
+                                                      iValue)
+                    attribute.attributeValues.append(attributeValue)
+
+                attributeStatement.attributes.append(attribute)
+
+            assertion.attributeStatements.append(attributeStatement)
+
+        elif isinstance(query, AuthzDecisionQuery):
+            authzDecisionStatement = AuthzDecisionStatement()
+            authzDecisionStatement.decision = self.decision
+            authzDecisionStatement.resource = query.resource
+            authzDecisionStatement.actions.extend(query.actions)
+            assertion.authzDecisionStatements.append(authzDecisionStatement)
+
+        response.assertions.append(assertion)
+
+
+def makeApp(queryInterface, deserialise, serialise=ResponseElementTree.toXML):
+    """Make the WSGI application stack for the service
+
+    @type queryInterface: callable
+    @param queryInterface: SAML query interface
+    @type deserialise: callable
+    @param deserialise: service query deserialisation callable
+    @type serialise: callable
+    @param serialise: service response serialisation callable
+    @rtype: callable
+    @return: WSGI application
+    """
+    def notFoundApp(environ, start_response):
+        start_response('404 Not Found', [('Content-type', 'text/plain')])
+        return ['Not Found']
+
+    middleware = SOAPQueryInterfaceMiddleware(notFoundApp)
+    middleware.initialise({},
+        mountPath=urlparse(SERVICE_URI).path,
+        queryInterfaceKeyName=QUERY_INTERFACE_KEYNAME,
+        deserialise=deserialise,
+        serialise=serialise,
+        clockSkewTolerance=60.)
+
+    def app(environ, start_response):
+        environ[QUERY_INTERFACE_KEYNAME] = queryInterface
+        return middleware(environ, start_response)
+
+    return app
+
+
+def makeAttributeQueryBinding(app=None):
+    """Make an attribute query client binding tolerant of clock skew between
+    client and stub service
+
+    @type app: callable / NoneType
+    @param app: WSGI application to connect the binding to in memory.  If
+    None, requests are made over the network as normal
+    @rtype: ndg.saml.saml2.binding.soap.client.attributequery.
+    AttributeQuerySOAPBinding
+    @return: binding
+    """
+    binding = AttributeQuerySOAPBinding()
+    binding.clockSkewTolerance = 60.
+    if app is not None:
+        binding.client.openerDirector.add_handler(WSGIHandler(app))
+    return binding
+
+
+def isLazyModule(moduleName):
+    """@type moduleName: string
+    @param moduleName: module name
+    @rtype: bool
+    @return: True if the module is one of LAZY_MODULES or a submodule of one
+    """
+    for name in LAZY_MODULES:
+        if moduleName == name or moduleName.startswith(name + '.'):
+            return True
+    return False
+
+
+def importModule(moduleName):
+    """Import a module in a fresh interpreter so that no other module is
+    already cached
+
+    @type moduleName: string
+    @param moduleName: module to import
+    @rtype: dict
+    @return: time in seconds and the modules loaded by the import
+    @raise RuntimeError: the import failed
+    """
+    proc = subprocess.Popen([sys.executable, '-c', _IMPORT_SCRIPT, moduleName],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output, error = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("Error importing %r: %s" % (moduleName,
+                                                       error.strip()))
+    return json.loads(output)
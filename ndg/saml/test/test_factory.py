@@ -25,9 +25,22 @@ __license__ = "http://www.apache.org/licenses/LICENSE-2.0"
 __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id$'
 import unittest
+from ConfigParser import SafeConfigParser
 
 from ndg.saml.utils.factory import (AttributeQueryFactory, 
-                                    AuthzDecisionQueryFactory)
+                                    AuthzDecisionQueryFactory,
+                                    CompiledConfig, importModuleObject)
+from ndg.soap.transport import HTTPConnectionPoolTransport, UrlLib2Transport
+from ndg.saml.saml2.binding.soap.client.attributequery import (
+                                                AttributeQuerySOAPBinding,
+                                                AttributeQuerySslSOAPBinding)
+from ndg.saml.utils.ssl_context import importSSLContextProxy
+
+try:
+    importSSLContextProxy()
+    ssl_backend_installed = True
+except ImportError:
+    ssl_backend_installed = False
 
 
 class AttributeQueryFactoryTestCase(unittest.TestCase):
@@ -87,6 +100,32 @@ class AttributeQueryFactoryTestCase(unittest.TestCase):
                           attr.name, 
                           self.config['attributeQuery.attributes.0']))
 
+    def test03_template(self):
+        template = AttributeQueryFactory.template_from_kw(
+                                                    prefix='attributeQuery.',
+                                                    **self.config)
+        query1 = template.instantiate(subject_id='https://openid.a/alice')
+        query2 = template.instantiate(subject_id='https://openid.a/bob')
+        
+        self.assertEqual(query1.subject.nameID.value, 'https://openid.a/alice')
+        self.assertEqual(query2.subject.nameID.format, 'urn:esg:openid')
+        self.assertNotEqual(query1.id, query2.id)
+        self.assertIsNotNone(query1.issueInstant)
+        
+        # Invariant parts are shared and read only
+        self.assertIs(query1.issuer, query2.issuer)
+        self.assertEqual(len(query2.attributes), 2)
+        self.assertIs(query1.attributes[0], query2.attributes[0])
+        self.assertRaises(AttributeError, setattr, query1.issuer, 'value', 
+                          'x')
+        
+        query3 = AttributeQueryFactory.from_kw(prefix='attributeQuery.',
+                                               **self.config)
+        self.assertEqual(query1.issuer.digest(), query3.issuer.digest())
+        self.assertEqual(
+            sorted([attr.digest() for attr in query1.attributes]),
+            sorted([attr.digest() for attr in query3.attributes]))
+
 
 class AuthzDecisionQueryFactoryTestCase(unittest.TestCase):
     '''Test authorisation decision query factory class'''
@@ -117,6 +156,107 @@ class AuthzDecisionQueryFactoryTestCase(unittest.TestCase):
                          'Parameter is %r, expected %r' % (
                          authz_query.issuer.value, 
                          self.config['authz_q.issuer.value']))
+
+    def test03_template(self):
+        self.config['authz_q.actions.0'] = \
+            'urn:oasis:names:tc:SAML:1.0:action:ghpp, GET'
+        template = AuthzDecisionQueryFactory.template_from_kw(
+                                                    prefix='authz_q.',
+                                                    **self.config)
+        query = template.instantiate(subject_id='https://openid.a/alice',
+                                     resource='http://LOCALHOST:80/data')
+        self.assertEqual(query.resource, 'http://localhost/data')
+        self.assertEqual(query.actions[0].value, 'GET')
+        self.assertIs(query.actions[0], template.actions[0])
+        self.assertEqual(query.subject.nameID.value, 'https://openid.a/alice')
+
+
+
+class CompiledConfigTestCase(unittest.TestCase):
+    '''Test creation of bindings and queries from a compiled configuration'''
+    def setUp(self):
+        cfg = SafeConfigParser()
+        cfg.optionxform = str
+        for name, value in (
+            ('binding.serialise', 
+             'ndg.saml.xml.etree:AttributeQueryElementTree.toXML'),
+            ('binding.deserialise', 
+             'ndg.saml.xml.etree:ResponseElementTree.fromXML'),
+            ('binding.clockSkewTolerance', '2.'),
+            ('attributeQuery.issuer.value', '/O=Site A/CN=Client'),
+            ('attributeQuery.attributes.0', 
+             'urn:esg:first:name, FirstName, '
+             'http://www.w3.org/2001/XMLSchema#string')):
+            cfg.set('DEFAULT', name, value)
+            
+        self.cfg = cfg
+        
+    def test01_make_binding(self):
+        compiled_cfg = CompiledConfig(self.cfg)
+        binding = compiled_cfg.makeBinding(AttributeQuerySOAPBinding,
+                                           prefix='binding.')
+        self.assertEqual(binding.clockSkewTolerance.seconds, 2)
+        
+        # Import paths are resolved once and cached
+        self.assertIs(binding.serialise, 
+                      importModuleObject('ndg.saml.xml.etree:'
+                                         'AttributeQueryElementTree.toXML'))
+        self.assertIs(compiled_cfg.keywords('binding.'),
+                      compiled_cfg.keywords('binding.'))
+        
+        binding2 = AttributeQuerySOAPBinding.fromConfig(compiled_cfg,
+                                                        prefix='binding.')
+        self.assertIs(binding2.deserialise, binding.deserialise)
+        
+    def test02_make_query(self):
+        compiled_cfg = CompiledConfig(self.cfg)
+        query = compiled_cfg.makeQuery(AttributeQueryFactory, 
+                                       prefix='attributeQuery.')
+        self.assertEqual(query.issuer.value, '/O=Site A/CN=Client')
+        self.assertEqual(len(query.attributes), 1)
+        
+        query2 = AttributeQueryFactory.from_config(compiled_cfg, 
+                                                   prefix='attributeQuery.')
+        self.assertIsNot(query2.issuer, query.issuer)
+        self.assertEqual(query2.attributes[0].name, query.attributes[0].name)
+        
+        template = compiled_cfg.queryTemplate(AttributeQueryFactory,
+                                              prefix='attributeQuery.')
+        self.assertIs(compiled_cfg.queryTemplate(AttributeQueryFactory,
+                                                 prefix='attributeQuery.'),
+                      template)
+        self.assertEqual(template.instantiate().attributes[0].name, 
+                         query.attributes[0].name)
+        
+    def test03_make_binding_with_transport(self):
+        self.cfg.set('DEFAULT', 'binding.transport', 
+                     'ndg.soap.transport:HTTPConnectionPoolTransport')
+        self.cfg.set('DEFAULT', 'binding.transport.maxIdleConnections', '2')
+        compiled_cfg = CompiledConfig(self.cfg)
+        binding = compiled_cfg.makeBinding(AttributeQuerySOAPBinding,
+                                           prefix='binding.')
+        self.assertIsInstance(binding.transport, HTTPConnectionPoolTransport)
+        self.assertEqual(binding.transport.maxIdleConnections, 2)
+        self.assertEqual(binding.clockSkewTolerance.seconds, 2)
+        
+    @unittest.skipIf(not ssl_backend_installed, 'Need an SSL backend to run '
+                     'test04_make_ssl_binding_with_transport')
+    def test04_make_ssl_binding_with_transport(self):
+        # SSL settings can't be applied to the pooled transport
+        self.cfg.set('DEFAULT', 'binding.transport', 
+                     'ndg.soap.transport:HTTPConnectionPoolTransport')
+        compiled_cfg = CompiledConfig(self.cfg)
+        self.assertRaises(TypeError, compiled_cfg.makeBinding,
+                          AttributeQuerySslSOAPBinding, prefix='binding.')
+        
+        # The HTTPS handler is carried over to a new urllib2 transport
+        self.cfg.set('DEFAULT', 'binding.transport', 
+                     'ndg.soap.transport:UrlLib2Transport')
+        compiled_cfg = CompiledConfig(self.cfg)
+        binding = compiled_cfg.makeBinding(AttributeQuerySslSOAPBinding,
+                                           prefix='binding.')
+        self.assertIsInstance(binding.transport, UrlLib2Transport)
+        self.assertEqual(len(binding.client.openerDirector.handlers), 3)
         
         
 if __name__ == "__main__":
@@ -33,24 +33,43 @@ from uuid import uuid4
 from cStringIO import StringIO
 
 import unittest
+from collections import MutableSequence
+import json
 import pickle
+from tempfile import NamedTemporaryFile
+import cPickle
 
 from ndg.saml import importElementTree
 ElementTree = importElementTree()
 
-from ndg.saml.utils import SAMLDateTime
+from ndg.saml.utils import (SAMLDateTime, LRUCache, summariseLatencies, 
+                            reduceSlots, restoreSlots, restoreNamedSlots)
+from ndg.saml.utils.command_line_client import SamlSoapCommandLineClient
+from ndg.saml.utils.factory import importModuleObject
 from ndg.saml.saml2.core import (SAMLVersion, Attribute, AttributeStatement, 
                                  AuthzDecisionStatement, Assertion, 
                                  AttributeQuery, Response, Issuer, Subject, 
                                  NameID, StatusCode, StatusMessage, Status, 
                                  Conditions, DecisionType, 
                                  XSStringAttributeValue, Action, 
-                                 AuthzDecisionQuery)
+                                 AuthzDecisionQuery, 
+                                 ColumnarAttributeStatement,
+                                 ResourceURINormaliser, AttributeIndex)
 
 from ndg.saml.common.xml import SAMLConstants
+from ndg.saml.xml import AttributeFilter
 from ndg.saml.xml.etree import (prettyPrint, AssertionElementTree, 
                             AttributeQueryElementTree, ResponseElementTree,
-                            AuthzDecisionQueryElementTree)
+                            AuthzDecisionQueryElementTree, 
+                            AttributeStatementElementTree,
+                            AttributeElementTree, LazyResponseElementTree)
+from ndg.saml.test.legacy_pickle import (LegacyPickling,
+                                        TransientSlotsPickling)
+from ndg.saml.test.support import (makeApp, makeAttributeQuery,
+                                   makeAttributeQueryBinding,
+                                   StubQueryInterface, SERVICE_URI,
+                                   importModule, isLazyModule)
+from ndg.soap.utils.metrics import Histogram, HistogramObserver
 
 
 class SAMLUtil(object):
@@ -752,6 +771,725 @@ class SAMLTestCase(unittest.TestCase):
         self.assertRaises(TypeError, SAMLDateTime.fromString, 
                           None)
         
+    def test18ColumnarAttributeStatement(self):
+        assertion = self._createAttributeAssertionHelper()
+        attributeStatement = assertion.attributeStatements[0]
+        
+        columnarStatement = ColumnarAttributeStatement.fromAttributeStatement(
+                                                            attributeStatement)
+        attributes = columnarStatement.attributes
+        self.assert_(len(attributes) == len(attributeStatement.attributes))
+        
+        for attribute, columnarAttribute in zip(attributeStatement.attributes,
+                                                attributes):
+            self.assert_(columnarAttribute.name == attribute.name)
+            self.assert_(columnarAttribute.nameFormat == attribute.nameFormat)
+            self.assert_(columnarAttribute.attributeValues[0].value == 
+                         attribute.attributeValues[0].value)
+            
+        # Changes to materialised attributes are preserved
+        attributes[0].friendlyName = 'GivenName'
+        self.assert_(attributes[0].friendlyName == 'GivenName')
+        attributes.compact()
+        self.assert_(attributes.getColumns(0)[2] == 'GivenName')
+        
+        attributes.addColumns('urn:badc:security:authz:1.0:attr',
+                              nameFormat=SAMLUtil.XSSTRING_NS,
+                              values=('urn:badc:a', 'urn:badc:b'))
+        self.assert_(len(attributes[-1].attributeValues) == 2)
+        self.assert_(attributes[-1].attributeValues[1].value == 'urn:badc:b')
+        
+        del attributes[0]
+        self.assert_(attributes[0].name == "urn:esg:last:name")
+        self.assertRaises(TypeError, attributes.append, None)
+        
+        assertion.attributeStatements[0] = columnarStatement
+        assertionElem = AssertionElementTree.toXML(assertion)
+        self.assert_(ElementTree.iselement(assertionElem))
+        
+    def test19ParseColumnarAttributeStatement(self):
+        assertion = self._createAttributeAssertionHelper()
+        attributeStatement = assertion.attributeStatements[0]
+        elem = AttributeStatementElementTree.toXML(attributeStatement)
+        
+        attributeStatement2 = AttributeStatementElementTree.fromXML(elem,
+                                                                columnar=True)
+        self.assert_(isinstance(attributeStatement2, 
+                                ColumnarAttributeStatement))
+        
+        columns = list(attributeStatement2.attributes.iterColumns())
+        self.assert_(len(columns) == len(attributeStatement.attributes))
+        self.assert_(columns[0] == ("urn:esg:first:name", 
+                                    SAMLUtil.XSSTRING_NS, 
+                                    "FirstName", 
+                                    ["Philip"]))
+        
+        response = self._createAttributeQueryResponse()
+        responseElem = ResponseElementTree.toXML(response)
+        response2 = ResponseElementTree.fromXML(responseElem, columnar=True)
+        attributes = response2.assertions[0].attributeStatements[0].attributes
+        self.assert_(attributes[1].attributeValues[0].value == 
+                     response.assertions[0].attributeStatements[0
+                                    ].attributes[1].attributeValues[0].value)
+        
+        # Round trip back to XML
+        elem2 = AttributeStatementElementTree.toXML(attributeStatement2)
+        self.assert_(len(elem2) == len(elem))
+        
+    def test20PickleColumnarAttributeStatement(self):
+        assertion = self._createAttributeAssertionHelper()
+        columnarStatement = ColumnarAttributeStatement.fromAttributeStatement(
+                                            assertion.attributeStatements[0])
+        columnarStatement.attributes[0].friendlyName = 'GivenName'
+        
+        jar = pickle.dumps(columnarStatement)
+        columnarStatement2 = pickle.loads(jar)
+        self.assert_(isinstance(columnarStatement2, 
+                                ColumnarAttributeStatement))
+        self.assert_(len(columnarStatement2.attributes) == 
+                     len(columnarStatement.attributes))
+        self.assert_(columnarStatement2.attributes[0].friendlyName == 
+                     'GivenName')
+        
+    def test21CompactPickleResponse(self):
+        response = self._createAttributeQueryResponse()
+        
+        for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+            jar = cPickle.dumps(response, protocol)
+            with LegacyPickling(protocol):
+                legacyJar = cPickle.dumps(response, protocol)
+                
+            self.assert_(len(jar) < len(legacyJar))
+            
+            # Pickles made with the previous scheme must still load
+            for response2 in (cPickle.loads(jar), cPickle.loads(legacyJar)):
+                self.assert_(isinstance(response2, Response))
+                self.assert_(response2.id == response.id)
+                self.assert_(response2.version == response.version)
+                self.assert_(response2.issuer.value == response.issuer.value)
+                self.assert_(response2.qname == response.qname)
+                self.assert_((response2.status.statusCode.value == 
+                              response.status.statusCode.value))
+                
+                assertion = response.assertions[0]
+                assertion2 = response2.assertions[0]
+                self.assert_(assertion2.issueInstant == assertion.issueInstant)
+                attributes = assertion.attributeStatements[0].attributes
+                attributes2 = assertion2.attributeStatements[0].attributes
+                self.assert_(attributes2.elementType is Attribute)
+                self.assert_(len(attributes2) == len(attributes))
+                self.assert_(attributes2[-1].attributeValues[0].value == 
+                             attributes[-1].attributeValues[0].value)
+                
+                # Restored lists must keep their type checking
+                self.assertRaises(TypeError, attributes2.append, None)
+                
+    def test22CompactPickleDecisionType(self):
+        response = self._createAuthzDecisionQueryResponse()
+        response2 = cPickle.loads(cPickle.dumps(response, 
+                                                cPickle.HIGHEST_PROTOCOL))
+        statement2 = response2.assertions[0].authzDecisionStatements[0]
+        self.assert_(statement2.decision == DecisionType.PERMIT)
+        self.assert_(statement2.resource == SAMLTestCase.RESOURCE_URI)
+
+    def test23AttributeQueryDigest(self):
+        samlUtil = SAMLUtil()
+        samlUtil.firstName = ''
+        samlUtil.lastName = ''
+        samlUtil.emailAddress = ''
+        query = samlUtil.buildAttributeQuery(SAMLTestCase.ISSUER_DN,
+                                             SAMLTestCase.NAMEID_VALUE)
+        query2 = samlUtil.buildAttributeQuery(SAMLTestCase.ISSUER_DN,
+                                              SAMLTestCase.NAMEID_VALUE)
+        
+        # Queries differ only in their ID and IssueInstant
+        self.assert_(query.digest() != query2.digest())
+        self.assert_(query.digest(ignoreVolatile=True) == 
+                     query2.digest(ignoreVolatile=True))
+        self.assert_(query != query2)
+        
+        query2.id = query.id
+        query2.issueInstant = query.issueInstant
+        self.assert_(query == query2)
+        self.assert_(query.digest() == query2.digest())
+        
+        query2.attributes[0].friendlyName = 'GivenName'
+        self.assert_(query != query2)
+        self.assert_(query.digest(ignoreVolatile=True) != 
+                     query2.digest(ignoreVolatile=True))
+        
+        # Digest and equality are independent of the ElementTree parse
+        queryElem = AttributeQueryElementTree.toXML(query)
+        query3 = AttributeQueryElementTree.fromXML(queryElem)
+        self.assert_(query3 == query)
+        self.assert_(query3.digest() == query.digest())
+        
+    def test24AuthzDecisionDigest(self):
+        samlUtil = SAMLUtil()
+        query = samlUtil.buildAuthzDecisionQuery()
+        query2 = samlUtil.buildAuthzDecisionQuery()
+        self.assert_(query.digest(ignoreVolatile=True) == 
+                     query2.digest(ignoreVolatile=True))
+        
+        query3 = samlUtil.buildAuthzDecisionQuery(
+                                        resource='http://localhost/other')
+        self.assert_(query.digest(ignoreVolatile=True) != 
+                     query3.digest(ignoreVolatile=True))
+        
+        response = self._createAuthzDecisionQueryResponse()
+        responseElem = ResponseElementTree.toXML(response)
+        response2 = ResponseElementTree.fromXML(responseElem)
+        self.assert_(response2 == response)
+        self.assert_(response2.assertions[0] == response.assertions[0])
+        
+        response2.id = str(uuid4())
+        response2.inResponseTo = str(uuid4())
+        response2.assertions[0].id = str(uuid4())
+        self.assert_(response2 != response)
+        self.assert_(response2.digest(ignoreVolatile=True) == 
+                     response.digest(ignoreVolatile=True))
+        
+    def test25FreezeResponse(self):
+        response = self._createAttributeQueryResponse()
+        responseClass = response.__class__
+        
+        # Objects are unhashable until frozen since they compare by content
+        self.assertRaises(TypeError, hash, response)
+        self.assertRaises(TypeError, set, [Issuer()])
+        self.assert_(len(set([Issuer().freeze(), Issuer().freeze()])) == 1)
+        digest = response.digest()
+        
+        response.freeze()
+        self.assert_(response.frozen)
+        self.assert_(response.digest() == digest)
+        self.assert_(isinstance(response, Response))
+        self.assert_(response.unfrozenClass() is responseClass)
+        self.assert_(hash(response) == hash(digest))
+        
+        # Frozen objects can be serialised
+        self.assert_(ResponseElementTree.toXML(response) is not None)
+        
+        assertion = response.assertions[0]
+        self.assert_(assertion.frozen)
+        self.assertRaises(AttributeError, setattr, response, 'id', 'x')
+        self.assertRaises(AttributeError, setattr, 
+                          assertion.attributeStatements[0].attributes[0], 
+                          'name', 'x')
+        self.assertRaises(AttributeError, 
+                          assertion.attributeStatements[0].attributes.append,
+                          Attribute())
+        self.assert_(isinstance(assertion.attributeStatements[0].attributes[0
+                                                ].attributeValues, tuple))
+        
+        # Objects are unpickled in a modifiable state
+        response2 = pickle.loads(pickle.dumps(response))
+        self.assert_(not response2.frozen)
+        self.assert_(response2 == response)
+        response2.id = 'x'
+        self.assert_(response2 != response)
+        
+        self.assert_(len(set([response, response.freeze()])) == 1)
+        
+    def test26ResourceURINormaliser(self):
+        normaliser = ResourceURINormaliser(cacheSize=2)
+        uri = 'https://LocalHost:443/my path'
+        self.assert_(normaliser(uri, '/%') == 'https://localhost/my%20path')
+        self.assert_(normaliser(uri, '/% ') == 'https://localhost/my path')
+        self.assert_(normaliser(uri, '/%') == 'https://localhost/my%20path')
+        self.assert_(normaliser('http://localhost:8080/', '/%') == 
+                     'http://localhost:8080/')
+        info = normaliser.cacheInfo()
+        self.assert_(info['hits'] == 1)
+        self.assert_(info['misses'] == 3)
+        self.assert_(info['evictions'] == 1)
+        self.assert_(info['size'] == 2)
+        
+        # Normaliser is shared between the statement and query classes
+        self.assert_(AuthzDecisionQuery.RESOURCE_NORMALISER is 
+                     AuthzDecisionStatement.RESOURCE_NORMALISER)
+        AuthzDecisionQuery.RESOURCE_NORMALISER.clearCache()
+        query = AuthzDecisionQuery()
+        query.resource = 'http://LOCALHOST:80/resource'
+        statement = AuthzDecisionStatement()
+        statement.resource = 'http://LOCALHOST:80/resource'
+        self.assert_(query.resource == statement.resource == 
+                     'http://localhost/resource')
+        self.assert_(AuthzDecisionQuery.RESOURCE_NORMALISER.cacheInfo(
+                                                            )['hits'] == 1)
+        
+        cache = LRUCache(maxSize=2)
+        self.assertRaises(ValueError, setattr, cache, 'maxSize', 0)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assert_('b' not in cache)
+        self.assert_(cache.get('a') == 1)
+        
+    def test27LazyResponse(self):
+        response = self._createAttributeQueryResponse()
+        responseElem = ResponseElementTree.toXML(response)
+        
+        # Lazy mode is selectable as a binding deserialise callable
+        deserialise = importModuleObject(
+                            'ndg.saml.xml.etree:LazyResponseElementTree.fromXML')
+        response2 = deserialise(responseElem)
+        self.assert_(not response2.assertions.loaded)
+        self.assert_(response2.status.statusCode.value == 
+                     response.status.statusCode.value)
+        
+        assertion = response2.assertions[0]
+        self.assert_(response2.assertions.loaded)
+        self.assert_(not assertion.attributeStatements.loaded)
+        self.assert_(assertion.subject.nameID.value == 
+                     response.assertions[0].subject.nameID.value)
+        
+        self.assert_(len(assertion.attributeStatements[0].attributes) == 
+                     len(response.assertions[0].attributeStatements[0
+                                                            ].attributes))
+        self.assert_(assertion.attributeStatements.loaded)
+        self.assert_(response2 == response)
+        
+        response3 = LazyResponseElementTree.fromXML(responseElem)
+        self.assert_(response3.digest() == response.digest())
+        response3 = pickle.loads(pickle.dumps(
+                                LazyResponseElementTree.fromXML(responseElem)))
+        self.assert_(response3 == response)
+        response3 = LazyResponseElementTree.fromXML(responseElem).freeze()
+        self.assertRaises(AttributeError, 
+                          response3.assertions[0].attributeStatements.append,
+                          AttributeStatement())
+        
+        response = self._createAuthzDecisionQueryResponse()
+        responseElem = ResponseElementTree.toXML(response)
+        response2 = LazyResponseElementTree.fromXML(responseElem)
+        assertion = response2.assertions[0]
+        self.assert_(not assertion.authzDecisionStatements.loaded)
+        self.assert_(assertion.authzDecisionStatements[0].decision == 
+                     DecisionType.PERMIT)
+        self.assert_(response2 == response)
+        
+    def test28FilteredAttributeStatement(self):
+        response = self._createAttributeQueryResponse()
+        responseElem = ResponseElementTree.toXML(response)
+        
+        attributeFilter = AttributeFilter(
+                                names='urn:esg:first:name urn:esg:last:name')
+        response2 = ResponseElementTree.fromXML(responseElem, 
+                                            attributeFilter=attributeFilter)
+        attributes = response2.assertions[0].attributeStatements[0].attributes
+        self.assert_([attribute.name for attribute in attributes] == 
+                     ['urn:esg:first:name', 'urn:esg:last:name'])
+        self.assert_(attributeFilter.nMatched == 2)
+        self.assert_(attributeFilter.nSkipped == 7)
+        
+        # Name and NameFormat pairs
+        attributeFilter = AttributeFilter(names=[('urn:esg:email:address',
+                                                  SAMLUtil.XSSTRING_NS)])
+        response2 = LazyResponseElementTree.fromXML(responseElem, 
+                                            attributeFilter=attributeFilter)
+        attributes = response2.assertions[0].attributeStatements[0].attributes
+        self.assert_(len(attributes) == 1)
+        self.assert_(attributes[0] == 
+                     response.assertions[0].attributeStatements[0
+                                                            ].attributes[2])
+        
+        attributeFilter.nameFormats = ['urn:other:format']
+        attributeFilter.resetCounts()
+        response2 = ResponseElementTree.fromXML(responseElem, columnar=True,
+                                            attributeFilter=attributeFilter)
+        self.assert_(len(response2.assertions[0].attributeStatements[0
+                                                        ].attributes) == 0)
+        self.assert_(attributeFilter.nSkipped == 9)
+        
+        # Plain set of names
+        response2 = ResponseElementTree.fromXML(responseElem, 
+                    attributeFilter=set(['urn:badc:security:authz:1.0:attr']))
+        self.assert_(len(response2.assertions[0].attributeStatements[0
+                                                        ].attributes) == 6)
+        
+        # Binding configuration
+        from ndg.saml.saml2.binding.soap.client.attributequery import \
+            AttributeQuerySOAPBinding
+            
+        binding = AttributeQuerySOAPBinding()
+        self.assert_(binding.attributeFilter is None)
+        binding.parseKeywords(prefix='attributeQuery.', **{
+            'attributeQuery.attributeFilterNames': 'urn:esg:first:name',
+            'attributeQuery.attributeFilterNameFormats': SAMLUtil.XSSTRING_NS
+        })
+        self.assert_(binding.attributeFilter.names == 
+                     frozenset(['urn:esg:first:name']))
+        response2 = binding._deserialiseResponse(responseElem)
+        self.assert_(len(response2.assertions[0].attributeStatements[0
+                                                        ].attributes) == 1)
+        self.assert_(binding.attributeFilter.nSkipped == 8)
+        
+    def test29AttributeIndex(self):
+        response = self._createAttributeQueryResponse()
+        firstNames = response.getAttributeValues(name='urn:esg:first:name')
+        self.assert_(len(firstNames) == 1)
+        firstName = firstNames[0].value
+        self.assert_(response.getAttributeValues(name='urn:esg:first:name',
+                                nameFormat=SAMLUtil.XSSTRING_NS) == firstNames)
+        self.assert_(response.getAttributeValues(name='urn:esg:first:name',
+                                                 nameFormat='urn:other') == ())
+        self.assert_(response.getAttributeValues(
+                                    friendlyName='FirstName') == firstNames)
+        self.assert_(response.getAttributeValues(
+                                    friendlyName='GivenName') == ())
+        self.assert_(len(response.getAttributeValues(
+                            name='urn:badc:security:authz:1.0:attr')) == 6)
+        self.assert_(response.hasAttributeValue(firstName, 
+                                                name='urn:esg:first:name'))
+        self.assert_(response.hasAttributeValue(firstNames[0], 
+                                                name='urn:esg:first:name'))
+        self.assert_(not response.hasAttributeValue('x', 
+                                                    name='urn:esg:first:name'))
+        self.assertRaises(TypeError, response.getAttributeValues)
+        
+        # Adding an attribute invalidates the index
+        attribute = Attribute()
+        attribute.name = 'urn:esg:first:name'
+        attribute.friendlyName = 'GivenName'
+        attribute.nameFormat = SAMLUtil.XSSTRING_NS
+        attributeValue = XSStringAttributeValue()
+        attributeValue.value = 'Phil'
+        attribute.attributeValues.append(attributeValue)
+        response.assertions[0].attributeStatements[0].attributes.append(
+                                                                    attribute)
+        self.assert_(len(response.getAttributeValues(
+                                            name='urn:esg:first:name')) == 2)
+        self.assert_(response.hasAttributeValue('Phil', 
+                                                friendlyName='GivenName'))
+        
+        # So does modifying an existing attribute value
+        attributeValue.value = 'Philip'
+        self.assert_(response.hasAttributeValue('Philip', 
+                                                friendlyName='GivenName'))
+        
+        # The index is excluded from digests, equality and pickles
+        response2 = ResponseElementTree.fromXML(
+                                        ResponseElementTree.toXML(response))
+        self.assert_(response2 == response)
+        self.assert_(response2.digest() == response.digest())
+        response2 = pickle.loads(pickle.dumps(response))
+        self.assert_(response2.hasAttributeValue('Philip', 
+                                                 friendlyName='GivenName'))
+        
+        response.freeze()
+        self.assert_(response.hasAttributeValue('Philip', 
+                                                friendlyName='GivenName'))
+        
+        response2 = LazyResponseElementTree.fromXML(
+                                        ResponseElementTree.toXML(response),
+                                        columnar=True)
+        self.assert_(len(response2.getAttributeValues(
+                                            name='urn:esg:first:name')) == 2)
+        
+        
+    def test30BenchQueryParams(self):
+        summary = summariseLatencies([float(i) for i in range(100, 0, -1)])
+        self.assert_(summary['n'] == 100)
+        self.assert_(summary['p50'] == 50.)
+        self.assert_(summary['p99'] == 99.)
+        self.assert_(summary['max'] == 100.)
+        self.assert_(summariseLatencies([])['p50'] is None)
+        
+        queryParams = SamlSoapCommandLineClient.read_query_params(StringIO(
+            "# comment\n"
+            "https://openid.localhost/a\n"
+            "\n"
+            "https://openid.localhost/b\thttp://localhost/x\tGET\n"))
+        self.assert_(queryParams == [
+            ('https://openid.localhost/a', None, None),
+            ('https://openid.localhost/b', 'http://localhost/x', 'GET')])
+        
+        
+    def test31BulkResponseToDict(self):
+        result = SamlSoapCommandLineClient.response_to_dict(
+                                    self._createAuthzDecisionQueryResponse())
+        self.assert_(result['status'] == StatusCode.SUCCESS_URI)
+        self.assert_(result['decisions'] == [
+            dict(resource=SAMLTestCase.RESOURCE_URI, decision='Permit')])
+        self.assert_('attributes' not in result)
+        
+        result = SamlSoapCommandLineClient.response_to_dict(
+                                    self._createAttributeQueryResponse())
+        self.assert_(result['attributes']['urn:esg:first:name'] == 
+                     ['Philip'])
+        
+    def test32RequestTimingObservers(self):
+        histogram = Histogram((0.1, 1.))
+        for value in (0.05, 0.5, 0.5, 5.):
+            histogram.observe(value)
+        self.assert_(histogram.counts == (1, 2, 1))
+        self.assert_(histogram.percentile(50) == 1.)
+        self.assert_(histogram.percentile(100) == 5.)
+        
+        app = makeApp(StubQueryInterface(), AttributeQueryElementTree.fromXML)
+        binding = makeAttributeQueryBinding(app)
+        observer = HistogramObserver()
+        timings = []
+        binding.observers = [observer, timings.append]
+        self.assert_(binding.client.observers == binding.observers)
+        
+        for i in range(2):
+            binding.send(makeAttributeQuery(2), uri=SERVICE_URI)
+        
+        timing = timings[0]
+        self.assert_(timing.phases.keys() == [
+            'initialise', 'serialise', 'envelopeSerialise', 'transport', 
+            'envelopeParse', 'deserialise', 'validation'])
+        self.assert_(timing.total >= sum(timing.phases.values()))
+        self.assert_(timing.httpStatus == 200)
+        self.assert_(timing.samlStatus == StatusCode.SUCCESS_URI)
+        
+        stats = observer.dump()[SERVICE_URI]
+        self.assert_(stats['requests'] == 2)
+        self.assert_(stats['phases']['total']['count'] == 2)
+        self.assert_(stats['bytesSent'] == 2*timing.requestSize)
+        
+        self.assertRaises(TypeError, setattr, binding, 'observers', [None])
+        
+    def test33LazyImports(self):
+        # SSL backends and XACML support are only imported on first use
+        for moduleName in ('ndg.saml.saml2.binding.soap.client.attributequery',
+                           'ndg.saml.saml2.binding.soap.server.wsgi.'
+                           'queryinterface'):
+            modules = importModule(moduleName)['modules']
+            self.assert_(moduleName in modules)
+            self.assert_(not [name for name in modules 
+                              if isLazyModule(name)])
+        
+    def test34BulkBadInputLine(self):
+        response = self._createAuthzDecisionQueryResponse()
+        
+        class StubBinding(object):
+            def send(self, query, uri=None):
+                return response
+            
+        class StubBindingClient(SamlSoapCommandLineClient):
+            __slots__ = ()
+            def create_binding(self, command):
+                return StubBinding()
+            
+        client = StubBindingClient()
+        client.query_command = SamlSoapCommandLineClient.\
+                                                    AUTHZ_DECISION_QUERY_CMD
+        client.service_uri = 'http://localhost/saml'
+        client.issuer = "/O=Site A/CN=PEP"
+        client.issuer_format = Issuer.X509_SUBJECT
+        client.subject_id_format = NameID.X509_SUBJECT
+        client.action_namespace = Action.GHPP_NS_URI
+        client.action = 'GET'
+        client.resource_id = SAMLTestCase.RESOURCE_URI
+        client.concurrency = 1
+        client.offset = 0
+        client.order = SamlSoapCommandLineClient.INPUT_ORDER
+        
+        # The second line has an action not in the action namespace
+        subjectsFile = NamedTemporaryFile()
+        subjectsFile.write("https://openid.localhost/a\n"
+                           "https://openid.localhost/b\thttp://localhost/x"
+                           "\tBOGUS\n"
+                           "https://openid.localhost/c\n")
+        subjectsFile.flush()
+        client.subjects_file = subjectsFile.name
+        
+        output = StringIO()
+        self.assert_(client.bulk(output) == (3, 1))
+        results = [json.loads(line) 
+                   for line in output.getvalue().splitlines()]
+        self.assert_([result['index'] for result in results] == [0, 1, 2])
+        self.assert_(results[1]['error']['category'] == 'input')
+        self.assert_(results[1]['subject'] == 'https://openid.localhost/b')
+        self.assert_('error' not in results[2])
+        self.assert_(results[2]['decisions'][0]['decision'] == 'Permit')
+        
+    def test35ColumnarAttributeListSequenceAPI(self):
+        assertion = self._createAttributeAssertionHelper()
+        attributeStatement = assertion.attributeStatements[0]
+        statement = ColumnarAttributeStatement.fromAttributeStatement(
+                                                            attributeStatement)
+        attributes = statement.attributes
+        self.assert_(isinstance(attributes, MutableSequence))
+        self.assert_(attributes.elementType is Attribute)
+        self.assert_(attributes == attributes[:])
+        self.assert_(attributes == list(attributeStatement.attributes))
+        self.assert_(attributes != attributes[1:])
+        
+        names = [attribute.name for attribute in attributeStatement.attributes]
+        attributes.reverse()
+        self.assert_([attribute.name for attribute in attributes] == 
+                     names[::-1])
+        attributes.sort(key=lambda attribute: attribute.name)
+        self.assert_([attribute.name for attribute in attributes] == 
+                     sorted(names))
+        
+        attribute = attributes.pop()
+        self.assert_(attribute.name == sorted(names)[-1])
+        self.assert_(attributes.count(attribute) == 0)
+        attributes.insert(0, attribute)
+        self.assert_(attributes.index(attribute) == 0)
+        self.assert_(attributes.count(attribute) == 1)
+        attributes.remove(attribute)
+        self.assertRaises(ValueError, attributes.index, attribute)
+        self.assertRaises(ValueError, attributes.remove, attribute)
+        
+        attributes[:2] = [attribute]
+        self.assert_(len(attributes) == len(names) - 2)
+        self.assert_(attributes[0] is attribute)
+        del attributes[1:]
+        self.assert_(len(attributes) == 1)
+        self.assertRaises(TypeError, attributes.insert, 0, None)
+        
+        # The statement doesn't hold a second, unused attribute list 
+        self.assert_(statement.attributes is attributes)
+        self.assert_(ColumnarAttributeStatement.__slots__ == ())
+        
+        statement.freeze()
+        self.assertRaises(AttributeError, attributes.reverse)
+        self.assertRaises(AttributeError, attributes.pop)
+        
+    def test36AttributeIndexObservesChanges(self):
+        response = self._createAttributeQueryResponse()
+        attributes = response.assertions[0].attributeStatements[0].attributes
+        
+        # Count index builds to check that lookups don't walk the response
+        nBuilds = [0]
+        build = AttributeIndex.__dict__['_build']
+        def countingBuild(self, response):
+            nBuilds[0] += 1
+            return build(self, response)
+        
+        AttributeIndex._build = countingBuild
+        try:
+            self.assert_(len(response.getAttributeValues(
+                                        name='urn:esg:first:name')) == 1)
+            self.assert_(response.hasAttributeValue('Philip', 
+                                                    name='urn:esg:first:name'))
+            self.assert_(nBuilds[0] == 1)
+            
+            # In place changes to an attribute's name and values
+            attributes[0].name = 'urn:esg:given:name'
+            self.assert_(response.getAttributeValues(
+                                        name='urn:esg:first:name') == ())
+            self.assert_(len(response.getAttributeValues(
+                                        name='urn:esg:given:name')) == 1)
+            
+            attributes[0].attributeValues[0].value = 'Phil'
+            self.assert_(response.hasAttributeValue('Phil', 
+                                                    name='urn:esg:given:name'))
+            
+            del attributes[0].attributeValues[0]
+            self.assert_(response.getAttributeValues(
+                                        name='urn:esg:given:name') == ())
+            
+            response.assertions.append(response.assertions[0])
+            self.assert_(len(response.getAttributeValues(
+                                        name='urn:esg:last:name')) == 2)
+            nBuilds[0] = 0
+            response.getAttributeValues(name='urn:esg:last:name')
+            self.assert_(nBuilds[0] == 0)
+            
+            # Changes to a plain list can't be observed and so the index is 
+            # rebuilt for each lookup
+            attributes[1].attributeValues = [XSStringAttributeValue()]
+            attributes[1].attributeValues[0].value = 'Kershaw'
+            attributes[1].attributeValues.append(XSStringAttributeValue())
+            attributes[1].attributeValues[1].value = 'K'
+            self.assert_(response.hasAttributeValue('K', 
+                                                    name='urn:esg:last:name'))
+        finally:
+            AttributeIndex._build = build
+        
+        # Attributes cached by a columnar list are observed too
+        response = self._createAttributeQueryResponse()
+        response.assertions[0].attributeStatements[0] = \
+            ColumnarAttributeStatement.fromAttributeStatement(
+                            response.assertions[0].attributeStatements[0])
+        self.assert_(len(response.getAttributeValues(
+                                        name='urn:esg:first:name')) == 1)
+        attributes = response.assertions[0].attributeStatements[0].attributes
+        attributes[0].name = 'urn:esg:given:name'
+        self.assert_(len(response.getAttributeValues(
+                                        name='urn:esg:given:name')) == 1)
+        attributes.pop(0)
+        self.assert_(response.getAttributeValues(
+                                        name='urn:esg:given:name') == ())
+        
+        
+    def test37PickleMadeBeforeSlotsAdded(self):
+        response = self._createAttributeQueryResponse()
+        for named in (True, False):
+            with TransientSlotsPickling(named=named):
+                jar = cPickle.dumps(response, cPickle.HIGHEST_PROTOCOL)
+                
+            response2 = cPickle.loads(jar)
+            self.assert_(response2 == response)
+            self.assert_(response2.hasAttributeValue('Philip', 
+                                                name='urn:esg:first:name'))
+            
+        # Values for slots which have since been removed are ignored
+        attribute = response.assertions[0].attributeStatements[0].attributes[0]
+        cls, slotNames, values = reduceSlots(attribute)[1]
+        attribute2 = restoreNamedSlots(cls, 
+                                       slotNames + ('_Attribute__removed',), 
+                                       values + (None,))
+        self.assert_(attribute2 == attribute)
+        self.assertRaises(TypeError, restoreSlots, cls, values[:-3])
+        
+    def test38ColumnarStatementEqualsStatement(self):
+        response = self._createAttributeQueryResponse()
+        responseElem = ResponseElementTree.toXML(response)
+        response1 = ResponseElementTree.fromXML(responseElem)
+        response2 = ResponseElementTree.fromXML(responseElem, columnar=True)
+        self.assert_(isinstance(response2.assertions[0].attributeStatements[0],
+                                ColumnarAttributeStatement))
+        self.assert_(response2 == response1)
+        self.assert_(response1 == response2)
+        self.assert_(response2.digest() == response1.digest())
+        self.assert_(hash(response2.freeze()) == hash(response1.freeze()))
+        
+    def test39ColumnarAttributeListCompact(self):
+        assertion = self._createAttributeAssertionHelper()
+        statement = ColumnarAttributeStatement.fromAttributeStatement(
+                                            assertion.attributeStatements[0])
+        attributes = statement.attributes
+        
+        # Pickling doesn't change the list or detach attributes already held
+        attribute = attributes[0]
+        statement2 = pickle.loads(pickle.dumps(statement))
+        attribute.name = 'urn:esg:given:name'
+        self.assert_(attributes[0] is attribute)
+        self.assert_(statement2.attributes[0].name == 'urn:esg:first:name')
+        
+        # Nor does compacting
+        attributes.compact()
+        self.assert_(attributes[0] is attribute)
+        self.assert_(attributes.getColumns(0)[0] == 'urn:esg:given:name')
+        
+        # Derived attribute types are kept as objects
+        elementTreeAttribute = AttributeElementTree()
+        elementTreeAttribute.name = 'urn:esg:other:name'
+        attributes[1] = elementTreeAttribute
+        del elementTreeAttribute
+        attributes.compact()
+        self.assert_(isinstance(attributes[1], AttributeElementTree))
+        statement2 = pickle.loads(pickle.dumps(statement))
+        self.assert_(isinstance(statement2.attributes[1], 
+                                AttributeElementTree))
+        self.assert_(statement2.attributes[0].name == 'urn:esg:given:name')
+        
+        # Attributes no longer referenced elsewhere are folded into the 
+        # columns
+        del attribute
+        attributes[2].friendlyName = 'Email'
+        attributes.compact()
+        self.assert_(len(attributes._ColumnarAttributeList__materialised) == 1)
+        self.assert_(attributes.getColumns(0)[0] == 'urn:esg:given:name')
+        self.assert_(attributes.getColumns(2)[2] == 'Email')
         
 if __name__ == "__main__":
     unittest.main()        
@@ -32,8 +32,20 @@ except ImportError:
     from time import strptime as _strptime
     strptime = lambda datetimeStr, format: datetime(*(_strptime(datetimeStr, 
                                                                 format)[0:6]))
+import math
 from datetime import datetime, timedelta
 
+# datetime.strptime imports this module on first use which is not thread safe
+# in Python 2 (http://bugs.python.org/issue7980).  Import it up front so that
+# SAMLDateTime can be used concurrently
+import _strptime
+
+from operator import attrgetter
+from itertools import izip
+from collections import OrderedDict
+from threading import Lock
+import weakref
+
         
 # Interpret a string as a boolean
 str2Bool = lambda str: str.lower() in ("yes", "true", "t", "1")
@@ -97,7 +109,348 @@ class SAMLDateTime(object):
         return dtValue
 
 
-class TypedList(list):
+# Caches of slot names, getters and restore functions for each class pickled 
+# with reduceSlots
+_slotNames = {}
+_slotGetters = {}
+_slotRestorers = {}
+
+
+def getSlotNames(cls):
+    """Get the attribute names for all the __slots__ defined by a class and
+    its bases.  The name mangling of private slot names is resolved once per
+    class and the result cached.
+    
+    @type cls: type
+    @param cls: class to get slot names for
+    @rtype: tuple
+    @return: slot attribute names in method resolution order, base class 
+    first
+    """
+    slotNames = _slotNames.get(cls)
+    if slotNames is None:
+        _slotNames_ = []
+        for klass in reversed(cls.__mro__):
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, basestring):
+                slots = (slots,)
+                
+            for slotName in slots:
+                if slotName in ('__dict__', '__weakref__'):
+                    continue
+                
+                if slotName.startswith('__') and not slotName.endswith('__'):
+                    slotName = "_%s%s" % (klass.__name__.lstrip('_'), 
+                                          slotName)
+                    
+                _slotNames_.append(slotName)
+                
+        slotNames = tuple(_slotNames_)
+        _slotNames[cls] = slotNames
+        
+    return slotNames
+
+
+def _getSlotGetter(cls):
+    """Get a callable returning a tuple of the slot values for an instance of
+    the given class
+    
+    @type cls: type
+    @param cls: class to get slot getter for
+    @rtype: callable
+    @return: slot getter
+    """
+    getter = _slotGetters.get(cls)
+    if getter is None:
+        slotNames = getSlotNames(cls)
+        if len(slotNames) == 0:
+            getter = lambda obj: ()
+        elif len(slotNames) == 1:
+            _getter = attrgetter(slotNames[0])
+            getter = lambda obj: (_getter(obj),)
+        else:
+            getter = attrgetter(*slotNames)
+            
+        _slotGetters[cls] = getter
+        
+    return getter
+    
+    
+def _getSlotRestorer(cls):
+    """Get a function to create an instance of the given class and assign its
+    slot values from a tuple.  The function is compiled once per class so 
+    that all values are assigned with a single tuple unpacking statement.
+    
+    @type cls: type
+    @param cls: class to get restore function for
+    @rtype: callable
+    @return: restore function
+    """
+    restorer = _slotRestorers.get(cls)
+    if restorer is None:
+        slotNames = getSlotNames(cls)
+        src = ["def restore(values):",
+               "    obj = new(cls)"]
+        if slotNames:
+            src.append("    (%s,) = values" % ", ".join(["obj." + slotName 
+                                                for slotName in slotNames]))
+        src.append("    return obj")
+        
+        namespace = dict(new=cls.__new__, cls=cls)
+        exec "\n".join(src) in namespace
+        restorer = namespace['restore']
+        _slotRestorers[cls] = restorer
+        
+    return restorer
+
+
+def reduceSlots(obj, cls=None):
+    """Pickle support for classes using __slots__.  State is returned as the
+    slot names given by getSlotNames and a flat tuple of the slot values.  
+    The tuple of names is cached for each class and so pickle memoisation 
+    writes it only once per pickle.  Recording the names allows objects to be
+    restored after slots have been added to or removed from the class - see
+    restoreNamedSlots.  Use as the implementation of a class's __reduce__ 
+    method.
+    
+    @param obj: object to reduce
+    @type obj: object
+    @type cls: type / NoneType
+    @param cls: class to restore the object as.  Defaults to the object's
+    class.  It must have the same slots
+    @rtype: tuple
+    @return: restoreNamedSlots callable and its arguments
+    """
+    if cls is None:
+        cls = obj.__class__
+        
+    slotNames = getSlotNames(cls)
+    try:
+        values = _getSlotGetter(cls)(obj)
+    except AttributeError:
+        # Unset slots are restored as None
+        values = tuple([getattr(obj, slotName, None) 
+                        for slotName in slotNames])
+    
+    # Classes which don't define __slots__ e.g. ElementTree subclasses of 
+    # the SAML types will also have an instance dictionary    
+    instanceDict = getattr(obj, '__dict__', None)
+    if instanceDict:
+        return restoreNamedSlots, (cls, slotNames, values, instanceDict)
+    else:
+        return restoreNamedSlots, (cls, slotNames, values)
+    
+    
+def _restoreSlotsByName(cls, slotNames, values):
+    """Create an instance of the given class and assign its slots by name.
+    Slots missing from slotNames are set to None and values for names which
+    are not slots of the class are ignored
+    
+    @type cls: type
+    @param cls: class of the object to restore
+    @type slotNames: tuple
+    @param slotNames: names of the slots the values are for
+    @type values: tuple
+    @param values: slot values
+    @rtype: object
+    @return: restored object
+    """
+    obj = cls.__new__(cls)
+    state = dict(izip(slotNames, values))
+    for slotName in getSlotNames(cls):
+        setattr(obj, slotName, state.get(slotName))
+        
+    return obj
+    
+    
+def restoreNamedSlots(cls, slotNames, values, instanceDict=None):
+    """Restore an object pickled with reduceSlots.  The object is created 
+    without calling its __init__ and the slot values are assigned directly
+    bypassing property setter validation.  Pickles are trusted content.  If 
+    the slots of the class have changed since the pickle was made, values 
+    are assigned by name - see _restoreSlotsByName
+    
+    @type cls: type
+    @param cls: class of the object to restore
+    @type slotNames: tuple
+    @param slotNames: slot names as returned by reduceSlots
+    @type values: tuple
+    @param values: slot values as returned by reduceSlots
+    @type instanceDict: dict / NoneType
+    @param instanceDict: instance dictionary for classes without __slots__
+    @rtype: object
+    @return: restored object
+    @raise TypeError: number of values doesn't match the number of names
+    """
+    if len(values) != len(slotNames):
+        raise TypeError("Pickled state has %d values for %d slots of %r" %
+                        (len(values), len(slotNames), cls))
+    
+    currentSlotNames = getSlotNames(cls)
+    if slotNames is currentSlotNames or slotNames == currentSlotNames:
+        obj = _getSlotRestorer(cls)(values)
+    else:
+        obj = _restoreSlotsByName(cls, slotNames, values)
+        
+    if instanceDict:
+        obj.__dict__.update(instanceDict)
+        
+    return obj
+    
+    
+def restoreSlots(cls, values, instanceDict=None):
+    """Restore an object pickled by the previous version of reduceSlots 
+    which recorded the slot values only.  If the number of values doesn't
+    match the slots of the class, the pickle is taken to have been made 
+    before the slots holding derived data, listed by the class's 
+    TRANSIENT_ATTRIBUTES, were added.  The values are assigned to the 
+    remaining slots in order and the others are set to None.
+    
+    @type cls: type
+    @param cls: class of the object to restore
+    @type values: tuple
+    @param values: slot values
+    @type instanceDict: dict / NoneType
+    @param instanceDict: instance dictionary for classes without __slots__
+    @rtype: object
+    @return: restored object
+    @raise TypeError: number of values doesn't match the class's slots
+    """
+    slotNames = getSlotNames(cls)
+    if len(values) != len(slotNames):
+        transientNames = getattr(cls, 'TRANSIENT_ATTRIBUTES', ())
+        slotNames = tuple([slotName for slotName in slotNames
+                           if slotName.rsplit('__', 1)[-1] 
+                           not in transientNames])
+        if len(values) != len(slotNames):
+            raise TypeError("Pickled state has %d values; expecting %d for "
+                            "%r" % (len(values), len(getSlotNames(cls)), cls))
+            
+    return restoreNamedSlots(cls, slotNames, values, 
+                             instanceDict=instanceDict)
+            
+
+class Observers(object):
+    """Weakly referenced observers of a mutable object.  Each observer must
+    have a changed method which is called with no arguments whenever the
+    object is modified.  Observers are not pickled.
+    """
+    __slots__ = ('__refs',)
+    
+    def __init__(self):
+        self.__refs = []
+        
+    def __reduce__(self):
+        """Pickle as an empty set of observers
+        
+        @rtype: tuple
+        @return: class and its arguments
+        """
+        return self.__class__, ()
+    
+    def __iter__(self):
+        """@rtype: generator
+        @return: iterator over the observers which are still alive
+        """
+        for ref in self.__refs:
+            observer = ref()
+            if observer is not None:
+                yield observer
+                
+    def add(self, observer):
+        """Add an observer.  Adding an observer more than once has no effect
+        
+        @type observer: object
+        @param observer: object with a changed method
+        """
+        ref = weakref.ref(observer)
+        if ref not in self.__refs:
+            self.__refs.append(ref)
+            
+    def notify(self):
+        """Call the changed method of each observer and discard any observers
+        which no longer exist
+        """
+        refs = []
+        for ref in self.__refs:
+            observer = ref()
+            if observer is not None:
+                observer.changed()
+                refs.append(ref)
+                
+        self.__refs = refs
+        
+
+def _notifyAfter(methodName):
+    """Wrap a list method so that an ObservedList notifies its observers
+    after the method is called
+    
+    @type methodName: string
+    @param methodName: name of method to wrap
+    @rtype: function
+    @return: wrapped method
+    """
+    method = getattr(list, methodName)
+    def _method(self, *arg, **kw):
+        result = method(self, *arg, **kw)
+        self._notifyObservers()
+        return result
+    
+    _method.__name__ = methodName
+    _method.__doc__ = method.__doc__
+    return _method
+
+
+class ObservedList(list):
+    """List which notifies observers when its contents are changed - see
+    Observers.  Observers are not pickled.
+    """
+    __slots__ = ('__observers',)
+    
+    _NOTIFY_AFTER_METHOD_NAMES = (
+        '__setitem__', '__delitem__', '__setslice__', '__delslice__', 
+        '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 
+        'reverse', 'sort'
+    )
+    for methodName in _NOTIFY_AFTER_METHOD_NAMES:
+        locals()[methodName] = _notifyAfter(methodName)
+    del methodName
+    
+    def __init__(self, *arg, **kw):
+        self.__observers = None
+        super(ObservedList, self).__init__(*arg, **kw)
+        
+    def __reduce__(self):
+        """Pickle as items only
+        
+        @rtype: tuple
+        @return: class and its arguments
+        """
+        return self.__class__, (list(self),)
+    
+    def addObserver(self, observer):
+        """Add an object to be notified when the contents of this list are
+        changed
+        
+        @type observer: object
+        @param observer: object with a changed method
+        """
+        # The slot is unset for lists unpickled from the previous scheme
+        observers = getattr(self, '_ObservedList__observers', None)
+        if observers is None:
+            observers = Observers()
+            self.__observers = observers
+            
+        observers.add(observer)
+        
+    def _notifyObservers(self):
+        """Notify observers that the contents of this list have changed"""
+        observers = getattr(self, '_ObservedList__observers', None)
+        if observers is not None:
+            observers.notify()
+            
+
+class TypedList(ObservedList):
     """Extend list type to enabled only items of a given type.  Supports
     any type where the array type in the Standard Library is restricted to 
     only limited set of primitive types
@@ -120,6 +473,14 @@ class TypedList(list):
     
     elementType = property(fget=_getElementType, 
                            doc="The allowed type or types for list elements")
+    
+    def __reduce__(self):
+        """Pickle as element type and items only
+        
+        @rtype: tuple
+        @return: class and its arguments
+        """
+        return self.__class__, (self.__elementType, list(self))
      
     def extend(self, iter):
         """Extend an existing list with the input iterable
@@ -157,3 +518,270 @@ class TypedList(list):
                                 (self.__elementType,))
     
         return super(TypedList, self).append(item)
+
+
+class FrozenTypedList(TypedList):
+    """Read only TypedList.  TypedList instances are converted to this type 
+    when the SAML object which contains them is frozen - see
+    ndg.saml.common.SAMLObject.freeze
+    """
+    def _readOnly(self, *arg, **kw):
+        """@raise AttributeError: list is read only"""
+        raise AttributeError("List is frozen and can't be modified")
+    
+    append = extend = insert = pop = remove = reverse = sort = _readOnly
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _readOnly
+    __iadd__ = __imul__ = _readOnly
+    
+    def __reduce__(self):
+        """Unpickle as a modifiable TypedList.  The objects it contains are 
+        not restored in a frozen state either
+        
+        @rtype: tuple
+        @return: class and its arguments
+        """
+        return TypedList, (self.elementType, list(self))
+
+
+class LRUCache(object):
+    """Bounded, thread safe mapping which discards the least recently used 
+    entry when full.  Hit, miss and eviction counts are kept so that the 
+    effectiveness of the cache can be monitored - see cacheInfo
+    
+    @cvar DEFAULT_MAX_SIZE: default maximum number of entries
+    @type DEFAULT_MAX_SIZE: int
+    """
+    DEFAULT_MAX_SIZE = 1024
+    
+    __slots__ = (
+        '__maxSize', 
+        '__entries', 
+        '__lock', 
+        '__hits', 
+        '__misses', 
+        '__evictions'
+    )
+    
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE):
+        """@type maxSize: int
+        @param maxSize: maximum number of entries to hold
+        """
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.maxSize = maxSize
+        
+    def _getMaxSize(self):
+        return self.__maxSize
+    
+    def _setMaxSize(self, value):
+        if not isinstance(value, (int, long)) or isinstance(value, bool):
+            raise TypeError('Expecting int type for "maxSize" attribute; got '
+                            '%r instead' % type(value))
+        if value < 1:
+            raise ValueError('"maxSize" attribute must be greater than zero; '
+                             'got %d' % value)
+        
+        self.__lock.acquire()
+        try:
+            self.__maxSize = value
+            self._evict()
+        finally:
+            self.__lock.release()
+        
+    maxSize = property(_getMaxSize, _setMaxSize, 
+                       doc="Maximum number of entries held by the cache")
+    
+    def _evict(self):
+        """Discard least recently used entries until the cache is within its 
+        size limit.  The caller must hold the lock
+        """
+        while len(self.__entries) > self.__maxSize:
+            self.__entries.popitem(last=False)
+            self.__evictions += 1
+    
+    def get(self, key, default=None):
+        """Look up an entry, marking it as most recently used
+        
+        @param key: cache key
+        @param default: value to return if key is not present
+        @return: cached value or default
+        """
+        self.__lock.acquire()
+        try:
+            try:
+                value = self.__entries.pop(key)
+            except KeyError:
+                self.__misses += 1
+                return default
+            
+            self.__entries[key] = value
+            self.__hits += 1
+            return value
+        finally:
+            self.__lock.release()
+            
+    def set(self, key, value):
+        """Add or replace an entry, discarding the least recently used entry
+        if the cache is full
+        
+        @param key: cache key
+        @param value: value to cache
+        """
+        self.__lock.acquire()
+        try:
+            self.__entries.pop(key, None)
+            self.__entries[key] = value
+            self._evict()
+        finally:
+            self.__lock.release()
+        
+    def clear(self):
+        """Remove all entries and reset the statistics"""
+        self.__lock.acquire()
+        try:
+            self.__entries.clear()
+            self.__hits = self.__misses = self.__evictions = 0
+        finally:
+            self.__lock.release()
+            
+    def __len__(self):
+        return len(self.__entries)
+    
+    def __contains__(self, key):
+        return key in self.__entries
+            
+    def cacheInfo(self):
+        """Get cache statistics
+        
+        @rtype: dict
+        @return: hits, misses, evictions, current size and maximum size
+        """
+        self.__lock.acquire()
+        try:
+            return dict(hits=self.__hits,
+                        misses=self.__misses,
+                        evictions=self.__evictions,
+                        size=len(self.__entries),
+                        maxSize=self.__maxSize)
+        finally:
+            self.__lock.release()
+
+
+def percentile(values, pct):
+    """Get a percentile of a list of values by the nearest rank method
+    
+    @type values: list
+    @param values: values sorted in ascending order
+    @type pct: int / float
+    @param pct: percentile in the range 0 to 100
+    @rtype: float / NoneType
+    @return: value at the given percentile or None if there are no values
+    """
+    if not values:
+        return None
+    
+    rank = int(math.ceil(pct / 100. * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def summariseLatencies(latencies):
+    """Summarise a list of latencies
+    
+    @type latencies: list
+    @param latencies: latencies in seconds
+    @rtype: dict
+    @return: number, mean, 50th, 90th and 99th percentile and maximum 
+    latencies
+    """
+    values = sorted(latencies)
+    if values:
+        mean = sum(values) / len(values)
+    else:
+        mean = None
+        
+    return dict(n=len(values), 
+                mean=mean,
+                p50=percentile(values, 50), 
+                p90=percentile(values, 90), 
+                p99=percentile(values, 99),
+                max=values[-1] if values else None)
+
+
+def _loadFirst(methodName):
+    """Wrap a TypedList method so that a LazyTypedList converts its pending
+    items before the method is called
+    
+    @type methodName: string
+    @param methodName: name of method to wrap
+    @rtype: function
+    @return: wrapped method
+    """
+    method = getattr(TypedList, methodName)
+    def _method(self, *arg, **kw):
+        self.load()
+        return method(self, *arg, **kw)
+    
+    _method.__name__ = methodName
+    _method.__doc__ = method.__doc__
+    return _method
+
+
+class LazyTypedList(TypedList):
+    """TypedList whose items are created from a sequence of pending source
+    objects, typically parsed XML elements, the first time the list is 
+    accessed.  Nb. some operations implemented in C read list contents 
+    directly and so will not trigger loading e.g. plain_list + lazy_list.  
+    Call load first in such cases
+    """
+    _LOAD_FIRST_METHOD_NAMES = (
+        '__iter__', '__reversed__', '__len__', '__contains__', 
+        '__getitem__', '__getslice__', '__setitem__', '__delitem__', 
+        '__setslice__', '__delslice__', '__add__', '__mul__', '__rmul__', 
+        '__iadd__', '__imul__', '__eq__', '__ne__', '__lt__', '__le__', 
+        '__gt__', '__ge__', '__repr__', 'append', 'extend', 'insert', 'pop', 
+        'remove', 'index', 'count', 'reverse', 'sort'
+    )
+    for methodName in _LOAD_FIRST_METHOD_NAMES:
+        locals()[methodName] = _loadFirst(methodName)
+    del methodName
+    
+    def __init__(self, elementType, convert, pending):
+        """
+        @type elementType: type/tuple
+        @param elementType: object type or types which the list is allowed to
+        contain.  If more than one type, pass as a tuple
+        @type convert: callable
+        @param convert: function to create a list item from a pending object
+        @type pending: iterable
+        @param pending: objects from which to create the list items
+        """
+        super(LazyTypedList, self).__init__(elementType)
+        self.__convert = convert
+        self.__pending = list(pending)
+        
+    @property
+    def loaded(self):
+        """@rtype: bool
+        @return: True if the list items have been created
+        """
+        return not self.__pending
+    
+    def load(self):
+        """Create list items from any pending objects.  If conversion fails,
+        the items remain pending
+        """
+        if self.__pending:
+            items = [self.__convert(i) for i in self.__pending]
+            self.__pending = []
+            TypedList.extend(self, items)
+            
+    def __reduce__(self):
+        """Pickle as a TypedList holding the converted items
+        
+        @rtype: tuple
+        @return: class and its arguments
+        """
+        return TypedList, (self.elementType, list(self))
@@ -4,6 +4,10 @@ Created on Feb 18, 2013
 @author: philipkershaw
 '''
 import sys
+import json
+import timeit
+import threading
+import urllib2
 from optparse import OptionParser
 from uuid import uuid4
 from datetime import datetime
@@ -13,6 +17,8 @@ ElementTree = importElementTree()
 
 from ndg.soap.utils.etree import prettyPrint
 
+from ndg.saml.saml2.binding.soap.client.requestbase import \
+    RequestResponseError
 from ndg.saml.saml2.binding.soap.client.authzdecisionquery import \
     AuthzDecisionQuerySslSOAPBinding
     
@@ -24,6 +30,32 @@ from ndg.saml.saml2.core import (SAMLVersion, Subject, NameID, Issuer,
                                  Attribute, Action, StatusCode,
                                  XSStringAttributeValue)
 from ndg.saml.xml.etree import ResponseElementTree
+from ndg.saml.utils import summariseLatencies
+
+
+class ByteCountHandler(urllib2.BaseHandler):
+    """urllib2 processor counting the bytes sent in request bodies and 
+    received in response bodies.  Response sizes are taken from the 
+    Content-length header
+    """
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        
+    def http_request(self, req):
+        data = req.get_data()
+        if data:
+            self.bytes_sent += len(data)
+        return req
+    
+    def http_response(self, req, response):
+        content_length = response.info().get('Content-length')
+        if content_length and content_length.isdigit():
+            self.bytes_received += int(content_length)
+        return response
+    
+    https_request = http_request
+    https_response = http_response
 
 
 class SamlSoapCommandLineClient(object):
@@ -47,11 +79,28 @@ class SamlSoapCommandLineClient(object):
         "client_prikey_filepath",
         "pretty_print",
         "clock_skew_tolerance",
-        "debug"
+        "debug",
+        "query_command",
+        "concurrency",
+        "requests",
+        "duration",
+        "warm_up",
+        "subjects_file",
+        "json",
+        "order",
+        "offset",
+        "output_file"
     )
     
     ATTRIBUTE_QUERY_CMD = 'attr'
     AUTHZ_DECISION_QUERY_CMD = 'authz'
+    BENCH_CMD = 'bench'
+    BULK_CMD = 'bulk'
+    QUERY_CMDS = (ATTRIBUTE_QUERY_CMD, AUTHZ_DECISION_QUERY_CMD)
+    
+    # Output orders for bulk query results
+    INPUT_ORDER = 'input'
+    COMPLETION_ORDER = 'completion'
     
     def __init__(self):
         for i in self.__class__.__slots__:
@@ -63,6 +112,11 @@ class SamlSoapCommandLineClient(object):
 commands:
   authz       Make a SAML Authorisation Decision Query
   attr        Make a SAML Attribute Query
+  bench       Load test a service with authz or attr queries e.g.
+              %prog bench authz [options]
+  bulk        Make authz or attr queries for each subject read from a file
+              or stdin and output the results as JSON Lines e.g.
+              %prog bulk attr [options]
 """
         parser = OptionParser(usage=usage)
         
@@ -146,16 +200,34 @@ commands:
         else:
             command = argv[1]
         
+        # The bench and bulk commands are followed by the query command to 
+        # send
+        query_command = command
+        n_command_args = 2
+        if command in (self.__class__.BENCH_CMD, self.__class__.BULK_CMD):
+            if n_args < 3:
+                parser.error('No query command set for %s: expecting one of '
+                             '%r' % (command, self.__class__.QUERY_CMDS))
+            query_command = argv[2]
+            n_command_args = 3
+            
+            if command == self.__class__.BENCH_CMD:
+                self._add_multi_query_options(parser)
+                self._add_bench_options(parser)
+            else:
+                self._add_multi_query_options(parser, subjects_file='-')
+                self._add_bulk_options(parser)
+            
+        usage_command = ' '.join(argv[1:n_command_args])
+        
         # Catch example of just specifying --help or '-h'
         if command in ('--help', '-h'):
             parser.print_usage()
             return
           
-        elif command == self.__class__.AUTHZ_DECISION_QUERY_CMD:
+        elif query_command == self.__class__.AUTHZ_DECISION_QUERY_CMD:
             # Set options which are specific to authorisation decision queries            
-            parser.set_usage('usage: %prog ' + \
-                             self.__class__.AUTHZ_DECISION_QUERY_CMD + \
-                             ' [options]')
+            parser.set_usage('usage: %prog ' + usage_command + ' [options]')
                              
             parser.add_option("-r", "--resource",
                               dest="resource_id", 
@@ -178,11 +250,9 @@ commands:
                               default=Action.GHPP_NS_URI,
                               metavar="ACTION_NS")
                 
-        elif command == self.__class__.ATTRIBUTE_QUERY_CMD:
+        elif query_command == self.__class__.ATTRIBUTE_QUERY_CMD:
             # Set options which are specific to attribute queries            
-            parser.set_usage('usage: %prog ' + \
-                             self.__class__.ATTRIBUTE_QUERY_CMD + \
-                             ' [options]')
+            parser.set_usage('usage: %prog ' + usage_command + ' [options]')
             
             parser.add_option("-a", "--attribute_name",
                               dest="attribute_names",
@@ -230,10 +300,18 @@ commands:
             parser.error('Command %s not supported' % command)
 
         # Leave the command option out of the parser's processing
-        options = parser.parse_args(argv[2:])[0]
+        options = parser.parse_args(argv[n_command_args:])[0]
+        options.query_command = query_command
+        
+        # Subjects and resources may be read from a file instead
+        if getattr(options, 'subjects_file', None):
+            if options.subject_id == '':
+                options.subject_id = None
+            if getattr(options, 'resource_id', None) == '':
+                options.resource_id = None
         
         # Post-processing needed for attribute query
-        if command == self.__class__.ATTRIBUTE_QUERY_CMD:
+        if query_command == self.__class__.ATTRIBUTE_QUERY_CMD:
             len_attribute_names = len(options.attribute_names)
             if len_attribute_names > 0:
                 len_attribute_friendly_names = len(
@@ -279,7 +357,128 @@ commands:
             
         return command
     
-    def _set_query_common_attrs(self, query):
+    @staticmethod
+    def _add_multi_query_options(parser, subjects_file=None):
+        """Add options for commands making more than one query"""
+        parser.add_option("--concurrency",
+                          dest="concurrency",
+                          help="Number of concurrent client threads",
+                          default=1,
+                          type="int",
+                          metavar="CONCURRENCY")
+        
+        parser.add_option("--subjects-file",
+                          dest="subjects_file",
+                          help="File of subject IDs to query for, one per "
+                               "line.  For authz queries, a line may also "
+                               "give a resource and action separated by "
+                               "tabs.  Set to '-' to read from stdin",
+                          default=subjects_file,
+                          metavar="SUBJECTS_FILE")
+    
+    @staticmethod
+    def _add_bench_options(parser):
+        """Add options for the bench command"""
+        parser.add_option("--requests",
+                          dest="requests",
+                          help="Total number of requests to make",
+                          default=100,
+                          type="int",
+                          metavar="REQUESTS")
+        
+        parser.add_option("--duration",
+                          dest="duration",
+                          help="Make requests for this many seconds instead "
+                               "of a set number of requests",
+                          type="float",
+                          metavar="DURATION")
+        
+        parser.add_option("--warm-up",
+                          dest="warm_up",
+                          help="Number of requests to make before timing "
+                               "starts",
+                          default=0,
+                          type="int",
+                          metavar="WARM_UP")
+        
+        parser.add_option("--json",
+                          dest="json",
+                          action="store_true",
+                          help="Output results as JSON",
+                          metavar="JSON")
+    
+    @classmethod
+    def _add_bulk_options(cls, parser):
+        """Add options for the bulk command"""
+        parser.add_option("--order",
+                          dest="order",
+                          help="Order to output results in: %r - the order "
+                               "of the subjects file (default) or %r - as "
+                               "each query completes" % (cls.INPUT_ORDER,
+                                                         cls.COMPLETION_ORDER),
+                          choices=(cls.INPUT_ORDER, cls.COMPLETION_ORDER),
+                          default=cls.INPUT_ORDER,
+                          metavar="ORDER")
+        
+        parser.add_option("--offset",
+                          dest="offset",
+                          help="Skip this many queries from the start of the "
+                               "subjects file in order to resume an "
+                               "interrupted run.  Blank and comment lines are "
+                               "not counted",
+                          default=0,
+                          type="int",
+                          metavar="OFFSET")
+        
+        parser.add_option("--output",
+                          dest="output_file",
+                          help="File to write the results to.  Defaults to "
+                               "stdout",
+                          metavar="OUTPUT_FILE")
+    
+    @staticmethod
+    def read_query_params(file_obj):
+        """Read query parameters, one query per line.  Each line has a 
+        subject ID optionally followed by a resource ID and action separated 
+        by tabs.  Blank lines and lines starting with '#' are ignored
+        
+        :param file_obj: file object to read from
+        :type file_obj: file
+        :return: list of (subject ID, resource ID, action) tuples.  Missing
+        resource IDs and actions are set to None
+        :rtype: list
+        """
+        query_params = []
+        for line in file_obj:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            
+            fields = [field.strip() or None for field in line.split('\t')]
+            query_params.append(tuple((fields + [None, None])[:3]))
+            
+        return query_params
+    
+    def _get_query_params(self):
+        """Get the parameters for the queries to send - from the subjects 
+        file if set, otherwise from the command line options
+        
+        :return: list of (subject ID, resource ID, action) tuples
+        :rtype: list
+        """
+        if not self.subjects_file:
+            return [(self.subject_id, self.resource_id, self.action)]
+        
+        if self.subjects_file == '-':
+            return self.read_query_params(sys.stdin)
+        
+        subjects_file = open(self.subjects_file)
+        try:
+            return self.read_query_params(subjects_file)
+        finally:
+            subjects_file.close()
+            
+    def _set_query_common_attrs(self, query, subject_id=None):
         """Set attributes common to both types of SAML query"""
         query.version = SAMLVersion(SAMLVersion.VERSION_20)
         query.id = str(uuid4())
@@ -292,26 +491,29 @@ commands:
         query.subject = Subject()
         query.subject.nameID = NameID()
         query.subject.nameID.format = self.subject_id_format
-        query.subject.nameID.value = self.subject_id
+        query.subject.nameID.value = subject_id or self.subject_id
  
-    def create_authz_decision_query(self):
-        """Convenience utility to make an Authorisation decision query"""
+    def create_authz_decision_query(self, subject_id=None, resource_id=None,
+                                    action=None):
+        """Convenience utility to make an Authorisation decision query.  The
+        subject, resource and action default to the command line settings"""
         authz_decision_query = AuthzDecisionQuery()
 
-        self._set_query_common_attrs(authz_decision_query)
+        self._set_query_common_attrs(authz_decision_query, 
+                                     subject_id=subject_id)
         
-        authz_decision_query.resource = self.resource_id
+        authz_decision_query.resource = resource_id or self.resource_id
         
         authz_decision_query.actions.append(Action())
         authz_decision_query.actions[-1].namespace = self.action_namespace
-        authz_decision_query.actions[-1].value = self.action
+        authz_decision_query.actions[-1].value = action or self.action
             
         return authz_decision_query
 
-    def create_attribute_query(self):
+    def create_attribute_query(self, subject_id=None):
         attr_query = AttributeQuery()
 
-        self._set_query_common_attrs(attr_query)
+        self._set_query_common_attrs(attr_query, subject_id=subject_id)
         
         for i, name in enumerate(self.attribute_names): 
             attribute = Attribute()
@@ -326,24 +528,325 @@ commands:
         
         return attr_query
                     
-    def dispatch(self, command):
+    def create_query(self, command, subject_id=None, resource_id=None,
+                     action=None):
+        """Make a query for the given command"""
+        if command == self.__class__.ATTRIBUTE_QUERY_CMD:
+            return self.create_attribute_query(subject_id=subject_id)
+        else:
+            return self.create_authz_decision_query(subject_id=subject_id,
+                                                    resource_id=resource_id,
+                                                    action=action)
+            
+    def create_binding(self, command):
+        """Make a SOAP binding to send queries for the given command"""
         if command == self.__class__.ATTRIBUTE_QUERY_CMD:
-            query = self.create_attribute_query()
             binding = AttributeQuerySslSOAPBinding()
             
         elif command == self.__class__.AUTHZ_DECISION_QUERY_CMD:
-            query = self.create_authz_decision_query()
             binding = AuthzDecisionQuerySslSOAPBinding()
 
         binding.sslCACertDir = self.ca_cert_dir
         binding.sslCertFilePath = self.client_cert_filepath
         binding.sslPriKeyFilePath = self.client_prikey_filepath
         binding.clockSkewTolerance = self.clock_skew_tolerance
+        
+        return binding
+        
+    def dispatch(self, command):
+        query = self.create_query(command)
+        binding = self.create_binding(command)
 
         response = binding.send(query, uri=self.service_uri)
         
         return response
     
+    @staticmethod
+    def _get_error_key(e):
+        """Classify a failed query for the error counts of the bench command
+        
+        :param e: exception raised by the query
+        :type e: Exception
+        :return: error category and value
+        :rtype: tuple
+        """
+        if isinstance(e, RequestResponseError):
+            response = getattr(e, 'response', None)
+            if response is not None and response.status is not None:
+                return 'status', response.status.statusCode.value
+        
+        urllib2_response = getattr(e, 'urllib2Response', e)
+        code = getattr(urllib2_response, 'code', None)
+        if isinstance(code, int):
+            return 'http', str(code)
+        
+        return 'exception', type(e).__name__
+    
+    def bench(self):
+        """Load test the service by sending queries from concurrent threads
+        
+        :return: bench results
+        :rtype: dict
+        """
+        query_params = self._get_query_params()
+        if not query_params:
+            raise ValueError('No subjects read from %r' % self.subjects_file)
+        
+        n_query_params = len(query_params)
+        timer = timeit.default_timer
+        lock = threading.Lock()
+        state = dict(n_started=0, start_time=None)
+        latencies = []
+        status_codes = {}
+        errors = {'status': {}, 'http': {}, 'exception': {}}
+        byte_counters = []
+        
+        def next_request():
+            # Get the index of the next request to make or None if done
+            with lock:
+                i_request = state['n_started']
+                if self.duration is not None:
+                    if timer() - state['start_time'] >= self.duration:
+                        return None
+                elif i_request >= self.requests:
+                    return None
+                
+                state['n_started'] += 1
+                return i_request
+        
+        def send(binding, i_request):
+            query = self.create_query(self.query_command,
+                                      *query_params[i_request % 
+                                                    n_query_params])
+            return binding.send(query, uri=self.service_uri)
+        
+        def worker(binding):
+            while True:
+                i_request = next_request()
+                if i_request is None:
+                    break
+                
+                t0 = timer()
+                try:
+                    response = send(binding, i_request)
+                except Exception, e:
+                    category, key = self._get_error_key(e)
+                    with lock:
+                        counts = errors[category]
+                        counts[key] = counts.get(key, 0) + 1
+                        if category == 'status':
+                            status_codes[key] = status_codes.get(key, 0) + 1
+                else:
+                    elapsed = timer() - t0
+                    key = response.status.statusCode.value
+                    with lock:
+                        latencies.append(elapsed)
+                        status_codes[key] = status_codes.get(key, 0) + 1
+        
+        if self.warm_up:
+            binding = self.create_binding(self.query_command)
+            for i_request in range(self.warm_up):
+                try:
+                    send(binding, i_request)
+                except Exception:
+                    pass
+            
+        # Make a binding for each thread up front so that any configuration
+        # errors are raised here
+        threads = []
+        for i in range(self.concurrency):
+            binding = self.create_binding(self.query_command)
+            byte_counter = ByteCountHandler()
+            binding.client.openerDirector.add_handler(byte_counter)
+            byte_counters.append(byte_counter)
+            threads.append(threading.Thread(target=worker, args=(binding,)))
+        
+        
+        state['start_time'] = timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = timer() - state['start_time']
+        
+        return dict(
+            command=self.query_command,
+            service_uri=self.service_uri,
+            concurrency=self.concurrency,
+            requests=state['n_started'],
+            successful=len(latencies),
+            seconds=elapsed,
+            throughput=len(latencies) / elapsed if elapsed else None,
+            latency=summariseLatencies(latencies),
+            status_codes=status_codes,
+            errors=errors,
+            bytes_sent=sum([i.bytes_sent for i in byte_counters]),
+            bytes_received=sum([i.bytes_received for i in byte_counters])
+        )
+        
+    @classmethod
+    def response_to_dict(cls, response):
+        """Summarise a SAML response for the results of the bulk command
+        
+        :param response: SAML response
+        :type response: ndg.saml.saml2.core.Response
+        :return: status, attribute values keyed by attribute name and 
+        authorisation decisions
+        :rtype: dict
+        """
+        result = dict(status=response.status.statusCode.value)
+        if response.status.statusMessage is not None:
+            result['status_message'] = response.status.statusMessage.value
+            
+        attributes = {}
+        decisions = []
+        for assertion in response.assertions:
+            for attribute_statement in assertion.attributeStatements:
+                for attribute in attribute_statement.attributes:
+                    values = attributes.setdefault(attribute.name, [])
+                    values.extend([getattr(attribute_value, 'value', None)
+                                   for attribute_value in 
+                                   attribute.attributeValues])
+                    
+            for authz_decision_statement in assertion.authzDecisionStatements:
+                decisions.append(dict(
+                    resource=authz_decision_statement.resource,
+                    decision=str(authz_decision_statement.decision)))
+                
+        if attributes:
+            result['attributes'] = attributes
+        if decisions:
+            result['decisions'] = decisions
+            
+        return result
+    
+    def bulk(self, output):
+        """Make a query for each subject read from the subjects file from 
+        concurrent threads.  Each thread reuses a single binding.  The 
+        results are written to output as JSON Lines as they become 
+        available
+        
+        :param output: file object to write results to
+        :type output: file
+        :return: number of queries made and number which failed
+        :rtype: tuple
+        """
+        query_params = self._get_query_params()
+        n_query_params = len(query_params)
+        lock = threading.Lock()
+        state = dict(i_next=self.offset, i_output=self.offset, n_errors=0)
+        pending = {}
+        
+        def next_query():
+            # Get the index of the next query to make or None if done
+            with lock:
+                i_query = state['i_next']
+                if i_query >= n_query_params:
+                    return None
+                
+                state['i_next'] += 1
+                return i_query
+            
+        def write(i_query, result):
+            # Called with the lock held
+            if self.order == self.__class__.COMPLETION_ORDER:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+                return
+            
+            # Buffer results until those before them have been written
+            pending[i_query] = result
+            while state['i_output'] in pending:
+                output.write(json.dumps(pending.pop(state['i_output'])) + 
+                             '\n')
+                state['i_output'] += 1
+            output.flush()
+            
+        def worker(binding):
+            while True:
+                i_query = next_query()
+                if i_query is None:
+                    break
+                
+                subject_id, resource_id, action = query_params[i_query]
+                result = dict(index=i_query, 
+                              subject=subject_id or self.subject_id)
+                try:
+                    query = self.create_query(self.query_command, subject_id,
+                                              resource_id, action)
+                except Exception, e:
+                    # Bad input line e.g. unrecognised action.  Record it 
+                    # and carry on with the next query
+                    result['error'] = dict(category='input', 
+                                           code=type(e).__name__,
+                                           message=str(e))
+                    with lock:
+                        state['n_errors'] += 1
+                        write(i_query, result)
+                    continue
+                
+                if self.query_command == self.__class__.\
+                                                    AUTHZ_DECISION_QUERY_CMD:
+                    result['resource'] = query.resource
+                    result['action'] = query.actions[0].value
+                try:
+                    response = binding.send(query, uri=self.service_uri)
+                except Exception, e:
+                    category, key = self._get_error_key(e)
+                    response = getattr(e, 'response', None)
+                    if category == 'status' and response is not None:
+                        result.update(self.response_to_dict(response))
+                    result['error'] = dict(category=category, code=key,
+                                           message=str(e))
+                else:
+                    result.update(self.response_to_dict(response))
+                    
+                with lock:
+                    if 'error' in result:
+                        state['n_errors'] += 1
+                    write(i_query, result)
+        
+        threads = []
+        for i in range(self.concurrency):
+            binding = self.create_binding(self.query_command)
+            threads.append(threading.Thread(target=worker, args=(binding,)))
+        
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+        return max(0, n_query_params - self.offset), state['n_errors']
+        
+    def display_bench_result(self, result):
+        """Output the results from the bench command as text or JSON"""
+        if self.json:
+            print(json.dumps(result, indent=2))
+            return
+        
+        print("Service:         %s" % result['service_uri'])
+        print("Query:           %s" % result['command'])
+        print("Concurrency:     %d" % result['concurrency'])
+        print("Requests:        %d (%d successful)" % (result['requests'],
+                                                       result['successful']))
+        print("Time:            %.3f s" % result['seconds'])
+        print("Throughput:      %.1f requests/s" % (result['throughput'] or 0.))
+        print("Bytes sent:      %d" % result['bytes_sent'])
+        print("Bytes received:  %d" % result['bytes_received'])
+        
+        latency = result['latency']
+        if latency['n']:
+            print("Latency (ms):    p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % 
+                  tuple([latency[i] * 1000. 
+                         for i in ('p50', 'p90', 'p99', 'max')]))
+            
+        for status_code, count in sorted(result['status_codes'].items()):
+            print("Status %s: %d" % (status_code, count))
+            
+        for category in ('http', 'exception'):
+            for key, count in sorted(result['errors'][category].items()):
+                print("Error (%s) %s: %d" % (category, key, count))
+    
     @classmethod
     def response_successful(cls, response):
         return response.status.statusCode.value == StatusCode.SUCCESS_URI
@@ -372,6 +875,38 @@ commands:
             
         logging.basicConfig(level=log_level)
         
+        if command == cls.BENCH_CMD:
+            try:
+                result = client.bench()
+            except Exception, e:
+                if client.debug:
+                    raise
+                else:
+                    raise SystemExit(e)
+                
+            client.display_bench_result(result)
+            sys.exit(0)
+            
+        elif command == cls.BULK_CMD:
+            if client.output_file:
+                output = open(client.output_file, 'a')
+            else:
+                output = sys.stdout
+            try:
+                n_queries, n_errors = client.bulk(output)
+            except Exception, e:
+                if client.debug:
+                    raise
+                else:
+                    raise SystemExit(e)
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+                
+            sys.stderr.write("%d queries made, %d failed\n" % (n_queries, 
+                                                              n_errors))
+            sys.exit(0)
+            
         try:
             response = client.dispatch(command)
         except Exception, e:
@@ -14,6 +14,8 @@ import logging
 import os
 import sys
 import re
+from uuid import uuid4
+from datetime import datetime
 from ConfigParser import ConfigParser, SafeConfigParser
 from abc import ABCMeta, abstractmethod
 
@@ -22,25 +24,61 @@ from ndg.saml.saml2 import core as saml2
 log = logging.getLogger(__name__)
 
 
+# Objects resolved by importModuleObject keyed by the module and object names
+# requested.  Modules stay in sys.modules once imported so the same names
+# always resolve to the same object
+_importCache = {}
+
+
+def clearImportCache():
+    '''Clear the cache of objects resolved by importModuleObject e.g. after
+    reloading a module'''
+    _importCache.clear()
+
+
 def importModuleObject(moduleName, objectName=None, objectType=None):
     '''Import from a string module name and object name.  Object can be
-    any entity contained in a module
-    
+    any entity contained in a module.  Resolved objects are cached so that
+    later calls for the same names do no import work
+
     @param moduleName: Name of module containing the class
-    @type moduleName: str 
-    @param objectName: Name of the class to import.  If none is given, the 
+    @type moduleName: str
+    @param objectName: Name of the class to import.  If none is given, the
     class name will be assumed to be the last component of modulePath
     @type objectName: str
     @rtype: class object
     @return: imported class'''
+    if isinstance(objectName, list):
+        cacheKey = (moduleName, tuple(objectName))
+    else:
+        cacheKey = (moduleName, objectName)
+
+    try:
+        importedObject = _importCache[cacheKey]
+
+    except KeyError:
+        importedObject = _importModuleObject(moduleName, objectName)
+        _importCache[cacheKey] = importedObject
+
+    # Check class inherits from a base class
+    if objectType and not issubclass(importedObject, objectType):
+        raise TypeError("Specified class %r must be derived from %r; got %r" %
+                        (objectName or moduleName, objectType,
+                         importedObject))
+
+    return importedObject
+
+
+def _importModuleObject(moduleName, objectName):
+    '''Import an object bypassing the cache - see importModuleObject'''
     if objectName is None:
         if ':' in moduleName:
-            # Support Paste style import syntax with rhs of colon denoting 
+            # Support Paste style import syntax with rhs of colon denoting
             # module content to import
             _moduleName, objectName = moduleName.rsplit(':', 1)
             if '.' in objectName:
                 objectName = objectName.split('.')
-        else: 
+        else:
             try:
                 _moduleName, objectName = moduleName.rsplit('.', 1)
             except ValueError:
@@ -48,12 +86,12 @@ def importModuleObject(moduleName, objectName=None, objectType=None):
                                  (moduleName, traceback.format_exc()))
     else:
         _moduleName = moduleName
-        
+
     if isinstance(objectName, basestring):
         objectName = [objectName]
-    
-    log.debug("Importing %r ..." % objectName) 
-      
+
+    log.debug("Importing %r ..." % objectName)
+
     module = __import__(_moduleName, globals(), locals(), [])
     components = _moduleName.split('.')
     try:
@@ -67,11 +105,6 @@ def importModuleObject(moduleName, objectName=None, objectType=None):
     for i in objectName:
         importedObject = getattr(importedObject, i)
 
-    # Check class inherits from a base class
-    if objectType and not issubclass(importedObject, objectType):
-        raise TypeError("Specified class %r must be derived from %r; got %r" %
-                        (objectName, objectType, importedObject))
-    
     log.info('Imported %r from module, %r', objectName, _moduleName)
     return importedObject
 
@@ -155,6 +188,159 @@ def callModuleObject(moduleName, objectName=None, moduleFilePath=None,
         raise
     
 
+def readConfigItems(cfg, section='DEFAULT'):
+    '''Get the option names and values from a config file section
+
+    @type cfg: basestring / ConfigParser derived type / CompiledConfig
+    @param cfg: configuration file path, ConfigParser type object or
+    compiled configuration.  A compiled configuration is already bound to a
+    section
+    @type section: basestring
+    @param section: configuration file section from which to extract
+    parameters
+    @rtype: dict
+    @return: option names and values
+    '''
+    if isinstance(cfg, CompiledConfig):
+        return cfg.items
+
+    elif isinstance(cfg, basestring):
+        cfg_filepath = os.path.expandvars(cfg)
+        here_dir = os.path.dirname(cfg_filepath)
+        _cfg = SafeConfigParser(defaults=dict(here=here_dir))
+        _cfg.optionxform = str
+
+        _cfg.read(cfg_filepath)
+
+    elif isinstance(cfg, ConfigParser):
+        _cfg = cfg
+    else:
+        raise AttributeError('Expecting basestring or ConfigParser type '
+                             'for "cfg" attribute; got %r type' % type(cfg))
+
+    return dict(_cfg.items(section))
+
+
+class CompiledConfig(object):
+    '''Configuration file section parsed once so that SOAP bindings and
+    queries can be created from it repeatedly with no file or import work.
+    Create one at start up and share it between threads.
+    '''
+    __slots__ = ('__items', '__keywords', '__templates')
+
+    def __init__(self, cfg, section='DEFAULT'):
+        '''
+        @type cfg: basestring / ConfigParser derived type
+        @param cfg: configuration file path or ConfigParser type object
+        @type section: basestring
+        @param section: configuration file section from which to extract
+        parameters
+        '''
+        self.__items = readConfigItems(cfg, section=section)
+
+        # Binding attribute names and values for each prefix
+        self.__keywords = {}
+
+        # Query templates for each factory class and prefix
+        self.__templates = {}
+
+    @property
+    def items(self):
+        '''Copy of the option names and values'''
+        return self.__items.copy()
+
+    def keywords(self, prefix=''):
+        '''Get the options starting with a prefix with the prefix removed.
+        As for SOAPBinding.parseConfig, a prefix option in the configuration
+        overrides the one given
+
+        @type prefix: basestring
+        @param prefix: option name prefix e.g. "attributeQuery."
+        @rtype: dict
+        @return: attribute names and values.  Nb. this is shared - callers
+        must not modify it
+        '''
+        try:
+            return self.__keywords[prefix]
+
+        except KeyError:
+            items = self.__items.copy()
+            _prefix = items.pop('prefix', prefix)
+            if _prefix:
+                prefixLen = len(_prefix)
+                keywords = dict([(name[prefixLen:], value)
+                                 for name, value in items.items()
+                                 if name.startswith(_prefix)])
+            else:
+                keywords = items
+
+            # Resolve serialisation functions and transport classes now so 
+            # that bindings made later find them in the import cache
+            for name in ('serialise', 'deserialise', 'transport'):
+                if isinstance(keywords.get(name), basestring):
+                    importModuleObject(keywords[name])
+
+            self.__keywords[prefix] = keywords
+            return keywords
+
+    def makeBinding(self, bindingClass, prefix=''):
+        '''Create a SOAP binding from the configuration.  Equivalent to
+        bindingClass.fromConfig(cfg, prefix=prefix)
+
+        @type bindingClass: type
+        @param bindingClass: ndg.saml.saml2.binding.soap.client.SOAPBinding
+        or derived type
+        @type prefix: basestring
+        @param prefix: option name prefix e.g. "attributeQuery."
+        @return: new binding
+        '''
+        binding = bindingClass()
+        binding.parseKeywords(**self.keywords(prefix))
+
+        return binding
+
+    def makeQuery(self, factoryClass, prefix=None):
+        '''Create a SAML query from the configuration.  Equivalent to
+        factoryClass.from_config(cfg, prefix=prefix)
+
+        @type factoryClass: type
+        @param factoryClass: QueryFactoryBase derived type
+        @type prefix: basestring / NoneType
+        @param prefix: option name prefix.  Defaults to the factory's PREFIX
+        @return: new query
+        '''
+        if prefix is None:
+            prefix = factoryClass.PREFIX
+
+        kw = self.__items.copy()
+        if 'prefix' not in kw and prefix:
+            kw['prefix'] = prefix
+
+        return factoryClass.from_kw(**kw)
+
+    def queryTemplate(self, factoryClass, prefix=None):
+        '''Get a template for creating queries from the configuration.  
+        Templates are created once for each factory class and prefix
+        
+        @type factoryClass: type
+        @param factoryClass: QueryFactoryBase derived type
+        @type prefix: basestring / NoneType
+        @param prefix: option name prefix.  Defaults to the factory's PREFIX
+        @rtype: QueryTemplate
+        @return: template for the factory's query type
+        '''
+        key = (factoryClass, prefix)
+        try:
+            return self.__templates[key]
+        
+        except KeyError:
+            template = factoryClass.template_from_config(
+                                    self, 
+                                    prefix=prefix or factoryClass.PREFIX)
+            self.__templates[key] = template
+            return template
+
+
 class SubjectFactory(object):
     '''Factory class to create Subject instance'''
     
@@ -168,6 +354,153 @@ class SubjectFactory(object):
         return subject
 
 
+class QueryTemplate(object):
+    '''Query parsed once from configuration settings from which new queries
+    are created cheaply.  The invariant parts of the query - issuer, 
+    attributes and actions - are frozen and shared between the queries 
+    created, so they must not be modified.  Each query gets a new subject, 
+    ID and issue instant.  Thread safe.  Create with the template_from_kw 
+    or template_from_config methods of the query factory classes.
+    '''
+    __slots__ = (
+        '__queryClass',
+        '__version',
+        '__issuer',
+        '__nameIdFormat',
+        '__nameIdValue'
+    )
+    
+    def __init__(self, prototype):
+        '''
+        @type prototype: ndg.saml.saml2.core.SubjectQuery
+        @param prototype: query created from the configuration settings
+        '''
+        self.__queryClass = prototype.__class__
+        self.__version = prototype.version
+        
+        self.__issuer = prototype.issuer
+        if self.__issuer is not None:
+            self.__issuer.freeze()
+        
+        self.__nameIdFormat = None
+        self.__nameIdValue = None
+        if prototype.subject is not None and \
+           prototype.subject.nameID is not None:
+            self.__nameIdFormat = prototype.subject.nameID.format
+            self.__nameIdValue = prototype.subject.nameID.value
+            
+    @property
+    def issuer(self):
+        '''Frozen issuer shared by the queries created'''
+        return self.__issuer
+    
+    def instantiate(self, subject_id=None):
+        '''Create a new query
+        
+        @type subject_id: basestring / NoneType
+        @param subject_id: subject name ID value.  Defaults to the value set
+        in the configuration if any
+        @rtype: ndg.saml.saml2.core.SubjectQuery
+        @return: new query
+        '''
+        return self._newQuery(subject_id)
+        
+    def _newQuery(self, subject_id):
+        '''Create a new query with the settings common to all query types'''
+        query = self.__queryClass()
+        query.version = self.__version
+        query.id = str(uuid4())
+        query.issueInstant = datetime.utcnow()
+        query.issuer = self.__issuer
+        
+        query.subject = SubjectFactory.create()
+        if self.__nameIdFormat is not None:
+            query.subject.nameID.format = self.__nameIdFormat
+            
+        if subject_id is None:
+            subject_id = self.__nameIdValue
+            
+        if subject_id is not None:
+            query.subject.nameID.value = subject_id
+            
+        return query
+    
+    
+class AttributeQueryTemplate(QueryTemplate):
+    '''Attribute query template'''
+    __slots__ = ('__attributes',)
+    
+    def __init__(self, prototype):
+        '''
+        @type prototype: ndg.saml.saml2.core.AttributeQuery
+        @param prototype: query created from the configuration settings
+        '''
+        super(AttributeQueryTemplate, self).__init__(prototype)
+        self.__attributes = tuple([attribute.freeze() 
+                                   for attribute in prototype.attributes])
+    
+    @property
+    def attributes(self):
+        '''Frozen attributes shared by the queries created'''
+        return self.__attributes
+        
+    def instantiate(self, subject_id=None):
+        '''Create a new attribute query
+        
+        @type subject_id: basestring / NoneType
+        @param subject_id: subject name ID value.  Defaults to the value set
+        in the configuration if any
+        @rtype: ndg.saml.saml2.core.AttributeQuery
+        @return: new query
+        '''
+        query = self._newQuery(subject_id)
+        query.attributes.extend(self.__attributes)
+        return query
+    
+    
+class AuthzDecisionQueryTemplate(QueryTemplate):
+    '''Authorisation decision query template'''
+    __slots__ = ('__actions', '__resource')
+    
+    def __init__(self, prototype):
+        '''
+        @type prototype: ndg.saml.saml2.core.AuthzDecisionQuery
+        @param prototype: query created from the configuration settings
+        '''
+        super(AuthzDecisionQueryTemplate, self).__init__(prototype)
+        self.__actions = tuple([action.freeze() 
+                                for action in prototype.actions])
+        self.__resource = prototype.resource
+        
+    @property
+    def actions(self):
+        '''Frozen actions shared by the queries created'''
+        return self.__actions
+        
+    def instantiate(self, subject_id=None, resource=None):
+        '''Create a new authorisation decision query
+        
+        @type subject_id: basestring / NoneType
+        @param subject_id: subject name ID value.  Defaults to the value set
+        in the configuration if any
+        @type resource: basestring / NoneType
+        @param resource: resource URI.  Defaults to the value set in the
+        configuration if any
+        @rtype: ndg.saml.saml2.core.AuthzDecisionQuery
+        @return: new query
+        '''
+        query = self._newQuery(subject_id)
+        query.actions.extend(self.__actions)
+        
+        if resource is None:
+            resource = self.__resource
+            
+        if resource is not None:
+            query.resource = resource
+            
+        return query
+
+
 class QueryFactoryBase(object):
     """Abstract base Factory class to create SAML queries from various 
     inputs - derived classes determine the query types
@@ -175,6 +508,7 @@ class QueryFactoryBase(object):
     __metaclass__ = ABCMeta
     
     QUERY_CLASS = None
+    TEMPLATE_CLASS = None
     PREFIX = None
     SUBJECT_PARAM_NAME_PREFIX = 'subject.'
     ISSUER_PARAM_NAME_PREFIX = 'issuer.'
@@ -203,31 +537,18 @@ class QueryFactoryBase(object):
     @classmethod
     def from_config(cls, cfg, prefix=PREFIX, section='DEFAULT'):
         '''Create query from config file settings
-        @type cfg: basestring /ConfigParser derived type
-        @param cfg: configuration file path or ConfigParser type object
+        @type cfg: basestring /ConfigParser derived type / CompiledConfig
+        @param cfg: configuration file path, ConfigParser type object or
+        compiled configuration
         @type prefix: basestring
         @param prefix: prefix for option names e.g. "attributeQuery."
         @type section: baestring
         @param section: configuration file section from which to extract
         parameters.
-        '''  
-        if isinstance(cfg, basestring):
-            cfg_filepath = os.path.expandvars(cfg)
-            here_dir = os.path.dirname(cfg_filepath)
-            _cfg = SafeConfigParser(defaults=dict(here=here_dir))
-            _cfg.optionxform = str
-
-            _cfg.read(cfg_filepath)
-            
-        elif isinstance(cfg, ConfigParser):
-            _cfg = cfg   
-        else:
-            raise AttributeError('Expecting basestring or ConfigParser type '
-                                 'for "cfg" attribute; got %r type' % type(cfg))
-        
+        '''
         # Get items for this section as a dictionary so that from_kw can
         # used to update the object
-        kw = dict(_cfg.items(section))
+        kw = readConfigItems(cfg, section=section)
         if 'prefix' not in kw and prefix:
             kw['prefix'] = prefix
             
@@ -237,6 +558,42 @@ class QueryFactoryBase(object):
     @abstractmethod
     def from_kw(cls, prefix=PREFIX, **config):
         '''parse attribute query from an input keywords'''
+        
+    @classmethod
+    def template_from_kw(cls, **config):
+        '''Parse a query template from input keywords.  Use the template to
+        create queries repeatedly without parsing the settings each time
+        
+        @type config: dict
+        @param config: keywords as for from_kw
+        @rtype: QueryTemplate
+        @return: template for this factory's query type
+        '''
+        if cls.TEMPLATE_CLASS is None:
+            raise NotImplementedError('"TEMPLATE_CLASS" class variable must '
+                                      'be set in derived class')
+            
+        return cls.TEMPLATE_CLASS(cls.from_kw(**config))
+    
+    @classmethod
+    def template_from_config(cls, cfg, prefix=PREFIX, section='DEFAULT'):
+        '''Parse a query template from config file settings
+        @type cfg: basestring /ConfigParser derived type / CompiledConfig
+        @param cfg: configuration file path, ConfigParser type object or
+        compiled configuration
+        @type prefix: basestring
+        @param prefix: prefix for option names e.g. "attributeQuery."
+        @type section: baestring
+        @param section: configuration file section from which to extract
+        parameters.
+        @rtype: QueryTemplate
+        @return: template for this factory's query type
+        '''
+        kw = readConfigItems(cfg, section=section)
+        if 'prefix' not in kw and prefix:
+            kw['prefix'] = prefix
+            
+        return cls.template_from_kw(**kw)
            
     
 class AttributeQueryFactory(QueryFactoryBase):
@@ -244,6 +601,7 @@ class AttributeQueryFactory(QueryFactoryBase):
     """
     PREFIX = 'attribute_query.'
     QUERY_CLASS = saml2.AttributeQuery
+    TEMPLATE_CLASS = AttributeQueryTemplate
     SUBJECT_PARAM_NAME_PREFIX = 'subject.'
     ISSUER_PARAM_NAME_PREFIX = 'issuer.'
     ATTR_PARAM_VAL_SEP_PAT = re.compile(',\s*')
@@ -305,10 +663,13 @@ class AuthzDecisionQueryFactory(QueryFactoryBase):
     """
     PREFIX = 'authz_decision_query.'
     QUERY_CLASS = saml2.AuthzDecisionQuery
+    TEMPLATE_CLASS = AuthzDecisionQueryTemplate
     SUBJECT_PARAM_NAME_PREFIX = 'subject.'
     ISSUER_PARAM_NAME_PREFIX = 'issuer.'
     ATTR_PARAM_VAL_SEP_PAT = re.compile(',\s*')
     ATTR_PARAM_NAME_PREFIX = 'attributes.'
+    RESOURCE_PARAM_NAME = 'resource'
+    ACTION_PARAM_NAME_PREFIX = 'actions.'
     
     @classmethod
     def from_kw(cls, prefix=PREFIX, **config):
@@ -352,6 +713,18 @@ class AuthzDecisionQueryFactory(QueryFactoryBase):
                  attribute.nameFormat) = pat.split(param_val)
          
                 authz_decision_query.attributes.append(attribute)
+                
+            elif _param_name == cls.RESOURCE_PARAM_NAME:
+                authz_decision_query.resource = param_val
+                
+            elif _param_name.startswith(cls.ACTION_PARAM_NAME_PREFIX):
+                # Actions are set as a comma-separated namespace and value 
+                # e.g.
+                #
+                # actions.0 = urn:oasis:names:tc:SAML:1.0:action:ghpp, GET
+                action = saml2.Action()
+                action.namespace, action.value = pat.split(param_val)
+                authz_decision_query.actions.append(action)
             else:
                 raise AttributeError('Config item %r not recognised as a valid '
                                      'AuthzDecisionbQuery object member '
@@ -10,6 +10,9 @@ __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id$'
 import os
 import re
+import urllib2
+from copy import copy
+from threading import Lock
 from abc import ABCMeta, abstractmethod
 import logging
 
@@ -231,3 +234,151 @@ class SSLContextProxyInterface(object):
         '''Enable pickling for use with beaker.session'''
         for attr, val in attrDict.items():
             setattr(self, attr, val)
+
+
+# The SSL backend modules are slow to import so they are imported on first use
+# by the SSL bindings rather than when the binding modules are imported
+_sslContextProxyClass = None
+_httpsHandlerClass = None
+
+
+def importSSLContextProxy():
+    """Import the SSL context proxy class for the available backend,
+    PyOpenSSL or else M2Crypto.  The result is cached
+
+    :rtype: type
+    :return: SSLContextProxyInterface derived class
+    :raise ImportError: neither backend is available
+    """
+    global _sslContextProxyClass
+    if _sslContextProxyClass is None:
+        try:
+            from ndg.saml.utils.pyopenssl import SSLContextProxy
+            
+        except ImportError, e:
+            log.debug("PyOpenSSL SSL context proxy not available: %s", e)
+            try:
+                from ndg.saml.utils.m2crypto import SSLContextProxy
+                
+            except ImportError, e:
+                raise ImportError("No SSL context proxy available - missing "
+                                  "PyOpenSSL or M2Crypto package?: %s" % e)
+                
+        _sslContextProxyClass = SSLContextProxy
+        
+    return _sslContextProxyClass
+
+
+def importHTTPSHandler():
+    """Import the urllib2 HTTPS handler class taking an SSL context, from
+    ndg.httpsclient or else M2Crypto.  The result is cached
+
+    :rtype: type
+    :return: urllib2 handler class with a ssl_context keyword
+    :raise ImportError: neither package is available
+    """
+    global _httpsHandlerClass
+    if _httpsHandlerClass is None:
+        try:
+            from ndg.httpsclient.https import \
+                HTTPSContextHandler as HTTPSHandler
+            
+        except ImportError:
+            from M2Crypto.m2urllib2 import HTTPSHandler
+            
+        _httpsHandlerClass = HTTPSHandler
+        
+    return _httpsHandlerClass
+
+
+class SSLContextProxySupport(object):
+    """Descriptor for the SSL_CONTEXT_PROXY_SUPPORT class attribute of SSL 
+    bindings.  Evaluates to True if an SSL context proxy can be imported, 
+    importing it on first access
+    """
+    def __get__(self, obj, objtype=None):
+        try:
+            importSSLContextProxy()
+            return True
+        
+        except ImportError:
+            return False
+
+
+class SSLContextHTTPSHandler(urllib2.AbstractHTTPHandler):
+    """urllib2 HTTPS handler making SSL connections with contexts created 
+    from an SSL context proxy.  The context for each host is created once 
+    with the proxy's ssl_valid_hostname set to the host name, and cached with 
+    the HTTPS handler using it.  The proxy itself is not modified so the 
+    handler can be shared between threads.  Call clearCache after changing 
+    the proxy's settings.
+    """
+    https_request = urllib2.AbstractHTTPHandler.do_request_
+    
+    def __init__(self, sslCtxProxy, debuglevel=0):
+        """
+        :type sslCtxProxy: SSLContextProxyInterface
+        :param sslCtxProxy: SSL context proxy to create contexts from
+        :type debuglevel: int
+        :param debuglevel: debug level for the handler
+        """
+        urllib2.AbstractHTTPHandler.__init__(self, debuglevel)
+        self.__sslCtxProxy = sslCtxProxy
+        self.__handlers = {}
+        self.__lock = Lock()
+        
+    def _getSslCtxProxy(self):
+        return self.__sslCtxProxy
+    
+    def _setSslCtxProxy(self, value):
+        self.__sslCtxProxy = value
+        self.clearCache()
+        
+    sslCtxProxy = property(_getSslCtxProxy, _setSslCtxProxy,
+                           doc="SSL context proxy contexts are created from.  "
+                               "Setting it clears the cache")
+    
+    def clearCache(self):
+        """Discard the contexts created so far"""
+        with self.__lock:
+            self.__handlers = {}
+        
+    def _getHandler(self, hostname):
+        """Get the HTTPS handler for a host creating it and its SSL context 
+        on first use
+        
+        :type hostname: basestring
+        :param hostname: host name without port
+        :return: HTTPS handler with the SSL context for the host
+        """
+        handler = self.__handlers.get(hostname)
+        if handler is None:
+            with self.__lock:
+                handler = self.__handlers.get(hostname)
+                if handler is None:
+                    sslCtxProxy = copy(self.__sslCtxProxy)
+                    sslCtxProxy.ssl_valid_hostname = hostname
+                    handler = importHTTPSHandler()(ssl_context=sslCtxProxy())
+                    self.__handlers[hostname] = handler
+                    
+        return handler
+    
+    def https_open(self, req):
+        """Open an HTTPS request with the SSL context for its host
+        
+        :type req: urllib2.Request
+        :param req: request
+        :return: response
+        """
+        hostname = req.get_host().rsplit('@', 1)[-1].split(':')[0]
+        return self._getHandler(hostname).https_open(req)
+    
+    def __getstate__(self):
+        '''Enable pickling - cached contexts are not included'''
+        return dict(sslCtxProxy=self.__sslCtxProxy, 
+                    _debuglevel=self._debuglevel)
+    
+    def __setstate__(self, attrDict):
+        '''Enable pickling'''
+        self.__init__(attrDict['sslCtxProxy'], 
+                      debuglevel=attrDict['_debuglevel'])
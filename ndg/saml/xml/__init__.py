@@ -28,6 +28,7 @@ __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = "$Id$"
 import logging
 log = logging.getLogger(__name__)
+from threading import Lock
    
 
 class XMLConstants(object):
@@ -134,4 +135,136 @@ class XMLTypeParseError(XMLTypeError):
 
 class UnknownAttrProfile(XMLTypeError):
     """Raise from Attribute Value factory if attribute type is not recognised
-    """
\ No newline at end of file
+    """
+
+
+class AttributeFilter(object):
+    """Select the attributes to be parsed from an AttributeStatement.  
+    Attribute elements not matching the filter are skipped without creating 
+    Attribute or AttributeValue objects.  Counts of the attributes matched 
+    and skipped are accumulated for monitoring
+    
+    @ivar __names: wanted attribute names.  Items may be a name or a (name, 
+    NameFormat) tuple.  If empty, any name is accepted
+    @type __names: frozenset
+    @ivar __nameFormats: wanted attribute NameFormats.  If empty, any 
+    NameFormat is accepted
+    @type __nameFormats: frozenset
+    @ivar __nMatched: number of attributes matched
+    @type __nMatched: int
+    @ivar __nSkipped: number of attributes skipped
+    @type __nSkipped: int
+    @ivar __lock: lock for updating counts
+    @type __lock: threading.Lock
+    """
+    __slots__ = (
+        '__names', 
+        '__nameFormats', 
+        '__nMatched', 
+        '__nSkipped', 
+        '__lock'
+    )
+    
+    def __init__(self, names=(), nameFormats=()):
+        """
+        @type names: iterable or basestring
+        @param names: wanted attribute names or (name, NameFormat) tuples.  A
+        string is treated as a whitespace separated list of names
+        @type nameFormats: iterable or basestring
+        @param nameFormats: wanted attribute NameFormats.  A string is treated
+        as a whitespace separated list
+        """
+        self.__lock = Lock()
+        self.__nMatched = 0
+        self.__nSkipped = 0
+        self.names = names
+        self.nameFormats = nameFormats
+        
+    @staticmethod
+    def _toFrozenSet(value, attrName):
+        """Convert a config file string or iterable into a frozenset
+        
+        @type value: iterable or basestring
+        @param value: value to convert
+        @type attrName: string
+        @param attrName: name of attribute being set for error message
+        @rtype: frozenset
+        @return: converted value
+        """
+        if isinstance(value, basestring):
+            return frozenset(value.split())
+        
+        try:
+            return frozenset(value)
+        except TypeError:
+            raise TypeError('Expecting string or iterable type for "%s" '
+                            'attribute; got %r' % (attrName, type(value)))
+    
+    def _getNames(self):
+        return self.__names
+    
+    def _setNames(self, value):
+        self.__names = self._toFrozenSet(value, 'names')
+        
+    names = property(_getNames, _setNames, 
+                     doc="Wanted attribute names or (name, NameFormat) "
+                         "tuples.  If empty any name is accepted")
+    
+    def _getNameFormats(self):
+        return self.__nameFormats
+    
+    def _setNameFormats(self, value):
+        self.__nameFormats = self._toFrozenSet(value, 'nameFormats')
+        
+    nameFormats = property(_getNameFormats, _setNameFormats, 
+                           doc="Wanted attribute NameFormats.  If empty any "
+                               "NameFormat is accepted")
+    
+    @property
+    def nMatched(self):
+        """Number of attributes matched"""
+        return self.__nMatched
+    
+    @property
+    def nSkipped(self):
+        """Number of attributes skipped"""
+        return self.__nSkipped
+    
+    def match(self, name, nameFormat=None):
+        """Test whether an attribute is wanted without updating the counts
+        
+        @type name: basestring
+        @param name: attribute name
+        @type nameFormat: basestring / NoneType
+        @param nameFormat: attribute NameFormat
+        @rtype: bool
+        @return: True if the attribute is wanted
+        """
+        names = self.__names
+        if names and name not in names and (name, nameFormat) not in names:
+            return False
+        
+        return not self.__nameFormats or nameFormat in self.__nameFormats
+    
+    def addCounts(self, nMatched, nSkipped):
+        """Add to the matched and skipped counts
+        
+        @type nMatched: int
+        @param nMatched: number of attributes matched
+        @type nSkipped: int
+        @param nSkipped: number of attributes skipped
+        """
+        self.__lock.acquire()
+        try:
+            self.__nMatched += nMatched
+            self.__nSkipped += nSkipped
+        finally:
+            self.__lock.release()
+            
+    def resetCounts(self):
+        """Set the matched and skipped counts to zero"""
+        self.__lock.acquire()
+        try:
+            self.__nMatched = self.__nSkipped = 0
+        finally:
+            self.__lock.release()
@@ -35,6 +35,8 @@ from ndg.saml import Config, importElementTree
 ElementTree = importElementTree()
 
 from ndg.saml.saml2.core import (SAMLObject, Attribute, AttributeStatement, 
+                                 ColumnarAttributeStatement, 
+                                 ColumnarAttributeList, Statement, 
                                  AuthnStatement, AuthzDecisionStatement, 
                                  Assertion, Conditions, AttributeValue, 
                                  AttributeQuery, AuthzDecisionQuery, Subject, 
@@ -45,8 +47,9 @@ from ndg.saml.saml2.core import (SAMLObject, Attribute, AttributeStatement,
 from ndg.saml.common import SAMLVersion
 from ndg.saml.common.xml import SAMLConstants
 from ndg.saml.common.xml import QName as GenericQName
-from ndg.saml.xml import XMLTypeParseError, UnknownAttrProfile
-from ndg.saml.utils import SAMLDateTime
+from ndg.saml.xml import (XMLTypeParseError, UnknownAttrProfile, 
+                          AttributeFilter)
+from ndg.saml.utils import SAMLDateTime, LazyTypedList
 
 # Map of QName to ElementTree parsing class to be used in addition to those
 # defined in this module.
@@ -504,12 +507,17 @@ class AssertionElementTree(Assertion):
         return elem
 
     @classmethod
-    def fromXML(cls, elem, **attributeValueElementTreeFactoryKw):
+    def fromXML(cls, elem, lazy=False, **attributeValueElementTreeFactoryKw):
         """Parse an ElementTree representation of an Assertion into an
         Assertion object
         
         @type elem: ElementTree.Element
         @param elem: ElementTree element containing the assertion
+        @type lazy: bool
+        @param lazy: set to True to defer parsing of statements until the 
+        statements, authzDecisionStatements or attributeStatements list is 
+        first accessed.  Each is then a LazyTypedList holding the child 
+        elements until then
         @type attributeValueElementTreeFactoryKw: dict
         @param attributeValueElementTreeFactoryKw: keywords for AttributeValue
         @rtype: saml.saml2.core.Assertion
@@ -552,6 +560,11 @@ class AssertionElementTree(Assertion):
         assertion.issueInstant = SAMLDateTime.fromString(attributeValues[1])
         assertion.id = attributeValues[2]
         
+        if lazy:
+            statementElems = []
+            authzDecisionStatementElems = []
+            attributeStatementElems = []
+            
         for childElem in elem:
             localName = QName.getLocalPart(childElem.tag)
 
@@ -573,27 +586,63 @@ class AssertionElementTree(Assertion):
                 assertion.conditions = ConditionsElementTree.fromXML(childElem)
 
             elif statementElementTree is not None:
-                statement = statementElementTree.fromXML(childElem)
-                assertion.statements.append(statement)
+                if lazy:
+                    statementElems.append(childElem)
+                else:
+                    statement = statementElementTree.fromXML(childElem)
+                    assertion.statements.append(statement)
 
             elif localName == AuthnStatement.DEFAULT_ELEMENT_LOCAL_NAME:
                 raise NotImplementedError("Assertion Authentication Statement "
                                           "parsing is not implemented")
         
             elif localName == AuthzDecisionStatement.DEFAULT_ELEMENT_LOCAL_NAME:
-                authzDecisionStatement = \
-                    AuthzDecisionStatementElementTree.fromXML(childElem)
-                assertion.authzDecisionStatements.append(authzDecisionStatement)
+                if lazy:
+                    authzDecisionStatementElems.append(childElem)
+                else:
+                    authzDecisionStatement = \
+                        AuthzDecisionStatementElementTree.fromXML(childElem)
+                    assertion.authzDecisionStatements.append(
+                                                        authzDecisionStatement)
             
             elif localName == AttributeStatement.DEFAULT_ELEMENT_LOCAL_NAME:
-                attributeStatement = AttributeStatementElementTree.fromXML(
+                if lazy:
+                    attributeStatementElems.append(childElem)
+                else:
+                    attributeStatement = AttributeStatementElementTree.fromXML(
                                         childElem,
                                         **attributeValueElementTreeFactoryKw)
-                assertion.attributeStatements.append(attributeStatement)
+                    assertion.attributeStatements.append(attributeStatement)
             else:
                 raise XMLTypeParseError('Assertion child element name "%s" '
                                         'not recognised' % localName)
         
+        if lazy:
+            def statementFromXML(statementElem):
+                statementElementTree = _getElementTreeImplementationForQName(
+                                                    QName(statementElem.tag))
+                return statementElementTree.fromXML(statementElem)
+            
+            def attributeStatementFromXML(attributeStatementElem):
+                return AttributeStatementElementTree.fromXML(
+                                        attributeStatementElem,
+                                        **attributeValueElementTreeFactoryKw)
+            
+            _setLazyList(assertion, Assertion, 'statements',
+                         LazyTypedList(Statement, statementFromXML, 
+                                       statementElems))
+            authzDecisionStatementFromXML = \
+                AuthzDecisionStatementElementTree.fromXML
+                
+            _setLazyList(assertion, Assertion, 'authzDecisionStatements',
+                         LazyTypedList(AuthzDecisionStatement,
+                                       authzDecisionStatementFromXML,
+                                       authzDecisionStatementElems))
+            _setLazyList(assertion, Assertion, 'attributeStatements',
+                         LazyTypedList(AttributeStatement,
+                                       attributeStatementFromXML,
+                                       attributeStatementElems))
+        
         return assertion
 
   
@@ -621,7 +670,12 @@ class AttributeStatementElementTree(AttributeStatement):
         elem = makeEtreeElement(tag, cls.DEFAULT_ELEMENT_NAME.prefix,
                                 cls.DEFAULT_ELEMENT_NAME.namespaceURI)
 
-        for attribute in attributeStatement.attributes:
+        attributes = attributeStatement.attributes
+        if isinstance(attributes, ColumnarAttributeList):
+            # Avoid caching an Attribute object for every item
+            attributes = attributes.iterAttributes()
+            
+        for attribute in attributes:
             # Factory enables support for multiple attribute types
             attributeElem = AttributeElementTree.toXML(attribute,
                                         **attributeValueElementTreeFactoryKw)
@@ -630,12 +684,22 @@ class AttributeStatementElementTree(AttributeStatement):
         return elem
     
     @classmethod
-    def fromXML(cls, elem, **attributeValueElementTreeFactoryKw):
+    def fromXML(cls, elem, columnar=False, attributeFilter=None,
+                **attributeValueElementTreeFactoryKw):
         """Parse an ElementTree SAML AttributeStatement element into an
         AttributeStatement object
         
         @type elem: ElementTree.Element
         @param elem: ElementTree element containing the AttributeStatement
+        @type columnar: bool
+        @param columnar: set to True to return a ColumnarAttributeStatement.
+        xs:string attributes are then added directly to its columns without
+        creating Attribute objects
+        @type attributeFilter: ndg.saml.xml.AttributeFilter / iterable
+        @param attributeFilter: if set, only attributes matching this filter
+        are parsed.  Others are skipped and counted in the filter.  An 
+        iterable of wanted attribute names may be given in place of an 
+        AttributeFilter
         @type attributeValueElementTreeFactoryKw: dict
         @param attributeValueElementTreeFactoryKw: keywords for AttributeValue
         factory
@@ -653,13 +717,43 @@ class AttributeStatementElementTree(AttributeStatement):
                                       cls.DEFAULT_ELEMENT_LOCAL_NAME)
         
         
-        attributeStatement = AttributeStatement()
+        if columnar:
+            attributeStatement = ColumnarAttributeStatement()
+            factory = AttributeValueElementTreeFactory(
+                                        **attributeValueElementTreeFactoryKw)
+        else:
+            attributeStatement = AttributeStatement()
+            
+        if attributeFilter is not None:
+            if not isinstance(attributeFilter, AttributeFilter):
+                attributeFilter = AttributeFilter(names=attributeFilter)
+            nSkipped = 0
 
         for childElem in elem:
+            if (attributeFilter is not None and 
+                not attributeFilter.match(
+                    childElem.attrib.get(Attribute.NAME_ATTRIB_NAME),
+                    childElem.attrib.get(Attribute.NAME_FORMAT_ATTRIB_NAME))):
+                nSkipped += 1
+                continue
+            
+            if columnar:
+                columns = AttributeElementTree.columnsFromXML(childElem, 
+                                                              factory)
+                if columns is not None:
+                    attributeStatement.attributes.addColumns(*columns)
+                    continue
+                
             # Factory enables support for multiple attribute types
             attribute = AttributeElementTree.fromXML(childElem,
                                         **attributeValueElementTreeFactoryKw)
             attributeStatement.attributes.append(attribute)
+            
+        if attributeFilter is not None:
+            nMatched = len(elem) - nSkipped
+            attributeFilter.addCounts(nMatched, nSkipped)
+            log.debug("Attribute filter matched %d and skipped %d attributes",
+                      nMatched, nSkipped)
         
         return attributeStatement
 
@@ -859,6 +953,63 @@ class AttributeElementTree(Attribute):
             attribute.attributeValues.append(attributeValue)
         
         return attribute
+
+    @classmethod
+    def columnsFromXML(cls, elem, factory):
+        """Parse ElementTree element into the string components of a SAML 
+        Attribute without creating Attribute or AttributeValue objects.  Only
+        attributes whose values are all of xs:string type can be parsed in 
+        this way.
+        
+        @type elem: ElementTree.Element
+        @param elem: Attribute as ElementTree XML element
+        @type factory: AttributeValueElementTreeFactory
+        @param factory: factory for matching Attribute Value types
+        @rtype: tuple / NoneType
+        @return: name, name format, friendly name and list of values or None
+        if the attribute has values other than xs:string
+        """
+        if not ElementTree.iselement(elem):
+            raise TypeError("Expecting %r input type for parsing; got %r" %
+                            (ElementTree.Element, elem))
+
+        if QName.getLocalPart(elem.tag) != cls.DEFAULT_ELEMENT_LOCAL_NAME:
+            raise XMLTypeParseError("No \"%s\" element found" %
+                                      cls.DEFAULT_ELEMENT_LOCAL_NAME)
+            
+        # Name is mandatory in the schema
+        name = elem.attrib.get(cls.NAME_ATTRIB_NAME)
+        if name is None:
+            raise XMLTypeParseError('No "%s" attribute found in the "%s" '
+                                    'element' %
+                                    (cls.NAME_ATTRIB_NAME,
+                                     cls.DEFAULT_ELEMENT_LOCAL_NAME))
+        values = []
+        for childElem in elem:
+            localName = QName.getLocalPart(childElem.tag)
+            if localName != AttributeValue.DEFAULT_ELEMENT_LOCAL_NAME:
+                raise XMLTypeParseError('Expecting "%s" element; found "%s"'%
+                                    (AttributeValue.DEFAULT_ELEMENT_LOCAL_NAME,
+                                     localName))
+            
+            if factory(childElem) is not XSStringAttributeValueElementTree:
+                return None
+            
+            if childElem.text is None:
+                values.append(None)
+            else:
+                values.append(childElem.text.strip())
+        
+        # Update namespace map as an XSI type has been referenced - see
+        # XSStringAttributeValueElementTree.fromXML
+        if values and not Config.use_lxml:
+            ElementTree._namespace_map[SAMLConstants.XSI_NS
+                                       ] = SAMLConstants.XSI_PREFIX
+            
+        return (name, 
+                elem.attrib.get(cls.NAME_FORMAT_ATTRIB_NAME),
+                elem.attrib.get(cls.FRIENDLY_NAME_ATTRIB_NAME),
+                values)
         
     
 class AttributeValueElementTreeBase(AttributeValue):
@@ -1068,7 +1219,7 @@ class AttributeValueElementTreeFactory(object):
         render or parse the relevant AttributeValue class
         """
         if isinstance(input, AttributeValue):
-            XMLTypeClass = self.__toXMLTypeMap.get(input.__class__)
+            XMLTypeClass = self.__toXMLTypeMap.get(input.unfrozenClass())
             if XMLTypeClass is None:
                 raise UnknownAttrProfile("no matching XMLType class "
                                          "representation for class %r" % 
@@ -1636,13 +1787,20 @@ class ResponseElementTree(Response):
         return elem
 
     @classmethod
-    def fromXML(cls, elem, **attributeValueElementTreeFactoryKw):
+    def fromXML(cls, elem, lazy=False, **attributeValueElementTreeFactoryKw):
         """Parse ElementTree element into a SAML Response object
         
         @type elem: ElementTree.Element
         @param elem: XML element containing the Response
+        @type lazy: bool
+        @param lazy: set to True to defer parsing of assertions until the 
+        assertions list is first accessed.  Assertions are then parsed in lazy
+        mode too - see AssertionElementTree.fromXML
         @type attributeValueElementTreeFactoryKw: dict
         @param attributeValueElementTreeFactoryKw: keywords for AttributeValue
+        factory.  Set columnar=True to parse attribute statements into
+        ColumnarAttributeStatement objects or attributeFilter to parse only 
+        selected attributes - see AttributeStatementElementTree.fromXML
         @rtype: saml.saml2.core.Response
         @return: Response object
         """
@@ -1683,6 +1841,7 @@ class ResponseElementTree(Response):
         response.id = attributeValues[2]
         response.inResponseTo = attributeValues[3]
         
+        assertionElems = []
         for childElem in elem:
             localName = QName.getLocalPart(childElem.tag)
             if localName == Issuer.DEFAULT_ELEMENT_LOCAL_NAME:
@@ -1698,16 +1857,53 @@ class ResponseElementTree(Response):
                 response.subject = SubjectElementTree.fromXML(childElem)
             
             elif localName == Assertion.DEFAULT_ELEMENT_LOCAL_NAME:
-                assertion = AssertionElementTree.fromXML(childElem,
+                if lazy:
+                    assertionElems.append(childElem)
+                else:
+                    assertion = AssertionElementTree.fromXML(childElem,
                                         **attributeValueElementTreeFactoryKw)
-                response.assertions.append(assertion)
+                    response.assertions.append(assertion)
             else:
                 raise XMLTypeParseError('Unrecognised Response child '
                                           'element "%s"' % localName)
         
+        if lazy:
+            def assertionFromXML(assertionElem):
+                return AssertionElementTree.fromXML(assertionElem, lazy=True,
+                                        **attributeValueElementTreeFactoryKw)
+                
+            _setLazyList(response, Response, 'indexedChildren',
+                         LazyTypedList(Assertion, assertionFromXML, 
+                                       assertionElems))
+        
         return response
 
 
+class LazyResponseElementTree(ResponseElementTree):
+    """Parse SAML Responses deferring the creation of assertions and their 
+    statements until they are first accessed.  Use LazyResponseElementTree.
+    fromXML as the deserialise callable for a SOAP binding where clients 
+    only inspect part of a response, typically the status and a single 
+    statement
+    """
+    
+    @classmethod
+    def fromXML(cls, elem, **attributeValueElementTreeFactoryKw):
+        """Parse ElementTree element into a SAML Response object in lazy mode
+        - see ResponseElementTree.fromXML
+        
+        @type elem: ElementTree.Element
+        @param elem: XML element containing the Response
+        @type attributeValueElementTreeFactoryKw: dict
+        @param attributeValueElementTreeFactoryKw: keywords for AttributeValue
+        factory
+        @rtype: saml.saml2.core.Response
+        @return: Response object
+        """
+        return super(LazyResponseElementTree, cls).fromXML(elem, lazy=True,
+                                        **attributeValueElementTreeFactoryKw)
+
+
 class ActionElementTree(Action):
     """Represent a SAML authorization action in XML using ElementTree"""
     
@@ -1899,6 +2095,22 @@ class AuthzDecisionQueryElementTree(AuthzDecisionQuery):
         
         return authzDecisionQuery
 
+def _setLazyList(obj, slotClass, attrName, lazyList):
+    """Replace a list held in a private slot of a SAML object with a lazy 
+    equivalent
+    
+    @type obj: ndg.saml.common.SAMLObject
+    @param obj: object to update
+    @type slotClass: type
+    @param slotClass: class which defines the slot
+    @type attrName: string
+    @param attrName: slot name without the leading double underscore
+    @type lazyList: ndg.saml.utils.LazyTypedList
+    @param lazyList: list to set
+    """
+    setattr(obj, "_%s__%s" % (slotClass.__name__, attrName), lazyList)
+    
+
 def _getElementTreeImplementationForQName(qname):
     key = ("{%s}%s" % (qname.namespaceURI, qname.localPart))
     return _extensionElementTreeMap.get(key)
@@ -11,13 +11,25 @@ __contact__ = "Philip.Kershaw@stfc.ac.uk"
 __revision__ = '$Id: client.py 7131 2010-06-30 13:37:48Z pjkersha $'
 from abc import ABCMeta, abstractmethod
 import httplib
-import urllib2
 from urllib import addinfourl
 
 import logging
 log = logging.getLogger(__name__)
 
 from ndg.soap import SOAPEnvelopeBase
+from ndg.soap.utils.metrics import RequestTiming, timer
+from ndg.soap.transport import (HTTPTransportBase, UrlLib2Transport, 
+                                TransportResponse)
+from ndg.soap.utils.compression import (SUPPORTED_ENCODINGS,
+                                        ACCEPT_ENCODING_HEADER,
+                                        CONTENT_ENCODING_HEADER,
+                                        DEFAULT_COMPRESS_LEVEL,
+                                        DEFAULT_COMPRESS_MIN_SIZE,
+                                        CompressionError, DecompressingReader,
+                                        normaliseEncoding, compress)
+from ndg.soap.utils.tracing import (TraceContext, TRACEPARENT_HEADER,
+                                    getCurrentTraceContext,
+                                    addTraceparentHeaderBlock)
 
 
 class SOAPClientError(Exception):
@@ -111,6 +123,7 @@ class UrlLib2SOAPClientError(SOAPClientError):
     def __init__(self, *arg, **kw):
         Exception.__init__(self, *arg, **kw)
         self.__urllib2Response = None
+        self.__transportResponse = None
 
     def _getUrllib2Response(self):
         return self.__urllib2Response
@@ -126,12 +139,50 @@ class UrlLib2SOAPClientError(SOAPClientError):
                                _setUrllib2Response, 
                                doc="Urllib2Response")
 
+    def _getTransportResponse(self):
+        return self.__transportResponse
+
+    def _setTransportResponse(self, value):
+        if not isinstance(value, TransportResponse):
+            raise TypeError('Expecting %r type for "transportResponse"; got '
+                            '%r' % (TransportResponse, type(value)))
+        self.__transportResponse = value
+        
+        # urllib2 responses are also set for backwards compatibility
+        if isinstance(value.raw, UrlLib2SOAPClientError.URLLIB2RESPONSE_TYPE):
+            self.__urllib2Response = value.raw
+
+    transportResponse = property(_getTransportResponse, 
+                                 _setTransportResponse, 
+                                 doc="Response returned by the HTTP "
+                                     "transport")
+
 
 class SOAPResponseError(UrlLib2SOAPClientError):
     """Raise for invalid SOAP response from server"""
        
 class HTTPException(UrlLib2SOAPClientError):
     """Server returned HTTP code error code"""
+    
+    def __init__(self, *arg, **kw):
+        UrlLib2SOAPClientError.__init__(self, *arg, **kw)
+        self.__responseBody = None
+        
+    def _getResponseBody(self):
+        return self.__responseBody
+
+    def _setResponseBody(self, value):
+        if not isinstance(value, (basestring, type(None))):
+            raise TypeError('Expecting string or None type for '
+                            '"responseBody"; got %r' % type(value))
+        self.__responseBody = value
+
+    responseBody = property(_getResponseBody, 
+                            _setResponseBody, 
+                            doc="Body of the error response e.g. a SOAP "
+                                "fault, truncated to "
+                                "HTTPSOAPClient.MAX_ERROR_BODY_SIZE bytes.  "
+                                "None if it couldn't be read")
 
 class UrlLib2SOAPRequest(SOAPRequestBase):  
     """Interface for UrlLib2 based SOAP Requests"""
@@ -177,17 +228,38 @@ class CapitalizedKeysDict(dict):
         return CapitalizedKeysDict(self)
     
     
-class UrlLib2SOAPClient(SOAPClientBase):
-    """urllib2 based SOAP Client"""
+class HTTPSOAPClient(SOAPClientBase):
+    """SOAP Client sending requests with a pluggable HTTP transport - see
+    ndg.soap.transport
+    
+    @cvar MAX_ERROR_BODY_SIZE: maximum number of bytes of an error response 
+    body to read into the HTTPException raised for it
+    @type MAX_ERROR_BODY_SIZE: int
+    """
     DEFAULT_HTTP_HEADER = CapitalizedKeysDict({'Content-type': 'text/xml'})
+    MAX_ERROR_BODY_SIZE = 65536
     
-    def __init__(self):
-        super(UrlLib2SOAPClient, self).__init__()
-        self.__openerDirector = urllib2.OpenerDirector()
-        self.__openerDirector.add_handler(urllib2.UnknownHandler())
-        self.__openerDirector.add_handler(urllib2.HTTPHandler())
+    def __init__(self, transport=None):
+        """
+        @type transport: ndg.soap.transport.HTTPTransportBase / NoneType
+        @param transport: HTTP transport.  Defaults to 
+        ndg.soap.transport.UrlLib2Transport
+        """
+        super(HTTPSOAPClient, self).__init__()
+        self.__transport = None
+        if transport is None:
+            self.transport = UrlLib2Transport()
+        else:
+            self.transport = transport
+            
         self.__timeout = None
-        self.__httpHeader = UrlLib2SOAPClient.DEFAULT_HTTP_HEADER.copy()
+        self.__httpHeader = HTTPSOAPClient.DEFAULT_HTTP_HEADER.copy()
+        self.__observers = []
+        self.__propagateTraceContext = False
+        self.__traceContextHeaderBlock = False
+        self.__compression = None
+        self.__compressLevel = DEFAULT_COMPRESS_LEVEL
+        self.__compressMinSize = DEFAULT_COMPRESS_MIN_SIZE
 
     @property
     def httpHeader(self):
@@ -220,41 +292,193 @@ class UrlLib2SOAPClient(SOAPClientBase):
                        fset=_setTimeout, 
                        doc="Timeout (seconds) for requests")
 
-    def _getOpenerDirector(self):
-        return self.__openerDirector
-
-    def _setOpenerDirector(self, value):
-        """This shouldn't need to be used much in practice because __init__
-        creates one"""
-        if not isinstance(value, urllib2.OpenerDirector):
-            raise TypeError("Setting opener: expecting %r; got %r" % 
-                            (urllib2.OpenerDirector, type(value)))
-        self.__openerDirector = value
-
-    openerDirector = property(fget=_getOpenerDirector, 
-                              fset=_setOpenerDirector, 
-                              doc="urllib2.OpenerDirector defines the "
-                                  "opener(s) for handling requests")
+    def _getTransport(self):
+        return self.__transport
+
+    def _setTransport(self, value):
+        if not isinstance(value, HTTPTransportBase):
+            raise TypeError("Setting transport: expecting %r; got %r" % 
+                            (HTTPTransportBase, type(value)))
+        self.__transport = value
+
+    transport = property(fget=_getTransport, 
+                         fset=_setTransport, 
+                         doc="HTTP transport for sending requests")
+
+    def _getObservers(self):
+        return self.__observers
+
+    def _setObservers(self, value):
+        observers = list(value)
+        for observer in observers:
+            if not callable(observer):
+                raise TypeError("Setting observers: expecting callable; got "
+                                "%r" % type(observer))
+        self.__observers = observers
+
+    observers = property(fget=_getObservers, 
+                         fset=_setObservers, 
+                         doc="Callables passed a "
+                             "ndg.soap.utils.metrics.RequestTiming instance "
+                             "with the phase timings, sizes and status of "
+                             "each request made")
     
-    def send(self, soapRequest):
-        """Make a request to the given URL with a SOAP Request object"""
+    def _getPropagateTraceContext(self):
+        return self.__propagateTraceContext
+
+    def _setPropagateTraceContext(self, value):
+        if not isinstance(value, bool):
+            raise TypeError("Setting propagateTraceContext: expecting bool; "
+                            "got %r" % type(value))
+        self.__propagateTraceContext = value
+
+    propagateTraceContext = property(fget=_getPropagateTraceContext, 
+                                     fset=_setPropagateTraceContext, 
+                                     doc="Send a W3C traceparent HTTP header "
+                                         "with each request.  The request is "
+                                         "a child of the trace context set "
+                                         "for the current thread if any, "
+                                         "otherwise it starts a new trace")
+
+    def _getTraceContextHeaderBlock(self):
+        return self.__traceContextHeaderBlock
+
+    def _setTraceContextHeaderBlock(self, value):
+        if not isinstance(value, bool):
+            raise TypeError("Setting traceContextHeaderBlock: expecting bool; "
+                            "got %r" % type(value))
+        self.__traceContextHeaderBlock = value
+
+    traceContextHeaderBlock = property(fget=_getTraceContextHeaderBlock, 
+                                       fset=_setTraceContextHeaderBlock, 
+                                       doc="Also send the trace context in a "
+                                           "SOAP header block when "
+                                           "propagateTraceContext is set")
+
+    def _getCompression(self):
+        return self.__compression
+
+    def _setCompression(self, value):
+        if not isinstance(value, (basestring, type(None))):
+            raise TypeError("Setting compression: expecting string or None "
+                            "type; got %r" % type(value))
+        try:
+            self.__compression = normaliseEncoding(value)
+        except CompressionError, e:
+            raise ValueError("Setting compression: %s" % e)
+
+    compression = property(fget=_getCompression, 
+                           fset=_setCompression, 
+                           doc="Content encoding, 'gzip' or 'deflate', for "
+                               "requests of compressMinSize bytes or more.  "
+                               "When set, compressed responses are also "
+                               "requested.  None disables compression.  "
+                               "Compressed responses are decompressed "
+                               "whatever the setting")
+
+    def _getCompressLevel(self):
+        return self.__compressLevel
+
+    def _setCompressLevel(self, value):
+        if not isinstance(value, (int, long)):
+            raise TypeError("Setting compressLevel: expecting int type; got "
+                            "%r" % type(value))
+        if not 1 <= value <= 9:
+            raise ValueError("Setting compressLevel: expecting a value from "
+                             "1 to 9; got %r" % value)
+        self.__compressLevel = value
+
+    compressLevel = property(fget=_getCompressLevel, 
+                             fset=_setCompressLevel, 
+                             doc="Compression level for requests from 1 "
+                                 "(fastest) to 9 (smallest)")
+
+    def _getCompressMinSize(self):
+        return self.__compressMinSize
+
+    def _setCompressMinSize(self, value):
+        if not isinstance(value, (int, long)):
+            raise TypeError("Setting compressMinSize: expecting int type; got "
+                            "%r" % type(value))
+        self.__compressMinSize = value
+
+    compressMinSize = property(fget=_getCompressMinSize, 
+                               fset=_setCompressMinSize, 
+                               doc="Requests smaller than this number of "
+                                   "bytes are sent uncompressed")
+    
+    def send(self, soapRequest, timing=None):
+        """Make a request to the given URL with a SOAP Request object
+        
+        @type soapRequest: UrlLib2SOAPRequest
+        @param soapRequest: SOAP request
+        @type timing: ndg.soap.utils.metrics.RequestTiming / NoneType
+        @param timing: record to add the phase timings of this request to.  
+        If None and observers are set, a record is created and passed to 
+        them when the request completes.  If set, the caller is responsible
+        for notifying observers
+        @rtype: UrlLib2SOAPResponse
+        @return: SOAP response
+        """
+        if timing is not None or not self.__observers:
+            return self._send(soapRequest, timing)
+        
+        timing = RequestTiming(soapRequest.url)
+        try:
+            return self._send(soapRequest, timing)
+        except Exception, e:
+            timing.error = type(e).__name__
+            raise
+        finally:
+            timing.notify(self.__observers)
+    
+    def _send(self, soapRequest, timing):
+        """Make a request recording phase timings in timing if set"""
         
         if not isinstance(soapRequest, UrlLib2SOAPRequest):
-            raise TypeError('UrlLib2SOAPClient.send: expecting %r '
+            raise TypeError('%s.send: expecting %r '
                             'derived type for SOAP request, got %r' % 
-                            (self.responseEnvelopeClass, type(soapRequest)))
+                            (type(self).__name__, UrlLib2SOAPRequest, 
+                             type(soapRequest)))
             
         if not isinstance(soapRequest.envelope, self.responseEnvelopeClass):
-            raise TypeError('UrlLib2SOAPClient.send: expecting %r '
+            raise TypeError('%s.send: expecting %r '
                             'derived type for SOAP envelope, got %r' % 
-                            (self.responseEnvelopeClass, type(soapRequest)))
+                            (type(self).__name__, self.responseEnvelopeClass, 
+                             type(soapRequest.envelope)))
                             
         if self.timeout is not None:
-            arg = (self.timeout,)
+            deadline = timer() + self.timeout
         else:
-            arg = ()
+            deadline = None
             
+        traceContext = None
+        if self.__propagateTraceContext:
+            parentContext = getCurrentTraceContext()
+            if parentContext is None:
+                traceContext = TraceContext()
+            else:
+                traceContext = parentContext.newChild()
+                
+            if self.__traceContextHeaderBlock:
+                addTraceparentHeaderBlock(soapRequest.envelope, traceContext)
+                
+            if timing is not None:
+                timing.traceContext = traceContext
+                
         soapRequestStr = soapRequest.envelope.serialize()
+        if timing is not None:
+            timing.mark('envelopeSerialise')
+        
+        contentEncoding = None
+        if (self.__compression is not None and 
+            len(soapRequestStr) >= self.__compressMinSize):
+            contentEncoding = self.__compression
+            soapRequestStr = compress(soapRequestStr, contentEncoding, 
+                                      level=self.__compressLevel)
+            
+        if timing is not None:
+            timing.requestSize = len(soapRequestStr)
 
         logLevel = log.getEffectiveLevel()
         if logLevel <= logging.DEBUG:
@@ -264,38 +488,75 @@ class UrlLib2SOAPClient(SOAPClientBase):
             log.debug(prettyPrint(soapRequest.envelope.elem))
 
         soapResponse = UrlLib2SOAPResponse()
-        urllib2Request = urllib2.Request(soapRequest.url) 
-        for i in self.httpHeader.items():
-            urllib2Request.add_header(*i)
+        httpHeader = self.httpHeader.copy()
+        if traceContext is not None:
+            httpHeader[TRACEPARENT_HEADER] = traceContext.toHeader()
+            
+        if self.__compression is not None:
+            httpHeader[ACCEPT_ENCODING_HEADER] = ', '.join(SUPPORTED_ENCODINGS)
             
-        response = self.openerDirector.open(urllib2Request, 
-                                            soapRequestStr, 
-                                            *arg)
-        if response.code != httplib.OK:
+        if contentEncoding is not None:
+            httpHeader[CONTENT_ENCODING_HEADER] = contentEncoding
+            
+        response = self.transport.send(soapRequest.url, 
+                                       soapRequestStr, 
+                                       httpHeader,
+                                       deadline=deadline)
+        if timing is not None:
+            timing.mark('transport')
+            timing.httpStatus = response.status
+            contentLength = response.headers.get('Content-length')
+            if contentLength and contentLength.isdigit():
+                timing.responseSize = int(contentLength)
+            
+        # Responses not parsed are closed before raising so that pooled 
+        # connections aren't left open.  Error response bodies are read 
+        # first as they may hold a SOAP fault - SOAP 1.1 faults are returned
+        # with a 500 status
+        if response.status != httplib.OK:
             excep = HTTPException("Response for request to [%s] is: %d %s" % 
                                   (soapRequest.url, 
-                                   response.code, 
-                                   response.msg))
-            excep.urllib2Response = response
+                                   response.status, 
+                                   response.reason))
+            excep.transportResponse = response
+            excep.responseBody = self._readErrorBody(response)
             raise excep
         
         # Check for accepted response type string in response from server
+        responseContentType = response.headers.get('Content-type', '')
         accepted_response_content_type = False
-        for content_type in UrlLib2SOAPClient.RESPONSE_CONTENT_TYPES:
-            if content_type in response.headers.typeheader:
+        for content_type in HTTPSOAPClient.RESPONSE_CONTENT_TYPES:
+            if content_type in responseContentType:
                 accepted_response_content_type = True
         
         if not accepted_response_content_type:
-            responseType = ', '.join(UrlLib2SOAPClient.RESPONSE_CONTENT_TYPES)
+            responseType = ', '.join(HTTPSOAPClient.RESPONSE_CONTENT_TYPES)
             excep = SOAPResponseError("Expecting %r response type; got %r for "
                                       "request to [%s]" % 
                                       (responseType, 
-                                       response.headers.typeheader,
+                                       responseContentType,
                                        soapRequest.url))
-            excep.urllib2Response = response
+            excep.transportResponse = response
+            response.stream.close()
+            raise excep
+            
+        # Decompress as the response is parsed
+        try:
+            responseEncoding = normaliseEncoding(
+                                response.headers.get(CONTENT_ENCODING_HEADER))
+        except CompressionError, e:
+            excep = SOAPResponseError("%s for request to [%s]" % 
+                                      (e, soapRequest.url))
+            excep.transportResponse = response
+            response.stream.close()
             raise excep
+        
+        if responseEncoding is None:
+            soapResponse.fileObject = response.stream
+        else:
+            soapResponse.fileObject = DecompressingReader(response.stream, 
+                                                          responseEncoding)
             
-        soapResponse.fileObject = response
         soapResponse.envelope = self.responseEnvelopeClass()  
         
         try:
@@ -304,10 +565,78 @@ class UrlLib2SOAPClient(SOAPClientBase):
             raise SOAPParseError("%r type error raised parsing response for "
                                  "request to [%s]: %s"
                                  % (type(e), soapRequest.url, e))
+        finally:
+            # Release the connection for pooling transports
+            soapResponse.fileObject.close()
         
+        if timing is not None:
+            timing.mark('envelopeParse')
+            
         if logLevel <= logging.DEBUG:
             log.debug("SOAP Response:")
             log.debug("_"*80)
             log.debug(prettyPrint(soapResponse.envelope.elem))
             
         return soapResponse
+    
+    def _readErrorBody(self, response):
+        """Read the body of an error response up to MAX_ERROR_BODY_SIZE bytes
+        and close it.  If it's read to the end, pooling transports can reuse
+        the connection
+        
+        @type response: ndg.soap.transport.TransportResponse
+        @param response: error response
+        @rtype: string / NoneType
+        @return: response body, decompressed if need be, or None if it 
+        couldn't be read
+        """
+        fileObject = response.stream
+        try:
+            responseEncoding = normaliseEncoding(
+                                response.headers.get(CONTENT_ENCODING_HEADER))
+            if responseEncoding is not None:
+                fileObject = DecompressingReader(fileObject, responseEncoding)
+                
+            return fileObject.read(self.__class__.MAX_ERROR_BODY_SIZE)
+        
+        except Exception, e:
+            log.debug("Error reading error response body: %s", e)
+            return None
+        
+        finally:
+            fileObject.close()
+
+
+class UrlLib2SOAPClient(HTTPSOAPClient):
+    """urllib2 based SOAP Client.  The urllib2 opener of the default
+    transport is accessible as openerDirector for adding handlers"""
+    
+    def __init__(self, transport=None):
+        """
+        @type transport: ndg.soap.transport.HTTPTransportBase / NoneType
+        @param transport: HTTP transport.  Defaults to 
+        ndg.soap.transport.UrlLib2Transport
+        """
+        super(UrlLib2SOAPClient, self).__init__(transport=transport)
+
+    def _getOpenerDirector(self):
+        if not isinstance(self.transport, UrlLib2Transport):
+            raise AttributeError("No openerDirector for %r transport" % 
+                                 type(self.transport))
+        return self.transport.openerDirector
+
+    def _setOpenerDirector(self, value):
+        """This shouldn't need to be used much in practice because __init__
+        creates one"""
+        if not isinstance(self.transport, UrlLib2Transport):
+            raise AttributeError("No openerDirector for %r transport" % 
+                                 type(self.transport))
+        self.transport.openerDirector = value
+
+    openerDirector = property(fget=_getOpenerDirector, 
+                              fset=_setOpenerDirector, 
+                              doc="urllib2.OpenerDirector defines the "
+                                  "opener(s) for handling requests.  Only "
+                                  "available with a "
+                                  "ndg.soap.transport.UrlLib2Transport "
+                                  "transport")
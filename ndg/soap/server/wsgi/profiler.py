@@ -0,0 +1,419 @@
+"""Sampling profiler WSGI middleware for SOAP services
+
+NERC DataGrid Project
+
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__license__ = "BSD - see LICENSE file in top-level directory"
+__revision__ = "$Id$"
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import re
+import time
+import glob
+import cProfile
+import pstats
+from cStringIO import StringIO
+from itertools import count
+from threading import Lock
+
+from ndg.soap.server.wsgi.middleware import SOAPMiddlewareConfigError
+
+
+class ProfilerMiddleware(object):
+    """Profile a sample of the requests made to the application it wraps,
+    typically a SOAPQueryInterfaceMiddleware or ZSIMiddleware instance.
+    Profiles are aggregated over a time window and then written as a pstats
+    file to an output directory, keeping only the most recent files.
+
+    Requests are profiled if they are 1 in every sampleRate requests or if
+    the text of an element in the request body matches a regular expression
+    set with a filter.<element local name> option.  For example, in a Paste
+    ini file pipeline, to profile 1 in 100 requests and all those from a
+    given issuer:
+
+    [filter:ProfilerFilter]
+    paste.filter_app_factory = ndg.soap.server.wsgi.profiler:ProfilerMiddleware.filter_app_factory
+    prefix = profile.
+    profile.sampleRate = 100
+    profile.filter.Issuer = ^/O=Site A/
+    profile.filter.NameID = ^https://openid\.localhost/
+    profile.outputDir = %(here)s/profiles
+    profile.window = 300
+    profile.maxFiles = 24
+
+    Dumps are written when a sampled request completes after the window has
+    expired or when flush is called.  Load them with pstats e.g.
+
+    $ python -m pstats profiles/profile-20161018T120000-1234-1.pstats
+
+    @type SAMPLE_RATE_OPTNAME: basestring
+    @cvar SAMPLE_RATE_OPTNAME: option name for the sample rate.  0 disables
+    sampling so that only filtered requests are profiled
+    @type FILTER_OPTPREFIX: basestring
+    @cvar FILTER_OPTPREFIX: prefix for options setting a regular expression to
+    match against the text of request body elements with the given local name
+    @type OUTPUT_DIR_OPTNAME: basestring
+    @cvar OUTPUT_DIR_OPTNAME: option name for the directory to write dumps to
+    @type WINDOW_OPTNAME: basestring
+    @cvar WINDOW_OPTNAME: option name for the time in seconds to aggregate
+    profiles over
+    @type MAX_FILES_OPTNAME: basestring
+    @cvar MAX_FILES_OPTNAME: option name for the number of dump files to keep
+    @type FILE_PREFIX_OPTNAME: basestring
+    @cvar FILE_PREFIX_OPTNAME: option name for the dump file name prefix
+    """
+    SAMPLE_RATE_OPTNAME = 'sampleRate'
+    FILTER_OPTPREFIX = 'filter.'
+    OUTPUT_DIR_OPTNAME = 'outputDir'
+    WINDOW_OPTNAME = 'window'
+    MAX_FILES_OPTNAME = 'maxFiles'
+    FILE_PREFIX_OPTNAME = 'filePrefix'
+
+    CONFIG_FILE_OPTNAMES = (
+        SAMPLE_RATE_OPTNAME,
+        OUTPUT_DIR_OPTNAME,
+        WINDOW_OPTNAME,
+        MAX_FILES_OPTNAME,
+        FILE_PREFIX_OPTNAME
+    )
+
+    DEFAULT_WINDOW = 60.
+    DEFAULT_MAX_FILES = 10
+    DEFAULT_FILE_PREFIX = 'profile'
+    FILE_SUFFIX = '.pstats'
+
+    ELEMENT_TEXT_PAT = r'<(?:[\w.-]+:)?%s\b[^>]*>\s*([^<]*?)\s*<'
+
+    def __init__(self, app):
+        '''@type app: callable following WSGI interface
+        @param app: application to profile
+        '''
+        self._app = app
+        self.__sampleRate = 0
+        self.__filters = {}
+        self.__outputDir = None
+        self.__window = ProfilerMiddleware.DEFAULT_WINDOW
+        self.__maxFiles = ProfilerMiddleware.DEFAULT_MAX_FILES
+        self.__filePrefix = ProfilerMiddleware.DEFAULT_FILE_PREFIX
+
+        self.__requestCount = count(1)
+        self.__lock = Lock()
+        self.__stats = None
+        self.__nProfiled = 0
+        self.__windowStart = time.time()
+        self.__dumpCount = count(1)
+
+    def initialise(self, global_conf, prefix='', **app_conf):
+        """Set attributes from the Paste configuration
+
+        @type global_conf: dict
+        @param global_conf: PasteDeploy global configuration dictionary
+        @type prefix: basestring
+        @param prefix: prefix for configuration items
+        @type app_conf: dict
+        @param app_conf: PasteDeploy application specific configuration
+        dictionary
+        @raise SOAPMiddlewareConfigError: no output directory set
+        """
+        for name in ProfilerMiddleware.CONFIG_FILE_OPTNAMES:
+            val = app_conf.get(prefix + name)
+            if val is not None:
+                setattr(self, name, val)
+
+        filterPrefix = prefix + ProfilerMiddleware.FILTER_OPTPREFIX
+        self.filters = dict([(name[len(filterPrefix):], val)
+                             for name, val in app_conf.items()
+                             if name.startswith(filterPrefix)])
+
+        if self.outputDir is None:
+            raise SOAPMiddlewareConfigError('No %r option set for profile '
+                                            'output' %
+                                        ProfilerMiddleware.OUTPUT_DIR_OPTNAME)
+
+        if not os.path.isdir(self.outputDir):
+            os.makedirs(self.outputDir)
+
+    @classmethod
+    def filter_app_factory(cls, app, global_conf, **app_conf):
+        """Set-up using a Paste app factory pattern.
+
+        @type app: callable following WSGI interface
+        @param app: next middleware application in the chain
+        @type global_conf: dict
+        @param global_conf: PasteDeploy global configuration dictionary
+        @type app_conf: dict
+        @param app_conf: PasteDeploy application specific configuration
+        dictionary
+        """
+        app = cls(app)
+        app.initialise(global_conf, **app_conf)
+
+        return app
+
+    def _getSampleRate(self):
+        return self.__sampleRate
+
+    def _setSampleRate(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int or string type for "sampleRate"; '
+                            'got %r' % type(value))
+        if value < 0:
+            raise ValueError('Expecting "sampleRate" >= 0; got %r' % value)
+
+        self.__sampleRate = value
+
+    sampleRate = property(_getSampleRate, _setSampleRate,
+                          doc="Profile 1 in this number of requests.  Set to "
+                              "0 to only profile requests matching filters")
+
+    def _getFilters(self):
+        return dict([(name, pat)
+                     for name, (elemPat, pat) in self.__filters.items()])
+
+    def _setFilters(self, value):
+        if not isinstance(value, dict):
+            raise TypeError('Expecting dict type for "filters"; got %r' %
+                            type(value))
+
+        filters = {}
+        for name, pat in value.items():
+            if isinstance(pat, basestring):
+                pat = re.compile(pat)
+            elif not hasattr(pat, 'search'):
+                raise TypeError('Expecting string or compiled regular '
+                                'expression for filter %r; got %r' %
+                                (name, type(pat)))
+            elemPat = re.compile(ProfilerMiddleware.ELEMENT_TEXT_PAT %
+                                 re.escape(name))
+            filters[name] = (elemPat, pat)
+
+        self.__filters = filters
+
+    filters = property(_getFilters, _setFilters,
+                       doc="Regular expressions keyed by element local name. "
+                           "A request is profiled if the text of any element "
+                           "in its body with a given name matches the "
+                           "expression for that name")
+
+    def _getOutputDir(self):
+        return self.__outputDir
+
+    def _setOutputDir(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError('Expecting string type for "outputDir"; got %r' %
+                            type(value))
+        self.__outputDir = os.path.expandvars(value)
+
+    outputDir = property(_getOutputDir, _setOutputDir,
+                         doc="Directory to write profile dumps to")
+
+    def _getWindow(self):
+        return self.__window
+
+    def _setWindow(self, value):
+        if isinstance(value, basestring):
+            value = float(value)
+        elif not isinstance(value, (int, long, float)):
+            raise TypeError('Expecting float, int, long or string type for '
+                            '"window"; got %r' % type(value))
+        self.__window = float(value)
+
+    window = property(_getWindow, _setWindow,
+                      doc="Time in seconds to aggregate profiles over before "
+                          "writing a dump")
+
+    def _getMaxFiles(self):
+        return self.__maxFiles
+
+    def _setMaxFiles(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+        elif not isinstance(value, (int, long)):
+            raise TypeError('Expecting int or string type for "maxFiles"; '
+                            'got %r' % type(value))
+        if value < 1:
+            raise ValueError('Expecting "maxFiles" >= 1; got %r' % value)
+
+        self.__maxFiles = value
+
+    maxFiles = property(_getMaxFiles, _setMaxFiles,
+                        doc="Number of dump files to keep.  The oldest are "
+                            "deleted first")
+
+    def _getFilePrefix(self):
+        return self.__filePrefix
+
+    def _setFilePrefix(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError('Expecting string type for "filePrefix"; got %r' %
+                            type(value))
+        self.__filePrefix = value
+
+    filePrefix = property(_getFilePrefix, _setFilePrefix,
+                          doc="Prefix for dump file names")
+
+    def _readBody(self, environ):
+        """Read the request body and replace wsgi.input so that it can be
+        read again by the application
+
+        @type environ: dict
+        @param environ: WSGI environment variables dictionary
+        @rtype: basestring
+        @return: request body
+        """
+        try:
+            contentLength = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            contentLength = 0
+
+        if contentLength <= 0 or 'wsgi.input' not in environ:
+            return ''
+
+        body = environ['wsgi.input'].read(contentLength)
+        environ['wsgi.input'] = StringIO(body)
+        return body
+
+    def _matchesFilters(self, environ):
+        """Check the request body against the element filters
+
+        @type environ: dict
+        @param environ: WSGI environment variables dictionary
+        @rtype: bool
+        @return: True if the text of an element matches its filter
+        """
+        if not self.__filters:
+            return False
+
+        body = self._readBody(environ)
+        for name, (elemPat, pat) in self.__filters.items():
+            for text in elemPat.findall(body):
+                if pat.search(text):
+                    log.debug("Profiling request with %s %r", name, text)
+                    return True
+
+        return False
+
+    def _isSampled(self, environ):
+        """@rtype: bool
+        @return: True if the request is to be profiled
+        """
+        if (self.__sampleRate and
+            self.__requestCount.next() % self.__sampleRate == 0):
+            return True
+
+        return self._matchesFilters(environ)
+
+    def __call__(self, environ, start_response):
+        """Call the application profiling the request if it is sampled.
+        The response is read within the profile so that applications which
+        generate it lazily are profiled fully
+
+        @type environ: dict
+        @param environ: WSGI environment variables dictionary
+        @type start_response: function
+        @param start_response: standard WSGI start response function
+        """
+        if not self._isSampled(environ):
+            return self._app(environ, start_response)
+
+        def callApp():
+            response = self._app(environ, start_response)
+            try:
+                return list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(callApp)
+        finally:
+            self._addProfile(profile)
+
+    def _addProfile(self, profile):
+        """Add a request profile to the current window and write a dump if
+        the window has expired
+
+        @type profile: cProfile.Profile
+        @param profile: profile for a request
+        """
+        self.__lock.acquire()
+        try:
+            if self.__stats is None:
+                self.__stats = pstats.Stats(profile)
+            else:
+                self.__stats.add(profile)
+            self.__nProfiled += 1
+
+            if time.time() - self.__windowStart >= self.__window:
+                self._dump()
+        except Exception, e:
+            log.exception("Error adding request profile: %s", e)
+        finally:
+            self.__lock.release()
+
+    def flush(self):
+        """Write a dump for the current window if any requests have been
+        profiled and start a new window
+
+        @rtype: basestring / NoneType
+        @return: path of the file written or None if there was nothing to
+        write
+        """
+        self.__lock.acquire()
+        try:
+            return self._dump()
+        finally:
+            self.__lock.release()
+
+    def _dump(self):
+        """Write the stats for the current window and start a new window.
+        The caller must hold the lock
+
+        @rtype: basestring / NoneType
+        @return: path of the file written or None if there was nothing to
+        write
+        """
+        stats, nProfiled = self.__stats, self.__nProfiled
+        self.__stats = None
+        self.__nProfiled = 0
+        self.__windowStart = time.time()
+        if stats is None:
+            return None
+
+        filePath = os.path.join(self.__outputDir, '%s-%s-%d-%d%s' % (
+                                self.__filePrefix,
+                                time.strftime('%Y%m%dT%H%M%S'),
+                                os.getpid(),
+                                self.__dumpCount.next(),
+                                ProfilerMiddleware.FILE_SUFFIX))
+
+        # Write to a temporary file first so that readers never see a
+        # partial dump
+        tmpFilePath = filePath + '.tmp'
+        stats.dump_stats(tmpFilePath)
+        os.rename(tmpFilePath, filePath)
+        log.info("Wrote profile of %d request(s) to %r", nProfiled, filePath)
+
+        self._rotate()
+        return filePath
+
+    def _rotate(self):
+        """Delete the oldest dump files in excess of maxFiles"""
+        filePaths = glob.glob(os.path.join(self.__outputDir, '%s-*%s' % (
+                                            self.__filePrefix,
+                                            ProfilerMiddleware.FILE_SUFFIX)))
+        filePaths.sort(key=os.path.getmtime)
+        for filePath in filePaths[:-self.__maxFiles]:
+            try:
+                os.remove(filePath)
+            except OSError, e:
+                log.warning("Error removing profile dump %r: %s", filePath, e)
@@ -16,8 +16,16 @@ logging.basicConfig(level=logging.DEBUG)
 
 import unittest
 import socket
+import time
+import shutil
+import pstats
+from tempfile import mkdtemp
 from cStringIO import StringIO
 from os import path
+from glob import glob
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 try:
     import paste.fixture
     paste_installed = True
@@ -28,7 +36,12 @@ from urllib2 import HTTPHandler, URLError
 
 from ndg.soap import SOAPFaultBase
 from ndg.soap.etree import SOAPEnvelope, SOAPFault, SOAPFaultException
-from ndg.soap.client import UrlLib2SOAPClient, UrlLib2SOAPRequest
+from ndg.soap.client import (UrlLib2SOAPClient, UrlLib2SOAPRequest, 
+                             HTTPSOAPClient, HTTPException)
+from ndg.soap.transport import (HTTPConnectionPoolTransport, CancelToken,
+                                TransportCancelled, TransportTimeout,
+                                setCurrentCancelToken)
+from ndg.soap.server.wsgi.profiler import ProfilerMiddleware
 from ndg.soap.test import PasteDeployAppServer
 
 
@@ -230,5 +243,218 @@ class SOAPServiceTestCase(unittest.TestCase):
                 service.terminateThread()
 
 
+class ProfilerMiddlewareTestCase(unittest.TestCase):
+    """Test sampling of requests by the profiler middleware"""
+    ISSUER = '/O=Site A/CN=Attribute Authority'
+    
+    def setUp(self):
+        self.outputDir = mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.outputDir)
+        
+    def _request(self, app, issuer):
+        body = ('<soap:Envelope xmlns:soap="%s"><soap:Body>'
+                '<saml:Issuer xmlns:saml="urn:oasis:names:tc:SAML:2.0:'
+                'assertion">%s</saml:Issuer></soap:Body></soap:Envelope>' %
+                (SOAPEnvelope.DEFAULT_ELEMENT_NS, issuer))
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body)
+        }
+        return app(environ, lambda status, headers: None)
+            
+    def test01SampleRequests(self):
+        app = ProfilerMiddleware.filter_app_factory(SOAPBindingMiddleware(),
+                {},
+                prefix='profile.',
+                **{'profile.sampleRate': '3',
+                   'profile.filter.Issuer': '^/O=Site A/',
+                   'profile.outputDir': self.outputDir,
+                   'profile.window': '3600',
+                   'profile.maxFiles': '2'})
+        self.assert_(app.sampleRate == 3)
+        
+        # Filtered requests are profiled and the application can still read
+        # the request body
+        response = self._request(app, self.__class__.ISSUER)
+        self.assert_('Envelope' in response[0])
+        
+        # 1 in 3 requests are sampled
+        for i in range(3):
+            self._request(app, '/O=Site B/CN=Attribute Authority')
+        
+        filePath = app.flush()
+        stats = pstats.Stats(filePath)
+        self.assert_([func for func in stats.stats 
+                      if func[2] == '__call__'])
+        self.assert_(app.flush() is None)
+        
+        # Older dumps are removed
+        for i in range(3):
+            self._request(app, self.__class__.ISSUER)
+            app.flush()
+        self.assert_(len(glob(path.join(self.outputDir, '*.pstats'))) == 2)
+
+
+class KeepAliveSOAPRequestHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 request handler returning an empty SOAP envelope and 
+    recording the client address of each request"""
+    protocol_version = 'HTTP/1.1'
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-length']))
+        self.server.clientAddresses.append(self.client_address)
+        time.sleep(self.server.latency)
+        
+        soapResponse = SOAPEnvelope()
+        soapResponse.create()
+        response = soapResponse.serialize()
+        
+        self.send_response(self.server.status)
+        self.send_header('Content-type', 'text/xml')
+        self.send_header('Content-length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+        
+        # Simulate the server closing an idle connection
+        if self.server.closeConnections:
+            self.close_connection = 1
+        
+    def handle(self):
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # Client closed the connection without reading the response
+            pass
+        self.server.nClosedConnections += 1
+        
+    def log_message(self, *arg):
+        pass
+    
+    
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+        
+
+class HTTPConnectionPoolTransportTestCase(unittest.TestCase):
+    """Test reuse of connections by the pooling transport"""
+    
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0), 
+                                          KeepAliveSOAPRequestHandler)
+        self.server.clientAddresses = []
+        self.server.closeConnections = False
+        self.server.latency = 0.
+        self.server.status = 200
+        self.server.nClosedConnections = 0
+        thread = Thread(target=self.server.serve_forever, 
+                        kwargs=dict(poll_interval=0.05))
+        thread.daemon = True
+        thread.start()
+        
+        self.client = HTTPSOAPClient(transport=HTTPConnectionPoolTransport())
+        self.client.responseEnvelopeClass = SOAPEnvelope
+        self.client.timeout = 10.
+        
+    def tearDown(self):
+        self.client.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        
+    def _send(self):
+        request = UrlLib2SOAPRequest()
+        request.url = 'http://localhost:%d/soap' % self.server.server_port
+        request.envelope = SOAPEnvelope()
+        request.envelope.create()
+        return self.client.send(request)
+    
+    def test01ReuseConnection(self):
+        for i in range(5):
+            response = self._send()
+            self.assert_(response.envelope.body is not None)
+            
+        self.assert_(len(set(self.server.clientAddresses)) == 1)
+        
+    def test02RetryClosedConnection(self):
+        self.server.closeConnections = True
+        for i in range(3):
+            self._send()
+            
+        self.assert_(len(set(self.server.clientAddresses)) == 3)
+        
+    def test03CancelRequest(self):
+        self.server.latency = 5.
+        cancelToken = CancelToken()
+        setCurrentCancelToken(cancelToken)
+        try:
+            Thread(target=lambda: (time.sleep(0.1), 
+                                   cancelToken.cancel())).start()
+            t0 = time.time()
+            self.assertRaises(TransportCancelled, self._send)
+            self.assert_(time.time() - t0 < self.server.latency)
+        finally:
+            setCurrentCancelToken(None)
+            
+    def test04CloseErrorResponse(self):
+        # The connection is closed even while the error is still referenced
+        # if the body is too big to read into the error
+        class ErrorBodyCappedClient(HTTPSOAPClient):
+            MAX_ERROR_BODY_SIZE = 8
+            
+        self.client = ErrorBodyCappedClient(
+                                transport=HTTPConnectionPoolTransport())
+        self.client.responseEnvelopeClass = SOAPEnvelope
+        self.server.status = 500
+        with self.assertRaises(HTTPException) as cm:
+            self._send()
+            
+        self.assert_(cm.exception.transportResponse.status == 500)
+        self.assert_(len(cm.exception.responseBody) == 8)
+        for i in range(20):
+            if self.server.nClosedConnections:
+                break
+            time.sleep(0.05)
+            
+        self.assert_(self.server.nClosedConnections == 1)
+        
+    def test05ErrorResponseBody(self):
+        # The fault returned with the error status is kept and the connection
+        # is reused once the body is read
+        self.server.status = 500
+        with self.assertRaises(HTTPException) as cm:
+            self._send()
+            
+        self.assert_('Envelope' in cm.exception.responseBody)
+        
+        self.server.status = 200
+        self._send()
+        self.assert_(len(set(self.server.clientAddresses)) == 1)
+        self.assert_(self.server.nClosedConnections == 0)
+        
+    def test06TimeoutRemovesCancelCallback(self):
+        callbacks = []
+        
+        class RecordingCancelToken(CancelToken):
+            def addCallback(self, callback):
+                callbacks.append(callback)
+                CancelToken.addCallback(self, callback)
+                
+            def removeCallback(self, callback):
+                callbacks.remove(callback)
+                CancelToken.removeCallback(self, callback)
+                
+        self.server.latency = 1.
+        self.client.timeout = 0.1
+        setCurrentCancelToken(RecordingCancelToken())
+        try:
+            self.assertRaises(TransportTimeout, self._send)
+        finally:
+            setCurrentCancelToken(None)
+            
+        self.assert_(callbacks == [])
+    
+    
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,559 @@
+"""HTTP transports for NDG SOAP clients
+
+A transport sends a request body with HTTP headers to a URL and returns the
+response status, headers and a stream to read the response body from.  SOAP
+clients serialise and parse envelopes and delegate the HTTP exchange to a
+transport so that the HTTP client library can be changed without changing
+query code.
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import errno
+import socket
+import httplib
+import urllib2
+from abc import ABCMeta, abstractmethod
+from collections import deque
+from threading import Lock, local
+from urlparse import urlsplit
+
+import logging
+log = logging.getLogger(__name__)
+
+from ndg.soap.utils.metrics import timer
+
+
+class TransportError(Exception):
+    """Base class for transport exceptions"""
+
+
+class TransportTimeout(TransportError):
+    """Request deadline passed before the response was received"""
+
+
+class TransportCancelled(TransportError):
+    """Request cancelled by another thread"""
+
+
+class CancelToken(object):
+    """Cancel requests in progress from another thread.  Set the token for
+    the thread making the requests with setCurrentCancelToken.  Transports
+    register callbacks with it to abort their connections"""
+
+    def __init__(self):
+        self.__cancelled = False
+        self.__callbacks = []
+        self.__lock = Lock()
+
+    @property
+    def cancelled(self):
+        "True if cancel has been called"
+        return self.__cancelled
+
+    def addCallback(self, callback):
+        """Add a callable to call on cancellation.  It is called immediately
+        if the token has already been cancelled
+
+        @type callback: callable
+        @param callback: callable taking no arguments
+        """
+        with self.__lock:
+            if not self.__cancelled:
+                self.__callbacks.append(callback)
+                return
+
+        self._call(callback)
+
+    def removeCallback(self, callback):
+        """Remove a callable added with addCallback if it's still set"""
+        with self.__lock:
+            if callback in self.__callbacks:
+                self.__callbacks.remove(callback)
+
+    def cancel(self):
+        """Cancel requests using this token"""
+        with self.__lock:
+            if self.__cancelled:
+                return
+
+            self.__cancelled = True
+            callbacks, self.__callbacks = self.__callbacks, []
+
+        for callback in callbacks:
+            self._call(callback)
+
+    @staticmethod
+    def _call(callback):
+        # Errors are logged so that they can't fail the cancelling thread
+        try:
+            callback()
+        except Exception:
+            log.exception('Error from cancel callback %r', callback)
+
+    def check(self):
+        """@raise TransportCancelled: the token has been cancelled"""
+        if self.__cancelled:
+            raise TransportCancelled('Request cancelled')
+
+
+# Cancel token for requests made by each thread
+_current = local()
+
+
+def getCurrentCancelToken():
+    """@rtype: CancelToken / NoneType
+    @return: token set for the current thread
+    """
+    return getattr(_current, 'cancelToken', None)
+
+
+def setCurrentCancelToken(token):
+    """Set the cancel token for requests made by the current thread
+
+    @type token: CancelToken / NoneType
+    @param token: token or None to clear it
+    @rtype: CancelToken / NoneType
+    @return: the token previously set so that callers can restore it
+    """
+    previous = getattr(_current, 'cancelToken', None)
+    _current.cancelToken = token
+    return previous
+
+
+class TransportResponse(object):
+    """HTTP response returned by a transport"""
+    __slots__ = ('__status', '__reason', '__headers', '__stream', '__raw')
+
+    def __init__(self, status, reason, headers, stream, raw=None):
+        """
+        @type status: int
+        @param status: HTTP status code
+        @type reason: basestring
+        @param reason: HTTP reason phrase
+        @type headers: httplib.HTTPMessage
+        @param headers: response headers
+        @type stream: file like object
+        @param stream: response body stream
+        @param raw: response object from the underlying HTTP library for
+        error reporting
+        """
+        self.__status = status
+        self.__reason = reason
+        self.__headers = headers
+        self.__stream = stream
+        self.__raw = raw
+
+    @property
+    def status(self):
+        "HTTP status code"
+        return self.__status
+
+    @property
+    def reason(self):
+        "HTTP reason phrase"
+        return self.__reason
+
+    @property
+    def headers(self):
+        "Response headers.  Header name look up is case insensitive"
+        return self.__headers
+
+    @property
+    def stream(self):
+        "File object to read the response body from"
+        return self.__stream
+
+    @property
+    def raw(self):
+        "Response object from the underlying HTTP library"
+        return self.__raw
+
+
+class HTTPTransportBase(object):
+    """Interface for HTTP transports used by SOAP clients.  Implementations
+    must be safe to share between threads"""
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def send(self, url, body, headers, deadline=None):
+        """POST a request
+
+        @type url: basestring
+        @param url: endpoint URL
+        @type body: str
+        @param body: request body
+        @type headers: dict
+        @param headers: HTTP header names and values
+        @type deadline: float / NoneType
+        @param deadline: ndg.soap.utils.metrics.timer() value by which the
+        response must have been received or None for no time limit
+        @rtype: TransportResponse
+        @return: response
+        @raise TransportTimeout: deadline passed
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Release any resources held such as open connections"""
+
+    @staticmethod
+    def _getTimeout(deadline):
+        """Get the time remaining before a deadline
+
+        @type deadline: float / NoneType
+        @param deadline: ndg.soap.utils.metrics.timer() value or None
+        @rtype: float / NoneType
+        @return: seconds remaining or None for no time limit
+        @raise TransportTimeout: deadline has passed
+        """
+        if deadline is None:
+            return None
+
+        timeout = deadline - timer()
+        if timeout <= 0.:
+            raise TransportTimeout('Request deadline passed before sending')
+
+        return timeout
+
+
+class UrlLib2Transport(HTTPTransportBase):
+    """Transport using a urllib2 opener.  Handlers may be added to the
+    opener to customise requests e.g. for SSL settings"""
+
+    def __init__(self):
+        self.__openerDirector = urllib2.OpenerDirector()
+        self.__openerDirector.add_handler(urllib2.UnknownHandler())
+        self.__openerDirector.add_handler(urllib2.HTTPHandler())
+
+    def _getOpenerDirector(self):
+        return self.__openerDirector
+
+    def _setOpenerDirector(self, value):
+        """This shouldn't need to be used much in practice because __init__
+        creates one"""
+        if not isinstance(value, urllib2.OpenerDirector):
+            raise TypeError("Setting opener: expecting %r; got %r" %
+                            (urllib2.OpenerDirector, type(value)))
+        self.__openerDirector = value
+
+    openerDirector = property(fget=_getOpenerDirector,
+                              fset=_setOpenerDirector,
+                              doc="urllib2.OpenerDirector defines the "
+                                  "opener(s) for handling requests")
+
+    def send(self, url, body, headers, deadline=None):
+        """POST a request with the urllib2 opener - see HTTPTransportBase
+        """
+        timeout = self._getTimeout(deadline)
+        if timeout is not None:
+            arg = (timeout,)
+        else:
+            arg = ()
+
+        urllib2Request = urllib2.Request(url)
+        for i in headers.items():
+            urllib2Request.add_header(*i)
+
+        # urllib2 gives no access to the connection while a request is in
+        # progress so cancellation is checked before and after it only
+        cancelToken = getCurrentCancelToken()
+        if cancelToken is not None:
+            cancelToken.check()
+
+        try:
+            response = self.__openerDirector.open(urllib2Request, body, *arg)
+
+        except urllib2.URLError, e:
+            if isinstance(e.reason, socket.timeout):
+                raise TransportTimeout('Request to [%s] timed out: %s' %
+                                       (url, e.reason))
+            raise
+
+        if cancelToken is not None and cancelToken.cancelled:
+            response.close()
+            cancelToken.check()
+
+        return TransportResponse(response.code, response.msg,
+                                 response.info(), response, raw=response)
+
+
+def _abortConnection(connection):
+    """Abort a connection in use by another thread.  Shutting the socket down
+    wakes the thread if it is blocked reading from it"""
+    sock = connection.sock
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class _PooledResponseStream(object):
+    """Response body stream returning its connection to the pool once the
+    body has been read"""
+
+    def __init__(self, pool, key, connection, response, cancelToken=None,
+                 abort=None):
+        self.__pool = pool
+        self.__key = key
+        self.__connection = connection
+        self.__response = response
+        self.__cancelToken = cancelToken
+        self.__abort = abort
+
+    def read(self, size=-1):
+        try:
+            if size is None or size < 0:
+                data = self.__response.read()
+            else:
+                data = self.__response.read(size)
+
+        except Exception:
+            if self.__cancelToken is not None:
+                self.__cancelToken.check()
+            raise
+
+        if self.__cancelToken is not None and self.__cancelToken.cancelled:
+            self.close()
+            self.__cancelToken.check()
+
+        if self.__connection is not None and self.__response.isclosed():
+            self._release()
+
+        return data
+
+    def _release(self):
+        connection, self.__connection = self.__connection, None
+        if self.__cancelToken is not None:
+            self.__cancelToken.removeCallback(self.__abort)
+            if self.__cancelToken.cancelled:
+                connection.close()
+                return
+
+        reusable = (self.__response.isclosed() and
+                    not self.__response.will_close)
+        self.__pool._releaseConnection(self.__key, connection, reusable)
+
+    def close(self):
+        """Close the response.  The connection can't be reused if the body
+        wasn't read to the end"""
+        if self.__connection is not None:
+            self._release()
+
+        self.__response.close()
+
+
+class HTTPConnectionPoolTransport(HTTPTransportBase):
+    """Transport keeping HTTP/1.1 connections open for reuse between
+    requests to the same host, port and scheme.  Each thread sending a
+    request takes a connection from the pool or opens a new one if none is
+    idle so the transport can be shared between threads
+
+    @cvar CONNECTION_CLASSES: httplib connection classes for each URL scheme
+    @type CONNECTION_CLASSES: dict
+    """
+    CONNECTION_CLASSES = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection
+    }
+
+    # Errors from a reused connection which the server closed while it was
+    # idle.  The request is retried once on a new connection
+    STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE,
+                               errno.ECONNABORTED)
+
+    def __init__(self, maxIdleConnections=10, idleTimeout=15.,
+                 sslContext=None):
+        """
+        @type maxIdleConnections: int / basestring
+        @param maxIdleConnections: maximum number of idle connections kept
+        for each host
+        @type idleTimeout: float / basestring
+        @param idleTimeout: close connections left idle for longer than this
+        number of seconds.  Set lower than the server's keep alive timeout
+        @type sslContext: ssl.SSLContext / NoneType
+        @param sslContext: SSL context for HTTPS connections.  If None the
+        httplib default is used
+        """
+        self.__maxIdleConnections = None
+        self.__idleTimeout = None
+        self.maxIdleConnections = maxIdleConnections
+        self.idleTimeout = idleTimeout
+        self.__sslContext = sslContext
+
+        # Idle connections and the time they were last used for each host
+        self.__pool = {}
+        self.__lock = Lock()
+
+    def _getMaxIdleConnections(self):
+        return self.__maxIdleConnections
+
+    def _setMaxIdleConnections(self, value):
+        if isinstance(value, basestring):
+            value = int(value)
+
+        elif not isinstance(value, (int, long)):
+            raise TypeError("Setting maxIdleConnections: expecting int type; "
+                            "got %r" % type(value))
+        self.__maxIdleConnections = value
+
+    maxIdleConnections = property(fget=_getMaxIdleConnections,
+                                  fset=_setMaxIdleConnections,
+                                  doc="Maximum number of idle connections "
+                                      "kept for each host")
+
+    def _getIdleTimeout(self):
+        return self.__idleTimeout
+
+    def _setIdleTimeout(self, value):
+        if isinstance(value, basestring):
+            value = float(value)
+
+        elif not isinstance(value, (int, long, float)):
+            raise TypeError("Setting idleTimeout: expecting float type; got "
+                            "%r" % type(value))
+        self.__idleTimeout = value
+
+    idleTimeout = property(fget=_getIdleTimeout,
+                           fset=_setIdleTimeout,
+                           doc="Close connections left idle for longer than "
+                               "this number of seconds")
+
+    @property
+    def sslContext(self):
+        "SSL context for HTTPS connections"
+        return self.__sslContext
+
+    def _getConnection(self, key, timeout):
+        """Get an idle connection for a host or open a new one
+
+        @rtype: tuple
+        @return: connection and flag set if it has been used before
+        """
+        now = timer()
+        connection = None
+        with self.__lock:
+            idle = self.__pool.get(key)
+            while idle:
+                _connection, lastUsed = idle.pop()
+                if now - lastUsed < self.__idleTimeout:
+                    connection = _connection
+                    break
+
+                _connection.close()
+
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+
+        scheme, host, port = key
+        kw = {'timeout': timeout}
+        if scheme == 'https' and self.__sslContext is not None:
+            kw['context'] = self.__sslContext
+
+        connectionClass = self.__class__.CONNECTION_CLASSES[scheme]
+        return connectionClass(host, port, **kw), False
+
+    def _releaseConnection(self, key, connection, reusable):
+        """Return a connection to the pool once its response has been read
+        """
+        if not reusable:
+            connection.close()
+            return
+
+        with self.__lock:
+            idle = self.__pool.setdefault(key, deque())
+            if len(idle) < self.__maxIdleConnections:
+                idle.append((connection, timer()))
+                return
+
+        connection.close()
+
+    def _isStaleConnectionError(self, e):
+        if isinstance(e, httplib.BadStatusLine):
+            return True
+
+        return (isinstance(e, socket.error) and
+                e.args and
+                e.args[0] in self.__class__.STALE_CONNECTION_ERRNOS)
+
+    def send(self, url, body, headers, deadline=None):
+        """POST a request on a pooled connection - see HTTPTransportBase
+        """
+        parsedUrl = urlsplit(url)
+        scheme = parsedUrl.scheme.lower()
+        if scheme not in self.__class__.CONNECTION_CLASSES:
+            raise TransportError('Unsupported URL scheme %r for request to '
+                                 '[%s]' % (scheme, url))
+        key = (scheme, parsedUrl.hostname, parsedUrl.port)
+
+        path = parsedUrl.path or '/'
+        if parsedUrl.query:
+            path += '?' + parsedUrl.query
+
+        cancelToken = getCurrentCancelToken()
+        while True:
+            if cancelToken is not None:
+                cancelToken.check()
+
+            connection, reused = self._getConnection(key,
+                                                     self._getTimeout(deadline))
+            abort = None
+            if cancelToken is not None:
+                abort = lambda: _abortConnection(connection)
+                cancelToken.addCallback(abort)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                break
+
+            except socket.timeout, e:
+                connection.close()
+                if cancelToken is not None:
+                    cancelToken.removeCallback(abort)
+                raise TransportTimeout('Request to [%s] timed out: %s' %
+                                       (url, e))
+
+            except Exception, e:
+                connection.close()
+                if cancelToken is not None:
+                    cancelToken.removeCallback(abort)
+                    cancelToken.check()
+
+                if not (reused and self._isStaleConnectionError(e)):
+                    raise
+
+                log.debug('Retrying request to [%s] on a new connection '
+                          'after error on idle connection: %s', url, e)
+
+        stream = _PooledResponseStream(self, key, connection, response,
+                                       cancelToken=cancelToken, abort=abort)
+        return TransportResponse(response.status, response.reason,
+                                 response.msg, stream, raw=response)
+
+    def close(self):
+        """Close all idle connections"""
+        with self.__lock:
+            pool, self.__pool = self.__pool, {}
+
+        for idle in pool.values():
+            for connection, lastUsed in idle:
+                connection.close()
+
+    def __getstate__(self):
+        '''Enable pickling - open connections are not included'''
+        return dict(maxIdleConnections=self.__maxIdleConnections,
+                    idleTimeout=self.__idleTimeout,
+                    sslContext=self.__sslContext)
+
+    def __setstate__(self, attrDict):
+        '''Enable pickling'''
+        self.__init__(**attrDict)
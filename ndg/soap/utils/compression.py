@@ -0,0 +1,280 @@
+"""HTTP content encoding utilities for NDG SOAP Package
+
+Clients and services compress SOAP messages with gzip or deflate using the
+standard Accept-Encoding and Content-Encoding HTTP headers.  Responses are
+decompressed as they are read so that large messages are not held in memory
+twice.
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import zlib
+
+import logging
+log = logging.getLogger(__name__)
+
+GZIP_ENCODING = 'gzip'
+DEFLATE_ENCODING = 'deflate'
+IDENTITY_ENCODING = 'identity'
+
+# In order of preference when a client accepts more than one encoding with
+# the same quality value
+SUPPORTED_ENCODINGS = (GZIP_ENCODING, DEFLATE_ENCODING)
+
+ACCEPT_ENCODING_HEADER = 'Accept-encoding'
+CONTENT_ENCODING_HEADER = 'Content-encoding'
+ACCEPT_ENCODING_ENVIRON_KEYNAME = 'HTTP_ACCEPT_ENCODING'
+CONTENT_ENCODING_ENVIRON_KEYNAME = 'HTTP_CONTENT_ENCODING'
+
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
+# zlib window bits settings for each format.  32 + MAX_WBITS detects a zlib
+# or gzip header automatically
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_ZLIB_WBITS = zlib.MAX_WBITS
+_RAW_DEFLATE_WBITS = -zlib.MAX_WBITS
+
+
+class CompressionError(Exception):
+    """Error compressing or decompressing a message"""
+
+
+def normaliseEncoding(encoding):
+    """Check a content encoding name
+
+    @type encoding: basestring / NoneType
+    @param encoding: encoding name.  None, '' or 'identity' mean no
+    compression
+    @rtype: basestring / NoneType
+    @return: supported encoding name in lower case or None
+    @raise CompressionError: unsupported encoding
+    """
+    if encoding is None:
+        return None
+
+    _encoding = encoding.strip().lower()
+    if _encoding in ('', IDENTITY_ENCODING):
+        return None
+
+    if _encoding not in SUPPORTED_ENCODINGS:
+        raise CompressionError('Unsupported content encoding %r: expecting '
+                               'one of %r' % (encoding, SUPPORTED_ENCODINGS))
+    return _encoding
+
+
+def compress(data, encoding, level=DEFAULT_COMPRESS_LEVEL):
+    """Compress a message body
+
+    @type data: str
+    @param data: message body
+    @type encoding: basestring
+    @param encoding: 'gzip' or 'deflate'.  deflate data is sent in zlib
+    format as RFC 7230 requires
+    @type level: int
+    @param level: compression level 1 (fastest) to 9 (smallest)
+    @rtype: str
+    @return: compressed body
+    """
+    wbits = _GZIP_WBITS if encoding == GZIP_ENCODING else _ZLIB_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _makeDecompressor(encoding):
+    if encoding == GZIP_ENCODING:
+        return zlib.decompressobj(_GZIP_WBITS)
+    else:
+        return zlib.decompressobj(_ZLIB_WBITS)
+
+
+def decompress(data, encoding, maxSize=None):
+    """Decompress a message body
+
+    @type data: str
+    @param data: compressed message body
+    @type encoding: basestring
+    @param encoding: 'gzip' or 'deflate'
+    @type maxSize: int / NoneType
+    @param maxSize: maximum size of the decompressed body.  Set to guard
+    against small requests which expand to use large amounts of memory
+    @rtype: str
+    @return: decompressed body
+    @raise CompressionError: invalid compressed data or maximum size exceeded
+    """
+    reader = DecompressingReader(_StringReader(data), encoding)
+    if maxSize is None:
+        return reader.read()
+
+    body = reader.read(maxSize + 1)
+    if len(body) > maxSize:
+        raise CompressionError('Decompressed message body is larger than the '
+                               'maximum of %d bytes' % maxSize)
+    return body
+
+
+def chooseEncoding(acceptEncoding):
+    """Choose a response encoding from an Accept-Encoding header value
+
+    @type acceptEncoding: basestring / NoneType
+    @param acceptEncoding: Accept-Encoding header value e.g.
+    "gzip;q=1.0, deflate;q=0.5"
+    @rtype: basestring / NoneType
+    @return: supported encoding with the highest quality value or None if
+    the client accepts none of them
+    """
+    if not acceptEncoding:
+        return None
+
+    qualities = {}
+    for item in acceptEncoding.split(','):
+        params = item.split(';')
+        encoding = params[0].strip().lower()
+        quality = 1.
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+
+        qualities[encoding] = quality
+
+    wildcardQuality = qualities.get('*', 0.)
+    chosenEncoding = None
+    chosenQuality = 0.
+    for encoding in SUPPORTED_ENCODINGS:
+        quality = qualities.get(encoding, wildcardQuality)
+        if quality > chosenQuality:
+            chosenEncoding = encoding
+            chosenQuality = quality
+
+    return chosenEncoding
+
+
+class _StringReader(object):
+    """Minimal file object for a string"""
+    def __init__(self, data):
+        self.__data = data
+        self.__pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.__data) - self.__pos
+
+        chunk = self.__data[self.__pos:self.__pos + size]
+        self.__pos += len(chunk)
+        return chunk
+
+
+class DecompressingReader(object):
+    """File object wrapper decompressing the content read from it
+    incrementally.  Only as much compressed data is read as is needed for
+    each read call
+
+    @cvar CHUNK_SIZE: size of compressed data reads from the wrapped file
+    @type CHUNK_SIZE: int
+    """
+    CHUNK_SIZE = 16384
+
+    def __init__(self, fileObject, encoding):
+        """
+        @type fileObject: file like object
+        @param fileObject: file object returning compressed data
+        @type encoding: basestring
+        @param encoding: 'gzip' or 'deflate'
+        """
+        self.__fileObject = fileObject
+        self.__encoding = encoding
+        self.__decompressor = _makeDecompressor(encoding)
+
+        # Data read but not yet decompressed and decompressed data not yet
+        # returned to the caller
+        self.__unconsumed = ''
+        self.__buffer = ''
+        self.__eof = False
+        self.__firstChunk = True
+
+    @property
+    def fileObject(self):
+        """Wrapped file object"""
+        return self.__fileObject
+
+    @property
+    def encoding(self):
+        """Content encoding of the wrapped file object"""
+        return self.__encoding
+
+    def _decompress(self, chunk, maxLength):
+        try:
+            try:
+                return self.__decompressor.decompress(chunk, maxLength)
+
+            except zlib.error:
+                # Some servers send raw deflate data without the zlib header
+                if not (self.__firstChunk and
+                        self.__encoding == DEFLATE_ENCODING):
+                    raise
+
+                self.__decompressor = zlib.decompressobj(_RAW_DEFLATE_WBITS)
+                return self.__decompressor.decompress(chunk, maxLength)
+
+        except zlib.error, e:
+            raise CompressionError('Error decompressing %r encoded message '
+                                   'body: %s' % (self.__encoding, e))
+
+    def _fill(self, size):
+        """Decompress until the buffer holds size bytes or the end of the
+        compressed data is reached.  size < 0 means read everything"""
+        while not self.__eof and (size < 0 or len(self.__buffer) < size):
+            if self.__unconsumed:
+                chunk = self.__unconsumed
+            else:
+                chunk = self.__fileObject.read(self.__class__.CHUNK_SIZE)
+                if not chunk:
+                    self.__eof = True
+                    self.__buffer += self.__decompressor.flush()
+                    break
+
+            # Limit output so that a highly compressed message doesn't
+            # expand in one step
+            maxLength = max(size - len(self.__buffer),
+                            self.__class__.CHUNK_SIZE)
+            self.__buffer += self._decompress(chunk, maxLength)
+            self.__firstChunk = False
+            self.__unconsumed = self.__decompressor.unconsumed_tail
+
+            if self.__decompressor.unused_data:
+                # End of the compressed stream
+                self.__eof = True
+
+    def read(self, size=-1):
+        """Read decompressed data
+
+        @type size: int
+        @param size: maximum number of bytes to return.  Read to the end if
+        negative
+        @rtype: str
+        @return: decompressed data
+        """
+        if size is None:
+            size = -1
+
+        self._fill(size)
+        if size < 0:
+            data, self.__buffer = self.__buffer, ''
+        else:
+            data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+
+        return data
+
+    def close(self):
+        """Close the wrapped file object"""
+        if hasattr(self.__fileObject, 'close'):
+            self.__fileObject.close()
@@ -0,0 +1,318 @@
+"""Hedged requests for replicated SOAP services
+
+A query is sent to its primary endpoint.  If no response has arrived after a
+delay, a duplicate is sent to a replica and the first successful response is
+used.  The other request is cancelled.  The number of duplicates sent is
+limited by a budget so that a slow service isn't overloaded further.
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import sys
+from collections import deque
+from Queue import Queue, Empty
+from threading import Thread, Lock
+
+import logging
+log = logging.getLogger(__name__)
+
+from ndg.saml.utils import percentile
+from ndg.soap.utils.metrics import timer
+from ndg.soap.utils.tracing import (getCurrentTraceContext,
+                                    setCurrentTraceContext)
+from ndg.soap.transport import (CancelToken, TransportCancelled,
+                                setCurrentCancelToken)
+
+
+class HedgePolicy(object):
+    """Policy for sending a duplicate of a slow request to a replica
+
+    The hedge delay is fixed if delay is set.  Otherwise it is the observed
+    percentile latency of the last window requests to the primary endpoint,
+    or initialDelay until minSamples latencies have been observed for it.
+    Requests cancelled because the other request returned first are 
+    included with the time until they were cancelled, so that the delay 
+    isn't biased towards the requests which were fast enough to win.
+
+    The budget is a token bucket.  Each request adds budget tokens up to
+    maxTokens and each hedge uses one, so that over time no more than a
+    budget fraction of requests are hedged.
+
+    @cvar COUNTER_NAMES: names of the counters returned by counters
+    @type COUNTER_NAMES: tuple
+    """
+    COUNTER_NAMES = ('requests', 'hedged', 'hedgeWins', 'budgetExhausted',
+                     'cancelled', 'errors')
+
+    def __init__(self, uris=(), delay=None, percentile=95., initialDelay=0.1,
+                 minDelay=0., minSamples=20, budget=0.1, maxTokens=10.,
+                 window=100):
+        """
+        @type uris: iterable / basestring
+        @param uris: URIs of the replicas of the service.  A string is split
+        on commas and whitespace
+        @type delay: float / basestring / NoneType
+        @param delay: fixed hedge delay in seconds.  None to use the observed
+        latency
+        @type percentile: float / basestring
+        @param percentile: observed latency percentile used as the delay
+        @type initialDelay: float / basestring
+        @param initialDelay: delay used until enough latencies are observed
+        @type minDelay: float / basestring
+        @param minDelay: lower limit for the observed latency delay
+        @type minSamples: int / basestring
+        @param minSamples: number of latencies observed for an endpoint 
+        before they are used
+        @type budget: float / basestring
+        @param budget: maximum fraction of requests hedged
+        @type maxTokens: float / basestring
+        @param maxTokens: maximum number of hedges that can be sent in a
+        burst
+        @type window: int / basestring
+        @param window: number of most recent latencies kept for each 
+        endpoint
+        """
+        self.__uris = ()
+        self.__delay = None
+        self.uris = uris
+        self.delay = delay
+        self.__percentile = float(percentile)
+        self.__initialDelay = float(initialDelay)
+        self.__minDelay = float(minDelay)
+        self.__minSamples = int(minSamples)
+        self.__budget = float(budget)
+        self.__maxTokens = float(maxTokens)
+        self.__window = int(window)
+
+        self.__tokens = 0.
+        self.__latencies = {}
+        self.__counters = dict([(name, 0)
+                                for name in self.__class__.COUNTER_NAMES])
+        self.__lock = Lock()
+
+    def _getUris(self):
+        return self.__uris
+
+    def _setUris(self, value):
+        if isinstance(value, basestring):
+            value = value.replace(',', ' ').split()
+
+        self.__uris = tuple(value)
+
+    uris = property(_getUris, _setUris,
+                    doc="URIs of the replicas of the service")
+
+    def _getDelay(self):
+        return self.__delay
+
+    def _setDelay(self, value):
+        if isinstance(value, basestring):
+            value = float(value) if value.strip() else None
+
+        elif not isinstance(value, (int, long, float, type(None))):
+            raise TypeError('Expecting float or None type for "delay"; got '
+                            '%r' % type(value))
+        self.__delay = value
+
+    delay = property(_getDelay, _setDelay,
+                     doc="Fixed hedge delay in seconds or None to use the "
+                         "observed latency")
+
+    @property
+    def counters(self):
+        """Copy of the counters for requests, hedges sent, hedges which
+        returned first, hedges not sent because the budget was used up,
+        requests cancelled and failed requests"""
+        with self.__lock:
+            return self.__counters.copy()
+
+    def getHedgeDelay(self, uri):
+        """Get the time to wait for a response before hedging
+
+        @type uri: basestring
+        @param uri: primary endpoint
+        @rtype: float
+        @return: delay in seconds
+        """
+        if self.__delay is not None:
+            return self.__delay
+
+        with self.__lock:
+            latencies = self.__latencies.get(uri)
+            if latencies is None or len(latencies) < self.__minSamples:
+                return self.__initialDelay
+
+            latencies = sorted(latencies)
+
+        return max(percentile(latencies, self.__percentile), self.__minDelay)
+
+    def getHedgeUri(self, uri):
+        """Get the replica to send a duplicate request to
+
+        @type uri: basestring
+        @param uri: primary endpoint
+        @rtype: basestring / NoneType
+        @return: replica URI or None if there is no other replica
+        """
+        uris = [i for i in self.__uris if i != uri]
+        if not uris:
+            return None
+
+        # Spread hedges over the replicas
+        with self.__lock:
+            return uris[self.__counters['hedged'] % len(uris)]
+
+    def _count(self, name):
+        with self.__lock:
+            self.__counters[name] += 1
+
+    def _takeToken(self):
+        """Use a hedge token from the budget
+
+        @rtype: bool
+        @return: True if a token was available
+        """
+        with self.__lock:
+            if self.__tokens < 1.:
+                self.__counters['budgetExhausted'] += 1
+                return False
+
+            self.__tokens -= 1.
+            self.__counters['hedged'] += 1
+            return True
+
+    def _observe(self, uri, latency):
+        """Record the latency of a request, discarding the oldest if there 
+        are more than window for the endpoint
+        """
+        with self.__lock:
+            latencies = self.__latencies.get(uri)
+            if latencies is None:
+                latencies = self.__latencies[uri] = deque(
+                                                    maxlen=self.__window)
+            latencies.append(latency)
+
+    def _start(self, send, uri, results):
+        """Send a request in a new thread putting the URI, outcome and
+        result on the results queue
+
+        @rtype: ndg.soap.transport.CancelToken
+        @return: token for cancelling the request
+        """
+        cancelToken = CancelToken()
+        
+        # Requests are sent in the trace of the calling thread
+        traceContext = getCurrentTraceContext()
+
+        def run():
+            setCurrentCancelToken(cancelToken)
+            setCurrentTraceContext(traceContext)
+            t0 = timer()
+            try:
+                result = send(uri)
+
+            except TransportCancelled:
+                # The request took at least this long
+                self._observe(uri, timer() - t0)
+                self._count('cancelled')
+                results.put((uri, False, sys.exc_info()))
+
+            except Exception:
+                if cancelToken.cancelled:
+                    self._observe(uri, timer() - t0)
+                    self._count('cancelled')
+                else:
+                    self._count('errors')
+                results.put((uri, False, sys.exc_info()))
+            else:
+                self._observe(uri, timer() - t0)
+                results.put((uri, True, result))
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return cancelToken
+
+    def send(self, send, uri, hedgeUri=None):
+        """Send a request hedging it if there's no response within the hedge
+        delay
+
+        @type send: callable
+        @param send: callable taking an endpoint URI and returning the
+        response.  It must be safe to call from more than one thread at once
+        @type uri: basestring
+        @param uri: primary endpoint
+        @type hedgeUri: basestring / NoneType
+        @param hedgeUri: replica to hedge to.  If None, one is chosen from 
+        uris
+        @return: the first successful response
+        @raise Exception: the error from the primary endpoint if both
+        requests fail
+        """
+        with self.__lock:
+            self.__counters['requests'] += 1
+            self.__tokens = min(self.__tokens + self.__budget,
+                                self.__maxTokens)
+
+        if hedgeUri is None:
+            hedgeUri = self.getHedgeUri(uri)
+            
+        if hedgeUri is None:
+            return send(uri)
+
+        results = Queue()
+        cancelTokens = {uri: self._start(send, uri, results)}
+        try:
+            result = results.get(timeout=self.getHedgeDelay(uri))
+
+        except Empty:
+            if self._takeToken():
+                log.debug('Hedging request to [%s] with request to [%s]',
+                          uri, hedgeUri)
+                cancelTokens[hedgeUri] = self._start(send, hedgeUri, results)
+
+            result = results.get()
+
+        # Wait for the other request if the first to return failed
+        pending = len(cancelTokens) - 1
+        errors = {}
+        while not result[1] and pending:
+            errors[result[0]] = result[2]
+            result = results.get()
+            pending -= 1
+
+        resultUri, success, value = result
+        if not success:
+            errors[resultUri] = value
+            excInfo = errors.get(uri, value)
+            raise excInfo[0], excInfo[1], excInfo[2]
+
+        for otherUri, cancelToken in cancelTokens.items():
+            if otherUri != resultUri:
+                cancelToken.cancel()
+
+        if resultUri != uri:
+            self._count('hedgeWins')
+
+        return value
+
+    def __getstate__(self):
+        '''Enable pickling - latencies and counters are not included'''
+        return dict(uris=self.__uris,
+                    delay=self.__delay,
+                    percentile=self.__percentile,
+                    initialDelay=self.__initialDelay,
+                    minDelay=self.__minDelay,
+                    minSamples=self.__minSamples,
+                    budget=self.__budget,
+                    maxTokens=self.__maxTokens,
+                    window=self.__window)
+
+    def __setstate__(self, attrDict):
+        '''Enable pickling'''
+        self.__init__(**attrDict)
@@ -0,0 +1,564 @@
+"""Request timing and metrics utilities for NDG SOAP Package
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import json
+import time
+import timeit
+import traceback
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock, local, currentThread
+
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    # Python 3
+    from time import monotonic as timer
+except ImportError:
+    try:
+        # Backport package for Python 2
+        from monotonic import monotonic as timer
+    except ImportError:
+        timer = timeit.default_timer
+
+
+class Histogram(object):
+    """Histogram of values with fixed bucket upper bounds as used for
+    Prometheus style metrics.  Updates are not thread safe - callers must
+    serialise them.
+
+    @cvar DEFAULT_BOUNDS: default bucket upper bounds for latencies in seconds
+    @type DEFAULT_BOUNDS: tuple
+    """
+    DEFAULT_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                      0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+    __slots__ = ('__bounds', '__counts', '__count', '__sum', '__min', '__max')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        """
+        @type bounds: tuple
+        @param bounds: bucket upper bounds in ascending order.  Values above
+        the last bound are counted in an overflow bucket
+        """
+        self.__bounds = tuple(bounds)
+        self.__counts = [0] * (len(self.__bounds) + 1)
+        self.__count = 0
+        self.__sum = 0.
+        self.__min = None
+        self.__max = None
+
+    @property
+    def bounds(self):
+        """Bucket upper bounds"""
+        return self.__bounds
+
+    @property
+    def counts(self):
+        """Count for each bucket - the last is the overflow bucket"""
+        return tuple(self.__counts)
+
+    @property
+    def count(self):
+        """Number of values observed"""
+        return self.__count
+
+    @property
+    def sum(self):
+        """Sum of the values observed"""
+        return self.__sum
+
+    @property
+    def min(self):
+        """Smallest value observed"""
+        return self.__min
+
+    @property
+    def max(self):
+        """Largest value observed"""
+        return self.__max
+
+    def observe(self, value):
+        """Add a value
+
+        @type value: float
+        @param value: value to add
+        """
+        self.__counts[bisect_left(self.__bounds, value)] += 1
+        self.__count += 1
+        self.__sum += value
+        if self.__min is None or value < self.__min:
+            self.__min = value
+        if self.__max is None or value > self.__max:
+            self.__max = value
+
+    def merge(self, histogram):
+        """Add the values of another histogram with the same bounds
+
+        @type histogram: Histogram
+        @param histogram: histogram to add
+        @raise ValueError: the bounds differ
+        """
+        if histogram.bounds != self.__bounds:
+            raise ValueError("Can't merge histograms with different bounds")
+
+        for i, count in enumerate(histogram.counts):
+            self.__counts[i] += count
+        self.__count += histogram.count
+        self.__sum += histogram.sum
+        for value in (histogram.min, histogram.max):
+            if value is not None:
+                if self.__min is None or value < self.__min:
+                    self.__min = value
+                if self.__max is None or value > self.__max:
+                    self.__max = value
+
+    def percentile(self, pct):
+        """Estimate a percentile as the upper bound of the bucket containing
+        it, limited to the largest value observed
+
+        @type pct: int / float
+        @param pct: percentile in the range 0 to 100
+        @rtype: float / NoneType
+        @return: estimate or None if no values have been observed
+        """
+        if not self.__count:
+            return None
+
+        rank = pct / 100. * self.__count
+        cumulative = 0
+        for bound, count in zip(self.__bounds, self.__counts):
+            cumulative += count
+            if cumulative >= rank and cumulative:
+                return min(bound, self.__max)
+
+        return self.__max
+
+    def toDict(self):
+        """@rtype: dict
+        @return: count, sum, min, max, percentile estimates and cumulative
+        bucket counts
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.__bounds + ('+Inf',), self.__counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+
+        return dict(count=self.__count,
+                    sum=self.__sum,
+                    min=self.__min,
+                    max=self.__max,
+                    p50=self.percentile(50),
+                    p90=self.percentile(90),
+                    p99=self.percentile(99),
+                    buckets=buckets)
+
+
+class RequestTiming(object):
+    """Timings and attributes for a single request.  Phases are timed
+    consecutively - each call to mark records the time since the previous
+    one.
+    """
+    __slots__ = (
+        '__endpoint',
+        '__phases',
+        '__start',
+        '__last',
+        '__total',
+        'requestSize',
+        'responseSize',
+        'httpStatus',
+        'samlStatus',
+        'error',
+        'startTime',
+        'traceContext'
+    )
+
+    def __init__(self, endpoint=None):
+        """
+        @type endpoint: basestring / NoneType
+        @param endpoint: URI of the service the request is made to
+        """
+        self.__endpoint = endpoint
+        self.__phases = OrderedDict()
+        self.__start = self.__last = timer()
+        self.__total = None
+        self.requestSize = None
+        self.responseSize = None
+        self.httpStatus = None
+        self.samlStatus = None
+        self.error = None
+
+        # Wall clock time for correlating with other records
+        self.startTime = time.time()
+        self.traceContext = None
+
+    @property
+    def endpoint(self):
+        """URI of the service the request is made to"""
+        return self.__endpoint
+
+    @property
+    def phases(self):
+        """Time in seconds for each phase in the order they were recorded"""
+        return self.__phases
+
+    @property
+    def total(self):
+        """Time in seconds from creation to the call to stop"""
+        return self.__total
+
+    def mark(self, phase):
+        """Record the time since the previous mark against a phase
+
+        @type phase: basestring
+        @param phase: phase name
+        """
+        now = timer()
+        self.__phases[phase] = (self.__phases.get(phase, 0.) +
+                                now - self.__last)
+        self.__last = now
+
+    def stop(self):
+        """Record the total time for the request"""
+        self.__total = timer() - self.__start
+
+    def notify(self, observers):
+        """Stop timing and pass this record to each observer.  Observer
+        errors are logged and not raised so that they can't fail the request
+
+        @type observers: iterable
+        @param observers: callables taking a RequestTiming instance
+        """
+        self.stop()
+        for observer in observers:
+            try:
+                observer(self)
+            except Exception:
+                log.error("Error calling request timing observer %r: %s",
+                          observer, traceback.format_exc())
+
+    def toDict(self):
+        """@rtype: dict
+        @return: timing record as a dictionary
+        """
+        return dict(endpoint=self.__endpoint,
+                    phases=dict(self.__phases),
+                    total=self.__total,
+                    requestSize=self.requestSize,
+                    responseSize=self.responseSize,
+                    httpStatus=self.httpStatus,
+                    samlStatus=self.samlStatus,
+                    error=self.error,
+                    startTime=self.startTime,
+                    traceparent=(self.traceContext and
+                                 self.traceContext.toHeader()))
+
+
+class HistogramObserver(object):
+    """Request timing observer aggregating the phase and total times of
+    requests in histograms held in memory, together with status code and
+    error counts and byte totals.  Thread safe.
+    """
+    TOTAL_PHASE = 'total'
+
+    def __init__(self, bounds=Histogram.DEFAULT_BOUNDS, byEndpoint=True):
+        """
+        @type bounds: tuple
+        @param bounds: histogram bucket upper bounds in seconds
+        @type byEndpoint: bool
+        @param byEndpoint: aggregate separately for each endpoint
+        """
+        self.__bounds = bounds
+        self.__byEndpoint = byEndpoint
+        self.__lock = Lock()
+        self.__endpoints = {}
+
+    def _newStats(self):
+        return dict(requests=0,
+                    errors={},
+                    httpStatus={},
+                    samlStatus={},
+                    bytesSent=0,
+                    bytesReceived=0,
+                    phases=OrderedDict())
+
+    @property
+    def bounds(self):
+        """Histogram bucket upper bounds"""
+        return self.__bounds
+
+    def __call__(self, timing):
+        """Add a request's timings
+
+        @type timing: RequestTiming
+        @param timing: request timings
+        """
+        self.__lock.acquire()
+        try:
+            self._update(self.__endpoints, timing)
+        finally:
+            self.__lock.release()
+
+    def _update(self, endpoints, timing):
+        """Add a request's timings to statistics keyed by endpoint
+
+        @type endpoints: dict
+        @param endpoints: statistics keyed by endpoint
+        @type timing: RequestTiming
+        @param timing: request timings
+        """
+        endpoint = timing.endpoint if self.__byEndpoint else None
+        stats = endpoints.get(endpoint)
+        if stats is None:
+            stats = endpoints[endpoint] = self._newStats()
+
+        stats['requests'] += 1
+        for key, value in (('errors', timing.error),
+                           ('httpStatus', timing.httpStatus),
+                           ('samlStatus', timing.samlStatus)):
+            if value is not None:
+                stats[key][value] = stats[key].get(value, 0) + 1
+
+        stats['bytesSent'] += timing.requestSize or 0
+        stats['bytesReceived'] += timing.responseSize or 0
+
+        phases = timing.phases.items()
+        if timing.total is not None:
+            phases.append((self.__class__.TOTAL_PHASE, timing.total))
+
+        for phase, seconds in phases:
+            histogram = stats['phases'].get(phase)
+            if histogram is None:
+                histogram = stats['phases'][phase] = Histogram(self.__bounds)
+            histogram.observe(seconds)
+
+    def _merge(self, endpoints, stats):
+        """Add statistics keyed by endpoint to another set
+
+        @type endpoints: dict
+        @param endpoints: statistics keyed by endpoint to update
+        @type stats: dict
+        @param stats: statistics keyed by endpoint to add
+        """
+        for endpoint, endpointStats in stats.items():
+            total = endpoints.get(endpoint)
+            if total is None:
+                total = endpoints[endpoint] = self._newStats()
+
+            for key in ('requests', 'bytesSent', 'bytesReceived'):
+                total[key] += endpointStats[key]
+
+            for key in ('errors', 'httpStatus', 'samlStatus'):
+                for value, count in endpointStats[key].items():
+                    total[key][value] = total[key].get(value, 0) + count
+
+            for phase, histogram in endpointStats['phases'].items():
+                totalHistogram = total['phases'].get(phase)
+                if totalHistogram is None:
+                    totalHistogram = total['phases'][phase] = Histogram(
+                                                                self.__bounds)
+                totalHistogram.merge(histogram)
+
+    def _getEndpoints(self):
+        """@rtype: dict
+        @return: a copy of the statistics keyed by endpoint with histogram
+        objects
+        """
+        self.__lock.acquire()
+        try:
+            endpoints = {}
+            self._merge(endpoints, self.__endpoints)
+            return endpoints
+        finally:
+            self.__lock.release()
+
+    def reset(self):
+        """Clear all the statistics"""
+        self.__lock.acquire()
+        try:
+            self.__endpoints = {}
+        finally:
+            self.__lock.release()
+
+    def dump(self):
+        """@rtype: dict
+        @return: statistics keyed by endpoint.  The key is None if they are
+        not aggregated by endpoint
+        """
+        endpoints = self._getEndpoints()
+        for stats in endpoints.values():
+            stats['phases'] = OrderedDict([
+                (phase, histogram.toDict())
+                for phase, histogram in stats['phases'].items()])
+        return endpoints
+
+    def dumps(self, **kw):
+        """@rtype: basestring
+        @return: statistics serialised as JSON
+        """
+        return json.dumps(dict([(str(endpoint), stats)
+                                for endpoint, stats in self.dump().items()]),
+                          **kw)
+
+    def toPrometheus(self, namespace='ndg_soap'):
+        """Format the statistics in the Prometheus text exposition format
+
+        @type namespace: basestring
+        @param namespace: prefix for metric names
+        @rtype: basestring
+        @return: metrics text
+        """
+        return formatPrometheus(self._getEndpoints(), namespace=namespace)
+
+
+class ThreadLocalHistogramObserver(HistogramObserver):
+    """Histogram observer which aggregates the timings of each thread
+    separately so that recording timings never waits on a lock shared with
+    other threads.  The statistics for each thread are combined when read.
+    Statistics read while requests are in progress may be missing parts of
+    those requests' updates.
+    """
+    def __init__(self, *arg, **kw):
+        super(ThreadLocalHistogramObserver, self).__init__(*arg, **kw)
+        self.__local = local()
+
+        # Statistics for each thread with the thread.  The lock is only
+        # taken when a thread records its first timing and when reading
+        self.__threadStats = []
+        self.__retired = {}
+        self.__lock = Lock()
+
+    def __call__(self, timing):
+        """Add a request's timings to the statistics for the current thread
+
+        @type timing: RequestTiming
+        @param timing: request timings
+        """
+        endpoints = getattr(self.__local, 'endpoints', None)
+        if endpoints is None:
+            endpoints = self.__local.endpoints = {}
+            self.__lock.acquire()
+            try:
+                self.__threadStats.append((currentThread(), endpoints))
+            finally:
+                self.__lock.release()
+
+        self._update(endpoints, timing)
+
+    def reset(self):
+        """Clear all the statistics"""
+        self.__lock.acquire()
+        try:
+            for thread, endpoints in self.__threadStats:
+                endpoints.clear()
+            self.__retired = {}
+        finally:
+            self.__lock.release()
+
+    def _getEndpoints(self):
+        """Combine the statistics from each thread.  Those of threads which
+        have exited are folded into a single set so that servers creating a
+        thread per request don't accumulate statistics sets
+
+        @rtype: dict
+        @return: statistics keyed by endpoint with histogram objects
+        """
+        self.__lock.acquire()
+        try:
+            threadStats = []
+            for thread, endpoints in self.__threadStats:
+                if thread.isAlive():
+                    threadStats.append((thread, endpoints))
+                else:
+                    self._merge(self.__retired, endpoints)
+            self.__threadStats = threadStats
+
+            result = {}
+            self._merge(result, self.__retired)
+            for thread, endpoints in threadStats:
+                # Copy first as the thread may add to its statistics
+                self._merge(result, endpoints.copy())
+            return result
+        finally:
+            self.__lock.release()
+
+
+def _formatLabels(**labels):
+    """Format Prometheus labels escaping values"""
+    return '{%s}' % ','.join([
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                     .replace('"', '\\"')
+                                     .replace('\n', '\\n'))
+        for name, value in sorted(labels.items())])
+
+
+def formatPrometheus(endpoints, namespace='ndg_soap'):
+    """Format statistics in the Prometheus text exposition format
+
+    @type endpoints: dict
+    @param endpoints: statistics keyed by endpoint as held by
+    HistogramObserver
+    @type namespace: basestring
+    @param namespace: prefix for metric names
+    @rtype: basestring
+    @return: metrics text
+    """
+    lines = []
+    counters = [
+        ('requests_total', 'Requests made', 'requests', None),
+        ('errors_total', 'Requests failed with an exception', 'errors',
+         'error'),
+        ('http_status_total', 'Responses by HTTP status code', 'httpStatus',
+         'code'),
+        ('saml_status_total', 'Responses by SAML status code', 'samlStatus',
+         'status'),
+        ('request_bytes_total', 'Request bytes', 'bytesSent', None),
+        ('response_bytes_total', 'Response bytes', 'bytesReceived', None)
+    ]
+    for name, description, key, labelName in counters:
+        name = '%s_%s' % (namespace, name)
+        lines += ['# HELP %s %s' % (name, description),
+                  '# TYPE %s counter' % name]
+        for endpoint, stats in sorted(endpoints.items()):
+            if labelName is None:
+                lines.append('%s%s %d' % (name,
+                                          _formatLabels(endpoint=endpoint),
+                                          stats[key]))
+                continue
+
+            for value, count in sorted(stats[key].items()):
+                lines.append('%s%s %d' % (name,
+                                          _formatLabels(endpoint=endpoint,
+                                                        **{labelName: value}),
+                                          count))
+
+    name = '%s_phase_seconds' % namespace
+    lines += ['# HELP %s Request time by processing phase' % name,
+              '# TYPE %s histogram' % name]
+    for endpoint, stats in sorted(endpoints.items()):
+        for phase, histogram in stats['phases'].items():
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ('+Inf',),
+                                    histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name,
+                                                 _formatLabels(
+                                                        endpoint=endpoint,
+                                                        phase=phase,
+                                                        le=bound),
+                                                 cumulative))
+            labels = _formatLabels(endpoint=endpoint, phase=phase)
+            lines += ['%s_sum%s %r' % (name, labels, histogram.sum),
+                      '%s_count%s %d' % (name, labels, histogram.count)]
+
+    return '\n'.join(lines) + '\n'
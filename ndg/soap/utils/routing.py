@@ -0,0 +1,435 @@
+"""Endpoint selection for replicated SOAP services
+
+Requests are routed between equivalent service endpoints using the latency
+and error rate observed for each.  Endpoints which keep failing are taken
+out of use by a circuit breaker until a cooldown period has passed.
+
+Alternatively requests can be routed by a key such as the query subject with
+consistent hashing so that each replica sees the same subjects and its cache
+stays effective.
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import math
+import random
+import struct
+from bisect import bisect
+from hashlib import md5
+from threading import Lock
+
+import logging
+log = logging.getLogger(__name__)
+
+from ndg.soap.utils.metrics import timer
+from ndg.soap.transport import TransportCancelled
+
+
+class NoEndpointAvailableError(Exception):
+    """All endpoints have been taken out of use by their circuit breakers"""
+
+
+class EndpointStats(object):
+    """Latency, error rate and circuit breaker state for an endpoint.  Not
+    thread safe - EndpointSelector serialises access
+
+    @cvar CLOSED: circuit state - endpoint in use
+    @cvar OPEN: circuit state - endpoint out of use until the cooldown ends
+    @cvar HALF_OPEN: circuit state - a trial request is in progress after the
+    cooldown.  If no outcome is recorded for it within another cooldown
+    period, another trial is allowed
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    __slots__ = ('uri', 'latency', 'errorRate', 'inFlight', 'requests',
+                 'errors', 'consecutiveFailures', 'state', 'openedAt',
+                 'trialAt')
+
+    def __init__(self, uri):
+        self.uri = uri
+
+        # Exponentially weighted moving averages.  latency is None until a
+        # response is received
+        self.latency = None
+        self.errorRate = 0.
+
+        self.inFlight = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutiveFailures = 0
+        self.state = EndpointStats.CLOSED
+        self.openedAt = None
+        self.trialAt = None
+
+    def toDict(self):
+        """@rtype: dict
+        @return: statistics for reporting
+        """
+        return dict([(name, getattr(self, name))
+                     for name in self.__class__.__slots__])
+
+
+class EndpointSelector(object):
+    """Choose an endpoint for each request from a list of equivalent ones.
+    Two endpoints are picked at random from those in use and the one with
+    the lower score is chosen (power of two choices).  The score is the
+    latency average weighted by the requests in progress and the error rate
+    average.  Endpoints with no latency recorded yet score 0 so that they
+    are tried.  Safe to share between threads.
+    """
+
+    def __init__(self, uris=(), alpha=0.3, failureThreshold=5,
+                 cooldown=30.):
+        """
+        @type uris: iterable / basestring
+        @param uris: endpoint URIs.  A string is split on commas and
+        whitespace
+        @type alpha: float / basestring
+        @param alpha: weight of the latest value in the moving averages from
+        0 to 1
+        @type failureThreshold: int / basestring
+        @param failureThreshold: number of consecutive failures which take
+        an endpoint out of use
+        @type cooldown: float / basestring
+        @param cooldown: seconds before an endpoint taken out of use is sent
+        a trial request
+        """
+        self.__alpha = float(alpha)
+        self.__failureThreshold = int(failureThreshold)
+        self.__cooldown = float(cooldown)
+        self.__stats = {}
+        self.__uris = ()
+        self.__lock = Lock()
+        self.uris = uris
+
+    def _getUris(self):
+        return self.__uris
+
+    def _setUris(self, value):
+        if isinstance(value, basestring):
+            value = value.replace(',', ' ').split()
+
+        uris = tuple(value)
+        with self.__lock:
+            # Keep the statistics of endpoints still in use
+            self.__stats = dict([(uri, self.__stats.get(uri) or
+                                       EndpointStats(uri))
+                                 for uri in uris])
+            self.__uris = uris
+
+    uris = property(_getUris, _setUris, doc="Endpoint URIs")
+
+    @property
+    def stats(self):
+        """Copy of the statistics for each endpoint keyed by URI"""
+        with self.__lock:
+            return dict([(uri, stats.toDict())
+                         for uri, stats in self.__stats.items()])
+
+    def _isAvailable(self, stats, now):
+        if stats.state == EndpointStats.CLOSED:
+            return True
+
+        # Allow one trial request once the cooldown has passed
+        if stats.state == EndpointStats.OPEN:
+            return now - stats.openedAt >= self.__cooldown
+
+        # Trial request chosen but abandoned without an outcome
+        return now - stats.trialAt >= self.__cooldown
+
+    def _startTrial(self, stats):
+        """Mark an endpoint out of use as having a trial request.  Call with
+        the lock held"""
+        if stats.state != EndpointStats.CLOSED:
+            log.info('Sending trial request to endpoint [%s]', stats.uri)
+            stats.state = EndpointStats.HALF_OPEN
+            stats.trialAt = timer()
+
+    @staticmethod
+    def _score(stats):
+        latency = stats.latency or 0.
+        return latency * (stats.inFlight + 1) / max(1. - stats.errorRate,
+                                                    0.01)
+
+    def _getAvailable(self, exclude):
+        """Get the statistics of the endpoints in use.  Call with the lock
+        held"""
+        now = timer()
+        return [self.__stats[uri] for uri in self.__uris
+                if uri not in exclude and
+                self._isAvailable(self.__stats[uri], now)]
+
+    def getAvailableUris(self, exclude=()):
+        """Get the endpoints currently in use
+
+        @type exclude: iterable
+        @param exclude: URIs to leave out
+        @rtype: list
+        @return: URIs
+        """
+        with self.__lock:
+            return [stats.uri for stats in self._getAvailable(exclude)]
+
+    def _choose(self, available, key):
+        """Choose from the endpoints in use.  Called with the lock held
+
+        @type available: list
+        @param available: EndpointStats for the endpoints in use
+        @type key: basestring / NoneType
+        @param key: routing key - not used by this class
+        @rtype: EndpointStats
+        @return: statistics for the endpoint chosen
+        """
+        if len(available) == 1:
+            return available[0]
+
+        stats1, stats2 = random.sample(available, 2)
+        if self._score(stats2) < self._score(stats1):
+            return stats2
+
+        return stats1
+
+    def select(self, exclude=(), key=None):
+        """Choose an endpoint
+
+        @type exclude: iterable
+        @param exclude: URIs not to choose e.g. an endpoint already sent the
+        request
+        @type key: basestring / NoneType
+        @param key: routing key e.g. query subject.  Used by selectors
+        routing by key
+        @rtype: basestring
+        @return: endpoint URI
+        @raise NoEndpointAvailableError: no endpoints are in use
+        """
+        with self.__lock:
+            available = self._getAvailable(exclude)
+            if not available:
+                raise NoEndpointAvailableError('No endpoints available from '
+                                               '%r' % (self.__uris,))
+            
+            # Mark a trial as soon as it's chosen so that concurrent callers
+            # don't choose the same endpoint for another
+            stats = self._choose(available, key)
+            self._startTrial(stats)
+            return stats.uri
+
+    def _begin(self, uri):
+        with self.__lock:
+            stats = self.__stats.get(uri)
+            if stats is None:
+                return None
+
+            if stats.state == EndpointStats.OPEN:
+                self._startTrial(stats)
+
+            stats.inFlight += 1
+            stats.requests += 1
+            return stats
+
+    def _end(self, stats, latency, success):
+        alpha = self.__alpha
+        with self.__lock:
+            stats.inFlight -= 1
+            if success:
+                if stats.latency is None:
+                    stats.latency = latency
+                else:
+                    stats.latency += alpha * (latency - stats.latency)
+
+                stats.errorRate *= 1. - alpha
+                stats.consecutiveFailures = 0
+                if stats.state != EndpointStats.CLOSED:
+                    log.info('Endpoint [%s] back in use', stats.uri)
+                    stats.state = EndpointStats.CLOSED
+                    stats.openedAt = None
+                    stats.trialAt = None
+                return
+
+            stats.errors += 1
+            stats.errorRate += alpha * (1. - stats.errorRate)
+            stats.consecutiveFailures += 1
+            if (stats.state == EndpointStats.HALF_OPEN or
+                stats.consecutiveFailures >= self.__failureThreshold):
+                if stats.state != EndpointStats.OPEN:
+                    log.warning('Taking endpoint [%s] out of use after %d '
+                                'failures', stats.uri,
+                                stats.consecutiveFailures)
+                stats.state = EndpointStats.OPEN
+                stats.openedAt = timer()
+                stats.trialAt = None
+
+    def call(self, uri, send):
+        """Send a request to an endpoint recording its latency and outcome
+
+        @type uri: basestring
+        @param uri: endpoint URI
+        @type send: callable
+        @param send: callable taking the URI and returning the response
+        @return: response
+        """
+        stats = self._begin(uri)
+        if stats is None:
+            # Not one of the endpoints managed
+            return send(uri)
+
+        t0 = timer()
+        try:
+            response = send(uri)
+
+        except TransportCancelled:
+            # Not the endpoint's fault.  A cancelled trial request is no
+            # test of the endpoint so another trial is allowed straight away
+            with self.__lock:
+                stats.inFlight -= 1
+                if stats.state == EndpointStats.HALF_OPEN:
+                    stats.state = EndpointStats.OPEN
+                    stats.trialAt = None
+            raise
+
+        except Exception:
+            self._end(stats, timer() - t0, False)
+            raise
+
+        self._end(stats, timer() - t0, True)
+        return response
+
+    def send(self, send, key=None):
+        """Send a request to the endpoint chosen by select
+
+        @type send: callable
+        @param send: callable taking the URI and returning the response
+        @type key: basestring / NoneType
+        @param key: routing key
+        @return: response
+        @raise NoEndpointAvailableError: no endpoints are in use
+        """
+        return self.call(self.select(key=key), send)
+
+    def __getstate__(self):
+        '''Enable pickling - statistics are not included'''
+        return dict(uris=self.__uris,
+                    alpha=self.__alpha,
+                    failureThreshold=self.__failureThreshold,
+                    cooldown=self.__cooldown)
+
+    def __setstate__(self, attrDict):
+        '''Enable pickling'''
+        self.__init__(**attrDict)
+
+
+class ConsistentHashSelector(EndpointSelector):
+    """Choose endpoints by hashing a routing key such as the query subject
+    onto a ring of points for the endpoints.  Each endpoint has vnodes
+    points on the ring so that keys are spread evenly.  When an endpoint is
+    added or removed or taken out of use by its circuit breaker, only the
+    keys for its points move to another endpoint.
+
+    Load is bounded: an endpoint is passed over for the next one on the ring
+    if it already has more than loadFactor times the average number of
+    requests in progress.  Only the requests made through this selector are
+    counted.  Requests without a key are routed as for EndpointSelector.
+    """
+
+    def __init__(self, uris=(), vnodes=100, loadFactor=1.25, **kw):
+        """
+        @type uris: iterable / basestring
+        @param uris: endpoint URIs.  A string is split on commas and
+        whitespace
+        @type vnodes: int / basestring
+        @param vnodes: number of points on the ring for each endpoint
+        @type loadFactor: float / basestring
+        @param loadFactor: maximum requests in progress for an endpoint as a
+        multiple of the average.  Must be at least 1
+        @type kw: dict
+        @param kw: EndpointSelector keywords
+        """
+        self.__vnodes = int(vnodes)
+        self.__loadFactor = float(loadFactor)
+        if self.__loadFactor < 1.:
+            raise ValueError('Expecting "loadFactor" >= 1; got %r' %
+                             self.__loadFactor)
+
+        self.__ringUris = None
+        self.__ringHashes = []
+        self.__ring = []
+        super(ConsistentHashSelector, self).__init__(uris=uris, **kw)
+
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        return struct.unpack('>Q', md5(value).digest()[:8])[0]
+
+    def _getRing(self):
+        """Get the ring rebuilding it if the endpoints have changed.  Called
+        with the lock held"""
+        uris = self.uris
+        if uris != self.__ringUris:
+            ring = sorted([(self._hash('%s#%d' % (uri, i)), uri)
+                           for uri in uris for i in range(self.__vnodes)])
+            self.__ringHashes = [hashValue for hashValue, _ in ring]
+            self.__ring = [uri for _, uri in ring]
+            self.__ringUris = uris
+
+        return self.__ringHashes, self.__ring
+
+    def _choose(self, available, key):
+        if key is None:
+            return super(ConsistentHashSelector, self)._choose(available, key)
+
+        statsByUri = dict([(stats.uri, stats) for stats in available])
+        totalInFlight = sum([stats.inFlight for stats in available])
+        capacity = math.ceil(self.__loadFactor * (totalInFlight + 1) /
+                             len(available))
+
+        # Walk round the ring from the key's point to the first endpoint in
+        # use with capacity.  There is always one since capacity is at least
+        # the average load including this request
+        ringHashes, ring = self._getRing()
+        start = bisect(ringHashes, self._hash(key))
+        for i in xrange(len(ring)):
+            stats = statsByUri.get(ring[(start + i) % len(ring)])
+            if stats is not None and stats.inFlight < capacity:
+                return stats
+
+        return available[0]
+
+    def __getstate__(self):
+        '''Enable pickling - statistics are not included'''
+        attrDict = super(ConsistentHashSelector, self).__getstate__()
+        attrDict.update(vnodes=self.__vnodes, loadFactor=self.__loadFactor)
+        return attrDict
+
+
+ROUTING_SELECTORS = {
+    'latency': EndpointSelector,
+    'hash': ConsistentHashSelector
+}
+
+
+def makeEndpointSelector(routing='latency', **kw):
+    """Make an endpoint selector
+
+    @type routing: basestring
+    @param routing: routing mode - 'latency' to route by latency and error
+    rate or 'hash' to route by consistent hashing of a key
+    @type kw: dict
+    @param kw: keywords for the selector class
+    @rtype: EndpointSelector
+    @return: selector
+    """
+    selectorClass = ROUTING_SELECTORS.get(routing)
+    if selectorClass is None:
+        raise ValueError('Expecting routing mode in %r; got %r' %
+                         (sorted(ROUTING_SELECTORS.keys()), routing))
+
+    return selectorClass(**kw)
@@ -0,0 +1,341 @@
+"""W3C Trace Context propagation and span export for NDG SOAP Package
+
+Clients send the context of a request in a traceparent HTTP header and
+optionally a SOAP header block.  Services continue the trace from it.
+Request timings recorded with ndg.soap.utils.metrics.RequestTiming are
+exported as spans by SpanObserver.
+
+NERC DataGrid Project
+"""
+__author__ = "P J Kershaw"
+__date__ = "18/10/16"
+__copyright__ = "(C) 2016 Science and Technology Facilities Council"
+__license__ = "http://www.apache.org/licenses/LICENSE-2.0"
+__contact__ = "Philip.Kershaw@stfc.ac.uk"
+__revision__ = '$Id$'
+import os
+import re
+import json
+from abc import ABCMeta, abstractmethod
+from binascii import hexlify
+from threading import Lock, local
+
+import logging
+log = logging.getLogger(__name__)
+
+import ndg.soap.utils.etree as etree
+
+TRACEPARENT_HEADER = 'traceparent'
+TRACEPARENT_ENVIRON_KEYNAME = 'HTTP_TRACEPARENT'
+
+# SOAP header block for services where HTTP headers are not passed through
+TRACE_CONTEXT_NS = 'urn:ndg:soap:tracecontext'
+TRACE_CONTEXT_NS_PREFIX = 'tc'
+TRACEPARENT_ELEMENT_NAME = '{%s}%s' % (TRACE_CONTEXT_NS, TRACEPARENT_HEADER)
+
+
+class TraceContext(object):
+    """W3C Trace Context for a span
+
+    @cvar VERSION: traceparent format version
+    @type VERSION: string
+    @cvar SAMPLED_FLAG: trace flag set if the caller may record the trace
+    @type SAMPLED_FLAG: int
+    """
+    VERSION = '00'
+    SAMPLED_FLAG = 0x01
+    TRACEPARENT_PAT = re.compile(
+        r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+    INVALID_TRACE_ID = '0' * 32
+    INVALID_SPAN_ID = '0' * 16
+
+    __slots__ = ('__traceId', '__spanId', '__parentId', '__flags')
+
+    def __init__(self, traceId=None, spanId=None, parentId=None,
+                 flags=SAMPLED_FLAG):
+        """
+        @type traceId: string / NoneType
+        @param traceId: 32 hex digit trace ID.  A new one is generated if
+        None
+        @type spanId: string / NoneType
+        @param spanId: 16 hex digit span ID.  A new one is generated if None
+        @type parentId: string / NoneType
+        @param parentId: span ID of the parent span if any
+        @type flags: int
+        @param flags: trace flags
+        """
+        self.__traceId = traceId or hexlify(os.urandom(16))
+        self.__spanId = spanId or hexlify(os.urandom(8))
+        self.__parentId = parentId
+        self.__flags = flags
+
+    @property
+    def traceId(self):
+        """Trace ID shared by all the spans in a trace"""
+        return self.__traceId
+
+    @property
+    def spanId(self):
+        """ID of this span"""
+        return self.__spanId
+
+    @property
+    def parentId(self):
+        """ID of the parent span or None for a root span"""
+        return self.__parentId
+
+    @property
+    def flags(self):
+        """Trace flags"""
+        return self.__flags
+
+    @property
+    def sampled(self):
+        """True if the caller may have recorded the trace"""
+        return bool(self.__flags & TraceContext.SAMPLED_FLAG)
+
+    @classmethod
+    def parse(cls, traceparent):
+        """Parse a traceparent header value.  Invalid values are ignored as
+        the W3C recommendation requires
+
+        @type traceparent: basestring / NoneType
+        @param traceparent: header value
+        @rtype: TraceContext / NoneType
+        @return: context of the calling span or None if the value is missing
+        or invalid
+        """
+        if not traceparent:
+            return None
+
+        match = cls.TRACEPARENT_PAT.match(traceparent.strip())
+        if match is None:
+            log.debug("Ignoring invalid traceparent %r", traceparent)
+            return None
+
+        version, traceId, spanId, flags, extra = match.groups()
+        if (version == 'ff' or (version == cls.VERSION and extra) or
+            traceId == cls.INVALID_TRACE_ID or spanId == cls.INVALID_SPAN_ID):
+            log.debug("Ignoring invalid traceparent %r", traceparent)
+            return None
+
+        return cls(traceId=traceId, spanId=spanId, flags=int(flags, 16))
+
+    def toHeader(self):
+        """@rtype: string
+        @return: traceparent header value for this span
+        """
+        return '%s-%s-%s-%02x' % (TraceContext.VERSION, self.__traceId,
+                                  self.__spanId, self.__flags)
+
+    def newChild(self):
+        """@rtype: TraceContext
+        @return: context for a new span which is a child of this one
+        """
+        return TraceContext(traceId=self.__traceId, parentId=self.__spanId,
+                            flags=self.__flags)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.toHeader())
+
+
+_current = local()
+
+
+def getCurrentTraceContext():
+    """@rtype: TraceContext / NoneType
+    @return: context set for the current thread
+    """
+    return getattr(_current, 'context', None)
+
+
+def setCurrentTraceContext(context):
+    """Set the context for the current thread.  Client requests made from
+    the thread are sent as children of it
+
+    @type context: TraceContext / NoneType
+    @param context: context or None to clear it
+    @rtype: TraceContext / NoneType
+    @return: the context previously set so that callers can restore it
+    """
+    previous = getattr(_current, 'context', None)
+    _current.context = context
+    return previous
+
+
+def addTraceparentHeaderBlock(envelope, context):
+    """Add a traceparent SOAP header block to an envelope
+
+    @type envelope: ndg.soap.etree.SOAPEnvelope
+    @param envelope: envelope created with its create method
+    @type context: TraceContext
+    @param context: context to send
+    """
+    elem = etree.makeEtreeElement(TRACEPARENT_ELEMENT_NAME,
+                                  TRACE_CONTEXT_NS_PREFIX,
+                                  TRACE_CONTEXT_NS)
+    elem.text = context.toHeader()
+    envelope.header.elem.append(elem)
+
+
+def findTraceparentHeaderBlock(envelope):
+    """Get the context from a traceparent SOAP header block
+
+    @type envelope: ndg.soap.etree.SOAPEnvelope
+    @param envelope: parsed envelope
+    @rtype: TraceContext / NoneType
+    @return: context or None if the block is missing or invalid
+    """
+    if envelope.header.elem is None:
+        return None
+
+    elem = envelope.header.elem.find(TRACEPARENT_ELEMENT_NAME)
+    if elem is None:
+        return None
+
+    return TraceContext.parse(elem.text)
+
+
+class Span(object):
+    """Timed operation within a trace"""
+    __slots__ = (
+        'name',
+        'traceId',
+        'spanId',
+        'parentId',
+        'startTime',
+        'endTime',
+        'attributes'
+    )
+
+    def __init__(self, name, context, startTime, endTime, attributes=None):
+        """
+        @type name: basestring
+        @param name: operation name
+        @type context: TraceContext
+        @param context: context of this span
+        @type startTime: float
+        @param startTime: start time in seconds since the epoch
+        @type endTime: float
+        @param endTime: end time in seconds since the epoch
+        @type attributes: dict / NoneType
+        @param attributes: additional attributes
+        """
+        self.name = name
+        self.traceId = context.traceId
+        self.spanId = context.spanId
+        self.parentId = context.parentId
+        self.startTime = startTime
+        self.endTime = endTime
+        self.attributes = attributes or {}
+
+    def toDict(self):
+        """@rtype: dict
+        @return: span as a dictionary
+        """
+        return dict([(name, getattr(self, name))
+                     for name in Span.__slots__])
+
+
+class SpanExporter(object):
+    """Interface for span exporters"""
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def export(self, spans):
+        """Export finished spans
+
+        @type spans: list
+        @param spans: Span instances
+        """
+        raise NotImplementedError()
+
+    def shutdown(self):
+        """Release any resources held"""
+
+
+class JSONFileSpanExporter(SpanExporter):
+    """Append spans to a file with one JSON object per line for offline
+    analysis.  Thread safe.
+    """
+    def __init__(self, filePath):
+        """
+        @type filePath: basestring
+        @param filePath: file to append to
+        """
+        self.__filePath = os.path.expandvars(filePath)
+        self.__lock = Lock()
+
+    @property
+    def filePath(self):
+        """File spans are appended to"""
+        return self.__filePath
+
+    def export(self, spans):
+        """Append spans to the file
+
+        @type spans: list
+        @param spans: Span instances
+        """
+        lines = ''.join([json.dumps(span.toDict()) + '\n' for span in spans])
+        self.__lock.acquire()
+        try:
+            spanFile = open(self.__filePath, 'a')
+            try:
+                spanFile.write(lines)
+            finally:
+                spanFile.close()
+        finally:
+            self.__lock.release()
+
+
+class SpanObserver(object):
+    """Request timing observer exporting a span for each request and child
+    spans for each of its phases.  Requests with no trace context set are
+    ignored.
+    """
+    def __init__(self, exporter, kind='client'):
+        """
+        @type exporter: SpanExporter
+        @param exporter: exporter to send spans to
+        @type kind: basestring
+        @param kind: span kind attribute - client or server
+        """
+        if not isinstance(exporter, SpanExporter):
+            raise TypeError('Expecting %r type for exporter; got %r' %
+                            (SpanExporter, type(exporter)))
+        self.__exporter = exporter
+        self.__kind = kind
+
+    @property
+    def exporter(self):
+        """Span exporter"""
+        return self.__exporter
+
+    def __call__(self, timing):
+        """Export spans for a request
+
+        @type timing: ndg.soap.utils.metrics.RequestTiming
+        @param timing: request timings
+        """
+        context = timing.traceContext
+        if context is None or not context.sampled:
+            return
+
+        attributes = dict(kind=self.__kind, endpoint=timing.endpoint)
+        for name in ('httpStatus', 'samlStatus', 'requestSize',
+                     'responseSize', 'error'):
+            value = getattr(timing, name)
+            if value is not None:
+                attributes[name] = value
+
+        spans = [Span(timing.endpoint, context, timing.startTime,
+                      timing.startTime + timing.total, attributes)]
+
+        startTime = timing.startTime
+        for phase, seconds in timing.phases.items():
+            spans.append(Span(phase, context.newChild(), startTime,
+                              startTime + seconds))
+            startTime += seconds
+
+        self.__exporter.export(spans)